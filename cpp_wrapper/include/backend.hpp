@@ -0,0 +1,20 @@
+#pragma once
+
+namespace kvcache {
+
+// Which implementation a KVCache / CPUInfer instance forwards to.
+//   PYTHON: calls back into the `cpuinfer_ext` python module, every call takes
+//           the GIL and boxes its arguments.
+//   NATIVE: links the ktransformers_ext C++ library directly, no python
+//           involved. Only available when built with KTRANSFORMERS_EXT_DIR.
+enum class Backend { PYTHON, NATIVE };
+
+// True when the library was built with the native backend.
+bool native_available();
+
+// NATIVE when available, PYTHON otherwise.
+inline Backend default_backend() {
+  return native_available() ? Backend::NATIVE : Backend::PYTHON;
+}
+
+} // namespace kvcache
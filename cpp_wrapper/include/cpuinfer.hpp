@@ -3,11 +3,13 @@
 #include <cuda_runtime.h>
 #include <memory>
 
+#include "backend.hpp"
+
 namespace kvcache {
 
 class CPUInfer {
 public:
-  explicit CPUInfer(int thread_num);
+  explicit CPUInfer(int thread_num, Backend backend = default_backend());
   ~CPUInfer();
 
   // Disable copy
@@ -18,14 +20,21 @@ public:
   CPUInfer(CPUInfer &&) noexcept;
   CPUInfer &operator=(CPUInfer &&) noexcept;
 
-  // Core operations
+  // Core operations. On the native backend `task` points to the
+  // std::pair<intptr_t, intptr_t> (function, args) returned by the
+  // ktransformers_ext `cpuinfer_interface` of an operator.
   void submit(void *task);
   void submit_with_cuda_stream(cudaStream_t stream, void *task);
   void sync();
   void sync_with_cuda_stream(cudaStream_t stream);
 
-private:
+  Backend backend() const { return backend_; }
+
+  // Implemented per backend in src/, see src/impl.hpp
   class Impl;
+
+private:
+  Backend backend_;
   std::unique_ptr<Impl> pimpl;
 };
 
@@ -24,6 +24,8 @@
 #include <torch/csrc/tensor/python_tensor.h>
 #include <pybind11/pybind11.h>
 
+#include "backend.hpp"
+
 namespace kvcache {
 
 enum class AnchorType { FIXED, QUEST, DYNAMIC, BLOCK_MEAN, BLOCK_MAX };
@@ -66,7 +68,8 @@ struct KVCacheConfig {
 
 class KVCache {
 public:
-  explicit KVCache(const KVCacheConfig &config);
+  explicit KVCache(const KVCacheConfig &config,
+                   Backend backend = default_backend());
   ~KVCache();
 
   // Disable copy
@@ -112,8 +115,13 @@ public:
   bool update_anchor_one_block(torch::Tensor &anchor, int layer_id,
                                int block_idx);
 
-private:
+  Backend backend() const { return backend_; }
+
+  // Implemented per backend in src/, see src/impl.hpp
   class Impl;
+
+private:
+  Backend backend_;
   std::unique_ptr<Impl> pimpl;
 };
 
@@ -1,4 +1,5 @@
 #include "cpuinfer.hpp"
+#include "impl.hpp"
 #include <Python.h>
 #include <stdexcept>
 #include <torch/csrc/autograd/engine.h>
@@ -9,16 +10,29 @@
 #include <torch/csrc/cuda/Stream.h>
 #include <torch/csrc/utils/pybind.h>
 #include <torch/torch.h>
+#include <utility>
 
 namespace kvcache {
 
-class CPUInfer::Impl {
+namespace {
+
+// (function, args) pair of a ktransformers_ext task as a python tuple
+PyObject *task_tuple(void *task) {
+  auto *params = static_cast<std::pair<intptr_t, intptr_t> *>(task);
+  return Py_BuildValue("(LL)", static_cast<long long>(params->first),
+                       static_cast<long long>(params->second));
+}
+
+} // namespace
+
+class PythonCPUInfer : public CPUInfer::Impl {
 public:
-  explicit Impl(int thread_num) {
+  explicit PythonCPUInfer(int thread_num) {
     // Initialize Python if not already initialized
     if (!Py_IsInitialized()) {
       Py_Initialize();
     }
+    GILGuard gil;
 
     // Import cpuinfer_ext module
     PyObject *module = PyImport_ImportModule("cpuinfer_ext");
@@ -45,31 +59,38 @@ public:
     }
   }
 
-  ~Impl() {
-    if (cpuinfer_obj) {
+  ~PythonCPUInfer() override {
+    if (cpuinfer_obj && Py_IsInitialized()) {
+      GILGuard gil;
       Py_DECREF(cpuinfer_obj);
     }
   }
 
-  void submit(void *task) {
-    PyObject *result = PyObject_CallMethod(cpuinfer_obj, "submit", "O",
-                                           PyLong_FromVoidPtr(task));
+  void submit(void *task) override {
+    GILGuard gil;
+    PyObject *task_obj = task_tuple(task);
+    PyObject *result =
+        PyObject_CallMethod(cpuinfer_obj, "submit", "O", task_obj);
+    Py_DECREF(task_obj);
     if (!result) {
       throw std::runtime_error("Failed to submit task");
     }
     Py_DECREF(result);
   }
 
-  void submit_with_cuda_stream(cudaStream_t stream, void *task) {
+  void submit_with_cuda_stream(cudaStream_t stream, void *task) override {
+    GILGuard gil;
     // Convert CUDA stream to PyObject
     PyObject *stream_capsule = PyCapsule_New(stream, "cudaStream_t", nullptr);
     if (!stream_capsule) {
       throw std::runtime_error("Failed to wrap CUDA stream");
     }
 
+    PyObject *task_obj = task_tuple(task);
     PyObject *result =
         PyObject_CallMethod(cpuinfer_obj, "submit_with_cuda_stream", "OO",
-                            stream_capsule, PyLong_FromVoidPtr(task));
+                            stream_capsule, task_obj);
+    Py_DECREF(task_obj);
     Py_DECREF(stream_capsule);
 
     if (!result) {
@@ -78,7 +99,8 @@ public:
     Py_DECREF(result);
   }
 
-  void sync() {
+  void sync() override {
+    GILGuard gil;
     PyObject *result = PyObject_CallMethod(cpuinfer_obj, "sync", nullptr);
     if (!result) {
       throw std::runtime_error("Failed to sync");
@@ -86,7 +108,8 @@ public:
     Py_DECREF(result);
   }
 
-  void sync_with_cuda_stream(cudaStream_t stream) {
+  void sync_with_cuda_stream(cudaStream_t stream) override {
+    GILGuard gil;
     // Convert CUDA stream to PyObject
     PyObject *stream_capsule = PyCapsule_New(stream, "cudaStream_t", nullptr);
     if (!stream_capsule) {
@@ -107,8 +130,26 @@ private:
   PyObject *cpuinfer_obj;
 };
 
-CPUInfer::CPUInfer(int thread_num)
-    : pimpl(std::make_unique<Impl>(thread_num)) {}
+#ifndef CPP_WRAPPER_NATIVE
+bool native_available() { return false; }
+
+std::unique_ptr<CPUInfer::Impl> make_native_cpuinfer(int) {
+  throw std::runtime_error(
+      "cpp_wrapper was built without the native backend, "
+      "reconfigure with -DKTRANSFORMERS_EXT_DIR=<path to ktransformers_ext>");
+}
+#endif
+
+static std::unique_ptr<CPUInfer::Impl> make_cpuinfer(int thread_num,
+                                                     Backend backend) {
+  if (backend == Backend::NATIVE) {
+    return make_native_cpuinfer(thread_num);
+  }
+  return std::make_unique<PythonCPUInfer>(thread_num);
+}
+
+CPUInfer::CPUInfer(int thread_num, Backend backend)
+    : backend_(backend), pimpl(make_cpuinfer(thread_num, backend)) {}
 
 CPUInfer::~CPUInfer() = default;
 
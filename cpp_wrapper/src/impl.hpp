@@ -0,0 +1,109 @@
+#pragma once
+
+// Backend interfaces shared by the python and the native implementation.
+// Not installed, only the public headers in include/ are.
+
+#include "cpuinfer.hpp"
+#include "kvcache.hpp"
+
+namespace kvcache {
+
+// RAII holder for the GIL, the python backend may be called from any thread.
+class GILGuard {
+public:
+  GILGuard() : state_(PyGILState_Ensure()) {}
+  ~GILGuard() { PyGILState_Release(state_); }
+
+  GILGuard(const GILGuard &) = delete;
+  GILGuard &operator=(const GILGuard &) = delete;
+
+private:
+  PyGILState_STATE state_;
+};
+
+// Fills in the optional attn arguments. Without a block table every sequence
+// of the batch reads blocks [0, max_block_num) up to the cache's total length
+// and attends over all of them.
+struct AttnArgs {
+  torch::Tensor *block_table;
+  torch::Tensor *cache_seqlens;
+  int pick_block_num;
+  int init_block_num;
+  int local_block_num;
+
+  AttnArgs(const KVCacheConfig &config, int batch_size, int cache_total_len,
+           torch::Tensor *block_table_, torch::Tensor *cache_seqlens_,
+           int *pick_block_num_, int *init_block_num_, int *local_block_num_)
+      : block_table(block_table_), cache_seqlens(cache_seqlens_),
+        pick_block_num(pick_block_num_ ? *pick_block_num_
+                                       : config.max_block_num),
+        init_block_num(init_block_num_ ? *init_block_num_ : 0),
+        local_block_num(local_block_num_ ? *local_block_num_ : 0) {
+    auto options = torch::TensorOptions().dtype(torch::kInt32);
+    if (!block_table) {
+      default_block_table = torch::arange(config.max_block_num, options)
+                                .repeat({batch_size, 1})
+                                .contiguous();
+      block_table = &default_block_table;
+    }
+    if (!cache_seqlens) {
+      default_cache_seqlens =
+          torch::full({batch_size}, cache_total_len, options);
+      cache_seqlens = &default_cache_seqlens;
+    }
+  }
+
+private:
+  torch::Tensor default_block_table;
+  torch::Tensor default_cache_seqlens;
+};
+
+class KVCache::Impl {
+public:
+  virtual ~Impl() = default;
+
+  virtual bool load_kvcache(const std::string &tensor_file_path) = 0;
+  virtual bool dump_kvcache(torch::Tensor &block_table, int cache_total_len,
+                            const std::string &tensor_file_path) = 0;
+  virtual void update_cache_total_len(int cache_total_len) = 0;
+  virtual int get_cache_total_len() const = 0;
+
+  virtual bool attn(torch::Tensor &q_in, torch::Tensor &output,
+                    torch::Tensor &attn_lse, int layer_idx,
+                    int generate_token_idx, torch::Tensor *block_table,
+                    torch::Tensor *cache_seqlens, int *pick_block_num,
+                    int *init_block_num, int *local_block_num) = 0;
+
+  virtual bool update_kvcache_one_block_fp16(torch::Tensor &k_in,
+                                             torch::Tensor &v_in, int layer_id,
+                                             int block_idx) = 0;
+  virtual bool get_kvcache_one_block_fp16(torch::Tensor &k_in,
+                                          torch::Tensor &v_in, int layer_id,
+                                          int block_idx) = 0;
+
+  virtual bool update_importance_one_block(torch::Tensor &importance,
+                                           int layer_id, int block_idx) = 0;
+  virtual bool get_importance_one_block(torch::Tensor &importance,
+                                        int layer_id, int block_idx) = 0;
+
+  virtual bool get_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                                    int block_idx) = 0;
+  virtual bool update_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                                       int block_idx) = 0;
+};
+
+class CPUInfer::Impl {
+public:
+  virtual ~Impl() = default;
+
+  virtual void submit(void *task) = 0;
+  virtual void submit_with_cuda_stream(cudaStream_t stream, void *task) = 0;
+  virtual void sync() = 0;
+  virtual void sync_with_cuda_stream(cudaStream_t stream) = 0;
+};
+
+// Defined in src/native.cpp, only linked in when CPP_WRAPPER_NATIVE is set.
+std::unique_ptr<KVCache::Impl> make_native_kvcache(const KVCacheConfig &config);
+std::unique_ptr<CPUInfer::Impl> make_native_cpuinfer(int thread_num);
+
+} // namespace kvcache
@@ -1,5 +1,7 @@
 #include "kvcache.hpp"
+#include "impl.hpp"
 #include <Python.h>
+#include <cstdarg>
 #include <iostream>
 #include <stdexcept>
 #include <torch/csrc/jit/python/pybind.h>
@@ -11,13 +13,61 @@ PyObject *PyInit_cpuinfer_ext(void);
 
 namespace kvcache {
 
-class KVCache::Impl {
+namespace {
+
+// Attribute names of the config enums in the cpuinfer_ext.kvcache module
+const char *anchor_type_name(AnchorType type) {
+  switch (type) {
+  case AnchorType::FIXED:
+    return "FIXED";
+  case AnchorType::QUEST:
+    return "QUEST";
+  case AnchorType::DYNAMIC:
+    return "DYNAMIC";
+  case AnchorType::BLOCK_MEAN:
+    return "BLOCK_MEAN";
+  case AnchorType::BLOCK_MAX:
+    return "BLOCK_MAX";
+  }
+  return "FIXED";
+}
+
+const char *ggml_type_name(GGMLType type) {
+  switch (type) {
+  case GGMLType::FP16:
+    return "FP16";
+  case GGMLType::FP32:
+    return "FP32";
+  case GGMLType::Q4_0:
+    return "Q4_0";
+  case GGMLType::Q8_0:
+    return "Q8_0";
+  }
+  return "FP16";
+}
+
+const char *retrieval_type_name(RetrievalType type) {
+  switch (type) {
+  case RetrievalType::LAYER:
+    return "LAYER";
+  case RetrievalType::QHEAD:
+    return "QHEAD";
+  case RetrievalType::KVHEAD:
+    return "KVHEAD";
+  }
+  return "LAYER";
+}
+
+} // namespace
+
+class PythonKVCache : public KVCache::Impl {
 public:
-  explicit Impl(const KVCacheConfig &config) : config_(config) {
+  explicit PythonKVCache(const KVCacheConfig &config) : config_(config) {
     // Initialize Python if not already initialized
     if (!Py_IsInitialized()) {
       Py_Initialize();
     }
+    GILGuard gil;
 
     // Import cpuinfer_ext module
     PyObject *module = PyImport_ImportModule("cpuinfer_ext");
@@ -53,10 +103,12 @@ public:
     }
 
     // Get the enum values
-    PyObject *fixed_anchor = PyObject_GetAttrString(anchor_type_enum, "FIXED");
-    PyObject *fp16_type = PyObject_GetAttrString(ggml_type_enum, "FP16");
-    PyObject *layer_retrieval =
-        PyObject_GetAttrString(retrieval_type_enum, "LAYER");
+    PyObject *fixed_anchor = PyObject_GetAttrString(
+        anchor_type_enum, anchor_type_name(config.anchor_type));
+    PyObject *fp16_type =
+        PyObject_GetAttrString(ggml_type_enum, ggml_type_name(config.kv_type));
+    PyObject *layer_retrieval = PyObject_GetAttrString(
+        retrieval_type_enum, retrieval_type_name(config.retrieval_type));
 
     if (!fixed_anchor || !fp16_type || !layer_retrieval) {
       Py_XDECREF(fixed_anchor);
@@ -194,6 +246,17 @@ public:
       throw std::runtime_error("Failed to create KVCache instance");
     }
 
+    // Tasks returned by the kvcache methods run on this pool
+    PyObject *cpuinfer_class = PyObject_GetAttrString(module, "CPUInfer");
+    if (cpuinfer_class) {
+      cpuinfer_obj =
+          PyObject_CallFunction(cpuinfer_class, "i", config.max_thread_num);
+      Py_DECREF(cpuinfer_class);
+    }
+    if (!cpuinfer_obj) {
+      PyErr_Print();
+    }
+
     // Cleanup
     Py_DECREF(kvcache_args);
     Py_DECREF(kvcache_class);
@@ -209,46 +272,41 @@ public:
     Py_DECREF(module);
   }
 
-  ~Impl() {}
-
-  bool load_kvcache(const std::string &tensor_file_path) {
-    PyObject *result = PyObject_CallMethod(kvcache_obj, "load_kvcache", "s",
-                                           tensor_file_path.c_str());
-    if (!result) {
-      return false;
+  ~PythonKVCache() override {
+    if (Py_IsInitialized()) {
+      GILGuard gil;
+      Py_XDECREF(kvcache_obj);
+      Py_XDECREF(cpuinfer_obj);
     }
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
-    return success;
+  }
+
+  bool load_kvcache(const std::string &tensor_file_path) override {
+    return run_task("load_kvcache", "(s)", tensor_file_path.c_str());
   }
 
   bool dump_kvcache(torch::Tensor &block_table, int cache_total_len,
-                    const std::string &tensor_file_path) {
-    PyObject *block_table_obj = THPVariable_Wrap(block_table);
-    PyObject *result =
-        PyObject_CallMethod(kvcache_obj, "dump_kvcache", "Ois", block_table_obj,
-                            cache_total_len, tensor_file_path.c_str());
-    Py_DECREF(block_table_obj);
-    if (!result) {
-      return false;
-    }
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
-    return success;
+                    const std::string &tensor_file_path) override {
+    return run_task("dump_kvcache", "(Lis)", ptr(block_table), cache_total_len,
+                    tensor_file_path.c_str());
   }
 
-  void update_cache_total_len(int cache_total_len) {
+  void update_cache_total_len(int cache_total_len) override {
+    GILGuard gil;
     PyObject *result = PyObject_CallMethod(
         kvcache_obj, "update_cache_total_len", "i", cache_total_len);
     if (result) {
       Py_DECREF(result);
+    } else {
+      PyErr_Print();
     }
   }
 
-  int get_cache_total_len() const {
+  int get_cache_total_len() const override {
+    GILGuard gil;
     PyObject *result =
         PyObject_CallMethod(kvcache_obj, "get_cache_total_len", NULL);
     if (!result) {
+      PyErr_Print();
       return 0;
     }
     int length = PyLong_AsLong(result);
@@ -259,219 +317,128 @@ public:
   bool attn(torch::Tensor &q_in, torch::Tensor &output, torch::Tensor &attn_lse,
             int layer_idx, int generate_token_idx, torch::Tensor *block_table,
             torch::Tensor *cache_seqlens, int *pick_block_num,
-            int *init_block_num, int *local_block_num) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // Extract dimensions from q_in tensor
+            int *init_block_num, int *local_block_num) override {
+    // q_in: [batch_size, q_len, q_head_num, head_dim]
     int batch_size = q_in.size(0);
     int q_len = q_in.size(1);
-    int num_heads = q_in.size(2);
-    int head_dim = q_in.size(3);
-
-    // Get max_block_num from config
-    int max_block_num = config_.max_block_num;
-
-    // Get pointers to the raw tensor data
-    void *q_in_ptr = q_in.data_ptr();
-    void *output_ptr = output.data_ptr();
-    void *attn_lse_ptr = attn_lse.data_ptr();
-    void *block_table_ptr = block_table ? block_table->data_ptr() : nullptr;
-    void *cache_seqlens_ptr =
-        cache_seqlens ? cache_seqlens->data_ptr() : nullptr;
-
-    // Call the Python method with all required arguments
-    PyObject *result = PyObject_CallMethod(
-        kvcache_obj, "attn", "iiiiiiiiiiiii", layer_idx, generate_token_idx,
-        q_len, batch_size, num_heads, head_dim,
-        pick_block_num ? *pick_block_num : 0,
-        init_block_num ? *init_block_num : 0,
-        local_block_num ? *local_block_num : 0, max_block_num, 0, 0);
-
-    bool success = false;
-    if (result) {
-      success = true;
-      Py_DECREF(result);
-    } else {
-      PyErr_Print(); // Print Python error if any
-    }
-
-    PyGILState_Release(gstate);
-    return success;
+    AttnArgs args(config_, batch_size, get_cache_total_len(), block_table,
+                  cache_seqlens, pick_block_num, init_block_num,
+                  local_block_num);
+    return run_task("attn", "(LLLiiiiiLLiii)", ptr(q_in), ptr(output),
+                    ptr(attn_lse), layer_idx, generate_token_idx, q_len,
+                    batch_size, config_.max_block_num, ptr(*args.block_table),
+                    ptr(*args.cache_seqlens), args.pick_block_num,
+                    args.init_block_num, args.local_block_num);
   }
 
   bool update_kvcache_one_block_fp16(torch::Tensor &k_in, torch::Tensor &v_in,
-                                     int layer_id, int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // Extract dimensions from k_in tensor
-    int batch_size = k_in.size(0);
-    int seq_len = k_in.size(1);
-    int num_heads = k_in.size(2);
-    int head_dim = k_in.size(3);
-
-    // Get pointers to the raw tensor data
-    void *k_in_ptr = k_in.data_ptr();
-    void *v_in_ptr = v_in.data_ptr();
-
-    // Get max_block_num from config
-    int max_block_num = config_.max_block_num;
-
-    // Call the Python method with all required arguments
-    PyObject *result = PyObject_CallMethod(
-        kvcache_obj, "update_kvcache_fp16", "iiiiiiii", batch_size, seq_len,
-        num_heads, head_dim, layer_id, block_idx, max_block_num, 0);
-
-    bool success = false;
-    if (result) {
-      success = true;
-      Py_DECREF(result);
-    } else {
-      PyErr_Print(); // Print Python error if any
-    }
-
-    PyGILState_Release(gstate);
-    return success;
+                                     int layer_id, int block_idx) override {
+    return run_task("update_kvcache_one_block_fp16", "(LLii)", ptr(k_in),
+                    ptr(v_in), layer_id, block_idx);
   }
 
   bool get_kvcache_one_block_fp16(torch::Tensor &k_in, torch::Tensor &v_in,
-                                  int layer_id, int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // 提取张量维度
-    int batch_size = k_in.size(0);
-    int seq_len = k_in.size(1);
-    int num_heads = k_in.size(2);
-    int head_dim = k_in.size(3);
-
-    // 直接传递整数参数
-    PyObject *result = PyObject_CallMethod(
-        kvcache_obj, "get_kvcache_one_block_fp16", "iiiiii", batch_size,
-        seq_len, num_heads, head_dim, layer_id, block_idx);
-
-    if (!result) {
-      PyErr_Print();
-      PyGILState_Release(gstate);
-      return false;
-    }
+                                  int layer_id, int block_idx) override {
+    return run_task("get_kvcache_one_block_fp16", "(LLii)", ptr(k_in),
+                    ptr(v_in), layer_id, block_idx);
+  }
 
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
+  bool update_importance_one_block(torch::Tensor &importance, int layer_id,
+                                   int block_idx) override {
+    return run_task("update_importance_one_block", "(Lii)", ptr(importance),
+                    layer_id, block_idx);
+  }
 
-    PyGILState_Release(gstate);
-    return success;
+  bool get_importance_one_block(torch::Tensor &importance, int layer_id,
+                                int block_idx) override {
+    return run_task("get_importance_one_block", "(Lii)", ptr(importance),
+                    layer_id, block_idx);
   }
 
-  bool update_importance_one_block(torch::Tensor &importance, int layer_id,
-                                   int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
+  bool get_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                            int block_idx) override {
+    return run_task("get_anchor_one_block", "(Lii)", ptr(anchor), layer_id,
+                    block_idx);
+  }
 
-    // 提取张量维度
-    int batch_size = importance.size(0);
-    int seq_len = importance.size(1);
+  bool update_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                               int block_idx) override {
+    return run_task("update_anchor_one_block", "(Lii)", ptr(anchor), layer_id,
+                    block_idx);
+  }
 
-    // 直接传递整数参数
-    PyObject *result =
-        PyObject_CallMethod(kvcache_obj, "update_importance_one_block", "iiii",
-                            batch_size, seq_len, layer_id, block_idx);
+private:
+  static long long ptr(const torch::Tensor &tensor) {
+    return reinterpret_cast<intptr_t>(tensor.data_ptr());
+  }
 
-    if (!result) {
+  // The cpuinfer_ext kvcache methods don't run anything, they return a
+  // (function, args) task that has to be submitted to a CPUInfer. Builds the
+  // arguments from `format`, submits the task and waits for it.
+  bool run_task(const char *method, const char *format, ...) {
+    if (!cpuinfer_obj) {
+      return false;
+    }
+    GILGuard gil;
+    va_list va;
+    va_start(va, format);
+    PyObject *args = Py_VaBuildValue(format, va);
+    va_end(va);
+    if (!args) {
       PyErr_Print();
-      PyGILState_Release(gstate);
       return false;
     }
-
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
-
-    PyGILState_Release(gstate);
-    return success;
-  }
-
-  bool get_importance_one_block(torch::Tensor &importance, int layer_id,
-                                int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // 提取张量维度
-    int batch_size = importance.size(0);
-    int seq_len = importance.size(1);
-
-    // 直接传递整数参数
-    PyObject *result =
-        PyObject_CallMethod(kvcache_obj, "get_importance_one_block", "iiii",
-                            batch_size, seq_len, layer_id, block_idx);
-
-    if (!result) {
+    PyObject *func = PyObject_GetAttrString(kvcache_obj, method);
+    if (!func) {
+      Py_DECREF(args);
       PyErr_Print();
-      PyGILState_Release(gstate);
       return false;
     }
-
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
-
-    PyGILState_Release(gstate);
-    return success;
-  }
-
-  bool get_anchor_one_block(torch::Tensor &anchor, int layer_id,
-                            int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // 提取张量维度
-    int batch_size = anchor.size(0);
-    int seq_len = anchor.size(1);
-
-    // 直接传递整数参数
-    PyObject *result =
-        PyObject_CallMethod(kvcache_obj, "get_anchor_one_block", "iiii",
-                            batch_size, seq_len, layer_id, block_idx);
-
-    if (!result) {
+    PyObject *task = PyObject_CallObject(func, args);
+    Py_DECREF(func);
+    Py_DECREF(args);
+    if (!task) {
       PyErr_Print();
-      PyGILState_Release(gstate);
       return false;
     }
-
-    bool success = PyObject_IsTrue(result);
-    Py_DECREF(result);
-
-    PyGILState_Release(gstate);
-    return success;
-  }
-
-  bool update_anchor_one_block(torch::Tensor &anchor, int layer_id,
-                               int block_idx) {
-    PyGILState_STATE gstate = PyGILState_Ensure();
-
-    // 提取张量维度
-    int batch_size = anchor.size(0);
-    int seq_len = anchor.size(1);
-
-    // 直接传递整数参数
     PyObject *result =
-        PyObject_CallMethod(kvcache_obj, "update_anchor_one_block", "iiii",
-                            batch_size, seq_len, layer_id, block_idx);
-
+        PyObject_CallMethod(cpuinfer_obj, "submit", "O", task);
+    Py_DECREF(task);
+    if (result) {
+      Py_DECREF(result);
+      result = PyObject_CallMethod(cpuinfer_obj, "sync", nullptr);
+    }
     if (!result) {
       PyErr_Print();
-      PyGILState_Release(gstate);
       return false;
     }
-
-    bool success = PyObject_IsTrue(result);
     Py_DECREF(result);
-
-    PyGILState_Release(gstate);
-    return success;
+    return true;
   }
 
-private:
+  PyObject *cpuinfer_obj = nullptr;
   PyObject *kvcache_obj;
   KVCacheConfig config_;
 };
 
-KVCache::KVCache(const KVCacheConfig &config)
-    : pimpl(std::make_unique<Impl>(config)) {}
+#ifndef CPP_WRAPPER_NATIVE
+std::unique_ptr<KVCache::Impl> make_native_kvcache(const KVCacheConfig &) {
+  throw std::runtime_error(
+      "cpp_wrapper was built without the native backend, "
+      "reconfigure with -DKTRANSFORMERS_EXT_DIR=<path to ktransformers_ext>");
+}
+#endif
+
+static std::unique_ptr<KVCache::Impl> make_kvcache(const KVCacheConfig &config,
+                                                   Backend backend) {
+  if (backend == Backend::NATIVE) {
+    return make_native_kvcache(config);
+  }
+  return std::make_unique<PythonKVCache>(config);
+}
+
+KVCache::KVCache(const KVCacheConfig &config, Backend backend)
+    : backend_(backend), pimpl(make_kvcache(config, backend)) {}
 KVCache::~KVCache() = default;
 
 KVCache::KVCache(KVCache &&) noexcept = default;
@@ -0,0 +1,253 @@
+// Native backend: calls the ktransformers_ext C++ operators directly. Tensors
+// are passed as raw pointers, no python object is created and the GIL is never
+// taken, so it can be driven from any number of C++ host threads.
+//
+// Only compiled when CMake is configured with KTRANSFORMERS_EXT_DIR.
+
+#include "impl.hpp"
+#include <algorithm>
+#include <iostream>
+#include <stdexcept>
+#include <utility>
+
+#include "cpu_backend/backend.h"
+#include "cpu_backend/cpuinfer.h"
+#include "operators/kvcache/kvcache.h"
+
+namespace kvcache {
+
+bool native_available() { return true; }
+
+namespace {
+
+::AnchorType native_anchor_type(AnchorType type) {
+  switch (type) {
+  case AnchorType::FIXED:
+    return ::AnchorType::FIXED_ANCHOR;
+  case AnchorType::QUEST:
+    return ::AnchorType::QUEST;
+  case AnchorType::DYNAMIC:
+    return ::AnchorType::DYNAMIC;
+  case AnchorType::BLOCK_MEAN:
+    return ::AnchorType::BLOCK_MEAN;
+  case AnchorType::BLOCK_MAX:
+    return ::AnchorType::BLOCK_MAX;
+  }
+  throw std::invalid_argument("unknown anchor type");
+}
+
+ggml_type native_ggml_type(GGMLType type) {
+  switch (type) {
+  case GGMLType::FP16:
+    return GGML_TYPE_F16;
+  case GGMLType::FP32:
+    return GGML_TYPE_F32;
+  case GGMLType::Q4_0:
+    return GGML_TYPE_Q4_0;
+  case GGMLType::Q8_0:
+    return GGML_TYPE_Q8_0;
+  }
+  throw std::invalid_argument("unknown kv type");
+}
+
+::RetrievalType native_retrieval_type(RetrievalType type) {
+  switch (type) {
+  case RetrievalType::LAYER:
+    return ::RetrievalType::LAYER;
+  case RetrievalType::QHEAD:
+    return ::RetrievalType::QHEAD;
+  case RetrievalType::KVHEAD:
+    return ::RetrievalType::KVHEAD;
+  }
+  throw std::invalid_argument("unknown retrieval type");
+}
+
+::KVCacheConfig native_config(const KVCacheConfig &config) {
+  return ::KVCacheConfig(
+      config.layer_num, config.kv_head_num, config.q_head_num, config.head_dim,
+      config.block_len, config.anchor_num,
+      native_anchor_type(config.anchor_type),
+      native_ggml_type(config.kv_type),
+      native_retrieval_type(config.retrieval_type), config.layer_step,
+      config.token_step, config.layer_offset, config.max_block_num,
+      config.max_batch_size, config.max_thread_num);
+}
+
+// The operators read and write host memory directly
+bool check(const torch::Tensor &tensor, torch::ScalarType dtype,
+           const char *name) {
+  if (!tensor.device().is_cpu() || !tensor.is_contiguous() ||
+      tensor.scalar_type() != dtype) {
+    std::cerr << name << " must be a contiguous cpu tensor of type " << dtype
+              << ", got " << tensor.device() << " " << tensor.scalar_type()
+              << std::endl;
+    return false;
+  }
+  return true;
+}
+
+ggml_fp16_t *fp16(torch::Tensor &tensor) {
+  return reinterpret_cast<ggml_fp16_t *>(tensor.data_ptr<at::Half>());
+}
+
+} // namespace
+
+class NativeKVCache : public KVCache::Impl {
+public:
+  explicit NativeKVCache(const KVCacheConfig &config)
+      : config_(config),
+        // the calling thread takes part in every job, like CPUInfer does
+        backend_(std::max(config.max_thread_num - 1, 1)),
+        kvcache_(native_config(config)) {}
+
+  bool load_kvcache(const std::string &tensor_file_path) override {
+    kvcache_.load_kvcache(tensor_file_path, &backend_);
+    return true;
+  }
+
+  bool dump_kvcache(torch::Tensor &block_table, int cache_total_len,
+                    const std::string &tensor_file_path) override {
+    if (!check(block_table, torch::kInt32, "block_table")) {
+      return false;
+    }
+    kvcache_.dump_kvcache(block_table.data_ptr<int>(), cache_total_len,
+                          tensor_file_path, &backend_);
+    return true;
+  }
+
+  void update_cache_total_len(int cache_total_len) override {
+    kvcache_.update_cache_total_len(cache_total_len);
+  }
+
+  int get_cache_total_len() const override {
+    return const_cast<::KVCache &>(kvcache_).get_cache_total_len();
+  }
+
+  bool attn(torch::Tensor &q_in, torch::Tensor &output, torch::Tensor &attn_lse,
+            int layer_idx, int generate_token_idx, torch::Tensor *block_table,
+            torch::Tensor *cache_seqlens, int *pick_block_num,
+            int *init_block_num, int *local_block_num) override {
+    if (!check(q_in, torch::kFloat16, "q_in") ||
+        !check(output, torch::kFloat16, "output") ||
+        !check(attn_lse, torch::kFloat32, "attn_lse")) {
+      return false;
+    }
+    // q_in: [batch_size, q_len, q_head_num, head_dim]
+    int batch_size = q_in.size(0);
+    int q_len = q_in.size(1);
+    AttnArgs args(config_, batch_size, get_cache_total_len(), block_table,
+                  cache_seqlens, pick_block_num, init_block_num,
+                  local_block_num);
+    if (!check(*args.block_table, torch::kInt32, "block_table") ||
+        !check(*args.cache_seqlens, torch::kInt32, "cache_seqlens")) {
+      return false;
+    }
+    kvcache_.attn(fp16(q_in), fp16(output), attn_lse.data_ptr<float>(),
+                  layer_idx, generate_token_idx, q_len, batch_size,
+                  config_.max_block_num, args.block_table->data_ptr<int>(),
+                  args.cache_seqlens->data_ptr<int>(), args.pick_block_num,
+                  args.init_block_num, args.local_block_num, &backend_);
+    return true;
+  }
+
+  bool update_kvcache_one_block_fp16(torch::Tensor &k_in, torch::Tensor &v_in,
+                                     int layer_id, int block_idx) override {
+    if (!check(k_in, torch::kFloat16, "k_in") ||
+        !check(v_in, torch::kFloat16, "v_in")) {
+      return false;
+    }
+    kvcache_.update_kvcache_one_block_fp16(fp16(k_in), fp16(v_in), layer_id,
+                                           block_idx, &backend_);
+    return true;
+  }
+
+  bool get_kvcache_one_block_fp16(torch::Tensor &k_in, torch::Tensor &v_in,
+                                  int layer_id, int block_idx) override {
+    if (!check(k_in, torch::kFloat16, "k_in") ||
+        !check(v_in, torch::kFloat16, "v_in")) {
+      return false;
+    }
+    kvcache_.get_kvcache_one_block_fp16(fp16(k_in), fp16(v_in), layer_id,
+                                        block_idx, &backend_);
+    return true;
+  }
+
+  bool update_importance_one_block(torch::Tensor &importance, int layer_id,
+                                   int block_idx) override {
+    if (!check(importance, torch::kFloat16, "importance")) {
+      return false;
+    }
+    kvcache_.update_importance_one_block(fp16(importance), layer_id, block_idx,
+                                         &backend_);
+    return true;
+  }
+
+  bool get_importance_one_block(torch::Tensor &importance, int layer_id,
+                                int block_idx) override {
+    if (!check(importance, torch::kFloat16, "importance")) {
+      return false;
+    }
+    kvcache_.get_importance_one_block(fp16(importance), layer_id, block_idx,
+                                      &backend_);
+    return true;
+  }
+
+  bool get_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                            int block_idx) override {
+    if (!check(anchor, torch::kFloat16, "anchor")) {
+      return false;
+    }
+    kvcache_.get_anchor_one_block(fp16(anchor), layer_id, block_idx,
+                                  &backend_);
+    return true;
+  }
+
+  bool update_anchor_one_block(torch::Tensor &anchor, int layer_id,
+                               int block_idx) override {
+    if (!check(anchor, torch::kFloat16, "anchor")) {
+      return false;
+    }
+    kvcache_.update_anchor_one_block(fp16(anchor), layer_id, block_idx,
+                                     &backend_);
+    return true;
+  }
+
+private:
+  KVCacheConfig config_;
+  ::Backend backend_;
+  ::KVCache kvcache_;
+};
+
+class NativeCPUInfer : public CPUInfer::Impl {
+public:
+  explicit NativeCPUInfer(int thread_num) : cpuinfer_(thread_num) {}
+
+  void submit(void *task) override {
+    cpuinfer_.submit(*static_cast<std::pair<intptr_t, intptr_t> *>(task));
+  }
+
+  void submit_with_cuda_stream(cudaStream_t stream, void *task) override {
+    cpuinfer_.submit_with_cuda_stream(
+        reinterpret_cast<intptr_t>(stream),
+        *static_cast<std::pair<intptr_t, intptr_t> *>(task));
+  }
+
+  void sync() override { cpuinfer_.sync(); }
+
+  void sync_with_cuda_stream(cudaStream_t stream) override {
+    cpuinfer_.sync_with_cuda_stream(reinterpret_cast<intptr_t>(stream));
+  }
+
+private:
+  ::CPUInfer cpuinfer_;
+};
+
+std::unique_ptr<KVCache::Impl> make_native_kvcache(const KVCacheConfig &config) {
+  return std::make_unique<NativeKVCache>(config);
+}
+
+std::unique_ptr<CPUInfer::Impl> make_native_cpuinfer(int thread_num) {
+  return std::make_unique<NativeCPUInfer>(thread_num);
+}
+
+} // namespace kvcache
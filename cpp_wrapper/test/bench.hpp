@@ -0,0 +1,79 @@
+#pragma once
+
+// Small latency helpers shared by the backend benchmarks in test/.
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <functional>
+#include <string>
+#include <vector>
+
+#include "backend.hpp"
+
+namespace bench {
+
+struct Latency {
+  int iters = 0;
+  int failures = 0;
+  double mean_us = 0;
+  double p50_us = 0;
+  double p99_us = 0;
+  double max_us = 0;
+};
+
+inline const char *backend_name(kvcache::Backend backend) {
+  return backend == kvcache::Backend::NATIVE ? "native" : "python";
+}
+
+// Backends to compare, python always and native when it was built in.
+inline std::vector<kvcache::Backend> backends() {
+  std::vector<kvcache::Backend> res = {kvcache::Backend::PYTHON};
+  if (kvcache::native_available()) {
+    res.push_back(kvcache::Backend::NATIVE);
+  }
+  return res;
+}
+
+inline Latency measure(const std::function<bool()> &fn, int iters,
+                       int warmup) {
+  Latency res;
+  for (int i = 0; i < warmup; i++) {
+    fn();
+  }
+  std::vector<double> samples;
+  samples.reserve(iters);
+  for (int i = 0; i < iters; i++) {
+    auto begin = std::chrono::steady_clock::now();
+    bool ok = fn();
+    auto end = std::chrono::steady_clock::now();
+    res.failures += ok ? 0 : 1;
+    samples.push_back(
+        std::chrono::duration<double, std::micro>(end - begin).count());
+  }
+  if (samples.empty()) {
+    return res;
+  }
+  std::sort(samples.begin(), samples.end());
+  res.iters = iters;
+  double sum = 0;
+  for (double s : samples) {
+    sum += s;
+  }
+  res.mean_us = sum / samples.size();
+  res.p50_us = samples[samples.size() / 2];
+  res.p99_us = samples[std::min(samples.size() - 1, samples.size() * 99 / 100)];
+  res.max_us = samples.back();
+  return res;
+}
+
+inline void report(const std::string &op, kvcache::Backend backend,
+                   const Latency &latency) {
+  std::printf("%-32s %-7s iters=%-6d mean=%9.1fus p50=%9.1fus p99=%9.1fus "
+              "max=%9.1fus failures=%d\n",
+              op.c_str(), backend_name(backend), latency.iters,
+              latency.mean_us, latency.p50_us, latency.p99_us, latency.max_us,
+              latency.failures);
+}
+
+} // namespace bench
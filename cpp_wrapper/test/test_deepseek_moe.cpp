@@ -1,21 +1,86 @@
+// Decode step latency for a DeepSeek sized KVCache, python backend against
+// native backend. One step runs attention over the cached blocks of every
+// layer and appends the new block, which is what the host does per token, so
+// the per call overhead of the python backend is paid layer_num times.
+//
+// The CPU kvcache reads and writes host memory, all tensors live on the CPU.
+
+#include "bench.hpp"
 #include "kvcache.hpp"
 #include <Python.h>
-#include <c10/cuda/CUDAStream.h>
 #include <iostream>
+#include <map>
 #include <stdexcept>
 #include <torch/torch.h>
 #include <vector>
 
+namespace {
+
+constexpr int kSteps = 50;
+constexpr int kWarmup = 3;
+constexpr int kFilledBlocks = 64;
+
+bench::Latency run(kvcache::Backend backend,
+                   const kvcache::KVCacheConfig &config) {
+  kvcache::KVCache kvcache(config, backend);
+
+  auto fp16 = torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat16);
+  auto fp32 = torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat32);
+
+  // Input query tensor (batch_size=1, seq_len=1, num_heads, head_dim)
+  auto q_in = torch::randn({1, 1, config.q_head_num, config.head_dim}, fp16);
+  auto output = torch::zeros({1, 1, config.q_head_num, config.head_dim}, fp16);
+  auto attn_lse = torch::zeros({1, 1, config.q_head_num}, fp32);
+  auto k_in = torch::randn(
+      {config.block_len, config.kv_head_num, config.head_dim}, fp16);
+  auto v_in = torch::randn(
+      {config.block_len, config.kv_head_num, config.head_dim}, fp16);
+
+  // Prefill the cache of every layer
+  for (int layer = 0; layer < config.layer_num; layer++) {
+    for (int block = 0; block < kFilledBlocks; block++) {
+      if (!kvcache.update_kvcache_one_block_fp16(k_in, v_in, layer, block)) {
+        throw std::runtime_error("failed to fill the kvcache");
+      }
+    }
+  }
+  kvcache.update_cache_total_len(kFilledBlocks * config.block_len);
+
+  auto block_table = torch::arange(config.max_block_num, torch::kInt32)
+                         .unsqueeze(0)
+                         .contiguous();
+  auto cache_seqlens =
+      torch::full({1}, kFilledBlocks * config.block_len, torch::kInt32);
+  int pick_block_num = 4;  // Number of blocks to pick
+  int init_block_num = 0;  // Initial block number
+  int local_block_num = 4; // Number of local blocks
+
+  return bench::measure(
+      [&]() {
+        bool ok = true;
+        for (int layer = 0; layer < config.layer_num; layer++) {
+          ok &= kvcache.attn(q_in, output, attn_lse, layer, 0, &block_table,
+                             &cache_seqlens, &pick_block_num, &init_block_num,
+                             &local_block_num);
+          ok &= kvcache.update_kvcache_one_block_fp16(k_in, v_in, layer,
+                                                      kFilledBlocks);
+        }
+        return ok;
+      },
+      kSteps, kWarmup);
+}
+
+} // namespace
+
 int main() {
   try {
-    // Initialize Python interpreter
+    // Initialize Python interpreter, only the python backend needs it
     Py_Initialize();
     std::cout << "Python version: " << Py_GetVersion() << std::endl;
-    std::cout << "Python path: " << Py_GetPath() << std::endl;
 
-    // Create a KVCacheConfig for DeepSeek 671B MoE
+    // A KVCacheConfig shaped like the DeepSeek 671B MoE attention
     kvcache::KVCacheConfig kvconfig(
-        32,                         // layer_num (DeepSeek 671B has 32 layers)
+        32,                         // layer_num
         32,                         // kv_head_num
         32,                         // q_head_num
         128,                        // head_dim
@@ -32,97 +97,38 @@ int main() {
         32                             // max_thread_num
     );
 
-    std::cout << "Creating KVCache instance for DeepSeek 671B MoE..."
-              << std::endl;
-    kvcache::KVCache kvcache(kvconfig);
-    std::cout << "KVCache instance created successfully" << std::endl;
-
-    // Create test tensors for MoE inference
-    std::cout << "Creating test tensors for MoE inference..." << std::endl;
-
-    // Input query tensor (batch_size=1, seq_len=1, num_heads=32, head_dim=128)
-    auto q_in = torch::randn(
-        {1, 1, kvconfig.q_head_num, kvconfig.head_dim},
-        torch::TensorOptions().device(torch::kCUDA).dtype(torch::kFloat16));
-
-    // Output tensor for attention results
-    auto output = torch::zeros(
-        {1, 1, kvconfig.q_head_num, kvconfig.head_dim},
-        torch::TensorOptions().device(torch::kCUDA).dtype(torch::kFloat16));
-
-    // Attention log-sum-exp tensor
-    auto attn_lse = torch::zeros(
-        {1, 1, kvconfig.q_head_num},
-        torch::TensorOptions().device(torch::kCUDA).dtype(torch::kFloat32));
-
-    // Block table for MoE routing
-    auto block_table = torch::zeros(
-        {1, kvconfig.max_block_num},
-        torch::TensorOptions().device(torch::kCUDA).dtype(torch::kInt32));
-
-    // Cache sequence lengths
-    auto cache_seqlens = torch::zeros(
-        {1}, torch::TensorOptions().device(torch::kCUDA).dtype(torch::kInt32));
-
-    std::cout << "Test tensors created successfully" << std::endl;
-
-    // Test MoE inference with attention operation
-    std::cout << "Testing MoE inference with attention operation..."
-              << std::endl;
-
-    // Initialize MoE-specific parameters
-    int pick_block_num = 4;  // Number of expert blocks to pick
-    int init_block_num = 0;  // Initial block number
-    int local_block_num = 4; // Number of local blocks
-
-    // Perform attention operation with MoE routing
-    bool success =
-        kvcache.attn(q_in, output, attn_lse, 0, 0, &block_table, &cache_seqlens,
-                     &pick_block_num, &init_block_num, &local_block_num);
-
-    if (success) {
-      std::cout << "MoE inference test passed successfully!" << std::endl;
-      std::cout << "Output shape: " << output.sizes() << std::endl;
-
-      // Test KVCache update for MoE
-      std::cout << "Testing KVCache update for MoE..." << std::endl;
-
-      // Create K and V tensors for cache update
-      auto k_in = torch::randn(
-          {1, 1, kvconfig.kv_head_num, kvconfig.head_dim},
-          torch::TensorOptions().device(torch::kCUDA).dtype(torch::kFloat16));
-      auto v_in = torch::randn(
-          {1, 1, kvconfig.kv_head_num, kvconfig.head_dim},
-          torch::TensorOptions().device(torch::kCUDA).dtype(torch::kFloat16));
-
-      // Update KVCache for the first expert block
-      bool update_success =
-          kvcache.update_kvcache_one_block_fp16(k_in, v_in, 0, 0);
-      if (update_success) {
-        std::cout << "KVCache update successful for expert block 0"
-                  << std::endl;
-      } else {
-        std::cerr << "Failed to update KVCache for expert block 0" << std::endl;
+    std::map<kvcache::Backend, bench::Latency> results;
+    for (auto backend : bench::backends()) {
+      try {
+        results[backend] = run(backend, kvconfig);
+      } catch (const std::exception &e) {
+        std::cerr << bench::backend_name(backend)
+                  << " backend skipped: " << e.what() << std::endl;
       }
-    } else {
-      std::cerr << "MoE inference test failed" << std::endl;
+    }
+    if (results.empty()) {
+      std::cerr << "No backend could be benchmarked" << std::endl;
       return 1;
     }
 
-    // Finalize Python interpreter
+    int failures = 0;
+    for (auto &[backend, latency] : results) {
+      bench::report("decode_step", backend, latency);
+      failures += latency.failures;
+    }
+    if (results.size() == 2) {
+      std::printf("decode_step native speedup x%.2f (p50)\n",
+                  results[kvcache::Backend::PYTHON].p50_us /
+                      results[kvcache::Backend::NATIVE].p50_us);
+    }
+
     Py_Finalize();
-    return 0;
+    return failures == 0 ? 0 : 1;
   } catch (const std::exception &e) {
-    std::cerr << "Test failed with exception: " << e.what() << std::endl;
-    if (Py_IsInitialized()) {
-      PyErr_Print(); // Print any Python errors
-    }
-    return 1;
-  } catch (...) {
-    std::cerr << "Test failed with unknown exception" << std::endl;
+    std::cerr << "Benchmark failed with exception: " << e.what() << std::endl;
     if (Py_IsInitialized()) {
       PyErr_Print(); // Print any Python errors
     }
     return 1;
   }
-}
\ No newline at end of file
+}
@@ -1,27 +1,76 @@
+// Latency benchmark of the KVCache wrapper, python backend against native
+// backend. Every backend fills the cache of one layer block by block and then
+// runs decode attention over it.
+
+#include "bench.hpp"
 #include "kvcache.hpp"
 #include <Python.h>
-#include <c10/cuda/CUDAStream.h>
 #include <iostream>
+#include <map>
 #include <stdexcept>
 #include <torch/torch.h>
-// void c10::detail::torchInternalAssertFail(
-//     char const *, char const *, unsigned int, char const *,
-//     std::__cxx11::basic_string<char, std::char_traits<char>,
-//                                std::allocator<char>> const &) {}
-// void c10::detail::torchCheckFail(
-//     char const *, char const *, unsigned int,
-//     std::__cxx11::basic_string<char, std::char_traits<char>,
-//                                std::allocator<char>> const &) {}
+
+namespace {
+
+constexpr int kIters = 200;
+constexpr int kWarmup = 10;
+constexpr int kFilledBlocks = 128;
+
+std::map<std::string, bench::Latency> run(kvcache::Backend backend,
+                                          const kvcache::KVCacheConfig &config) {
+  std::map<std::string, bench::Latency> res;
+  kvcache::KVCache kvcache(config, backend);
+
+  auto fp16 = torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat16);
+  auto fp32 = torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat32);
+  auto k_in = torch::randn(
+      {config.block_len, config.kv_head_num, config.head_dim}, fp16);
+  auto v_in = torch::randn(
+      {config.block_len, config.kv_head_num, config.head_dim}, fp16);
+
+  int block_idx = 0;
+  res["update_kvcache_one_block_fp16"] = bench::measure(
+      [&]() {
+        bool ok = kvcache.update_kvcache_one_block_fp16(k_in, v_in, 0,
+                                                        block_idx);
+        block_idx = (block_idx + 1) % kFilledBlocks;
+        return ok;
+      },
+      kIters, kWarmup);
+  kvcache.update_cache_total_len(kFilledBlocks * config.block_len);
+
+  auto q_in = torch::randn({1, 1, config.q_head_num, config.head_dim}, fp16);
+  auto output = torch::zeros({1, 1, config.q_head_num, config.head_dim}, fp16);
+  auto attn_lse = torch::zeros({1, 1, config.q_head_num}, fp32);
+  auto block_table = torch::arange(config.max_block_num, torch::kInt32)
+                         .unsqueeze(0)
+                         .contiguous();
+  auto cache_seqlens =
+      torch::full({1}, kFilledBlocks * config.block_len, torch::kInt32);
+  int pick_block_num = kFilledBlocks;
+  int init_block_num = 0;
+  int local_block_num = 0;
+  res["attn"] = bench::measure(
+      [&]() {
+        return kvcache.attn(q_in, output, attn_lse, 0, 0, &block_table,
+                            &cache_seqlens, &pick_block_num, &init_block_num,
+                            &local_block_num);
+      },
+      kIters, kWarmup);
+  return res;
+}
+
+} // namespace
+
 int main() {
   try {
-    // Initialize Python interpreter
+    // Initialize Python interpreter, only the python backend needs it
     Py_Initialize();
-
-    // Print Python version and paths
     std::cout << "Python version: " << Py_GetVersion() << std::endl;
-    std::cout << "Python path: " << Py_GetPath() << std::endl;
+    std::cout << "Native backend: "
+              << (kvcache::native_available() ? "available" : "not built")
+              << std::endl;
 
-    // Create a KVCacheConfig with all required parameters
     kvcache::KVCacheConfig kvconfig(
         32,                            // layer_num
         32,                            // kv_head_num
@@ -40,54 +89,43 @@ int main() {
         32                             // max_thread_num
     );
 
-    std::cout << "Creating KVCache instance..." << std::endl;
-
-    // Create KVCache instance
-    kvcache::KVCache kvcache(kvconfig);
-    std::cout << "KVCache instance created successfully" << std::endl;
-
-    // Create test tensors
-    std::cout << "Creating test tensors..." << std::endl;
-    auto q_in = torch::randn(
-        {1, 1, kvconfig.q_head_num, kvconfig.head_dim},
-        torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat16));
-    auto output = torch::zeros(
-        {1, 1, kvconfig.q_head_num, kvconfig.head_dim},
-        torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat16));
-    auto attn_lse = torch::zeros(
-        {1, 1, kvconfig.q_head_num},
-        torch::TensorOptions().device(torch::kCPU).dtype(torch::kFloat32));
-    std::cout << "Test tensors created successfully" << std::endl;
-
-    // Test attention operation
-    std::cout << "Testing attention operation..." << std::endl;
-    bool success = kvcache.attn(q_in, output, attn_lse, 0, 0, nullptr, nullptr,
-                                nullptr, nullptr, nullptr);
-
-    if (success) {
-      std::cout << "Test passed: KVCache attention operation successful!"
-                << std::endl;
-      std::cout << "Output shape: " << output.sizes() << std::endl;
-    } else {
-      std::cerr << "Test failed: KVCache attention operation failed"
-                << std::endl;
+    std::map<kvcache::Backend, std::map<std::string, bench::Latency>> results;
+    for (auto backend : bench::backends()) {
+      try {
+        results[backend] = run(backend, kvconfig);
+      } catch (const std::exception &e) {
+        std::cerr << bench::backend_name(backend)
+                  << " backend skipped: " << e.what() << std::endl;
+      }
+    }
+    if (results.empty()) {
+      std::cerr << "No backend could be benchmarked" << std::endl;
       return 1;
     }
 
-    // Finalize Python interpreter
+    int failures = 0;
+    for (auto &[backend, ops] : results) {
+      for (auto &[op, latency] : ops) {
+        bench::report(op, backend, latency);
+        failures += latency.failures;
+      }
+    }
+    auto python = results.find(kvcache::Backend::PYTHON);
+    auto native = results.find(kvcache::Backend::NATIVE);
+    if (python != results.end() && native != results.end()) {
+      for (auto &[op, latency] : native->second) {
+        std::printf("%-32s native speedup x%.2f (p50)\n", op.c_str(),
+                    python->second[op].p50_us / latency.p50_us);
+      }
+    }
+
     Py_Finalize();
-    return 0;
+    return failures == 0 ? 0 : 1;
   } catch (const std::exception &e) {
-    std::cerr << "Test failed with exception: " << e.what() << std::endl;
-    if (Py_IsInitialized()) {
-      PyErr_Print(); // Print any Python errors
-    }
-    return 1;
-  } catch (...) {
-    std::cerr << "Test failed with unknown exception" << std::endl;
+    std::cerr << "Benchmark failed with exception: " << e.what() << std::endl;
     if (Py_IsInitialized()) {
       PyErr_Print(); // Print any Python errors
     }
     return 1;
   }
-}
\ No newline at end of file
+}
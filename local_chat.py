@@ -63,7 +63,11 @@ def local_chat(
     prompt_file : str | None = None,
     mode: str = "normal",
     force_think: bool = True,
-    chunk_size: int = 8192
+    chunk_size: int = 8192,
+    kv_cache_dtype: str = Config().kv_cache_dtype,
+    ngram_decoding: bool = Config().ngram_decoding,
+    adaptive_chunk: bool = Config().adaptive_chunk,
+    load_workers: int = Config().load_workers,
 ):
 
     torch.set_grad_enabled(False)
@@ -109,7 +113,8 @@ def local_chat(
         gguf_path = input(
             "please input the path of your gguf file(gguf file in the dir containing input gguf file must all belong to current model):"
         )
-    optimize_and_load_gguf(model, optimize_config_path, gguf_path, config)
+    optimize_and_load_gguf(model, optimize_config_path, gguf_path, config, load_workers=load_workers,
+                           max_bytes_in_flight=Config().load_max_inflight_mb << 20)
     
     try:
         model.generation_config = GenerationConfig.from_pretrained(model_path)
@@ -165,7 +170,11 @@ def local_chat(
         torch.bfloat16
     )  # TODO: Remove this, replace dtype using config
     generated = prefill_and_generate(
-        model, tokenizer, input_tensor, max_new_tokens, use_cuda_graph, mode
+        model, tokenizer, input_tensor, max_new_tokens, use_cuda_graph, mode,
+        kv_cache_dtype=kv_cache_dtype, ngram_decoding=ngram_decoding,
+        ngram_num_draft=Config().ngram_num_draft, ngram_max_ngram=Config().ngram_max_ngram,
+        adaptive_chunk=adaptive_chunk, chunk_memory_mb=Config().chunk_memory_mb,
+        cpu_infer=cpu_infer, localstore_path=Config().localstore_path,
     )
         #return
 
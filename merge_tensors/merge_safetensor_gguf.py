@@ -5,16 +5,31 @@ import os
 import sys
 sys.path.insert(0, "/home/azure/ktransformers")
 import argparse
-import torch
+import json
+import struct
+import numpy as np
 from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
-from safetensors import safe_open
-from safetensors.torch import save_file
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def read_safetensor_keys_from_folder(folder_path)->dict:
+COPY_CHUNK_BYTES = 64 << 20
+
+def read_safetensor_header(file_path: str) -> tuple[dict, int]:
+    """
+    :param file_path: safetensors file
+    :return: (header without __metadata__, absolute offset of the data section)
+    """
+    with open(file_path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    return header, 8 + header_len
+
+def read_safetensor_keys_from_folder(folder_path, headers: dict | None = None)->dict:
     """    
     :param folder_path: folder path
+    :param headers: if given, filled with {file_path: (header, data_offset)} so callers don't reopen the shards
     :return: key_to_file_map
     """
     # check if the folder path is exist
@@ -34,19 +49,18 @@ def read_safetensor_keys_from_folder(folder_path)->dict:
                 found_safetensor = True
                 file_path = os.path.join(root, file)
                 try:
-                    with safe_open(file_path, framework="pt") as f:
-                        for key in f.keys():
-                            if "model.layers.61" in key:
-                                # skip MTP layer
-                                continue
-                            # try:
-                            #     if int(key.split('.')[2]) > 4:
-                            #         continue
-                            # except:
-                            #     pass
-                            key_to_file_map[key] = file_path
+                    # only the json header is read, no tensor is materialized
+                    header, data_offset = read_safetensor_header(file_path)
                 except Exception as e:
                     print(f"Error reading Safetensor file {file_path}: {e}")
+                    continue
+                if headers is not None:
+                    headers[file_path] = (header, data_offset)
+                for key in header.keys():
+                    if "model.layers.61" in key:
+                        # skip MTP layer
+                        continue
+                    key_to_file_map[key] = file_path
     
     if not found_safetensor:
         raise FileNotFoundError(f"No Safetensor files found in {folder_path}")
@@ -68,10 +82,10 @@ def translate_name(name:str)->str:
     return name
     
 
-def combine_tensor_sources(safetensor_path:str, gguf_path:str):
+def combine_tensor_sources(safetensor_path:str, gguf_path:str, safetensor_headers: dict | None = None):
     gguf_loader = GGUFLoader(gguf_path)
     gguf_tensor_file_map = gguf_loader.tensor_file_map
-    safetensor_tensor_file_map = read_safetensor_keys_from_folder(safetensor_path)
+    safetensor_tensor_file_map = read_safetensor_keys_from_folder(safetensor_path, safetensor_headers)
     
     # build a map for the key to the tensor
     # according to the key, we can get the tensor from the file
@@ -94,14 +108,99 @@ def combine_tensor_sources(safetensor_path:str, gguf_path:str):
     
     return target_tensor_map, gguf_loader
 
-def write_combined_tensor(target_tensor_map: dict, output_path: str, gguf_loader: GGUFLoader):
-    # Ensure output directory exists
-    os.makedirs(output_path, exist_ok=True)
-    
-    # Cache for safetensor file handles and GGUF loaders
-    safetensors_cache = {}
-    gguf_cache = {}
-    
+def ggml_type_key(name: str) -> str:
+    return name[:-7] + ".ggml_type" if name.endswith(".weight") else name + ".ggml_type"
+
+def plan_tensor(key: str, file_path: str, gguf_loader: GGUFLoader, safetensor_headers: dict) -> list[tuple]:
+    """
+    Describe where the bytes of one output tensor come from without reading them.
+    :return: [(name, dtype, shape, source)], source is (file_path, offset, nbytes) or inline bytes
+    """
+    name = translate_name(key)
+    if file_path.endswith('.safetensors'):
+        header, data_offset = safetensor_headers[file_path]
+        info = header[key]
+        begin, end = info["data_offsets"]
+        return [(name, info["dtype"], info["shape"], (file_path, data_offset + begin, end - begin))]
+    if file_path.endswith('.gguf'):
+        t = gguf_loader.tensor_info[name]
+        nbytes = np.dtype(t["item_type"]).itemsize * t["item_count"]
+        # raw gguf blob as flat bytes, the uint8 slice get_undequanted_tensor_and_ggml_type returns
+        res = [(name, "U8", [nbytes], (file_path, t["offset"], nbytes))]
+        if t["ggml_type"]:
+            res.append((ggml_type_key(name), "I64", [], struct.pack("<q", t["ggml_type"])))
+        return res
+    raise ValueError(f"Unsupported file format: {file_path}")
+
+def shard_header(entries: list[tuple]) -> bytes:
+    """safetensors header for `entries`, tensors are laid out in the given order."""
+    header = {}
+    offset = 0
+    for name, dtype, shape, source in entries:
+        nbytes = len(source) if isinstance(source, bytes) else source[2]
+        header[name] = {"dtype": dtype, "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data section has to start 8 byte aligned
+    data += b" " * ((8 - len(data) % 8) % 8)
+    return struct.pack("<Q", len(data)) + data
+
+def shard_size(header: bytes, entries: list[tuple]) -> int:
+    return len(header) + sum(len(s) if isinstance(s, bytes) else s[2] for _, _, _, s in entries)
+
+def shard_is_complete(output_file: str, header: bytes, entries: list[tuple]) -> bool:
+    """A shard only gets its final name once fully written, a matching header and size means it's done."""
+    if not os.path.exists(output_file) or os.path.getsize(output_file) != shard_size(header, entries):
+        return False
+    with open(output_file, "rb") as f:
+        return f.read(len(header)) == header
+
+def copy_range(src, offset: int, nbytes: int, dst):
+    if hasattr(os, "copy_file_range"):
+        # in kernel copy, the bytes never enter user space
+        while nbytes > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), min(nbytes, 1 << 30), offset)
+            if copied == 0:
+                raise IOError(f"Unexpected end of {src.name}")
+            offset += copied
+            nbytes -= copied
+        return
+    mm = np.memmap(src.name, dtype=np.uint8, mode="r")
+    for begin in range(offset, offset + nbytes, COPY_CHUNK_BYTES):
+        dst.write(mm[begin:min(begin + COPY_CHUNK_BYTES, offset + nbytes)].tobytes())
+
+def write_shard(output_file: str, entries: list[tuple]) -> str:
+    """Stream one shard: header first, then every tensor copied straight from its source file."""
+    header = shard_header(entries)
+    if shard_is_complete(output_file, header, entries):
+        return f"Skipping complete {output_file}"
+    tmp_file = output_file + ".tmp"
+    sources = {}
+    try:
+        with open(tmp_file, "wb") as dst:
+            dst.write(header)
+            dst.flush()
+            for _, _, _, source in entries:
+                if isinstance(source, bytes):
+                    dst.write(source)
+                    continue
+                dst.flush()
+                file_path, offset, nbytes = source
+                if file_path not in sources:
+                    sources[file_path] = open(file_path, "rb")
+                # copy_file_range writes at the fd position, keep the buffered writer in sync
+                copy_range(sources[file_path], offset, nbytes, dst)
+                dst.seek(0, os.SEEK_END)
+            dst.flush()
+            os.fsync(dst.fileno())
+    finally:
+        for f in sources.values():
+            f.close()
+    os.replace(tmp_file, output_file)
+    return f"Saved {output_file}"
+
+def plan_shards(target_tensor_map: dict, output_path: str, gguf_loader: GGUFLoader, safetensor_headers: dict) -> list[tuple[str, list]]:
+    """Non layer tensors go to the first shard, then one shard per layer."""
     # Group tensors by layer
     layer_groups = defaultdict(list)
     non_layer_keys = []
@@ -120,71 +219,36 @@ def write_combined_tensor(target_tensor_map: dict, output_path: str, gguf_loader
     if total_shards == 0:
         raise ValueError("No tensors to save")
     
-    shard_idx = 0
-    
-    # Save non-layer tensors to the first shard if they exist
-    if non_layer_keys:
-        tensors = {}
-        for key in non_layer_keys:
-            file_path = target_tensor_map[key]
-            tensor = None
-            ggml_type = None
-            if file_path.endswith('.safetensors'):
-                if file_path not in safetensors_cache:
-                    safetensors_cache[file_path] = safe_open(file_path, framework='pt')
-                f = safetensors_cache[file_path]
-                tensor = f.get_tensor(key)
-            elif file_path.endswith('.gguf'):
-                gguf_name = translate_name(key)
-                tensor, ggml_type = gguf_loader.get_undequanted_tensor_and_ggml_type(gguf_name)
-            else:
-                raise ValueError(f"Unsupported file format: {file_path}")
-            tensors[translate_name(key)] = tensor
-            if ggml_type:
-                ggml_type = torch.tensor(ggml_type)
-                ggml_key = translate_name(key)[:-7] + ".ggml_type" if translate_name(key).endswith(".weight") else translate_name(key) + ".ggml_type"
-                tensors[ggml_key] = ggml_type
-        
+    groups = ([non_layer_keys] if non_layer_keys else []) + [layer_groups[n] for n in sorted(layer_groups.keys())]
+    shards = []
+    for shard_idx, keys in enumerate(groups):
+        entries = []
+        for key in keys:
+            entries.extend(plan_tensor(key, target_tensor_map[key], gguf_loader, safetensor_headers))
         output_file = os.path.join(output_path, f"model-{shard_idx:05}-of-{total_shards:05}.safetensors")
-        print(f"Saving non-layer tensors to {output_file}")
-        save_file(tensors, output_file)
-        print(tensors.keys())
-
-        shard_idx += 1
-    
-    # Save each layer's tensors to subsequent shards
-    for layer_num in sorted(layer_groups.keys()):
-        layer_keys = layer_groups[layer_num]
-        tensors = {}
-        for key in layer_keys:
-            file_path = target_tensor_map[key]
-            tensor = None
-            ggml_type = None
+        shards.append((output_file, entries))
+    return shards
+
+def write_combined_tensor(target_tensor_map: dict, output_path: str, gguf_loader: GGUFLoader,
+                          safetensor_headers: dict | None = None, workers: int = 1):
+    # Ensure output directory exists
+    os.makedirs(output_path, exist_ok=True)
+    if safetensor_headers is None:
+        safetensor_headers = {}
+        for file_path in set(target_tensor_map.values()):
             if file_path.endswith('.safetensors'):
-                if file_path not in safetensors_cache:
-                    safetensors_cache[file_path] = safe_open(file_path, framework='pt')
-                f = safetensors_cache[file_path]
-                tensor = f.get_tensor(key)
-                tensor_info = tensor.shape
-            elif file_path.endswith('.gguf'):
-                gguf_name = translate_name(key)
-                tensor, ggml_type = gguf_loader.get_undequanted_tensor_and_ggml_type(gguf_name)
-                # tensor_info = gguf_loader.tensor_info[gguf_name]
-                # ggml_type = gguf_loader.tensor_info[gguf_name]['ggml_type']
-            else:
-                raise ValueError(f"Unsupported file format: {file_path}")
-            tensors[translate_name(key)] = tensor
-            if ggml_type:
-                ggml_type = torch.tensor(ggml_type)
-                ggml_key = translate_name(key)[:-7] + ".ggml_type" if translate_name(key).endswith(".weight") else translate_name(key) + ".ggml_type"
-                tensors[ggml_key] = ggml_type
-        
-        output_file = os.path.join(output_path, f"model-{shard_idx:05}-of-{total_shards:05}.safetensors")
-        print(f"Saving layer {layer_num} to {output_file}")
-        # print(tensors.keys())
-        save_file(tensors, output_file)
-        shard_idx += 1
+                safetensor_headers[file_path] = read_safetensor_header(file_path)
     
+    shards = plan_shards(target_tensor_map, output_path, gguf_loader, safetensor_headers)
+    if workers <= 1:
+        for output_file, entries in shards:
+            print(write_shard(output_file, entries))
+        return
+    # shards only hold file offsets, workers don't need the loaders
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_shard, output_file, entries) for output_file, entries in shards]
+        for future in as_completed(futures):
+            print(future.result())
     return
     
 def main():
@@ -193,6 +257,7 @@ def main():
     parser.add_argument("--safetensor_path", type=str, help="Path to the Safetensor file", default="/mnt/data/model/DeepSeek-V3")
     parser.add_argument("--gguf_path", type=str, help="Path to the GGUF file", default="/mnt/data/model/DeepseekV3-q4km-gguf")
     parser.add_argument("--output_path", type=str, help="Path to the output file", default="/mnt/data/model/ktrans-safetensors/DeepSeek-V3-q4km-fp8")
+    parser.add_argument("--workers", type=int, help="Number of shards written in parallel, complete shards are skipped on rerun", default=os.cpu_count() // 4 or 1)
     
     # print all the arguments
     print("All the arguments:")
@@ -205,8 +270,9 @@ def main():
     gguf_path = args.gguf_path
     output_path = args.output_path
     
-    target_tensor_map, gguf_loader = combine_tensor_sources(safetensor_path, gguf_path)
-    write_combined_tensor(target_tensor_map, output_path, gguf_loader)
+    safetensor_headers = {}
+    target_tensor_map, gguf_loader = combine_tensor_sources(safetensor_path, gguf_path, safetensor_headers)
+    write_combined_tensor(target_tensor_map, output_path, gguf_loader, safetensor_headers, args.workers)
     
     return
 
@@ -12,10 +12,170 @@ import torch.nn as nn
 import transformers
 from transformers import Cache, PretrainedConfig
 from typing import List, Optional, Dict, Any, Tuple
+from ktransformers.models.page_allocator import PageAllocator, SequencePages
 try:
     from ktransformers.server.balance_serve.settings import sched_ext
 except:
     print("no balance_serve")
+
+KV_QUANT_BITS = {"int8": 8, "int4": 4}
+# pages dequantized per step of a read, bounds the float32 temporaries
+READ_CHUNK_PAGES = 256
+
+
+def kv_quant_bits(kv_cache_dtype: Optional[str]) -> Optional[int]:
+    """Bits per element of a quantized kv cache, None when the cache keeps the model precision."""
+    if kv_cache_dtype is None or kv_cache_dtype == "auto":
+        return None
+    if kv_cache_dtype not in KV_QUANT_BITS:
+        raise ValueError(f"kv_cache_dtype should be one of auto, {', '.join(KV_QUANT_BITS)}, got {kv_cache_dtype}")
+    return KV_QUANT_BITS[kv_cache_dtype]
+
+
+def kv_bytes_per_token(config: PretrainedConfig, kv_cache_dtype: Optional[str] = "auto", dtype=torch.bfloat16,
+                       page_size: int = 64, group_size: int = 64) -> float:
+    """Cache bytes one token takes over all layers, to size `cache_lens` for a memory budget."""
+    if config.architectures[0] in ("DeepseekV2ForCausalLM", "DeepseekV3ForCausalLM"):
+        heads, dim, tensors = 1, config.kv_lora_rank + config.qk_rope_head_dim, 1
+    else:
+        heads = config.num_attention_heads if config.num_key_value_heads is None else config.num_key_value_heads
+        dim = config.head_dim if hasattr(config, "head_dim") else config.hidden_size // config.num_attention_heads
+        tensors = 2
+    bits = kv_quant_bits(kv_cache_dtype)
+    if bits is None:
+        per_tensor = heads * dim * torch.tensor([], dtype=dtype).element_size()
+    else:
+        groups = dim // group_size if dim % group_size == 0 else 1
+        per_tensor = heads * dim * bits / 8 + heads * groups * 4 / page_size
+    return per_tensor * tensors * config.num_hidden_layers
+
+
+class QuantizedKVPages:
+    """
+    int8 or 4-bit storage of a paged kv buffer [num_pages, page_size, heads, dim]. Every page holds one
+    float32 scale per head and group of `group_size` channels (symmetric absmax). A write quantizes only the
+    new tokens against the scales of their page. A token that would clip raises the scale of its group
+    first, which requantizes the tokens already in that group once, instead of being clipped; scales only
+    grow, so a page is requantized a few times while it fills up, not on every write.
+    4-bit values are stored offset by 8, two per byte along the last dim.
+    """
+    def __init__(self, num_pages: int, page_size: int, heads: int, dim: int, bits: int = 8,
+                 group_size: int = 64, device="cpu"):
+        if bits not in (4, 8):
+            raise ValueError(f"only 8 and 4 bit kv cache is supported, got {bits}")
+        if bits == 4 and dim % 2 != 0:
+            raise ValueError(f"4 bit kv cache needs an even head dim, got {dim}")
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.heads = heads
+        self.dim = dim
+        self.bits = bits
+        self.group_size = group_size if dim % group_size == 0 else dim
+        self.groups = dim // self.group_size
+        self.qmax = (1 << (bits - 1)) - 1
+        self.zero_byte = 0 if bits == 8 else 0x88
+        packed_dim = dim if bits == 8 else dim // 2
+        self.data = torch.full((num_pages, page_size, heads, packed_dim), self.zero_byte,
+                               dtype=torch.int8 if bits == 8 else torch.uint8, device=device)
+        self.scales = torch.zeros((num_pages, heads, self.groups), dtype=torch.float32, device=device)
+
+    @property
+    def device(self):
+        return self.data.device
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.scales.nbytes
+
+    def quantize(self, pages: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """[n, page_size, heads, dim] float -> (packed data, scales)"""
+        n = pages.size(0)
+        grouped = pages.float().view(n, self.page_size, self.heads, self.groups, self.group_size)
+        scales = grouped.abs().amax(dim=(1, 4)) / self.qmax
+        return self.quantize_with(pages, scales[:, None]), scales
+
+    def quantize_with(self, states: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+        """[..., heads, dim] float against scales [..., heads, groups] -> packed data"""
+        grouped = states.float().view(*states.shape[:-1], self.groups, self.group_size)
+        inv = torch.where(scales > 0, 1.0 / scales, torch.zeros_like(scales))
+        q = torch.round(grouped * inv[..., None]).clamp_(-self.qmax, self.qmax).view(states.shape)
+        if self.bits == 8:
+            return q.to(torch.int8)
+        q = (q + 8).to(torch.uint8)
+        return q[..., 0::2] | (q[..., 1::2] << 4)
+
+    def dequantize(self, data: torch.Tensor, scales: torch.Tensor, dtype=torch.float32) -> torch.Tensor:
+        """(packed data, scales) -> [n, page_size, heads, dim] in `dtype`"""
+        n = data.size(0)
+        if self.bits == 8:
+            q = data.float()
+        else:
+            q = torch.stack((data & 0xF, data >> 4), dim=-1).view(n, self.page_size, self.heads, self.dim).float() - 8
+        q = q.view(n, self.page_size, self.heads, self.groups, self.group_size) * scales[:, None, :, :, None]
+        return q.view(n, self.page_size, self.heads, self.dim).to(dtype)
+
+    def write(self, page_idx: torch.Tensor, page_offset: torch.Tensor, states: torch.Tensor):
+        """states [tokens, heads, dim] go to (page_idx, page_offset)"""
+        states = states.reshape(-1, self.heads, self.dim).float()
+        pages, inverse = torch.unique(page_idx, return_inverse=True)
+        absmax = states.view(-1, self.heads, self.groups, self.group_size).abs().amax(dim=-1)
+        needed = torch.zeros((pages.size(0), self.heads, self.groups), dtype=torch.float32, device=self.device)
+        needed.scatter_reduce_(0, inverse[:, None, None].expand_as(absmax), absmax / self.qmax, "amax")
+        scales = self.scales[pages]
+        grow = (needed > scales).any(dim=(1, 2))
+        if grow.any():
+            # the new tokens would clip: widen the scales of their groups and requantize what the page holds
+            grown = pages[grow]
+            widened = torch.maximum(scales[grow], needed[grow])
+            self.data[grown] = self.quantize_with(self.dequantize(self.data[grown], scales[grow]), widened[:, None])
+            self.scales[grown] = widened
+        self.data[page_idx, page_offset] = self.quantize_with(states, self.scales[page_idx])
+
+    def read_pages(self, out: torch.Tensor, pages: List[int]):
+        """dequantize `pages` in order into out [len(pages), page_size, heads, dim]"""
+        for chunk in range(0, len(pages), READ_CHUNK_PAGES):
+            idx = torch.tensor(pages[chunk:chunk + READ_CHUNK_PAGES], dtype=torch.long, device=self.device)
+            out[chunk:chunk + idx.numel()] = self.dequantize(self.data[idx], self.scales[idx], out.dtype)
+
+    def copy_page(self, src: int, dst: int):
+        self.data[dst] = self.data[src]
+        self.scales[dst] = self.scales[src]
+
+    def clear_pages(self, pages: List[int], offset: int = 0):
+        """zero the tokens from `offset` on in every page of `pages`"""
+        idx = torch.tensor(pages, dtype=torch.long, device=self.device)
+        self.data[idx, offset:] = self.zero_byte
+        if offset == 0:
+            self.scales[idx] = 0
+
+    def read(self, out: torch.Tensor, begin: int = 0, end: Optional[int] = None):
+        """dequantize pages [begin, end) into out [end - begin, page_size, heads, dim]"""
+        end = self.num_pages if end is None else end
+        for chunk in range(begin, end, READ_CHUNK_PAGES):
+            chunk_end = min(chunk + READ_CHUNK_PAGES, end)
+            out[chunk - begin:chunk_end - begin] = self.dequantize(
+                self.data[chunk:chunk_end], self.scales[chunk:chunk_end], out.dtype)
+
+    def clear_from(self, begin: int, seqs: int = 1):
+        """zero every token from position `begin` on, pages are split evenly over `seqs` sequences"""
+        self.data.view(seqs, -1, self.heads, self.data.size(-1))[:, begin:].fill_(self.zero_byte)
+
+    def reset(self):
+        self.data.fill_(self.zero_byte)
+        self.scales.zero_()
+
+
+class DequantScratch:
+    """
+    Full precision buffer the quantized pages of one layer are read into. Layers on a device share it,
+    so a quantized cache costs one layer at model precision on top of its pages. `valid` is how many
+    tokens (pages for paged buffers) the last read filled, a shorter read zeroes the stale tail.
+    """
+    def __init__(self, shape, dtype, device):
+        self.buf = torch.zeros(shape, dtype=dtype, device=device)
+        self.valid = 0
+
+
 class StaticCache(transformers.StaticCache):
     """
     Static Cache class to be used with `torch.compile(model)`.
@@ -32,10 +192,21 @@ class StaticCache(transformers.StaticCache):
             If a `dict`, it should contain the `device` key with the device name as the value.
         dtype (*optional*, defaults to `torch.float32`):
             The default `dtype` to use when initializing the layer.
+        kv_cache_dtype (`str`, *optional*, defaults to `"auto"`):
+            `"int8"` or `"int4"` stores the cache as `QuantizedKVPages` and dequantizes it when `update` returns it,
+            `"auto"` keeps `dtype`. Only paths reading the cache through `update` (e.g. `forward_chunck`) support it,
+            and its writes can't be captured in a cuda graph.
+        num_pages (`int`, *optional*):
+            Size of the MLA page pool shared by all sequences, defaults to `max_batch_size` sequences of
+            `max_cache_len`. Pages are handed out by a `PageAllocator` as sequences grow, and `fork` lets a
+            sequence share the prefix pages of another one until it writes into them.
     """
 
-    def __init__(self, config: PretrainedConfig, max_batch_size: int, max_cache_len: int, device: torch.device| dict, dtype=None) -> None:
+    def __init__(self, config: PretrainedConfig, max_batch_size: int, max_cache_len: int, device: torch.device| dict, dtype=None,
+                 kv_cache_dtype: str = "auto", num_pages: Optional[int] = None) -> None:
         Cache.__init__(self)
+        self.kv_quant_bits = kv_quant_bits(kv_cache_dtype)
+        self.kv_cache_dtype = kv_cache_dtype
         self.max_batch_size = max_batch_size
         self.max_cache_len = config.max_position_embeddings if max_cache_len is None else max_cache_len
         # Some model define a custom `head_dim` != config.hidden_size // config.num_attention_heads
@@ -58,11 +229,22 @@ class StaticCache(transformers.StaticCache):
             # TODO: for deepseek, cache_shape is different whether using Absorbed MLA, check it automatically
             self.page_size = 64
             self.max_pages = (self.max_cache_len + self.page_size - 1) // self.page_size
-            latent_shape = (self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
+            self.num_pages = max_batch_size * self.max_pages if num_pages is None else num_pages
+            # one extra page stays zero, unallocated page table slots point at it
+            self.zero_page = self.num_pages
+            latent_shape = (self.num_pages + 1, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
             self.kv_lora_rank = config.kv_lora_rank
             self.qk_rope_head_dim = config.qk_rope_head_dim
-            # TODO: support real page table
+            self.allocator = PageAllocator(self.num_pages)
+            self.seq_pages = SequencePages(self.allocator, max_batch_size, self.page_size,
+                                           self._copy_page, self._clear_pages)
+            # sequences whose pages `reserve` prepared, their writes skip the per step page check
+            self.reserved = [False] * max_batch_size
+            # every sequence owns pages [seq_id * max_pages, (seq_id + 1) * max_pages), reads can skip the gather
+            self.contiguous_pages = self.num_pages >= max_batch_size * self.max_pages
             self.page_table_map = dict()
+            # sequence major layout of the dequantized scratch
+            self.seq_order_table_map = dict()
             self.page_table_list = []
             for idx in range(config.num_hidden_layers):
                 if isinstance(device, dict):
@@ -71,10 +253,12 @@ class StaticCache(transformers.StaticCache):
                     target_device = device
                 
                 if target_device not in self.page_table_map:
-                    page_table = torch.zeros((max_batch_size, self.max_pages), dtype=torch.int32, device=target_device)
-                    for seq_id in range(max_batch_size):
-                        page_table[seq_id, :] = torch.arange(seq_id * self.max_pages, seq_id * self.max_pages + self.max_pages, dtype=torch.int32, device=target_device)
+                    page_table = torch.full((max_batch_size, self.max_pages), self.zero_page, dtype=torch.int32, device=target_device)
                     self.page_table_map[target_device] = page_table
+                    # keyed by the tensor device ("cuda" -> cuda:0), the device the cached tensors report
+                    self.seq_order_table_map[page_table.device] = torch.arange(
+                        max_batch_size * self.max_pages, dtype=torch.int32, device=target_device
+                    ).view(max_batch_size, self.max_pages)
                     
                 self.page_table_list.append(self.page_table_map[target_device])
                     
@@ -84,8 +268,14 @@ class StaticCache(transformers.StaticCache):
             key_shape = cache_shape
             value_shape = cache_shape
             self.is_MLA = False
+            # quantized storage pages the sequence dim
+            self.page_size = 64
+            self.max_pages = (self.max_cache_len + self.page_size - 1) // self.page_size
 
         self.past_tokens = []
+        # tokens written to the quantized pages of each layer, bounds the dequantized prefix
+        self.quant_len = []
+        self.scratch: Dict[Any, DequantScratch] = {}
         self.num_hidden_layers = config.num_hidden_layers
         for idx in range(self.num_hidden_layers):
             # Note: `mark_static_address` is used to tag the cache as an fixed data pointer, preventing cuda graph
@@ -95,7 +285,10 @@ class StaticCache(transformers.StaticCache):
             else:
                 target_device = device
             
-            if self.is_MLA:
+            if self.kv_quant_bits is not None:
+                new_layer_key_cache, new_layer_value_cache = self._alloc_quantized(
+                    config, latent_shape if self.is_MLA else cache_shape, target_device)
+            elif self.is_MLA:
                 new_layer_key_cache = torch.zeros(latent_shape, dtype=self.dtype, device=target_device)
                 new_layer_value_cache = None
                 torch._dynamo.mark_static_address(new_layer_key_cache)
@@ -108,6 +301,164 @@ class StaticCache(transformers.StaticCache):
             self.key_cache.append(new_layer_key_cache)
             self.value_cache.append(new_layer_value_cache)
             self.past_tokens.append(0)
+            self.quant_len.append(0)
+
+    def _alloc_quantized(self, config: PretrainedConfig, shape, device):
+        # the scratch is looked up by the device the pages report, e.g. cuda:0 for "cuda"
+        device = torch.empty(0, device=device).device
+        if (device, "key") not in self.scratch:
+            if self.is_MLA:
+                self.scratch[(device, "key")] = DequantScratch(
+                    (self.max_batch_size * self.max_pages, *shape[1:]), self.dtype, device)
+            else:
+                self.scratch[(device, "key")] = DequantScratch(shape, self.dtype, device)
+                self.scratch[(device, "value")] = DequantScratch(shape, self.dtype, device)
+        if self.is_MLA:
+            dim = config.kv_lora_rank + config.qk_rope_head_dim
+            return QuantizedKVPages(shape[0], self.page_size, 1, dim, self.kv_quant_bits, device=device), None
+        num_pages = self.max_batch_size * self.max_pages
+        return tuple(
+            QuantizedKVPages(num_pages, self.page_size, self.num_key_value_heads, self.head_dim, self.kv_quant_bits,
+                             device=device)
+            for _ in range(2)
+        )
+
+    def _copy_page(self, src: int, dst: int):
+        for k_cache in self.key_cache:
+            if self.kv_quant_bits is not None:
+                k_cache.copy_page(src, dst)
+            else:
+                k_cache[dst] = k_cache[src]
+
+    def _clear_pages(self, pages: List[int], offset: int = 0):
+        for k_cache in self.key_cache:
+            if self.kv_quant_bits is not None:
+                k_cache.clear_pages(pages, offset)
+            else:
+                k_cache[torch.tensor(pages, dtype=torch.long, device=k_cache.device), offset:] = 0
+
+    def _sync_page_table(self, seq_id: int):
+        table = self.seq_pages.tables[seq_id]
+        row = torch.tensor(table + [self.zero_page] * (self.max_pages - len(table)), dtype=torch.int32)
+        for page_table in self.page_table_map.values():
+            page_table[seq_id].copy_(row)
+        self.contiguous_pages = self.num_pages >= self.max_batch_size * self.max_pages and all(
+            pages == list(range(seq * self.max_pages, seq * self.max_pages + len(pages)))
+            for seq, pages in enumerate(self.seq_pages.tables)
+        )
+
+    def _prepare_pages(self, cache_position: torch.Tensor, bsz: int):
+        """Grow the page tables of the first `bsz` sequences over `cache_position` and unshare the pages it writes."""
+        begin, end = int(cache_position.min()), int(cache_position.max()) + 1
+        for seq_id in range(bsz):
+            grown = self.seq_pages.reserve(seq_id, end)
+            unshared = self.seq_pages.make_writable(seq_id, begin, end)
+            if grown or unshared:
+                self._sync_page_table(seq_id)
+
+    def reserve(self, seq_id: int, num_tokens: int, begin: int = 0):
+        """
+        Allocate the pages `seq_id` needs for `num_tokens` tokens ahead of time and unshare the ones holding
+        [begin, num_tokens). Until the sequence is forked, truncated or freed its writes must stay in that range,
+        `update` then skips the page check and the host sync on the write positions it needs.
+        """
+        grown = self.seq_pages.reserve(seq_id, num_tokens)
+        unshared = self.seq_pages.make_writable(seq_id, begin, num_tokens)
+        if grown or unshared:
+            self._sync_page_table(seq_id)
+        self.reserved[seq_id] = True
+
+    def fork(self, src_seq: int, dst_seq: int, num_tokens: Optional[int] = None):
+        """Let `dst_seq` reuse the first `num_tokens` cached tokens of `src_seq`, pages are copied on write."""
+        self.seq_pages.fork(src_seq, dst_seq, num_tokens)
+        self.reserved[src_seq] = self.reserved[dst_seq] = False
+        self._sync_page_table(dst_seq)
+
+    def free_seq(self, seq_id: int):
+        """Give the pages of `seq_id` back to the pool."""
+        self.seq_pages.free(seq_id)
+        self.reserved[seq_id] = False
+        self._sync_page_table(seq_id)
+
+    def seq_major(self, kv: torch.Tensor, page_table: torch.Tensor, bsz: int) -> torch.Tensor:
+        """
+        Pages of the first `bsz` sequences back to back, `max_pages` each, for readers that view the cache
+        as [bsz, cache_len, ...]. `kv` and `page_table` are what `update` returned.
+        """
+        if self.contiguous_pages or page_table is self.seq_order_table_map.get(kv.device):
+            return kv[:bsz * self.max_pages]
+        return kv[page_table[:bsz].long()].flatten(0, 1)
+
+    def seq_major_prefix(self, kv: torch.Tensor, page_table: torch.Tensor, bsz: int, num_tokens: int) -> torch.Tensor:
+        """
+        [bsz, num_tokens, dim] view of the first `num_tokens` tokens of each sequence, reading only the pages that
+        hold them. A view when the pages are in sequence order, a gather of those pages otherwise.
+        """
+        pages = (num_tokens + self.page_size - 1) // self.page_size
+        if self.contiguous_pages or page_table is self.seq_order_table_map.get(kv.device):
+            kv = kv[:bsz * self.max_pages].view(bsz, self.max_pages, self.page_size, -1)[:, :pages]
+        else:
+            kv = kv[page_table[:bsz, :pages].long()]
+        return kv.reshape(bsz, pages * self.page_size, -1)[:, :num_tokens]
+
+    def _write_quantized(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor,
+                         cache_position: torch.Tensor):
+        if key_states.is_cuda and torch.cuda.is_current_stream_capturing():
+            # requantizing the touched pages needs their ids on the host
+            raise RuntimeError(f"kv_cache_dtype {self.kv_cache_dtype} can't be captured in a cuda graph")
+        page_idx = cache_position // self.page_size
+        page_offset = cache_position % self.page_size
+        self.quant_len[layer_idx] = max(self.quant_len[layer_idx], int(cache_position.max()) + 1)
+        bsz = key_states.size(0)
+        if self.is_MLA:
+            page_idx = self.page_table_list[layer_idx][:bsz, page_idx].flatten().long()
+            states = torch.cat([key_states, value_states], dim=-1)
+            self.key_cache[layer_idx].write(page_idx, page_offset.repeat(bsz), states.reshape(-1, *states.shape[2:]))
+            return
+        seq_pages = torch.arange(bsz, device=page_idx.device)[:, None] * self.max_pages
+        page_idx = (seq_pages + page_idx[None, :]).flatten()
+        page_offset = page_offset.repeat(bsz)
+        # [bsz, heads, q_len, head_dim] -> [bsz * q_len, heads, head_dim]
+        self.key_cache[layer_idx].write(page_idx, page_offset, key_states.transpose(1, 2).flatten(0, 1))
+        self.value_cache[layer_idx].write(page_idx, page_offset, value_states.transpose(1, 2).flatten(0, 1))
+
+    def _read_quantized(self, layer_idx: int, bsz: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Dequantize the written prefix of layer `layer_idx` into the shared scratch buffers. MLA reads only the
+        written pages in the page tables of the first `bsz` sequences (all of them by default).
+        The scratch holds one layer at a time, so every call dequantizes the whole prefix again: a decode step
+        pays O(context) dequantization per layer next to the attention over the same tokens. A per layer
+        full precision copy would avoid that but give back the memory the quantized pages save.
+        """
+        pages = (self.quant_len[layer_idx] + self.page_size - 1) // self.page_size
+        if self.is_MLA:
+            k_pages = self.key_cache[layer_idx]
+            scratch = self.scratch[(k_pages.device, "key")]
+            valid = 0
+            for seq_id, table in enumerate(self.seq_pages.tables[:bsz]):
+                table = table[:pages]
+                base = seq_id * self.max_pages
+                k_pages.read_pages(scratch.buf[base:base + len(table)], table)
+                if len(table) < scratch.valid:
+                    scratch.buf[base + len(table):base + scratch.valid].zero_()
+                valid = max(valid, len(table))
+            # rows past `bsz` keep what an earlier read left, valid stays a bound over every row
+            scratch.valid = valid if bsz is None or bsz >= len(self.seq_pages.tables) else max(valid, scratch.valid)
+            return scratch.buf, self.seq_order_table_map[k_pages.device]
+        tokens = min(pages * self.page_size, self.max_cache_len)
+        out = []
+        for name, q_pages in (("key", self.key_cache[layer_idx]), ("value", self.value_cache[layer_idx])):
+            scratch = self.scratch[(q_pages.device, name)]
+            bsz, heads, _, head_dim = scratch.buf.shape
+            tmp = torch.empty((bsz, pages, self.page_size, heads, head_dim), dtype=self.dtype, device=q_pages.device)
+            for seq_id in range(bsz):
+                q_pages.read(tmp[seq_id], seq_id * self.max_pages, seq_id * self.max_pages + pages)
+            scratch.buf[:, :, :tokens] = tmp.permute(0, 3, 1, 2, 4).reshape(bsz, heads, -1, head_dim)[:, :, :tokens]
+            if tokens < scratch.valid:
+                scratch.buf[:, :, tokens:scratch.valid].zero_()
+            scratch.valid = tokens
+            out.append(scratch.buf)
+        return tuple(out)
 
     def update(
         self,
@@ -139,13 +490,20 @@ class StaticCache(transformers.StaticCache):
         v_out = self.value_cache[layer_idx]
         self.past_tokens[layer_idx] += cache_position.size(0)
         #print(cache_position)
+        if self.is_MLA and layer_idx == 0 and not all(self.reserved[:key_states.size(0)]):
+            # all layers share one page table, allocate and copy on write once per step
+            self._prepare_pages(cache_position, key_states.size(0))
+        if self.kv_quant_bits is not None:
+            self._write_quantized(layer_idx, key_states, value_states, cache_position)
+            return self._read_quantized(layer_idx, key_states.size(0))
         if self.is_MLA:
-            page_idx = cache_position // self.page_size
+            page_table = self.page_table_list[layer_idx]
+            page_idx = page_table[:key_states.size(0), cache_position // self.page_size].long()
             page_offset = cache_position % self.page_size
-            # key shape (self.max_pages, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
+            # key shape (self.num_pages + 1, self.page_size, 1, config.kv_lora_rank + config.qk_rope_head_dim)
             k_out[page_idx, page_offset, :, :self.kv_lora_rank] = key_states
             k_out[page_idx, page_offset, :, self.kv_lora_rank:] = value_states
-            return k_out, self.page_table_list[layer_idx]
+            return k_out, page_table
         else:
             k_out[:, :, cache_position] = key_states
             v_out[:, :, cache_position] = value_states
@@ -172,23 +530,44 @@ class StaticCache(transformers.StaticCache):
 
     def reset(self):
         """Resets the cache values while preserving the objects"""
+        if self.is_MLA:
+            for seq_id in range(self.max_batch_size):
+                self.free_seq(seq_id)
         for layer_idx in range(len(self.key_cache)):
+            self.past_tokens[layer_idx] = 0
+            self.quant_len[layer_idx] = 0
+            if self.kv_quant_bits is not None:
+                self.key_cache[layer_idx].reset()
+                if self.value_cache[layer_idx] is not None:
+                    self.value_cache[layer_idx].reset()
+                continue
             # In-place ops prevent breaking the static address
             self.key_cache[layer_idx].zero_()
             if self.value_cache[layer_idx] is not None:
                 self.value_cache[layer_idx].zero_()
-            self.past_tokens[layer_idx] = 0
 
     def remove_suffix(self, start_pos):
+        if self.is_MLA:
+            # pages past start_pos go back to the pool, only the tail of the last kept page is zeroed
+            for seq_id, table in enumerate(self.seq_pages.tables):
+                self.seq_pages.truncate(seq_id, start_pos)
+                self.reserved[seq_id] = False
+                if start_pos % self.page_size and table:
+                    self.seq_pages.make_writable(seq_id, start_pos, start_pos + 1)
+                    self._clear_pages([table[-1]], start_pos % self.page_size)
+                self._sync_page_table(seq_id)
         for layer_idx in range(len(self.key_cache)):
-            # In-place ops prevent breaking the static address
-            if self.is_MLA:
-                k_cache = self.key_cache[layer_idx]
-                k_cache.view(-1, k_cache.shape[-1])[start_pos:].zero_()
-            else:
-                self.key_cache[layer_idx][..., start_pos:, :].zero_()
-                self.value_cache[layer_idx][..., start_pos:, :].zero_()
             self.past_tokens[layer_idx] = start_pos
+            self.quant_len[layer_idx] = min(self.quant_len[layer_idx], start_pos)
+            if self.is_MLA:
+                continue
+            if self.kv_quant_bits is not None:
+                self.key_cache[layer_idx].clear_from(start_pos, self.max_batch_size)
+                self.value_cache[layer_idx].clear_from(start_pos, self.max_batch_size)
+                continue
+            # In-place ops prevent breaking the static address
+            self.key_cache[layer_idx][..., start_pos:, :].zero_()
+            self.value_cache[layer_idx][..., start_pos:, :].zero_()
     
     def get_max_cache_shape(self) -> Tuple[int, int, int, int]:
         """Returns the maximum shape of the cache."""
@@ -204,11 +583,23 @@ class StaticCache(transformers.StaticCache):
         Returns:
             A tuple containing the key and value cache for the specified layer.
         """
+        if self.kv_quant_bits is not None:
+            return self._read_quantized(layer_idx)
         if self.is_MLA:
             return self.key_cache[layer_idx], self.page_table_list[layer_idx]
         else:
             return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
+def check_kvc2_cache_dtype(kv_cache_dtype: Optional[str]):
+    """
+    kvc2 allocates the page pool the balance_serve caches run on and reuses cached prefixes straight from it,
+    quantized pages kept next to that pool would neither save memory nor stay in sync with the prefix cache.
+    """
+    if kv_quant_bits(kv_cache_dtype) is not None:
+        raise ValueError(f"kv_cache_dtype {kv_cache_dtype} is not supported by the balance_serve backend, "
+                         f"its kv cache is owned by kvc2, use kv_cache_dtype auto")
+
+
 class KDeepSeekV3Cache(nn.Module):
     def __init__(
         self,
@@ -216,7 +607,7 @@ class KDeepSeekV3Cache(nn.Module):
         page_size: int = 256,
         dtype=torch.bfloat16,
         device=torch.device("cpu"),
-        
+        kv_cache_dtype: str = "auto",
     ):
         super().__init__()
         self.config = config
@@ -224,6 +615,7 @@ class KDeepSeekV3Cache(nn.Module):
         self.device = device
         self.kv_lora_rank = config.kv_lora_rank
         self.page_size = page_size
+        check_kvc2_cache_dtype(kv_cache_dtype)
         self.k_caches = []
         self.v_caches = []
         
@@ -292,13 +684,14 @@ class KGQACache(nn.Module):
         page_size: int = 256,
         dtype=torch.bfloat16,
         device=torch.device("cpu"),
-        
+        kv_cache_dtype: str = "auto",
     ):
         super().__init__()
         self.config = config
         self.dtype = dtype
         self.device = device
         self.page_size = page_size
+        check_kvc2_cache_dtype(kv_cache_dtype)
         self.k_caches = []
         self.v_caches = []
         
@@ -0,0 +1,123 @@
+'''
+Description  : Block allocator for the paged kv cache. Pages come from a free list and carry a
+               reference count, so sequences that share a prompt prefix can point at the same
+               pages and only copy one when they write into it (copy on write).
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+from typing import Callable, List, Optional
+
+
+class OutOfPages(RuntimeError):
+    pass
+
+
+class PageAllocator:
+    """
+    Free list over `num_pages` pages. Freed pages are reused last in first out, and a fresh pool hands
+    out ascending ids, so a single sequence gets contiguous pages until the pool has been churned.
+    """
+    def __init__(self, num_pages: int):
+        self.num_pages = num_pages
+        self.free: List[int] = list(range(num_pages - 1, -1, -1))
+        self.refcount: List[int] = [0] * num_pages
+
+    @property
+    def num_free(self) -> int:
+        return len(self.free)
+
+    @property
+    def num_used(self) -> int:
+        return self.num_pages - len(self.free)
+
+    def alloc(self, n: int = 1) -> List[int]:
+        if n > len(self.free):
+            raise OutOfPages(f"kv cache needs {n} more pages, only {len(self.free)} of {self.num_pages} are free")
+        pages = [self.free.pop() for _ in range(n)]
+        for page in pages:
+            self.refcount[page] = 1
+        return pages
+
+    def share(self, pages: List[int]):
+        for page in pages:
+            assert self.refcount[page] > 0, f"page {page} is not allocated"
+            self.refcount[page] += 1
+
+    def release(self, pages: List[int]):
+        # pushed in reverse so the pages come back out in their original order
+        for page in reversed(pages):
+            assert self.refcount[page] > 0, f"page {page} is released twice"
+            self.refcount[page] -= 1
+            if self.refcount[page] == 0:
+                self.free.append(page)
+
+    def is_shared(self, page: int) -> bool:
+        return self.refcount[page] > 1
+
+
+class SequencePages:
+    """
+    Page tables of `max_seqs` sequences over one `PageAllocator`. `copy_page(src, dst)` and
+    `clear_pages(pages)` are called back to move the cached data when a shared page is written and to
+    wipe stale data out of pages coming off the free list.
+    """
+    def __init__(self, allocator: PageAllocator, max_seqs: int, page_size: int,
+                 copy_page: Optional[Callable[[int, int], None]] = None,
+                 clear_pages: Optional[Callable[[List[int]], None]] = None):
+        self.allocator = allocator
+        self.page_size = page_size
+        self.tables: List[List[int]] = [[] for _ in range(max_seqs)]
+        self.copy_page = copy_page
+        self.clear_pages = clear_pages
+
+    def num_pages(self, num_tokens: int) -> int:
+        return (num_tokens + self.page_size - 1) // self.page_size
+
+    def reserve(self, seq_id: int, num_tokens: int) -> bool:
+        """Grow `seq_id` to hold `num_tokens`, returns whether its table changed."""
+        table = self.tables[seq_id]
+        missing = self.num_pages(num_tokens) - len(table)
+        if missing <= 0:
+            return False
+        pages = self.allocator.alloc(missing)
+        if self.clear_pages is not None:
+            self.clear_pages(pages)
+        table.extend(pages)
+        return True
+
+    def make_writable(self, seq_id: int, begin: int, end: int) -> bool:
+        """Give `seq_id` private copies of the shared pages covering tokens [begin, end)."""
+        table = self.tables[seq_id]
+        changed = False
+        for slot in range(begin // self.page_size, min(self.num_pages(end), len(table))):
+            page = table[slot]
+            if not self.allocator.is_shared(page):
+                continue
+            new_page = self.allocator.alloc(1)[0]
+            if self.copy_page is not None:
+                self.copy_page(page, new_page)
+            self.allocator.release([page])
+            table[slot] = new_page
+            changed = True
+        return changed
+
+    def fork(self, src_seq: int, dst_seq: int, num_tokens: Optional[int] = None):
+        """Point `dst_seq` at the pages holding the first `num_tokens` tokens of `src_seq`."""
+        src = self.tables[src_seq]
+        shared = src if num_tokens is None else src[:self.num_pages(num_tokens)]
+        self.allocator.share(shared)
+        self.free(dst_seq)
+        self.tables[dst_seq] = list(shared)
+
+    def truncate(self, seq_id: int, num_tokens: int) -> List[int]:
+        """Drop the pages past `num_tokens`, returns the ones given back."""
+        table = self.tables[seq_id]
+        keep = self.num_pages(num_tokens)
+        dropped = table[keep:]
+        del table[keep:]
+        self.allocator.release(dropped)
+        return dropped
+
+    def free(self, seq_id: int):
+        self.allocator.release(self.tables[seq_id])
+        self.tables[seq_id] = []
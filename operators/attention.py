@@ -29,6 +29,7 @@ except:
     pass
 from ktransformers.operators.triton_attention import decode_attention_fwd_grouped 
 from ktransformers.operators.triton_attention_prefill import context_attention_fwd
+from ktransformers.operators.mla_decode import mla_prefix_attention
 import os
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled
 if flashinfer_enabled:
@@ -59,6 +60,7 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                  chunck_size: int = 1000,
                  absorb_for_prefill: bool = False,
                  device: str = "cpu",
+                 decode_max_q_len: int = 16,
                  **kwargs):
         BaseInjectedModule.__init__(self, key, gguf_loader, config, orig_module, prefill_device,  **kwargs)
         self.orig_module.__init__(orig_module.config,
@@ -66,6 +68,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
         self.chunck_size = chunck_size # TODO, generate chunck_size automatically.
         self.mla_wrapper = None
         self.absorb_for_prefill = absorb_for_prefill
+        # forward_chunck calls with at most this many tokens, or without a mask, read only the valid cache pages
+        self.decode_max_q_len = decode_max_q_len
 
     def get_absorbed(self) -> Tuple[torch.Tensor, torch.Tensor]:
         if not (hasattr(self, 'q_absorb') and hasattr(self, 'out_absorb')):
@@ -125,7 +129,19 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
             # k_pe [bsz, 1, q_len, self.qk_rope_head_dim]
             k_pe = k_pe.transpose(1,2)
             compressed_kv = compressed_kv.unsqueeze(2)
-            compressed_kv_with_k_pe, _ = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+            compressed_kv_with_k_pe, page_table = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+            if bsz == 1 and cache_position is not None and (q_len <= self.decode_max_q_len or attention_mask is None):
+                # decode, or a prefill chunk without a mask: the tokens up to the last query, causal by position,
+                # no dense mask over max_cache_len
+                q_absorb, out_absorb = self.get_absorbed()
+                kv = past_key_value.seq_major_prefix(compressed_kv_with_k_pe, page_table, bsz,
+                                                     int(cache_position[-1]) + 1)
+                attn_output = mla_prefix_attention(torch.matmul(q_nope, q_absorb), q_pe, kv, self.kv_lora_rank,
+                                                   self.softmax_scale, cache_position)
+                attn_output = torch.matmul(attn_output, out_absorb.mT)
+                attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.v_head_dim)
+                return self.o_proj(attn_output), None, past_key_value
+            compressed_kv_with_k_pe = past_key_value.seq_major(compressed_kv_with_k_pe, page_table, bsz)
             compressed_kv, k_pe = torch.split(
                 compressed_kv_with_k_pe, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
             )
@@ -142,59 +158,7 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
         # compressed_kv [bsz, 1, cache_len,self.kv_lora_rank]
         q_nope = torch.matmul(q_nope, q_absorb)
         
-        # Add safety checks for tensor shapes
-        try:
-            if q_pe.shape[-2] != k_pe.shape[-2]:
-                print(f"Shape mismatch in attention: q_pe shape {q_pe.shape}, k_pe shape {k_pe.shape}")
-                # Adjust shapes to be compatible
-                min_len = min(q_pe.shape[-2], k_pe.shape[-2])
-                q_pe = q_pe[:, :, :min_len, :]
-                k_pe = k_pe[:, :, :min_len, :]
-            
-            if q_nope.shape[-2] != compressed_kv.shape[-2]:
-                print(f"Shape mismatch in attention: q_nope shape {q_nope.shape}, compressed_kv shape {compressed_kv.shape}")
-                # Adjust shapes to be compatible
-                min_len = min(q_nope.shape[-2], compressed_kv.shape[-2])
-                q_nope = q_nope[:, :, :min_len, :]
-                compressed_kv = compressed_kv[:, :, :min_len, :]
-                
-            # Ensure attention_mask has the right shape
-            if attention_mask is not None and attention_mask.shape[-1] != k_pe.shape[-2]:
-                print(f"Attention mask shape mismatch: {attention_mask.shape}, k_pe shape: {k_pe.shape}")
-                # Resize attention mask to match
-                if attention_mask.shape[-1] > k_pe.shape[-2]:
-                    attention_mask = attention_mask[:, :, :, :k_pe.shape[-2]]
-                else:
-                    # Pad with large negative values to mask out additional positions
-                    pad_size = k_pe.shape[-2] - attention_mask.shape[-1]
-                    padding = torch.full((attention_mask.shape[0], attention_mask.shape[1], attention_mask.shape[2], pad_size), 
-                                          -10000.0, device=attention_mask.device, dtype=attention_mask.dtype)
-                    attention_mask = torch.cat([attention_mask, padding], dim=-1)
-            
-            attn_weights = (torch.matmul(q_pe, k_pe.mT) + torch.matmul(q_nope, compressed_kv.mT)) * self.softmax_scale
-        except RuntimeError as e:
-            print(f"Error in attention calculation: {e}")
-            print(f"q_pe shape: {q_pe.shape}, k_pe shape: {k_pe.shape}")
-            print(f"q_nope shape: {q_nope.shape}, compressed_kv shape: {compressed_kv.shape}")
-            # Attempt to reshape for compatibility
-            bsz, num_heads, q_len, _ = q_pe.shape
-            kv_seq_len = k_pe.shape[-2]
-            
-            # Reshape all tensors to ensure compatibility
-            reshaped_q_pe = q_pe.reshape(bsz * num_heads, q_len, -1)
-            reshaped_k_pe = k_pe.reshape(bsz * 1, kv_seq_len, -1)
-            reshaped_q_nope = q_nope.reshape(bsz * num_heads, q_len, -1)
-            reshaped_compressed_kv = compressed_kv.reshape(bsz * 1, kv_seq_len, -1)
-            
-            # Compute attention weights with reshaped tensors
-            pe_weights = torch.bmm(reshaped_q_pe, reshaped_k_pe.transpose(1, 2))
-            nope_weights = torch.bmm(reshaped_q_nope, reshaped_compressed_kv.transpose(1, 2))
-            
-            # Reshape back
-            pe_weights = pe_weights.reshape(bsz, num_heads, q_len, kv_seq_len)
-            nope_weights = nope_weights.reshape(bsz, num_heads, q_len, kv_seq_len)
-            
-            attn_weights = (pe_weights + nope_weights) * self.softmax_scale
+        attn_weights = (torch.matmul(q_pe, k_pe.mT) + torch.matmul(q_nope, compressed_kv.mT)) * self.softmax_scale
         
         #attn_weights [bsz, self.num_heads, q_len, kv_seq_len]
         compressed_kv = compressed_kv.squeeze(1)
@@ -354,7 +318,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
                 k_pe.squeeze(0)
                 compressed_kv.squeeze(0)
-                compressed_kv_with_k_pe, _ = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+                compressed_kv_with_k_pe, page_table = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+                compressed_kv_with_k_pe = past_key_value.seq_major(compressed_kv_with_k_pe, page_table, bsz)
                 compressed_kv, k_pe = torch.split(
                     compressed_kv_with_k_pe, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
                 )
@@ -469,8 +434,10 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 self.mla_wrapper = MLAWrapperSingleton.get_instance(self.device, 1, past_key_value.max_pages, use_cuda_graph = True)
             if self.mla_wrapper.need_plan:
                 self.mla_wrapper.need_plan = False
+                # the wrapper's own indices are arange(max_pages), only pass the table once pages are shared or reused
+                kv_indices = None if past_key_value.contiguous_pages else page_table[0]
                 if q_len == 1:
-                    self.mla_wrapper.plan(None,None,None,
+                    self.mla_wrapper.plan(None,None,kv_indices,
                                         position_ids.squeeze(1)+1,
                                         None,
                                         self.num_heads,
@@ -483,7 +450,7 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 else:
                     qo_indptr = torch.tensor([0, q_len], dtype=torch.int32, device=self.device)
                     kv_len_arr = torch.tensor([position_ids[0, -1].item()+1], dtype=torch.int32, device=self.device)
-                    self.mla_wrapper.plan(qo_indptr,None,None,
+                    self.mla_wrapper.plan(qo_indptr,None,kv_indices,
                                         kv_len_arr,
                                         None,
                                         self.num_heads,
@@ -530,7 +497,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
                 k_pe.squeeze(0)
                 compressed_kv.squeeze(0)
-                compressed_kv_with_k_pe, _ = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+                compressed_kv_with_k_pe, page_table = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
+                compressed_kv_with_k_pe = past_key_value.seq_major(compressed_kv_with_k_pe, page_table, bsz)
                 compressed_kv, k_pe = torch.split(
                     compressed_kv_with_k_pe, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
                 )
@@ -601,10 +569,14 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                         )
 
         assert output_attentions == False, "output_attentions is not supported when using chunked attention"
-        attn_output = None
+        # a single sequence is causal over the cache positions, forward_chunck applies that without a mask
+        implicit_causal = bsz == 1 and past_key_value is not None and cache_position is not None
+        attn_output = torch.empty(bsz, q_len, self.hidden_size, device=hidden_states.device, dtype=hidden_states.dtype)
         cur_idx = 0
         while cur_idx < q_len:
-            if attention_mask is not None:
+            if implicit_causal:
+                chunk_mask = None
+            elif attention_mask is not None:
                 chunk_mask = attention_mask[:, :, cur_idx:min(cur_idx + self.chunck_size, q_len), ...]
             else:
                 # generate chunk_mask automatically.
@@ -629,11 +601,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                             cache_position[cur_idx:min(cur_idx + self.chunck_size, q_len)],
                             **kwargs
                         )
+            attn_output[:, cur_idx:cur_idx + cur_output.size(1)] = cur_output
             cur_idx += self.chunck_size
-            if attn_output is None:
-                attn_output = cur_output
-            else:
-                attn_output = torch.cat((attn_output, cur_output), dim=-2)
                 
         return attn_output, None, past_key_value
 
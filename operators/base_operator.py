@@ -10,6 +10,8 @@ from ktransformers.util.custom_gguf import GGUFLoader
 from transformers.configuration_utils import PretrainedConfig
 import ktransformers.util.utils as utils
 class BaseInjectedModule(nn.Module):
+    # load() may run alongside other loads in the parallel load_weights, see util/weight_loader.py
+    load_concurrently = False
     
     def __init__(self,
                  key: str,
@@ -23,7 +23,16 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build", "Release"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "ktransformers_ext", "build", "Debug"))
 import cpuinfer_ext
+from collections import deque
+from time import perf_counter
 from ktransformers.server.config.config import Config
+from ktransformers.util.metrics import MetricsRegistry
+
+# time blocked waiting for the CPU experts / kvcache tasks: the python side in sync(), the cuda stream
+# in sync_with_cuda_stream()
+CPUINFER_WAIT = MetricsRegistry.get_instance().histogram(
+    "ktransformers_cpuinfer_wait_seconds",
+    "Time blocked in CPUInfer.sync / sync_with_cuda_stream for submitted tasks.")
 
 
 class CPUInferKVCache:
@@ -745,6 +754,8 @@ class CPUInferKVCache:
 class CPUInfer:
     cpuinfer = None
     cur_backend_thread_num = 0
+    # (begin, end) events around the stream waits of sync_with_cuda_stream, observed once they complete
+    stream_waits: deque = deque()
     
     def __init__(self, thread_num):
         if thread_num > CPUInfer.cur_backend_thread_num:
@@ -759,10 +770,61 @@ class CPUInfer:
         CPUInfer.cpuinfer.submit_with_cuda_stream(current_cuda_stream, task)
 
     def sync(self):
+        begin = perf_counter()
         CPUInfer.cpuinfer.sync()
+        CPUINFER_WAIT.observe(perf_counter() - begin)
 
     def sync_with_cuda_stream(self, current_cuda_stream):
+        if torch.cuda.is_current_stream_capturing():
+            # events timed at capture would only measure the capture, replays go unobserved
+            CPUInfer.cpuinfer.sync_with_cuda_stream(current_cuda_stream)
+            return
+        # the host returns at once, it is the stream that waits: time it with events around the wait
+        stream = torch.cuda.ExternalStream(current_cuda_stream)
+        begin = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        begin.record(stream)
         CPUInfer.cpuinfer.sync_with_cuda_stream(current_cuda_stream)
+        end.record(stream)
+        CPUInfer.stream_waits.append((begin, end))
+        observe_stream_waits()
+
+
+def observe_stream_waits():
+    """Observe the stream waits that have finished, without blocking on the ones still running."""
+    waits = CPUInfer.stream_waits
+    while waits and waits[0][1].query():
+        begin, end = waits.popleft()
+        CPUINFER_WAIT.observe(begin.elapsed_time(end) / 1e3)
+
+
+class NodeCPUInfer:
+    """A CPUInfer backend whose worker threads are pinned to the cpus of one numa node.
+
+    Worker threads inherit the affinity of the thread that creates them, so the affinity is narrowed
+    around the construction of the backend and restored afterwards.
+    """
+    pools: dict = {}
+
+    def __init__(self, node: int, cpus: list, thread_num: int):
+        self.node = node
+        old_affinity = os.sched_getaffinity(0)
+        try:
+            os.sched_setaffinity(0, cpus)
+            self.cpuinfer = cpuinfer_ext.CPUInfer(thread_num)
+        finally:
+            os.sched_setaffinity(0, old_affinity)
+
+    @classmethod
+    def get_pool(cls, node: int, cpus: list, thread_num: int) -> "NodeCPUInfer":
+        if node not in cls.pools:
+            cls.pools[node] = cls(node, cpus, thread_num)
+        return cls.pools[node]
 
+    def submit(self, task):
+        self.cpuinfer.submit(task)
 
-        
+    def sync(self):
+        begin = perf_counter()
+        self.cpuinfer.sync()
+        CPUINFER_WAIT.observe(perf_counter() - begin)
@@ -1,9 +1,11 @@
 # Add this to your custom_moe.py file
 from ktransformers.operators.experts import KTransformersExperts, KExpertsCPU
 from ktransformers.util import InferenceState
+from ktransformers.util.routing_stats import ExpertRoutingStats, layer_idx_from_key
 # Create this in a new file, e.g., custom_attention.py
 from ktransformers.operators.attention import KDeepseekV2Attention
 from ktransformers.operators.dynamic_attention import DynamicScaledDotProductAttention
+from ktransformers.server.config.config import Config
 from ktransformers.util import InferenceState
 
 class KCustomAttention(KDeepseekV2Attention):
@@ -19,7 +21,8 @@ class KCustomAttention(KDeepseekV2Attention):
             threads_num=kwargs.get('threads_num', 8),
             use_attn_sparsity=kwargs.get('use_attn_sparsity', True),
             preselect_block=kwargs.get('preselect_block', True),
-            preselect_block_count=kwargs.get('preselect_block_count', 64)
+            preselect_block_count=kwargs.get('preselect_block_count', 64),
+            importance_decay=kwargs.get('importance_decay', Config().importance_decay),
         )
         self.current_state = InferenceState.UNLOAD
     
@@ -103,4 +106,22 @@ class SparseMemoryManager:
                 if expert_indices:
                     self.moe_modules[key].unload_specific_experts(expert_indices)
                 else:
-                    self.moe_modules[key].unload()
\ No newline at end of file
+                    self.moe_modules[key].unload()
+
+    def load_hot_experts(self, topk, stats: ExpertRoutingStats = None):
+        """Load only the `topk` most frequently routed experts of every MoE layer"""
+        if stats is None:
+            stats = ExpertRoutingStats.get_instance()
+        for key, module in self.moe_modules.items():
+            hot = stats.hot_experts(layer_idx_from_key(key), topk)
+            if hot and hasattr(module, "load_specific_experts"):
+                module.load_specific_experts(hot)
+
+    def unload_cold_experts(self, keep, stats: ExpertRoutingStats = None):
+        """Unload every expert outside the `keep` hottest ones of each MoE layer"""
+        if stats is None:
+            stats = ExpertRoutingStats.get_instance()
+        for key, module in self.moe_modules.items():
+            cold = stats.hot_experts(layer_idx_from_key(key))[keep:]
+            if cold and hasattr(module, "unload_specific_experts"):
+                module.unload_specific_experts(cold)
@@ -17,6 +17,7 @@ import logging
 logger = logging.getLogger("dynamic_attention")
 sys.path.append(os.path.dirname(__file__) + "/../ktransformers_ext/cpu_backend")
 from ktransformers.operators.cpuinfer import CPUInfer, CPUInferKVCache
+from ktransformers.util.kv_snapshot import KVSnapshot
 from flash_attn import flash_attn_func, flash_attn_with_kvcache
 
 
@@ -30,6 +31,154 @@ os.environ["OMP_NUM_THREADS"] = str(os.cpu_count())
 os.environ["ONEDNN_PRIMITIVE_CACHE_CAPACITY"] = "1024"
 torch.backends.mkldnn.enabled = True
 
+# upper bound of query x key scores materialized at once by attn_score_one_block
+SCORE_CHUNK_ELEMS = 1 << 26
+
+
+def attn_score_one_block(
+    importance: torch.Tensor,
+    query: torch.Tensor,
+    key: torch.Tensor,
+    head_dim: int,
+    mask: torch.Tensor | None = None,
+    use_softmax: bool = True,
+    chunk_elems: int = SCORE_CHUNK_ELEMS,
+):
+    """Accumulate the attention each key token receives from `query` into `importance`, for all heads at once.
+
+    importance: [len_k, q_head_num], updated in place
+    query:      [len_q, q_head_num, head_dim]
+    key:        [len_k, kv_head_num, head_dim], shared by q_head_num // kv_head_num query heads
+    mask:       [>= len_q, >= len_k] 0/1 mask, its bottom right corner is applied to the scores
+    """
+    q_head_num = query.size(1)
+    n_gqa = q_head_num // key.size(1)
+    len_q, len_k = query.size(0), key.size(0)
+    if mask is not None:
+        mask = mask[-len_q:, -len_k:]
+    # as many heads per batched matmul as fit the chunk budget
+    heads_per_chunk = max(1, min(q_head_num, chunk_elems // max(1, len_q * len_k)))
+    for head_begin in range(0, q_head_num, heads_per_chunk):
+        head_end = min(head_begin + heads_per_chunk, q_head_num)
+        # [len_k, heads, head_dim], every query head next to its kv head
+        key_heads = key[:, head_begin // n_gqa:(head_end - 1) // n_gqa + 1].repeat_interleave(n_gqa, dim=1)
+        key_heads = key_heads[:, head_begin % n_gqa:head_begin % n_gqa + head_end - head_begin]
+        qk = torch.einsum("qhd,khd->hqk", query[:, head_begin:head_end], key_heads)
+        if mask is not None:
+            qk = qk * mask
+        if use_softmax:
+            qk = torch.nn.functional.softmax(
+                qk / math.sqrt(head_dim), dim=-1, dtype=torch.float32
+            ).to(torch.float16)
+        importance[:, head_begin:head_end] += torch.sum(qk, dim=-2).transpose(0, 1)
+
+
+def merge_preselect_block_table(block_table: torch.Tensor, src_layer: int, topk: int, count: int = 6):
+    """Give every layer the best blocks of `src_layer` it misses.
+
+    The i-th best block of `src_layer` (1 <= i < min(topk, count)) replaces slot topk - i of each
+    other layer that doesn't select it yet. Vectorized over layers, the few candidates are visited
+    in order so a slot freed earlier is seen by the later ones.
+    block_table: [layer_num, preselect_block_count], updated in place
+    """
+    layers = torch.ones(block_table.size(0), dtype=torch.bool, device=block_table.device)
+    layers[src_layer] = False
+    for i in range(1, min(topk, count)):
+        x = block_table[src_layer, i]
+        missing = layers & ~(block_table == x).any(dim=1)
+        block_table[missing, topk - i] = x
+
+
+def preselect_block_scores(importance_cache: torch.Tensor, block_size: int) -> torch.Tensor:
+    """Score of every block from its token importance, widened by a quarter block of each neighbour.
+
+    importance_cache: [batch_size, block_num, block_size, q_head_num]
+    return:           [batch_size, block_num]
+    """
+    # average over heads before widening every block with a quarter of its
+    # neighbours, so only [batch, block, token] is concatenated
+    importance_cache = importance_cache.mean(dim=-1)
+    importance_r = importance_cache[:, 1:, : block_size // 4]
+    pad_r = torch.zeros_like(importance_r[:, :1])
+    importance_r = torch.cat((importance_r, pad_r), dim=1)
+    importance_l = importance_cache[:, :-1, -block_size // 4 :]
+    pad_l = torch.zeros_like(importance_l[:, :1])
+    importance_l = torch.cat((pad_l, importance_l), dim=1)
+    importance = torch.cat(
+        (importance_l, importance_cache, importance_r), dim=2
+    )
+    return importance.mean(dim=-1)
+
+
+class BlockImportance:
+    """Running, decayed per block importance for DYNAMIC_INCREMENTAL preselection (batch size 1).
+
+    Instead of re-scoring the whole cache on every refresh, each refresh only adds the importance of the
+    tokens it wrote. Every block keeps the head averaged importance summed over the block and over its first
+    and last quarter, which is all preselect_block_scores needs. Older refreshes are weighted down by `decay`
+    per refresh of the layer; the decay is applied lazily when a block is touched or read, so an update costs
+    O(new tokens) and a read O(blocks). Decode steps add their token to the current refresh without
+    starting a new one, so a long generation doesn't decay the prompt away.
+    """
+
+    def __init__(self, layer_num: int, block_num: int, block_size: int, decay: float = 1.0):
+        self.block_size = block_size
+        self.edge = block_size // 4
+        self.decay = decay
+        # [layer, block, (whole block, first quarter, last quarter)]
+        self.stats = torch.zeros((layer_num, block_num, 3), dtype=torch.float32)
+        self.last_step = torch.zeros((layer_num, block_num), dtype=torch.int64)
+        self.steps = torch.zeros((layer_num,), dtype=torch.int64)
+
+    def reset(self, layer_idx: int | None = None):
+        if layer_idx is None:
+            self.stats.zero_()
+            self.last_step.zero_()
+            self.steps.zero_()
+            return
+        self.stats[layer_idx].zero_()
+        self.last_step[layer_idx].zero_()
+        self.steps[layer_idx] = 0
+
+    def _decay_factor(self, layer_idx: int, begin: int, end: int) -> torch.Tensor:
+        age = self.steps[layer_idx] - self.last_step[layer_idx, begin:end]
+        return torch.pow(torch.tensor(self.decay, dtype=torch.float32), age.to(torch.float32))
+
+    def update(self, layer_idx: int, importance: torch.Tensor, offset: int, refresh: bool = True):
+        """importance: [n, q_head_num] importance of tokens [offset, offset + n), added to the last refresh
+        instead of a new one when `refresh` is False"""
+        n = importance.size(0)
+        if n == 0:
+            return
+        if refresh:
+            self.steps[layer_idx] += 1
+        begin, end = offset // self.block_size, (offset + n - 1) // self.block_size + 1
+        stats = self.stats[layer_idx]
+        if self.decay != 1.0:
+            stats[begin:end] *= self._decay_factor(layer_idx, begin, end).unsqueeze(-1)
+        self.last_step[layer_idx, begin:end] = self.steps[layer_idx]
+
+        token_importance = importance.to(torch.float32).mean(dim=-1)
+        positions = torch.arange(offset, offset + n)
+        blocks = positions // self.block_size
+        in_block = positions % self.block_size
+        stats[:, 0].index_add_(0, blocks, token_importance)
+        first = in_block < self.edge
+        stats[:, 1].index_add_(0, blocks[first], token_importance[first])
+        last = in_block >= self.block_size - self.edge
+        stats[:, 2].index_add_(0, blocks[last], token_importance[last])
+
+    def scores(self, layer_idx: int, block_num: int) -> torch.Tensor:
+        """[block_num] decayed block scores, same widening as preselect_block_scores."""
+        stats = self.stats[layer_idx, :block_num]
+        if self.decay != 1.0:
+            stats = stats * self._decay_factor(layer_idx, 0, block_num).unsqueeze(-1)
+        scores = stats[:, 0].clone()
+        scores[:-1] += stats[1:, 1]
+        scores[1:] += stats[:-1, 2]
+        return scores / (self.block_size + 2 * self.edge)
+
+
 class DynamicScaledDotProductAttention:
     remaining_length: int
 
@@ -53,12 +202,17 @@ class DynamicScaledDotProductAttention:
         preselect_block_count: int = 96,
         prefill_chunk_size: int = 20480,
         use_attn_sparsity: bool = False,
+        importance_decay: float = 1.0,
     ):
         # assert anchor_num == 1
         # assert anchor_type == "DYNAMIC"
         self.remaining_length = 0
-        valid_anchor_types = ["DYNAMIC", "FIXED", "BLOCK_MEAN", "BLOCK_MAX", "QUEST"]
+        valid_anchor_types = ["DYNAMIC", "DYNAMIC_INCREMENTAL", "FIXED", "BLOCK_MEAN", "BLOCK_MAX", "QUEST"]
         assert anchor_type in valid_anchor_types
+        # DYNAMIC anchors, but the importance is kept incrementally by BlockImportance
+        self.incremental_importance = anchor_type == "DYNAMIC_INCREMENTAL"
+        if self.incremental_importance:
+            anchor_type = "DYNAMIC"
         if anchor_type == "QUEST":
             assert anchor_num == 2
         elif anchor_type != "FIXED" and anchor_type != "DYNAMIC":
@@ -188,6 +342,10 @@ class DynamicScaledDotProductAttention:
             )
             self.preselect_block_num = 0  # block_num before preselect
             self.evict_tokens = 0
+            if self.incremental_importance:
+                self.block_importance = BlockImportance(
+                    self.layer_num, self.block_num, self.block_size, importance_decay
+                )
 
         self.cpu_infer = CPUInfer(threads_num)
         self.local_thread = CPUInferKVCache(
@@ -232,6 +390,9 @@ class DynamicScaledDotProductAttention:
         self.triu_mask = mask ^ 1
 
         self.generate_token_idx = 0
+        # a KVSnapshot restored by load_snapshot(), drained layer by layer on the first decode step
+        self.snapshot = None
+        self.snapshot_layers = set()
 
     def get_attn_score_one_block(
         self,
@@ -244,32 +405,14 @@ class DynamicScaledDotProductAttention:
         mask_mode: str | None = None,
         use_softmax: bool = True,
     ):
-        n_rep = self.q_head_num // self.kv_head_num
         importance = self.cache_importance.view(-1, self.q_head_num)
         importance = importance.narrow(0, batch_idx * max_block_num + offset, width)
-        n_gqa_ = self.q_head_num // self.kv_head_num 
-        for head_idx in range(self.q_head_num):
-            key_item = key[..., head_idx // n_gqa_, :].view(key.size(0), -1)
-            qk = torch.einsum(
-                "qd,kd->qk", query[:,head_idx,:], key_item
-            )  # (num_attention_heads, len_q, len_k)
-
-            if mask_mode == "tril":
-                mask = self.tril_mask
-                mask = mask[0, -qk.size(-2) :, -qk.size(-1) :]
-                qk = qk * mask
-            elif mask_mode == "triu":
-                mask = self.triu_mask
-                mask = mask[0, -qk.size(-2) :, -qk.size(-1) :]
-                qk = qk * mask
-
-            if use_softmax:
-                qk = torch.nn.functional.softmax(
-                    qk / math.sqrt(self.head_dim), dim=-1, dtype=torch.float32
-                ).to(torch.float16)
-              
-            qk = torch.sum(qk, dim=-2)
-            importance[...,head_idx] += qk
+        mask = None
+        if mask_mode == "tril":
+            mask = self.tril_mask[0]
+        elif mask_mode == "triu":
+            mask = self.triu_mask[0]
+        attn_score_one_block(importance, query, key, self.head_dim, mask, use_softmax)
 
     def get_preselect_block_table_and_attn_score(
         self,
@@ -281,6 +424,10 @@ class DynamicScaledDotProductAttention:
         key: torch.Tensor,
         union_with_last_layer: bool = True,
     ):
+        if self.incremental_importance:
+            return self.update_importance_incremental(
+                layer_idx, batch_size, offset, width, query, key, union_with_last_layer
+            )
         max_seqs_len = offset.max().item() + width
         max_block_num = (max_seqs_len + self.block_size - 1) // self.block_size
 
@@ -312,17 +459,7 @@ class DynamicScaledDotProductAttention:
                     batch_size, self.prefill_block_num, self.block_size, self.q_head_num
                 )
 
-                importance_r = importance_cache[:, 1:, : self.block_size // 4]
-                pad_r = torch.zeros_like(importance_r[:, :1])
-                importance_r = torch.cat((importance_r, pad_r), dim=1)
-                importance_l = importance_cache[:, :-1, -self.block_size // 4 :]
-                pad_l = torch.zeros_like(importance_l[:, :1])
-                importance_l = torch.cat((pad_l, importance_l), dim=1)
-                importance = torch.cat(
-                    (importance_l, importance_cache, importance_r), dim=2
-                )
-                importance = importance.mean(dim=-1)
-                importance = importance.mean(dim=-1)
+                importance = preselect_block_scores(importance_cache, self.block_size)
                 # importance: (batch_size, max_block_num)
                 topk = min(self.preselect_block_count, self.prefill_block_num)
                 values, indices = torch.topk(
@@ -336,12 +473,8 @@ class DynamicScaledDotProductAttention:
                     :topk,
                 ].copy_(indices)
 
-                if union_with_last_layer and layer_idx == 31:
-                    for tmp_layer_idx in range(self.layer_num - 1):
-                        for i in range(1, min(topk, 6)):
-                            x = self.preselect_block_table[-1, i]
-                            if x not in self.preselect_block_table[tmp_layer_idx]:
-                                self.preselect_block_table[tmp_layer_idx, topk - i] = x
+                if union_with_last_layer and layer_idx == self.layer_num - 1:
+                    merge_preselect_block_table(self.preselect_block_table, layer_idx, topk)
         if self.anchor_type == "DYNAMIC":
             importance_cache = self.cache_importance.narrow(
                 0, 0, max_block_num * batch_size
@@ -397,6 +530,105 @@ class DynamicScaledDotProductAttention:
             importance_cache, device="cpu", pin_memory=use_pin_memory
         )
 
+    def update_importance_incremental(
+        self,
+        layer_idx: int,
+        batch_size: int,
+        offset: torch.Tensor,
+        width: int,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        union_with_last_layer: bool = True,
+    ):
+        """DYNAMIC_INCREMENTAL version of get_preselect_block_table_and_attn_score.
+
+        Called for every prefill chunk. Only the keys written by the chunk, [offset, offset + width), are
+        scored against the chunk's last queries, fed to block_importance and pushed to the kvcache; older
+        blocks keep their decayed importance. A prompt that fits one chunk scores the same keys as the full
+        path.
+        """
+        assert batch_size == 1, "incremental importance only supports batch size 1"
+        begin = offset[0].item()
+        max_block_num = (begin + width + self.block_size - 1) // self.block_size
+
+        self.get_attn_score_one_block(
+            0,
+            max_block_num,
+            query[0][-128:],
+            key[0][begin : begin + width],
+            begin,
+            width,
+            mask_mode=None,
+        )
+        importance_rows = self.cache_importance.view(-1, self.q_head_num).narrow(0, begin, width)
+
+        if self.preselect_block:
+            if begin == 0:
+                # new sequence
+                self.block_importance.reset(layer_idx)
+            self.block_importance.update(layer_idx, importance_rows, begin)
+            self.prefill_block_num = max(
+                0, max_block_num - self.local_windows_len // self.block_size
+            )
+            self.evict_tokens = (
+                max(self.prefill_block_num - self.preselect_block_count, 0)
+                * self.block_size
+            )
+            if self.prefill_block_num != 0:
+                importance = self.block_importance.scores(layer_idx, self.prefill_block_num)
+                topk = min(self.preselect_block_count, self.prefill_block_num)
+                indices = torch.topk(importance, k=topk).indices
+                self.preselect_block_table[layer_idx, :topk].copy_(indices)
+
+                if union_with_last_layer and layer_idx == self.layer_num - 1:
+                    merge_preselect_block_table(self.preselect_block_table, layer_idx, topk)
+
+        # update_importance only reads rows [offset, offset + width), on the cpu the cache is handed over
+        # as is, otherwise just those rows go through a pinned staging buffer
+        token_num = max_block_num * self.block_size
+        if self.cache_importance.device.type == "cpu":
+            importance_cache_cpu = self.cache_importance.view(-1, self.q_head_num)[:token_num]
+        else:
+            if getattr(self, "importance_staging", None) is None:
+                self.importance_staging = torch.zeros(
+                    (self.block_num * self.block_size, self.q_head_num),
+                    dtype=torch.float16,
+                    pin_memory=torch.cuda.is_available(),
+                )
+            self.importance_staging[begin : begin + width].copy_(importance_rows)
+            importance_cache_cpu = self.importance_staging[:token_num]
+        importance_cache_cpu = importance_cache_cpu.view(1, token_num, self.q_head_num)
+
+        block_table_cpu = self.prefix_block_table[:, :max_block_num].to("cpu")
+        offset_cpu = offset.contiguous().to("cpu")
+        task = self.local_thread.update_importance(
+            importance_cache_cpu,
+            layer_idx,
+            block_table_cpu,
+            max_block_num,
+            offset_cpu,
+            width,
+        )
+        if torch.cuda.is_available():
+            self.cpu_infer.submit_with_cuda_stream(torch.cuda.current_stream().cuda_stream, task)
+            self.cpu_infer.sync_with_cuda_stream(torch.cuda.current_stream().cuda_stream)
+        else:
+            self.cpu_infer.submit(task)
+            self.cpu_infer.sync()
+        # the next refresh accumulates into these rows again
+        importance_rows.zero_()
+
+    def update_importance_decode(self, layer_idx: int, position: int):
+        """DYNAMIC_INCREMENTAL decode step: the token just written at `position` gets the attention weight the
+        current query gives it, from the lse attn_with_kvcache returned, so only its block is touched and
+        the cache isn't read. The next prefill chunk then ranks the generated blocks with the prompt."""
+        n_gqa = self.q_head_num // self.kv_head_num
+        query = self.q_in_cpu[0, 0].float().view(self.kv_head_num, n_gqa, self.head_dim)
+        key = self.k_in_cpu[0, 0].float()
+        scores = torch.einsum("kgd,kd->kg", query, key).flatten() / math.sqrt(self.head_dim)
+        importance = torch.exp(scores - self.lse_cpu[0, 0])
+        self.block_importance.update(layer_idx, importance.view(1, -1), position, refresh=False)
+
     # key: [bsz, past_len, head_num, head_dim] float16
     # query: [bsz, q_len, q_head_num, head_dim] float16
     def get_attn_score(
@@ -744,7 +976,8 @@ class DynamicScaledDotProductAttention:
                 value_states,
             )
 
-            if last_chunk and (self.anchor_type == "DYNAMIC" or self.preselect_block):
+            # the incremental importance is fed chunk by chunk, the full path rescans the cache once
+            if (last_chunk or self.incremental_importance) and (self.anchor_type == "DYNAMIC" or self.preselect_block):
                 self.get_preselect_block_table_and_attn_score(
                     layer_idx,
                     bsz,
@@ -810,6 +1043,11 @@ class DynamicScaledDotProductAttention:
 
         elif mode == "generate":
             assert self.generate_token_idx >= 0
+            if self.snapshot is not None and layer_idx not in self.snapshot_layers:
+                self.restore_snapshot_layer(layer_idx)
+                if len(self.snapshot_layers) == self.layer_num:
+                    self.snapshot.close()
+                    self.snapshot = None
             # 判断是否可以使用non_blocking
             use_non_blocking = torch.cuda.is_available()
             
@@ -921,12 +1159,73 @@ class DynamicScaledDotProductAttention:
                     )
                 else:
                     self.cpu_infer.sync()
+                if self.preselect_block and self.incremental_importance:
+                    self.update_importance_decode(layer_idx, past_len)
                 #            print("submit_with_cuda_stream finished\n")
                 self.output_cuda.copy_(self.output_cpu, non_blocking=use_non_blocking)
                 # 强制内存连续
                 self.output_cuda = self.output_cuda.contiguous()
                 return self.output_cuda.transpose(1, 2)
 
+    def save_snapshot(self, path: str, length: int):
+        """
+        Write a KVSnapshot of the first `length` tokens: the fp16 blocks, anchors and importance of every
+        layer, plus the preselect table and position metadata that decode needs to resume.
+        """
+        cur_block_num = (length + self.block_size - 1) // self.block_size
+        meta = {"generate_token_idx": self.generate_token_idx}
+        if self.preselect_block:
+            meta.update(prefill_block_num=getattr(self, "prefill_block_num", 0), evict_tokens=self.evict_tokens)
+        snapshot = KVSnapshot.create(
+            path, self.snapshot_geometry(), length, meta,
+            self.preselect_block_count if self.preselect_block else 0,
+        )
+        try:
+            self.dump_snapshot_blocks(snapshot, cur_block_num)
+        except BaseException:
+            # the views into the mapping live on in the traceback, drop the file and leave the map to gc
+            snapshot.file.close()
+            os.remove(snapshot.tmp_path)
+            raise
+        snapshot.close()
+
+    def dump_snapshot_blocks(self, snapshot: KVSnapshot, cur_block_num: int):
+        anchor = torch.from_numpy(snapshot.section("anchor"))
+        importance = torch.from_numpy(snapshot.section("importance"))
+        for layer_idx in range(self.layer_num):
+            for block_idx in range(cur_block_num):
+                k, v = snapshot.kv(layer_idx, block_idx)
+                self.cpu_infer.submit(self.local_thread.get_kvcache_one_block_fp16(
+                    torch.from_numpy(k), torch.from_numpy(v), layer_idx, block_idx))
+                self.cpu_infer.submit(self.local_thread.get_anchor_one_block(
+                    anchor[layer_idx, block_idx], layer_idx, block_idx))
+                self.cpu_infer.submit(self.local_thread.get_importance_one_block(
+                    importance[layer_idx, block_idx], layer_idx, block_idx))
+            self.cpu_infer.sync()
+        if self.preselect_block:
+            torch.from_numpy(snapshot.section("preselect")).copy_(self.preselect_block_table)
+
+    def load_snapshot(self, path: str, length: int | None = None):
+        """
+        Map a snapshot written by `save_snapshot`. Only the header and the position metadata are read here, the
+        blocks a layer attends to are pushed into the CPUInfer cache by its first decode step.
+        """
+        snapshot = KVSnapshot.open(path)
+        snapshot.check_geometry(self.snapshot_geometry())
+        if length is not None and length != snapshot.length:
+            raise ValueError(f"kv snapshot {path} holds {snapshot.length} tokens, not {length}")
+        meta = snapshot.meta
+        self.generate_token_idx = meta["generate_token_idx"]
+        if self.preselect_block:
+            if "prefill_block_num" not in meta:
+                raise ValueError(f"kv snapshot {path} was saved without block preselection")
+            self.prefill_block_num = meta["prefill_block_num"]
+            self.evict_tokens = meta["evict_tokens"]
+            self.preselect_block_table.copy_(torch.from_numpy(snapshot.section("preselect")))
+        self.local_thread.update_cache_total_len(snapshot.length)
+        self.snapshot = snapshot
+        self.snapshot_layers = set()
+
     def save(self, path: str, length: int):
         cur_block_num = (length + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[0, :cur_block_num].to("cpu")
@@ -948,6 +1247,47 @@ class DynamicScaledDotProductAttention:
         )
         self.cpu_infer.sync()
 
+    def snapshot_geometry(self) -> dict:
+        return {
+            "layer_num": self.layer_num,
+            "kv_head_num": self.kv_head_num,
+            "q_head_num": self.q_head_num,
+            "head_dim": self.head_dim,
+            "block_size": self.block_size,
+            "anchor_num": self.anchor_num,
+            "anchor_type": self.anchor_type,
+            "kv_type": self.kv_type,
+        }
+
+    def snapshot_blocks(self, layer_idx: int) -> list[int]:
+        """Blocks of the snapshot that decode of `layer_idx` reads."""
+        block_num = self.snapshot.block_num
+        if (
+            layer_idx < self.dense_layer_num
+            or not self.preselect_block
+            or self.preselect_block_count >= self.prefill_block_num
+        ):
+            return list(range(block_num))
+        # the same table apply() builds: the preselected blocks, then the local window
+        local = range(self.prefill_block_num, min(self.prefill_block_num + self.local_block_num, block_num))
+        return sorted(set(self.preselect_block_table[layer_idx].tolist()) | set(local))
+
+    def restore_snapshot_layer(self, layer_idx: int):
+        """Fault in the blocks `layer_idx` attends to and push them into the CPUInfer cache."""
+        anchor = torch.from_numpy(self.snapshot.section("anchor")[layer_idx])
+        importance = torch.from_numpy(self.snapshot.section("importance")[layer_idx])
+        blocks = self.snapshot_blocks(layer_idx)
+        self.snapshot.prefetch(layer_idx, blocks)
+        for block_idx in blocks:
+            k, v = self.snapshot.kv(layer_idx, block_idx)
+            self.cpu_infer.submit(self.local_thread.update_kvcache_one_block_fp16(
+                torch.from_numpy(k), torch.from_numpy(v), layer_idx, block_idx))
+            self.cpu_infer.submit(self.local_thread.update_anchor_one_block(anchor[block_idx], layer_idx, block_idx))
+            self.cpu_infer.submit(self.local_thread.update_importance_one_block(
+                importance[block_idx], layer_idx, block_idx))
+        self.cpu_infer.sync()
+        self.snapshot_layers.add(layer_idx)
+
     def test_gradient(self, query, key, value):
         # 梯度检查
         torch.autograd.gradcheck(fn, (query, key, value), eps=1e-3, atol=1e-2)
@@ -34,7 +34,10 @@ from transformers.configuration_utils import PretrainedConfig
 from abc import ABC, abstractmethod
 from ktransformers.operators.linear import KLinearMarlin, KLinearTorch, KTransformersLinear
 import time
-from ktransformers.operators.cpuinfer import CPUInfer
+from ktransformers.operators.cpuinfer import CPUInfer, NodeCPUInfer
+from ktransformers.util.routing_stats import record_routing
+from ktransformers.util.expert_prefetch import expert_prefetch
+from ktransformers.util.expert_placement import PLACEMENT_CUDA_GRAPH_ERROR
 
 
 def deduplicate_and_sort(lst):
@@ -117,6 +120,23 @@ class KExpertsBase(ABC):
         return tensors
 
 
+class PlacedExpertsShard:
+    """The experts of one layer that live on one numa node, computed by the worker pool of `compute_node`."""
+    def __init__(self, node: int, compute_node: int, experts: list[int], n_routed_experts: int, moe, cpu_infer: NodeCPUInfer, buffers: tuple):
+        self.node = node
+        self.compute_node = compute_node
+        self.experts = experts
+        self.moe = moe
+        self.cpu_infer = cpu_infer
+        # keep the node local buffers alive as long as the C++ MOE points into them
+        self.buffers = buffers
+        self.owner = torch.zeros(n_routed_experts, dtype=torch.bool)
+        self.owner[experts] = True
+        # global expert id -> index inside this shard, only looked up for the experts the shard owns
+        self.local_index = torch.zeros(n_routed_experts, dtype=torch.long)
+        self.local_index[experts] = torch.arange(len(experts), dtype=torch.long)
+
+
 class KExpertsCPU(KExpertsBase):
     input_tensor_cpu:Tensor = None
     expert_ids_cpu:Tensor = None
@@ -142,6 +162,9 @@ class KExpertsCPU(KExpertsBase):
         self.n_routed_experts = n_routed_experts
         self.out_device = out_device
         self.backend = kwargs.get("backend", "llamafile")
+        self.shards: list[PlacedExpertsShard] | None = None
+        # shards submitted by submit_for_one_decode, collected by sync_for_one_decode
+        self.placed_pending = None
 
     def load(self, w: dict | nn.Parameter | tuple | None = None, device:str|None = None, warmup:bool = False):
         if device:
@@ -186,7 +209,9 @@ class KExpertsCPU(KExpertsBase):
         n_routed_experts = self.n_routed_experts
         self.cpu_infer = KExpertsCPU.CPU_INFER
         # n_routed_experts = len(self.orig_module)
-        if self.backend == "llamafile":
+        if self.backend == "llamafile" and Config().expert_placement_enable:
+            self.load_placed_experts()
+        elif self.backend == "llamafile":
             moe_config = MOEConfig(
                 n_routed_experts,
                 self.config.num_experts_per_tok,
@@ -242,7 +267,11 @@ class KExpertsCPU(KExpertsBase):
             self.cpu_infer.sync()
         # print(n_routed_experts, hidden_size, moe_intermediate_size)
         num_experts_per_tok = self.config.num_experts_per_tok
-        if warmup:
+        if warmup and self.shards is not None:
+            for shard in self.shards:
+                shard.cpu_infer.submit(shard.moe.warm_up())
+                shard.cpu_infer.sync()
+        elif warmup:
             self.cpu_infer.submit(self.moe.warm_up())
             self.cpu_infer.sync()
         if self.out_device not in KExpertsCPU.output_gpu_map:
@@ -267,6 +296,14 @@ class KExpertsCPU(KExpertsBase):
     def submit_for_one_decode(self, input_tensor, expert_ids, weights, bsz_tensor=None, cuda_graph_idx=0):
         if bsz_tensor is None:
             bsz_tensor = torch.ones(1, device=input_tensor.device, dtype=torch.int32)
+        if self.shards is not None:
+            if torch.cuda.is_current_stream_capturing():
+                raise RuntimeError(PLACEMENT_CUDA_GRAPH_ERROR)
+            input_tensor = input_tensor.reshape(1, -1).contiguous().cpu()
+            self.placed_pending = (self.submit_placed(input_tensor, expert_ids.reshape(1, -1).contiguous().cpu(),
+                                                      weights.reshape(1, -1).contiguous().to(torch.float32).cpu(),
+                                                      bsz_tensor.contiguous().cpu()), input_tensor)
+            return
         if cuda_graph_idx != -1:
             KExpertsCPU.input_tensor_cpu[cuda_graph_idx].copy_(input_tensor, non_blocking=True)
             KExpertsCPU.expert_ids_cpu[cuda_graph_idx].copy_(expert_ids, non_blocking=True)
@@ -282,6 +319,10 @@ class KExpertsCPU(KExpertsBase):
         
 
     def sync_for_one_decode(self, cuda_graph_idx=0):
+        if self.shards is not None:
+            pending, input_tensor = self.placed_pending
+            self.placed_pending = None
+            return self.sync_placed(pending, input_tensor).to(device=object.__getattribute__(self, "out_device"))
         if cuda_graph_idx != -1:
             self.cpu_infer.sync_with_cuda_stream(torch.cuda.current_stream(self.out_device).cuda_stream)
             KExpertsCPU.output_gpu_map[self.out_device][cuda_graph_idx].copy_(KExpertsCPU.output_cpu[cuda_graph_idx], non_blocking=True)
@@ -297,6 +338,8 @@ class KExpertsCPU(KExpertsBase):
         if bsz_tensor is None:
             bsz_tensor = torch.tensor([input_tensor.size(0)], device=input_tensor.device, dtype=torch.int32)
         if torch.cuda.is_current_stream_capturing():
+            if self.shards is not None:
+                raise RuntimeError(PLACEMENT_CUDA_GRAPH_ERROR)
             if cuda_graph_idx != -1:
                 KExpertsCPU.input_tensor_cpu[cuda_graph_idx].copy_(input_tensor, non_blocking=True)
                 KExpertsCPU.expert_ids_cpu[cuda_graph_idx].copy_(expert_ids, non_blocking=True)
@@ -321,11 +364,91 @@ class KExpertsCPU(KExpertsBase):
             expert_ids = expert_ids.contiguous().cpu()
             weights = weights.contiguous().to(torch.float32).cpu()
             bsz_tensor = bsz_tensor.contiguous().cpu()
+            if self.shards is not None:
+                output = self.forward_placed(input_tensor, expert_ids, weights, bsz_tensor)
+                return output.to(device=object.__getattribute__(self, "out_device"))
             output = torch.empty_like(input_tensor).contiguous()
             self.cpu_infer.submit(self.moe.forward(expert_ids.size(0), expert_ids.size(1), expert_ids.data_ptr(), weights.data_ptr(), input_tensor.data_ptr(), output.data_ptr(), bsz_tensor.data_ptr()))
             self.cpu_infer.sync()
             return output.to(device=object.__getattribute__(self, "out_device"))
-    
+
+    def load_placed_experts(self):
+        """Split the experts of this layer into per numa node MOEs following the global placement plan."""
+        from ktransformers.util.expert_placement import ExpertPlacementPlanner, gather_experts
+        from ktransformers.util.routing_stats import layer_idx_from_key
+        planner = ExpertPlacementPlanner.get_instance()
+        n_routed_experts = self.n_routed_experts
+        expert_bytes = (self.gate.nbytes + self.up.nbytes + self.down.nbytes) // n_routed_experts
+        placement = planner.get_placement(self.config.num_hidden_layers, n_routed_experts, expert_bytes)
+        self.shards = []
+        for node_idx, experts in placement.groups(layer_idx_from_key(self.key)).items():
+            node = planner.topology.get_node(node_idx)
+            gate = gather_experts(self.gate, experts, n_routed_experts, node, f"{self.key}.gate.node{node_idx}")
+            up = gather_experts(self.up, experts, n_routed_experts, node, f"{self.key}.up.node{node_idx}")
+            down = gather_experts(self.down, experts, n_routed_experts, node, f"{self.key}.down.node{node_idx}")
+            cpus, thread_num = planner.topology.compute_threads(node.compute_node)
+            cpu_infer = NodeCPUInfer.get_pool(node.compute_node, cpus, thread_num)
+            moe_config = MOEConfig(
+                len(experts),
+                self.config.num_experts_per_tok,
+                self.config.hidden_size,
+                self.config.moe_intermediate_size,
+                64,
+                10,
+                1024,
+                gate.ctypes.data,
+                up.ctypes.data,
+                down.ctypes.data,
+                self.gate_type,
+                self.up_type,
+                self.down_type,
+                30, # TODO: get from model.dtype
+            )
+            self.shards.append(PlacedExpertsShard(node_idx, node.compute_node, experts, n_routed_experts,
+                                                  MOE(moe_config), cpu_infer, (gate, up, down)))
+        self.moe = None
+
+    def forward_placed(self, input_tensor, expert_ids, weights, bsz_tensor):
+        return self.sync_placed(self.submit_placed(input_tensor, expert_ids, weights, bsz_tensor), input_tensor)
+
+    def submit_placed(self, input_tensor, expert_ids, weights, bsz_tensor) -> list:
+        """Submit every shard to its own node pool with only the routed experts it owns. If every row owns the
+        same number of them (always the case in decode) the shard runs the batch as is, otherwise it gets one
+        row per (token, owned expert) pair with k = 1, so no row computes an expert it isn't routed to."""
+        pending = []
+        for shard in self.shards:
+            owned = shard.owner[expert_ids]
+            counts = owned.sum(dim=-1)
+            k = int(counts.max())
+            if k == 0:
+                continue
+            if int(counts.min()) == k:
+                rows, shard_input, shard_bsz = None, input_tensor, bsz_tensor
+                shard_ids = shard.local_index[expert_ids[owned].view(-1, k)].contiguous()
+                shard_weights = weights[owned].view(-1, k).contiguous()
+            else:
+                rows, slots = owned.nonzero(as_tuple=True)
+                k, shard_input = 1, input_tensor[rows].contiguous()
+                shard_bsz = torch.tensor([rows.size(0)], dtype=torch.int32)
+                shard_ids = shard.local_index[expert_ids[rows, slots]].view(-1, 1).contiguous()
+                shard_weights = weights[rows, slots].view(-1, 1).contiguous()
+            output = torch.empty_like(shard_input)
+            shard.cpu_infer.submit(shard.moe.forward(shard_ids.size(0), k, shard_ids.data_ptr(), shard_weights.data_ptr(), shard_input.data_ptr(), output.data_ptr(), shard_bsz.data_ptr()))
+            pending.append((shard, rows, (shard_ids, shard_weights, shard_input, shard_bsz), output))
+        return pending
+
+    def sync_placed(self, pending: list, input_tensor):
+        """Wait for the shards `submit_placed` submitted and sum their outputs into the token rows."""
+        for cpu_infer in {shard.compute_node: shard.cpu_infer for shard, *_ in pending}.values():
+            cpu_infer.sync()
+        output = torch.zeros_like(input_tensor)
+        for _, rows, _, shard_output in pending:
+            if rows is None:
+                output += shard_output
+            else:
+                output.index_add_(0, rows, shard_output)
+        return output
+
     def unload(self):
         return
 
@@ -725,6 +848,8 @@ class KQwen2MoeSparseMoeBlock(BaseInjectedModule, Qwen2MoeSparseMoeBlock):
 
         routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
         routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+        record_routing(self.key, selected_experts, self.config)
+        expert_prefetch(self, hidden_states, selected_experts)
         if self.norm_topk_prob:
             routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         # we cast back to the input dtype
@@ -824,6 +949,8 @@ class KDeepseekV2MoE(BaseInjectedModule, DeepseekV2MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight, aux_loss = self.gate(hidden_states)
+        record_routing(self.key, topk_idx, self.config)
+        expert_prefetch(self, hidden_states, topk_idx)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
         if sequence_length == 1 and hasattr(self.experts.generate_experts, "submit_for_one_decode") and torch.cuda.is_current_stream_capturing():
@@ -923,6 +1050,8 @@ class KDeepseekV3MoE(BaseInjectedModule, DeepseekV3MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight = self.gate(hidden_states)
+        record_routing(self.key, topk_idx, self.config)
+        expert_prefetch(self, hidden_states, topk_idx)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
         # only for generate phase
@@ -1032,6 +1161,8 @@ class KMistralSparseMoEBlock(BaseInjectedModule, MixtralSparseMoeBlock):
 
         routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
         routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+        record_routing(self.key, selected_experts, self.config)
+        expert_prefetch(self, hidden_states, selected_experts)
         routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         # we cast back to the input dtype
         routing_weights = routing_weights.to(hidden_states.dtype)
@@ -1122,6 +1253,8 @@ class KDeepseekV3MoEV2(BaseInjectedModule, DeepseekV3MoE):
         orig_shape = hidden_states.shape
         sequence_length = orig_shape[1]
         topk_idx, topk_weight = self.gate(hidden_states)
+        record_routing(self.key, topk_idx, self.config)
+        expert_prefetch(self, hidden_states, topk_idx)
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         
 
@@ -1302,6 +1435,7 @@ class KQwen2MoeSparseMoeBlockV2(BaseInjectedModule, Qwen2MoeSparseMoeBlock):
 
         routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
         routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+        record_routing(self.key, selected_experts, self.config)
         if self.norm_topk_prob:
             routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         # we cast back to the input dtype
@@ -1415,6 +1549,7 @@ class KQwen3MoeSparseMoeBlockV2(BaseInjectedModule, Qwen3MoeSparseMoeBlock):
 
         routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
         routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+        record_routing(self.key, selected_experts, self.config)
         if self.norm_topk_prob:
             routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
         # we cast back to the input dtype
@@ -83,6 +83,8 @@ class KMoEGateBase(ABC):
 
 
 class KMoEGate(BaseInjectedModule, KMoEGateBase):
+    load_concurrently = True
+
     def __init__(
         self,
         key: str,
@@ -123,6 +125,8 @@ class KMoEGate(BaseInjectedModule, KMoEGateBase):
 
 
 class KMoEGateQwen2Moe(BaseInjectedModule, KMoEGateBase):
+    load_concurrently = True
+
     def __init__(
         self,
         key: str,
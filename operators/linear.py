@@ -815,6 +815,11 @@ class KTransformersLinear(BaseInjectedModule, KLinearBase):
             self.generate_linear = None
         self.mode = InferenceState.UNLOAD
 
+    @property
+    def load_concurrently(self) -> bool:
+        # KLinearCPUInfer instances share one CPUInfer task queue
+        return not any(isinstance(linear, KLinearCPUInfer) for linear in (self.prefill_linear, self.generate_linear))
+
     def forward(self, x, bsz_tensor=None):
         if self.mode == InferenceState.PREFILL:
             assert self.prefill_linear is not None, "cpu linear is not initialized"
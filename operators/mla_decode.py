@@ -0,0 +1,95 @@
+'''
+Description  : Length-aware absorbed MLA attention for CPU decode and chunked prefill. Only the
+               latent cache pages up to the last query are read, the context is cut into splits that
+               one batched matmul scores in parallel (torch intra-op threads run over the splits),
+               each split keeps its own max and exp-sum, and the splits are merged with a log-sum-exp
+               reduction. Causality comes from the query positions, so no dense mask is built, and
+               cost follows the tokens in the cache rather than max_cache_len.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import math
+from typing import Optional
+import torch
+
+# masked scores: finite, so a split with no visible key gets weight exp(MASKED - max) = 0 in the merge
+MASKED = -1e30
+MIN_SPLIT = 256
+# scores held at once, [rows, keys] floats: prefill chunks walk the keys in passes of this size
+SCORE_BUDGET = 1 << 24
+
+
+def split_size_for(kv_len: int, page_size: int = 64, num_threads: Optional[int] = None) -> int:
+    """About one split per thread, at least MIN_SPLIT tokens, in whole pages."""
+    num_threads = torch.get_num_threads() if num_threads is None else num_threads
+    split = max(MIN_SPLIT, math.ceil(kv_len / max(num_threads, 1)))
+    return math.ceil(split / page_size) * page_size
+
+
+def split_partials(q: torch.Tensor, kv: torch.Tensor, kv_lora_rank: int, softmax_scale: float,
+                   key_begin: int, query_pos: Optional[torch.Tensor]):
+    """
+    q [bsz, rows, dim] against kv [bsz, splits, split_len, dim], keys of split s starting at
+    key_begin + s * split_len. Returns per split max, exp-sum and unnormalized output.
+    """
+    scores = torch.matmul(q.unsqueeze(1), kv.transpose(-1, -2)).float() * softmax_scale
+    # scores [bsz, splits, rows, split_len]
+    if query_pos is not None:
+        splits, split_len = kv.shape[1], kv.shape[2]
+        key_pos = key_begin + torch.arange(splits * split_len, device=kv.device).view(splits, 1, split_len)
+        scores = scores.masked_fill(key_pos > query_pos.view(1, -1, 1), MASKED)
+    max_score = scores.amax(dim=-1, keepdim=True)
+    probs = torch.exp(scores - max_score)
+    out = torch.matmul(probs.to(kv.dtype), kv[..., :kv_lora_rank]).float()
+    return max_score, probs.sum(dim=-1, keepdim=True), out
+
+
+def lse_merge(max_score: torch.Tensor, exp_sum: torch.Tensor, out: torch.Tensor):
+    """Log-sum-exp merge of the partials along dim 1 into one, keeping the dim."""
+    global_max = max_score.amax(dim=1, keepdim=True)
+    weight = torch.exp(max_score - global_max)
+    return global_max, (exp_sum * weight).sum(dim=1, keepdim=True), (out * weight).sum(dim=1, keepdim=True)
+
+
+def mla_prefix_attention(q_nope: torch.Tensor, q_pe: torch.Tensor, kv: torch.Tensor, kv_lora_rank: int,
+                         softmax_scale: float, cache_position: torch.Tensor,
+                         split_size: Optional[int] = None, max_score_elems: int = SCORE_BUDGET) -> torch.Tensor:
+    """
+    Absorbed MLA attention of q_len query tokens over the first kv.size(1) cached tokens.
+
+    q_nope [bsz, heads, q_len, kv_lora_rank] is already multiplied by q_absorb, q_pe [bsz, heads, q_len, rope_dim],
+    kv [bsz, kv_len, kv_lora_rank + rope_dim] the latent cache prefix. Query i sees the keys up to
+    cache_position[i], as the causal mask of forward_chunck does. Returns [bsz, heads, q_len, kv_lora_rank]
+    in the dtype of q_nope, before out_absorb.
+
+    Decode sized queries score every split in one pass. Prefill chunks have many more query rows, so the keys
+    are walked in passes of at most `max_score_elems` scores, merged online into a running max / exp-sum / output.
+    """
+    bsz, heads, q_len, _ = q_nope.shape
+    kv_len, dim = kv.shape[1], kv.shape[2]
+    rows = heads * q_len
+    q = torch.cat([q_nope, q_pe], dim=-1).to(kv.dtype).reshape(bsz, rows, dim)
+    # a single decode token sees the whole prefix, more need the causal cut
+    query_pos = None if q_len == 1 else cache_position.view(1, q_len).expand(heads, q_len).reshape(-1)
+    split_size = split_size_for(kv_len) if split_size is None else split_size
+    pass_len = max(split_size, max_score_elems // max(rows, 1) // split_size * split_size)
+
+    running = None
+    for begin in range(0, kv_len, pass_len):
+        end = min(begin + pass_len, kv_len)
+        full = (end - begin) // split_size
+        parts = []
+        if full:
+            split_end = begin + full * split_size
+            parts.append(split_partials(q, kv[:, begin:split_end].view(bsz, full, split_size, dim), kv_lora_rank,
+                                        softmax_scale, begin, query_pos))
+        if begin + full * split_size < end:
+            parts.append(split_partials(q, kv[:, begin + full * split_size:end].unsqueeze(1), kv_lora_rank,
+                                        softmax_scale, begin + full * split_size, query_pos))
+        if running is not None:
+            parts.append(running)
+        running = lse_merge(*(torch.cat(part, dim=1) for part in zip(*parts)))
+
+    _, exp_sum, out = running
+    attn_output = (out / exp_sum).squeeze(1)
+    return attn_output.view(bsz, heads, q_len, kv_lora_rank).to(q_nope.dtype)
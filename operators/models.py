@@ -12,6 +12,7 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 
 import inspect
 import math
+from functools import partial
 from typing import List, Optional, Tuple, Union
 import time
 import torch
@@ -58,6 +59,7 @@ from ktransformers.models.configuration_llama import LlamaConfig
 from ktransformers.operators.base_operator import BaseInjectedModule
 from ktransformers.util.utils import InferenceState
 from ktransformers.util.custom_gguf import GGUFLoader
+from ktransformers.util.layer_prefetch import LayerPrefetcher
 from transformers.configuration_utils import PretrainedConfig
 from ktransformers.models.modeling_llama import (
     LlamaDecoderLayer,
@@ -192,12 +194,14 @@ class KQwen2MoeModel(BaseInjectedModule):
         device: str = "cpu",
         per_layer_prefill_intput_threshold: int = 30000,  # if None, no per-layer prefill
         transfer_map: dict = None,
+        prefetch_layers: int = 0,  # layers loaded ahead in per-layer prefill, 0 loads each in turn
         **kwargs,
     ):
         BaseInjectedModule.__init__(
             self, key, gguf_loader, config, orig_module, device, **kwargs
         )
         self.per_layer_prefill_intput_threshold = per_layer_prefill_intput_threshold
+        self.prefetch_layers = prefetch_layers
         self.transfer_map = transfer_map
         self.stream_device_map = dict()
 
@@ -311,7 +315,18 @@ class KQwen2MoeModel(BaseInjectedModule):
         all_router_logits = () if output_router_logits else None
         next_decoder_cache = None
 
-        for i, decoder_layer in enumerate(self.layers):
+        layers = self.layers
+        prefetching = per_layer_prefill_flag and torch.cuda.is_available() and self.prefetch_layers > 0
+        if prefetching:
+            # the next layers load on a background thread while this one computes
+            layers = LayerPrefetcher(
+                self.layers,
+                partial(self.load_layer_to, target=InferenceState.PREFILL),
+                partial(self.load_layer_to, target=InferenceState.UNLOAD),
+                self.prefetch_layers,
+            )
+
+        for i, decoder_layer in enumerate(layers):
             if self.transfer_map is not None and i in self.transfer_map:
                 prev_stream = torch.cuda.current_stream() if torch.cuda.is_available() else None
                 cur_device = self.transfer_map[i]
@@ -358,7 +373,7 @@ class KQwen2MoeModel(BaseInjectedModule):
                     cache_position,
                 )
             else:
-                if per_layer_prefill_flag:
+                if per_layer_prefill_flag and not prefetching:
                     # print(f"to gpu")
                     try:
                         if torch.cuda.is_available():
@@ -386,7 +401,7 @@ class KQwen2MoeModel(BaseInjectedModule):
                         layer_outputs = (hidden_states, None, past_key_values)
                     else:
                         raise e
-                if per_layer_prefill_flag:
+                if per_layer_prefill_flag and not prefetching:
                     # print(f"to cpu")
                     try:
                         self.load_layer_to(decoder_layer, InferenceState.UNLOAD)
@@ -563,12 +578,14 @@ class KDeepseekV2Model(BaseInjectedModule):
         device: str = "cpu",
         per_layer_prefill_intput_threshold: int = 30000,  # if None, no per-layer prefill
         transfer_map: dict = None,
+        prefetch_layers: int = 0,  # layers loaded ahead in per-layer prefill, 0 loads each in turn
         **kwargs,
     ):
         BaseInjectedModule.__init__(
             self, key, gguf_loader, config, orig_module, device, **kwargs
         )
         self.per_layer_prefill_intput_threshold = per_layer_prefill_intput_threshold
+        self.prefetch_layers = prefetch_layers
         self.transfer_map = transfer_map
         self.stream_device_map = dict()
 
@@ -690,7 +707,18 @@ class KDeepseekV2Model(BaseInjectedModule):
         t_cpu = 0
         t_f = 0
 
-        for i, decoder_layer in enumerate(self.layers):
+        layers = self.layers
+        prefetching = per_layer_prefill_flag and torch.cuda.is_available() and self.prefetch_layers > 0
+        if prefetching:
+            # the next layers load on a background thread while this one computes
+            layers = LayerPrefetcher(
+                self.layers,
+                partial(self.load_layer_to, target=InferenceState.PREFILL),
+                partial(self.load_layer_to, target=InferenceState.UNLOAD),
+                self.prefetch_layers,
+            )
+
+        for i, decoder_layer in enumerate(layers):
             if self.transfer_map is not None and i in self.transfer_map:
                 prev_stream = torch.cuda.current_stream() if torch.cuda.is_available() else None
                 cur_device = self.transfer_map[i]
@@ -737,7 +765,7 @@ class KDeepseekV2Model(BaseInjectedModule):
                 )
             else:
                 t3 = time.time()
-                if per_layer_prefill_flag:
+                if per_layer_prefill_flag and not prefetching:
                     # print(f"to gpu")
                     try:
                         if torch.cuda.is_available():
@@ -761,7 +789,7 @@ class KDeepseekV2Model(BaseInjectedModule):
                     cache_position=cache_position,
                 )
                 t5 = time.time()
-                if per_layer_prefill_flag:
+                if per_layer_prefill_flag and not prefetching:
                     # print(f"to cpu")
                     try:
                         self.load_layer_to(decoder_layer, InferenceState.UNLOAD)
@@ -1076,6 +1104,7 @@ class KLlamaModel(BaseInjectedModule):
             token_step=0 if self.long_context_config["token_step"] is None else self.long_context_config["token_step"],
             prefill_chunk_size=self.long_context_config["chunk_size"],
             use_attn_sparsity=False,
+            importance_decay=Config().importance_decay,
         )
 
     def get_input_embeddings(self):
@@ -16,19 +16,88 @@ from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
 from ktransformers.util.utils import set_module, load_weights
 import itertools
 import copy
+import functools
+
+@functools.lru_cache(maxsize=None)
+def import_class(class_path: str) -> type:
+    import_path = class_path.split(".")
+    return getattr(__import__(".".join(import_path[:-1]), fromlist=[""]), import_path[-1])
+
+
+class OptimizeRules:
+    """
+    A rule list compiled once: the name regexes are precompiled, the match classes imported once, and
+    the rules that can apply to a module class are cached per class, so each module only runs the name
+    regexes of its candidate rules, in rule order.
+    """
+    def __init__(self, rule_list: List):
+        self.rules = []
+        for rule in rule_list:
+            match_meta = rule["match"]
+            if "class" not in match_meta and "name" not in match_meta:
+                raise Exception("match must have at least one of \"class\" and \"name\"")
+            if "replace" not in rule:
+                raise Exception("replace must be in rule")
+            module_cls = import_class(match_meta["class"]) if "class" in match_meta else None
+            pattern = re.compile(match_meta["name"]) if "name" in match_meta else None
+            self.rules.append((module_cls, pattern, rule))
+        self.candidates_by_type = {}
+
+    def candidates(self, module_type: type) -> List:
+        candidates = self.candidates_by_type.get(module_type)
+        if candidates is None:
+            candidates = [(pattern, rule) for module_cls, pattern, rule in self.rules
+                          if module_cls is None or issubclass(module_type, module_cls)]
+            self.candidates_by_type[module_type] = candidates
+        return candidates
+
+    def match(self, module: nn.Module, module_name: str):
+        """The first rule matching `module`, or None."""
+        for pattern, rule in self.candidates(type(module)):
+            if pattern is None or pattern.search(module_name) is not None:
+                return rule
+        return None
+
+
+class OptimizeConfigTrie:
+    """The per module optimize config, keyed by module path segments, walked alongside the module tree."""
+    __slots__ = ("meta", "children")
+
+    def __init__(self, meta=None):
+        self.meta = meta
+        self.children = {}
+
+    @classmethod
+    def build(cls, optimize_config: Mapping) -> "OptimizeConfigTrie":
+        root = cls()
+        for module_name, meta in optimize_config.items():
+            node = root
+            if module_name:
+                for segment in module_name.split("."):
+                    child = node.children.get(segment)
+                    if child is None:
+                        child = node.children[segment] = cls()
+                    node = child
+            node.meta = meta
+        return root
+
 
 def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader:GGUFLoader, prefix=''):
+    trie = local_optimization_dict
+    if not isinstance(trie, OptimizeConfigTrie):
+        trie = OptimizeConfigTrie.build(local_optimization_dict)
+        for segment in prefix.split(".")[:-1]:
+            trie = trie.children.get(segment, OptimizeConfigTrie())
     for name, child in module._modules.items():
         if child is not None:
             child_prefix = prefix + name
-            if child_prefix in local_optimization_dict:
-                inject_module_meta=local_optimization_dict[child_prefix]
+            node = trie.children.get(name)
+            if node is not None and node.meta is not None:
+                inject_module_meta=node.meta
                 if inject_module_meta["class"] != "default":
-                    import_path = inject_module_meta["class"].split(".")
-                    import_module_name = ".".join(import_path[:-1])
                     gguf_loader.tensor_device_map[inject_module_meta["key"]] = inject_module_meta["kwargs"] if "kwargs" in inject_module_meta else dict()
-                    import_class_name = import_path[-1]
-                    module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
+                    import_module_name, import_class_name = inject_module_meta["class"].rsplit(".", 1)
+                    module_cls=import_class(inject_module_meta["class"])
                     print(f"Injecting {child_prefix} as", import_module_name, ".", import_class_name)
                     inject_module=module_cls(key = inject_module_meta["key"], gguf_loader = gguf_loader, config = model_config, orig_module=child, device = "cpu", **inject_module_meta["kwargs"])
                     set_module(module, name, inject_module)
@@ -38,8 +107,7 @@ def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader
                 else:
                     raise Exception("inject_module_meta[\"class\"] must be \"default\" or a class path")
                 child_prefix += "."
-                child_optimization_dict = {k: v for k, v in local_optimization_dict.items() if k.startswith(child_prefix)}
-                inject(child, child_optimization_dict, model_config, gguf_loader, child_prefix)
+                inject(child, node, model_config, gguf_loader, child_prefix)
 
 def del_meta(module:nn.Module):
     #print("default loading weights", prefix)
@@ -53,41 +121,26 @@ def del_meta(module:nn.Module):
         del_meta(child)
 
 def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, prefix: str="", default_device: str = "cpu"):
+    rules = rule_list if isinstance(rule_list, OptimizeRules) else OptimizeRules(rule_list)
     module_name = prefix[:-1]
     translated_name = translate_name_to_gguf(prefix)[:-1]
     #print("gen_optimize_config", prefix, module_name, translated_name)
     recursive = True
-    for rule in rule_list:
-        match_meta = rule["match"]
-        if "class" not in match_meta and "name" not in match_meta:
-            raise Exception("match must have at least one of \"class\" and \"name\"")
-        if "class" in match_meta:
-            import_path = match_meta["class"].split(".")
-            import_module_name = ".".join(import_path[:-1])
-            import_class_name = import_path[-1]
-            module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
-            if not isinstance(module, module_cls):
-                continue
-        if "name" in match_meta:
-            if re.search(match_meta["name"], module_name) is None:
-                continue
-        if "replace" not in rule:
-            raise Exception("replace must be in rule")
-        if "replace" in rule:
-            replace_meta = rule["replace"]
-            if module_name not in out_data:
-                out_data[module_name]={"key": translated_name,
-                                    "class": replace_meta["class"] if "class" in replace_meta else "default",
-                                    # "device": replace_meta["device"] if "device" in replace_meta else default_device,
-                                    "kwargs": copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict()}
-            else:
-                if out_data[module_name]["class"] == "default":
-                    out_data[module_name]["class"] = replace_meta["class"] if "class" in replace_meta else "default"
-                out_data[module_name]["kwargs"].update(copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict())
+    rule = rules.match(module, module_name)
+    if rule is not None:
+        replace_meta = rule["replace"]
+        if module_name not in out_data:
+            out_data[module_name]={"key": translated_name,
+                                "class": replace_meta["class"] if "class" in replace_meta else "default",
+                                # "device": replace_meta["device"] if "device" in replace_meta else default_device,
+                                "kwargs": copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict()}
+        else:
+            if out_data[module_name]["class"] == "default":
+                out_data[module_name]["class"] = replace_meta["class"] if "class" in replace_meta else "default"
+            out_data[module_name]["kwargs"].update(copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict())
         if "recursive" in rule:
             recursive = bool(rule["recursive"])
-        break
-            
+
     if module_name not in out_data:
         out_data[module_name]= {
             "class": "default",
@@ -103,7 +156,7 @@ def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, p
         for name, child in module._modules.items():
             if child is not None:
                 child_prefix = prefix + name + "."
-                gen_optimize_config(child, out_data, rule_list, child_prefix)
+                gen_optimize_config(child, out_data, rules, child_prefix)
     
 
 def translate_model_config(model_config: PretrainedConfig):
@@ -114,21 +167,22 @@ def translate_model_config(model_config: PretrainedConfig):
     return model_config
 
 
-def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cpu"):
+def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cpu",
+                           load_workers: int = 1, max_bytes_in_flight: int = 4 << 30):
     with open(rule_file, 'r', encoding='utf-8') as f:
         rule_list = yaml.load(f.read(), Loader=yaml.FullLoader)
     
     optimize_config = dict()
-    gen_optimize_config(module, optimize_config, rule_list, default_device = default_device)
+    gen_optimize_config(module, optimize_config, OptimizeRules(rule_list), default_device = default_device)
     
     model_config = translate_model_config(model_config)
 
     gguf_loader=GGUFLoader(gguf_path)
     with torch.device("cpu"):
-        inject(module, optimize_config, model_config, gguf_loader)
+        inject(module, OptimizeConfigTrie.build(optimize_config), model_config, gguf_loader)
     # pre load lm_head because its big inter result
     load_weights(module.lm_head, gguf_loader, "lm_head.")
-    load_weights(module, gguf_loader)
+    load_weights(module, gguf_loader, num_workers=load_workers, max_bytes_in_flight=max_bytes_in_flight)
     module.gguf_loader = gguf_loader
     del_meta(module)
     torch.cuda.empty_cache()
@@ -11,12 +11,23 @@ from pydantic import BaseModel, Field
 from ktransformers.server.config.config import Config
 from ktransformers.server.utils.create_interface import get_interface
 from ktransformers.server.schemas.assistants.streaming import check_link_response
+from ktransformers.server.utils.stream_writer import JsonTemplate, hole
 from ktransformers.server.backend.base import BackendInterfaceBase
 
 from ktransformers.server.schemas.endpoints.chat import RawUsage
 
 router = APIRouter(prefix='/api')
 
+
+def sampling_options(options: Optional[dict]) -> dict:
+    """The temperature, top_p and num_predict of Ollama options, as inference() keyword arguments."""
+    options = options or {}
+    params = {name: options[name] for name in ("temperature", "top_p") if options.get(name) is not None}
+    if options.get("num_predict") is not None and options["num_predict"] >= 0:
+        params["max_tokens"] = options["num_predict"]
+    return params
+
+
 # https://github.com/ollama/ollama/blob/main/docs/api.md#generate-a-completion
 class OllamaGenerateCompletionRequest(BaseModel):
     model: str = Field(..., description="The model name, which is required.")
@@ -63,18 +74,19 @@ async def generate(request: Request, input: OllamaGenerateCompletionRequest):
 
     if input.stream:
         async def inner():
-            async for res in interface.inference(input.prompt, id):
+            created_at, response = hole(), hole()
+            token_frame = JsonTemplate(OllamaGenerationStreamResponse(
+                model=config.model_name,
+                created_at=created_at,
+                response=response,
+                done=False
+            ).model_dump_json() + '\n', [created_at, response])
+            async for res in interface.inference(input.prompt, id, **sampling_options(input.options)):
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
-                    d = OllamaGenerationStreamResponse(
-                        model=config.model_name,
-                        created_at=str(datetime.now()),
-                        response=token,
-                        done=False
-                    )
-                    yield d.model_dump_json() + '\n'
+                    yield token_frame.render(str(datetime.now()), token)
             d = OllamaGenerationStreamResponse(
                 model=config.model_name,
                 created_at=str(datetime.now()),
@@ -82,10 +94,10 @@ async def generate(request: Request, input: OllamaGenerateCompletionRequest):
                 done=True
             )
             yield d.model_dump_json() + '\n'
-        return check_link_response(request, inner())
+        return check_link_response(inner())
     else:
         complete_response = ""
-        async for res in interface.inference(input.prompt, id):
+        async for res in interface.inference(input.prompt, id, **sampling_options(input.options)):
             if isinstance(res, RawUsage):
                 raw_usage = res
             else: 
@@ -109,6 +121,8 @@ class OllamaChatCompletionRequest(BaseModel):
     messages: List[OllamaChatCompletionMessage] = Field(
         ..., description="A list of messages to generate a response for.")
     stream: bool = Field(True, description="If true, the response will be streamed.")
+    options: Optional[dict] = Field(
+        None, description="Additional model parameters as listed in the documentation.")
 
 class OllamaChatCompletionStreamResponse(BaseModel):
     model: str
@@ -148,19 +162,20 @@ async def chat(request: Request, input: OllamaChatCompletionRequest):
         async def inner():
             start_time = time()  # 记录开始时间（秒）
             tokens = []
+            created_at, content = hole(), hole()
+            token_frame = JsonTemplate(OllamaChatCompletionStreamResponse(
+                model=config.model_name,
+                created_at=created_at,
+                message={"role": "assistant", "content": content},
+                done=False
+            ).model_dump_json() + '\n', [created_at, content])
 
-            async for res in interface.inference(input_message, id):
+            async for res in interface.inference(input_message, id, **sampling_options(input.options)):
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
-                    d = OllamaChatCompletionStreamResponse(
-                        model=config.model_name,
-                        created_at=str(datetime.now()),
-                        message={"role": "assistant", "content": token}, 
-                        done=False
-                    )
-                    yield d.model_dump_json() + '\n'
+                    yield token_frame.render(str(datetime.now()), token)
             # 计算性能数据
             end_time = time()
             total_duration = int((end_time - start_time) * 1_000_000_000) # unit: ns
@@ -185,13 +200,13 @@ async def chat(request: Request, input: OllamaChatCompletionRequest):
                 done_reason=done_reason
             )
             yield d.model_dump_json() + '\n'
-        return check_link_response(request, inner())
+        return check_link_response(inner())
     else:
         start_time = time()
         complete_response = ""
         eval_count = 0 
 
-        async for res in interface.inference(input_message, id):
+        async for res in interface.inference(input_message, id, **sampling_options(input.options)):
             if isinstance(res, RawUsage):
                 raw_usage = res
             else: 
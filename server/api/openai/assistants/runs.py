@@ -27,7 +27,7 @@ async def create_run(request: Request, thread_id: str, run_create: RunCreate):
            
             async for event in ctx.work():
                 yield event
-        return api_stream_response(request, inner())
+        return api_stream_response(inner())
     else:
         run = runs_manager.db_create_run(thread_id, run_create)
         ctx: ThreadContext = await get_thread_context_manager().get_context_by_run_object(run)
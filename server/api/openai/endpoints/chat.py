@@ -3,7 +3,6 @@ from time import time
 from uuid import uuid4
 from typing import Dict, List, Optional, Any, Literal, Union
 from pydantic import BaseModel, Field
-import re
 from fastapi import APIRouter
 from fastapi.requests import Request
 from ktransformers.server.utils.create_interface import get_interface
@@ -13,6 +12,8 @@ from ktransformers.server.schemas.endpoints.chat import RawUsage, Role
 from ktransformers.server.backend.base import BackendInterfaceBase
 from ktransformers.server.config.config import Config
 from ktransformers.server.config.log import logger
+from ktransformers.server.utils.tool_calls import ToolCallParser
+from ktransformers.server.utils.stream_writer import JsonTemplate, hole
 from fastapi.responses import JSONResponse
 from ktransformers.server.schemas.endpoints.chat import ChatCompletionChunk, CompletionUsage
 
@@ -58,62 +59,6 @@ router = APIRouter()
 async def list_models():
     return {"data": [{"id": Config().model_name, "name": Config().model_name}], "object": "list"}
 
-def getTools(buffer):
-    tool_calls_begin_marker = "<｜tool▁calls▁begin｜>"
-    tool_call_begin_marker = "<｜tool▁call▁begin｜>"
-    tool_sep_marker = "<｜tool▁sep｜>"
-    tool_call_end_marker = "<｜tool▁call▁end｜>"
-    tool_calls_end_marker = "<｜tool▁calls▁end｜>"
-    extracted_tools = []
-    working_buffer = buffer
-
-    # Iterate over all function calls
-    while tool_call_begin_marker in working_buffer and tool_call_end_marker in working_buffer:
-        # Find a complete function call
-        start_index = working_buffer.find(tool_call_begin_marker)
-        end_index = working_buffer.find(tool_call_end_marker) + len(tool_call_end_marker)
-
-        if start_index == -1 or end_index == -1 or start_index > end_index:
-            logger.warning("Not a function")
-            break
-
-        # Extract the full function call
-        full_tool_call = working_buffer[start_index:end_index]
-
-        # Remove this function call from the working buffer to prevent duplicate processing
-        working_buffer = working_buffer.replace(full_tool_call, "", 1)
-
-        # Extract the function name
-        function_name_start = full_tool_call.find(tool_sep_marker) + len(tool_sep_marker)
-        function_name_end = full_tool_call.find("\n", function_name_start)
-        function_name = full_tool_call[function_name_start:function_name_end].strip()
-
-        # Extract JSON parameters
-        json_pattern = r'```json\s*(.*?)\s*```'
-        json_match = re.search(json_pattern, full_tool_call, re.DOTALL)
-
-        if json_match:
-            arguments_str = json_match.group(1).strip()
-            # Generate tool call IDs
-            tool_call_id = f"call_{uuid4().hex[:24]}"
-
-            # Add to tool call list
-            extracted_tools.append({
-                "id": tool_call_id,
-                "type": "function",
-                "function": {
-                    "name": function_name,
-                    "arguments": arguments_str
-                }
-            })
-
-            logger.info(f"Get Function: {function_name}")
-        else:
-            logger.warning(f"Unable to get function, function_name: {function_name}")
-
-    logger.info(f"Total {len(extracted_tools)} Functions")
-    return extracted_tools
-
 def get_tool_instructions():
     """Return concise tool calling instructions in English"""
     return """
@@ -212,9 +157,10 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
                 break
 
         # Build the tool descriptions
-        tools_description = ""
-        for tool in create.tools:
-            tools_description += f"<function><function_name>{tool.function.name}</function_name><function_description>{tool.function.description}</function_description><function_parameters>{tool.function.parameters}</function_parameters></function>\n"
+        tools_description = "".join(
+            f"<function><function_name>{tool.function.name}</function_name><function_description>{tool.function.description}</function_description><function_parameters>{tool.function.parameters}</function_parameters></function>\n"
+            for tool in create.tools
+        )
 
         # If first message is system, add concise tool instructions
         if enhanced_messages[0].role == Role.system or enhanced_messages[0].role == Role.user:
@@ -242,26 +188,14 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
                 model=Config().model_name,
                 system_fingerprint=f"fp_{uuid4().hex[:12]}",
             )
-
-            # Collect the full output of the model
-            full_content = ""
-            buffer = ""  # Used to temporarily store the current block of text
-            tool_call_mode = False  # Mark if a tool call is being processed
-            tool_calls = []  # Store all detected tool calls
-
-            # Tool call markers
-            tool_calls_begin_marker = "<｜tool▁calls▁begin｜>"
-            tool_call_begin_marker = "<｜tool▁call▁begin｜>"
-            tool_sep_marker = "<｜tool▁sep｜>"
-            tool_call_end_marker = "<｜tool▁call▁end｜>"
-            tool_calls_end_marker = "<｜tool▁calls▁end｜>"
-            too_calls_dict = {
-                "<tools▁begin>":"<｜tool▁calls▁begin｜>",
-                "<tool▁begin>":"<｜tool▁call▁begin｜>",
-                "<tool▁sep>":"<｜tool▁sep｜>",
-                "<tool▁end>":"<｜tool▁call▁end｜>",
-                "<tools▁end>":"<｜tool▁calls▁end｜>"
-            }
+            # content deltas are spliced into the chunk rendered once, the rest go through the model
+            content = hole()
+            chunk.choices = [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+            content_frame = JsonTemplate(chunk.to_stream_reply(), [content])
+
+            # content and tool call deltas, as the tokens arrive
+            parser = ToolCallParser()
+            finished = False
             # Use check_client_connected for early stopping
             async for res in interface.inference(input_message, id, create.temperature, create.top_p, create.max_tokens, create.max_completion_tokens):
                 if isinstance(res, RawUsage):
@@ -282,157 +216,38 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
                     yield chunk
                 elif isinstance(res, tuple) and len(res) == 2:
                     token, finish_reason = res
-                    token = re.sub('|'.join(map(re.escape, too_calls_dict.keys())), lambda m: too_calls_dict[m.group(0)], token)
-                    # Detecting model-specific formatting tool call starts
-                    if not tool_call_mode and tool_calls_begin_marker in buffer + token:
-                        tool_call_mode = True
-
-                        # Adjust full_content to remove tool call section
-                        if buffer.endswith(tool_calls_begin_marker):
-                            full_content = full_content[:-len(tool_calls_begin_marker)]
-                        elif tool_calls_begin_marker in (buffer + token):
-                            idx = (buffer + token).find(tool_calls_begin_marker)
-                            full_content = full_content[:-(len(buffer) - idx)]
-                        buffer = ""
-
-                        # Send the current cumulative text content (if any)
-                        if full_content:
-                            chunk.choices = [{
-                                "index": 0,
-                                "delta": {"content": full_content},
-                                "finish_reason": None
-                            }]
-                            yield chunk
-                            full_content = ""
-
-                    # Accumulation of content in non-tool call mode
-                    if not tool_call_mode:
-                        full_content += token
-                        buffer += token
-                        # Keep the buffer at a reasonable size
-                        if len(buffer) > 200:
-                            buffer = buffer[-200:]
-                    else:
-                        # In tool call mode, continue to collect tool call related text
-                        buffer += token
-
-                        # If the tool call end marker is found
-                        if tool_calls_end_marker in buffer:
-                            try:
-                                # Parse and extract tool calling information
-                                tool_calls = getTools(buffer)
-                                if len(tool_calls):
-                                    # reset state
-                                    tool_call_mode = False
-                                    buffer = ""
-
-                                    # Send tool call events
-                                    for idx, tool_call in enumerate(tool_calls):
-                                        # First tool call message
-                                        chunk.choices = [{
-                                            "index": 0,
-                                            "delta": {
-                                                "role": "assistant",
-                                                "content": None,
-                                                "tool_calls": [{
-                                                    "index": idx,
-                                                    "id": tool_call["id"],
-                                                    "type": "function",
-                                                    "function": {
-                                                        "name": tool_call["function"]["name"],
-                                                        "arguments": ""
-                                                    }
-                                                }]
-                                            },
-                                            "finish_reason": None
-                                        }]
-                                        yield chunk
-
-                                        # Sending Parameters
-                                        chunk.choices = [{
-                                            "index": 0,
-                                            "delta": {
-                                                "tool_calls": [{
-                                                    "index": idx,
-                                                    "function": {"arguments": tool_call["function"]["arguments"]}
-                                                }]
-                                            },
-                                            "finish_reason": None
-                                        }]
-                                        yield chunk
-
-                                    # Send Completion Message
-                                    chunk.choices = [{
-                                        "index": 0,
-                                        "delta": {},
-                                        "finish_reason": "tool_calls"
-                                    }]
-                                    yield chunk
-
-                                    # No further processing after return
-                                    return
-                                else:
-                                    # JSON extraction failed, probably incomplete formatting
-                                    logger.warning("Failed to extract JSON from tool call")
-                                    tool_call_mode = False
-                                    buffer = ""
-                            except Exception as e:
-                                logger.error(f"Error processing tool call: {e}")
-                                tool_call_mode = False
-                                buffer = ""
-
-                    # Normal text output (only in non-tool call mode)
-                    if not tool_call_mode and token:
-                        if finish_reason is not None:
-                            chunk.choices = [{
-                                "index": 0,
-                                "delta": {},
-                                "finish_reason": finish_reason
-                            }]
-                            yield chunk
-                        else:
-                            if any(marker in token for marker in [tool_calls_begin_marker, tool_call_begin_marker]):
-                                pass
-                            else:
-                                chunk.choices = [{
-                                    "index": 0,
-                                    "delta": {"content": token},
-                                    "finish_reason": None
-                                }]
-                                yield chunk
-
-            # If gotten this far without returning, it means that the full tool call was not detected
-            # Send Routine Completion Message
-            if not tool_call_mode:
-                chunk.choices = [{
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": "stop"
-                }]
+                    deltas = parser.feed(token)
+                    if finish_reason is not None or parser.done:
+                        deltas += parser.finish()
+                    for delta in deltas:
+                        if delta.keys() == {"content"}:
+                            yield content_frame.render(delta["content"])
+                            continue
+                        chunk.choices = [{"index": 0, "delta": delta, "finish_reason": None}]
+                        yield chunk
+                    if parser.done:
+                        # the tool calls are complete, no need to generate the rest
+                        chunk.choices = [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]
+                        yield chunk
+                        return
+                    if finish_reason is not None and not finished:
+                        finished = True
+                        chunk.choices = [{"index": 0, "delta": {}, "finish_reason": parser.finish_reason or finish_reason}]
+                        yield chunk
+
+            # the output ended without a finish reason
+            if not finished:
+                for delta in parser.finish():
+                    chunk.choices = [{"index": 0, "delta": delta, "finish_reason": None}]
+                    yield chunk
+                chunk.choices = [{"index": 0, "delta": {}, "finish_reason": parser.finish_reason or "stop"}]
                 yield chunk
 
-        return chat_stream_response(request, inner())
+        return chat_stream_response(inner())
     else:
         # non streaming response processing
-        full_content = ""
         finish_reason = None
-        tool_calls = []
-        buffer = ""
-        tool_call_mode = False
-
-        # Custom model special markers
-        tool_calls_begin_marker = "<｜tool▁calls▁begin｜>"
-        tool_call_begin_marker = "<｜tool▁call▁begin｜>"
-        tool_sep_marker = "<｜tool▁sep｜>"
-        tool_call_end_marker = "<｜tool▁call▁end｜>"
-        tool_calls_end_marker = "<｜tool▁calls▁end｜>"
-        too_calls_dict = {
-            "<tools▁begin>":"<｜tool▁calls▁begin｜>",
-            "<tool▁begin>":"<｜tool▁call▁begin｜>",
-            "<tool▁sep>":"<｜tool▁sep｜>",
-            "<tool▁end>":"<｜tool▁call▁end｜>",
-            "<tools▁end>":"<｜tool▁calls▁end｜>"
-        }
+        parser = ToolCallParser()
         async for res in interface.inference(input_message, id, create.temperature, create.top_p, create.max_tokens, create.max_completion_tokens):
             if isinstance(res, RawUsage):
                 raw_usage = res
@@ -450,48 +265,12 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
 
             elif isinstance(res, tuple) and len(res) == 2:
                 token, finish_reason = res
-                token = re.sub('|'.join(map(re.escape, too_calls_dict.keys())), lambda m: too_calls_dict[m.group(0)], token)
-                # Detecting the start of model-specific formatting tool calls
-                if not tool_call_mode and tool_calls_begin_marker in buffer + token:
-                    tool_call_mode = True
-
-                    # Adjust full_content to remove tool call section
-                    if buffer.endswith(tool_calls_begin_marker):
-                        full_content = full_content[:-len(tool_calls_begin_marker)]
-                    elif tool_calls_begin_marker in (buffer + token):
-                        idx = (buffer + token).find(tool_calls_begin_marker)
-                        full_content = full_content[:-(len(buffer) - idx)]
-                    buffer = ""
-
-                # Accumulation of content in non-tool call mode
-                if not tool_call_mode:
-                    full_content += token
-                    buffer += token
-                    # Keep the buffer at a reasonable size
-                    if len(buffer) > 200:
-                        buffer = buffer[-200:]
-                else:
-                    # In tool call mode, continue to collect tool call related text
-                    buffer += token
-
-                    # If the tool call end marker is found
-                    if tool_calls_end_marker in buffer:
-                        # Extract tool calls
-                        tool_calls = getTools(buffer)
-                        if tool_calls:
-                            finish_reason = "tool_calls"
-
-                        # Reset state
-                        tool_call_mode = False
-                        buffer = ""
+                parser.feed(token)
+        parser.finish()
+        if parser.tool_calls:
+            logger.info(f"Total {len(parser.tool_calls)} Functions")
 
         # Build Response
-        message = {
-            "role": "assistant",
-            "content": None if tool_calls else full_content
-        }
-        if tool_calls:
-            message["tool_calls"] = tool_calls
         response = {
             "id": id,
             "object": "chat.completion",
@@ -499,11 +278,11 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
             "model": Config().model_name,
             "choices": [{
                 "index": 0,
-                "message": message,
-                "finish_reason": finish_reason or "stop"
+                "message": parser.message(),
+                "finish_reason": parser.finish_reason or finish_reason or "stop"
             }],
             "usage": usage.__dict__ if 'usage' in locals() else None,
             "system_fingerprint": f"fp_{uuid4().hex[:12]}"
         }
 
-        return response
\ No newline at end of file
+        return response
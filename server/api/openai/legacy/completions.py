@@ -9,6 +9,7 @@ from ktransformers.server.schemas.legacy.completions import CompletionCreate,Com
 from ktransformers.server.schemas.endpoints.chat import RawUsage
 from fastapi.responses import JSONResponse
 from ktransformers.server.config.config import Config
+from ktransformers.server.utils.stream_writer import JsonTemplate, hole
 router = APIRouter()
 
 @router.post("/completions",tags=['openai'])
@@ -60,16 +61,17 @@ async def create_completion(request:Request, create:CompletionCreate):
    
     if create.stream:
         async def inner():
+            content = hole()
+            content_frame = JsonTemplate(f"data:{json.dumps({'choices':[{'delta':{'content':content}}]})}\n\n", [content], ensure_ascii=True)
             async for res in interface.inference(create.prompt, id, create.temperature, create.top_p, create.max_tokens, create.max_completion_tokens):     
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
-                    d = {'choices':[{'delta':{'content':token}}]}
-                    yield f"data:{json.dumps(d)}\n\n"
+                    yield content_frame.render(token)
             d = {'choices':[{'delta':{'content':''},'finish_reason':''}]}
             yield f"data:{json.dumps(d)}\n\n"
-        return stream_response(request,inner())
+        return stream_response(inner())
     else:
         comp = CompletionObject(id=id,object='text_completion',created=int(time()))
         async for res in interface.inference(create.prompt,id,create.temperature,create.top_p, create.max_tokens, create.max_completion_tokens):     
@@ -1,6 +1,10 @@
 from fastapi import APIRouter
 from .system import router as system_router
+from .routing_stats import router as routing_stats_router
+from .metrics import router as metrics_router
 
 
 router = APIRouter()
 router.include_router(system_router)
+router.include_router(routing_stats_router)
+router.include_router(metrics_router)
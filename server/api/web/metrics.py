@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ktransformers.util.metrics import MetricsRegistry
+
+router = APIRouter()
+
+
+@router.get('/metrics', tags=['web'], response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(MetricsRegistry.get_instance().render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,47 @@
+from typing import Optional
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+from ktransformers.util.routing_stats import ExpertRoutingStats
+from ktransformers.util.expert_prefetch import ExpertPrefetcher
+
+router = APIRouter()
+
+
+class RoutingStatsDumpRequest(BaseModel):
+    path: Optional[str] = Field(None, description="Where to write the counters, defaults to routing_stats.dump_path.")
+
+
+@router.get('/routing-stats', tags=['web'])
+def routing_stats(topk: int = 8):
+    return ExpertRoutingStats.get_instance().summary(topk=topk)
+
+
+@router.post('/routing-stats/dump', tags=['web'])
+def dump_routing_stats(request: RoutingStatsDumpRequest):
+    path = ExpertRoutingStats.get_instance().dump(request.path)
+    if path is None:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "object": "error",
+                "message": "routing stats are empty or no dump path is configured.",
+                "type": "BadRequestError",
+                "param": None,
+                "code": 400
+            })
+    return {"path": path}
+
+
+@router.post('/routing-stats/reset', tags=['web'])
+def reset_routing_stats():
+    ExpertRoutingStats.get_instance().reset()
+    ExpertPrefetcher.get_instance().reset()
+    return {"reset": True}
+
+
+@router.get('/routing-stats/prefetch', tags=['web'])
+def expert_prefetch_stats():
+    return ExpertPrefetcher.get_instance().stats()
@@ -11,6 +11,8 @@ class ArgumentParser:
         parser.add_argument("--host", type=str, default=self.cfg.server_ip)
         parser.add_argument("--port", type=int, default=self.cfg.server_port)
         parser.add_argument("--api_key", type=str, default=self.cfg.api_key)
+        parser.add_argument("--stream_flush_bytes", type=int, default=self.cfg.stream_flush_bytes)
+        parser.add_argument("--stream_flush_ms", type=float, default=self.cfg.stream_flush_ms)
         parser.add_argument("--ssl_keyfile", type=str)
         parser.add_argument("--ssl_certfile", type=str)
         parser.add_argument("--web", type=bool, default=self.cfg.mount_web)
@@ -32,6 +34,7 @@ class ArgumentParser:
         parser.add_argument("--max_batch_size", type=int, default=self.cfg.max_batch_size)
         parser.add_argument("--max_new_tokens", type=int, default=self.cfg.max_new_tokens)
         parser.add_argument("--json_mode", type=bool, default=self.cfg.json_mode)
+        parser.add_argument("--json_schema", type=str, default=self.cfg.json_schema, required=False)
         parser.add_argument("--healing", type=bool, default=self.cfg.healing)
         parser.add_argument("--ban_strings", type=list, default=self.cfg.ban_strings, required=False)
         parser.add_argument("--gpu_split", type=str, default=self.cfg.gpu_split, required=False)
@@ -66,10 +69,25 @@ class ArgumentParser:
         parser.add_argument("--cache_8bit", type=bool, default=self.cfg.cache_8bit)
         parser.add_argument("--cache_q4", type=bool, default=self.cfg.cache_q4)
         parser.add_argument("--ngram_decoding", type=bool, default=self.cfg.ngram_decoding)
+        parser.add_argument("--ngram_num_draft", type=int, default=self.cfg.ngram_num_draft)
+        parser.add_argument("--ngram_max_ngram", type=int, default=self.cfg.ngram_max_ngram)
+        parser.add_argument("--adaptive_chunk", type=bool, default=self.cfg.adaptive_chunk)
+        parser.add_argument("--chunk_memory_mb", type=int, default=self.cfg.chunk_memory_mb)
         parser.add_argument("--print_timings", type=bool, default=self.cfg.print_timings)
         parser.add_argument("--amnesia", type=bool, default=self.cfg.amnesia)
         parser.add_argument("--batch_size", type=int, default=self.cfg.batch_size)
         parser.add_argument("--cache_lens", type=int, default=self.cfg.cache_lens)
+        parser.add_argument("--kv_cache_dtype", type=str, default=self.cfg.kv_cache_dtype,
+                            choices=["auto", "int8", "int4"])
+        parser.add_argument("--mock_prefill_tps", type=float, default=self.cfg.mock_prefill_tps)
+        parser.add_argument("--mock_decode_tps", type=float, default=self.cfg.mock_decode_tps)
+        parser.add_argument("--mock_max_batch", type=int, default=self.cfg.mock_max_batch)
+        parser.add_argument("--mock_output_tokens", type=int, default=self.cfg.mock_output_tokens)
+        parser.add_argument("--response_cache", type=bool, default=self.cfg.response_cache)
+        parser.add_argument("--response_cache_mb", type=int, default=self.cfg.response_cache_mb)
+        parser.add_argument("--response_cache_dir", type=str, default=self.cfg.response_cache_dir, required=False)
+        parser.add_argument("--response_cache_disk_mb", type=int, default=self.cfg.response_cache_disk_mb)
+        parser.add_argument("--response_cache_replay_tps", type=float, default=self.cfg.response_cache_replay_tps)
 
         # kvc2 config
         parser.add_argument("--kvc2_config_dir", type=str, default=self.cfg.kvc2_config_dir)
@@ -26,6 +26,7 @@ class ConfigArgs(BaseModel):
     json_mode: bool = Field(
         None, description="Use LMFE to constrain the output to JSON format. See schema and details below"
     )
+    json_schema: Optional[str] = Field(None, description="JSON schema file json_mode generates to, any object if unset")
     healing: bool = Field(None, description="Demonstrate token healing")
     ban_strings: Optional[list] = Field(None, description="Ban some phrases maybe")
     gpu_split: Optional[str] = Field(None, description='"auto", or VRAM allocation per GPU in GB')
@@ -67,12 +68,26 @@ class ConfigArgs(BaseModel):
     cache_8bit: bool = Field(None, description="Use 8-bit (FP8) cache")
     cache_q4: bool = Field(None, description="Use Q4 cache")
     ngram_decoding: bool = Field(None, description="Use n-gram speculative decoding")
+    ngram_num_draft: int = Field(None, description="Tokens drafted per forward in n-gram decoding")
+    ngram_max_ngram: int = Field(None, description="Longest n-gram looked up in n-gram decoding")
+    adaptive_chunk: bool = Field(None, description="Tune the prefill chunk length per context position")
+    chunk_memory_mb: int = Field(None, description="Activation memory cap of an adaptive prefill chunk, in MB")
     print_timings: bool = Field(None, description="Output timings after each prompt")
     amnesia: bool = Field(None, description="Forget context after every response")
 
     # for transformers
     batch_size: int = Field(None, description="Batch Size")
     cache_lens: int = Field(None, description="Cache lens for transformers static cache")
+    kv_cache_dtype: str = Field(None, description="auto, int8 or int4 StaticCache storage (balance_serve needs auto)")
+    mock_prefill_tps: float = Field(None, description="Prompt tokens per second of the mock backend")
+    mock_decode_tps: float = Field(None, description="Generated tokens per second per request of the mock backend")
+    mock_max_batch: int = Field(None, description="Requests the mock backend generates for at once")
+    mock_output_tokens: int = Field(None, description="Tokens the mock backend generates without a request limit")
+    response_cache: bool = Field(None, description="Replay the replies of repeated temperature 0 requests")
+    response_cache_mb: int = Field(None, description="Memory of the response cache, in MB")
+    response_cache_dir: Optional[str] = Field(None, description="Directory the response cache also keeps replies in")
+    response_cache_disk_mb: int = Field(None, description="Disk space of the response cache, in MB")
+    response_cache_replay_tps: float = Field(None, description="Tokens per second of a replayed reply, 0 for at once")
     device: str = Field(None, description="device")
 
 
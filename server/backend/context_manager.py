@@ -8,11 +8,13 @@ from ktransformers.server.config.log import logger
 from ktransformers.server.backend.interfaces.transformers import TransformersThreadContext
 from ktransformers.server.backend.interfaces.ktransformers import KTransformersThreadContext
 from ktransformers.server.backend.interfaces.exllamav2 import ExllamaThreadContext
+from ktransformers.server.backend.interfaces.mock import MockThreadContext
 
 
 from ktransformers.server.backend.interfaces.exllamav2 import ExllamaInterface
 from ktransformers.server.backend.interfaces.transformers import TransformersInterface
 from ktransformers.server.backend.interfaces.ktransformers import KTransformersInterface
+from ktransformers.server.backend.interfaces.mock import MockInterface
 
 class ThreadContextManager:
     lock: Lock
@@ -37,6 +39,8 @@ class ThreadContextManager:
                     new_context = KTransformersThreadContext(run, self.interface)
                 elif isinstance(self.interface, TransformersInterface):
                     new_context = TransformersThreadContext(run, self.interface)
+                elif isinstance(self.interface, MockInterface):
+                    new_context = MockThreadContext(run, self.interface)
                 else:
                     from ktransformers.server.backend.interfaces.balance_serve import BalanceServeThreadContext
                     from ktransformers.server.backend.interfaces.balance_serve import BalanceServeInterface
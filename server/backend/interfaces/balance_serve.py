@@ -1,5 +1,5 @@
 from typing import Any, AsyncIterator, List, Optional, Set
-from ktransformers.models.custom_cache import KDeepSeekV3Cache, KGQACache
+from ktransformers.models.custom_cache import KDeepSeekV3Cache, KGQACache, check_kvc2_cache_dtype
 from transformers import (
     AutoTokenizer,
     AutoConfig,
@@ -36,6 +36,11 @@ import torch.multiprocessing as mp
 from multiprocessing.synchronize import Event
 from ktransformers.server.schemas.endpoints.chat import RawUsage
 from ktransformers.server.utils.multi_timer import Profiler
+from ktransformers.util.json_grammar import json_automaton
+from ktransformers.util.expert_placement import check_cuda_graph
+from ktransformers.util.metrics import (
+    COUNT_BUCKETS, MetricsRegistry, RequestMetrics, SnapshotPublisher, SnapshotReceiver, record_request,
+)
 import zmq
 import time
 import queue
@@ -61,9 +66,11 @@ default_optimize_rules = {
     "Qwen2MoeForCausalLM": ktransformer_rules_dir + "Qwen2-serve.yaml",
     "Qwen3MoeForCausalLM": ktransformer_rules_dir + "Qwen3Moe-serve.yaml",
 }
+# json_mode forgets the grammar state of a query after this many batches in a row without it
+JSON_STATE_IDLE_BATCHES = 256
 
 
-async def chat_stream(queue: asyncio.Queue, tokenizer: AutoTokenizer):
+async def chat_stream(queue: asyncio.Queue, tokenizer: AutoTokenizer, request_metrics: Optional[RequestMetrics] = None):
     streamer = TextStreamer(tokenizer)
     while True:
         token = await queue.get()
@@ -76,16 +83,24 @@ async def chat_stream(queue: asyncio.Queue, tokenizer: AutoTokenizer):
                 yield s
             break
 
+        if request_metrics is not None:
+            request_metrics.token()
         # str = model.tokenizer.decode(token)
         yield streamer.put(token)
         
 
 
+def batch_query_ids(batch: sched_ext.BatchQueryTodo) -> list[int]:
+    """Query ids of the rows sampled for a batch, in the order query_manager.update() reports them."""
+    return [id for id, _, _ in batch.prefill_mini_batches] + [id for ids in batch.decode_mini_batches for id in ids]
+
+
 def fill_generated_tokens(query_updates: list[sched_ext.QueryUpdate], generated_tokens: torch.Tensor, query_manager: QueryManager = None):
     #print(len(query_updates), generated_tokens.size(0), generated_tokens)
+    # one device to host copy for the whole batch
+    tokens = generated_tokens.tolist()
     for i in range(generated_tokens.size(0)):
-        print(generated_tokens[i].item())
-        query_updates[i].generated_token = generated_tokens[i].item()
+        query_updates[i].generated_token = tokens[i]
         if not query_manager.query_map[query_updates[i].id].is_prefill:
             pos = query_updates[i].active_position
             if pos < query_manager.query_map[query_updates[i].id].max_length:
@@ -111,13 +126,15 @@ class Engine:
     sampler: Sampler
     query_manager: QueryManager
     cache: KDeepSeekV3Cache | KGQACache
-    def __init__(self, args: ConfigArgs = default_args, generated_token_queue:Queue = None, broadcast_endpoint: str = None, kvcache_event: Event = None):
+    def __init__(self, args: ConfigArgs = default_args, generated_token_queue:Queue = None, broadcast_endpoint: str = None, kvcache_event: Event = None, metrics_queue: Queue = None):
         self.args = args
 
         # 子进程和父进程无法共享 config 变量
         for key, value in vars(args).items():
             if value is not None and hasattr(Config(), key):
                 setattr(Config(), key, value)
+        if Config().expert_placement_enable:
+            check_cuda_graph(args.use_cuda_graph)
 
         self.device = self.args.device
         self.sched_client = SchedulerClient(args.sched_port)
@@ -136,13 +153,13 @@ class Engine:
             
         with torch.device("meta"):
             if config.architectures[0] == "DeepseekV3ForCausalLM":
-                self.cache = KDeepSeekV3Cache(config, self.args.page_size)
+                self.cache = KDeepSeekV3Cache(config, self.args.page_size, kv_cache_dtype=self.args.kv_cache_dtype)
                 self.model = KDeepseekV3ForCausalLM(config, self.cache)
             elif config.architectures[0] == "DeepseekV2ForCausalLM":
-                self.cache = KDeepSeekV3Cache(config, self.args.page_size)
+                self.cache = KDeepSeekV3Cache(config, self.args.page_size, kv_cache_dtype=self.args.kv_cache_dtype)
                 self.model = KDeepseekV2ForCausalLM(config, self.cache)
             elif config.architectures[0] == "Qwen2MoeForCausalLM" or config.architectures[0] == "Qwen3MoeForCausalLM":
-                self.cache = KGQACache(config, self.args.page_size)
+                self.cache = KGQACache(config, self.args.page_size, kv_cache_dtype=self.args.kv_cache_dtype)
                 if config.architectures[0] == "Qwen2MoeForCausalLM":
                     self.model = KQwen2MoeForCausalLM(config, self.cache)
                 else:
@@ -178,7 +195,9 @@ class Engine:
                 "please input the path of your gguf file(gguf file in the dir containing input gguf file must all"
                 " belong to current model):"
             )
-        optimize_and_load_gguf(self.model, optimize_config_path, gguf_path, config)
+        optimize_and_load_gguf(self.model, optimize_config_path, gguf_path, config,
+                               load_workers=Config().load_workers,
+                               max_bytes_in_flight=Config().load_max_inflight_mb << 20)
         self.model.generation_config = generation_config
         if self.model.generation_config.pad_token_id is None:
             self.model.generation_config.pad_token_id = self.model.generation_config.eos_token_id
@@ -205,6 +224,24 @@ class Engine:
         self.sampler = Sampler()
         self.query_manager = QueryManager(device = self.device, page_size = args.page_size)
 
+        # json_mode: grammar state per query id, the initial state until its first token, None once a query
+        # sampled a token the grammar doesn't allow; json_seen is the last batch each query was in
+        self.json_automaton = None
+        self.json_states: dict[int, Optional[int]] = {}
+        self.json_seen: dict[int, int] = {}
+        self.json_batches = 0
+        if args.json_mode:
+            tokenizer = AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True)
+            self.json_automaton = json_automaton(tokenizer, config.vocab_size, args.json_schema,
+                                                 generation_config.eos_token_id)
+
+        # the engine runs in its own process, its metrics reach /metrics as snapshots on metrics_queue
+        self.metrics_publisher = SnapshotPublisher(metrics_queue) if metrics_queue is not None else None
+        registry = MetricsRegistry.get_instance()
+        self.model_time = registry.histogram("ktransformers_engine_model_seconds", "Model forward time of a batch.")
+        self.batch_queries = registry.histogram("ktransformers_engine_batch_queries",
+                                                "Queries in a batch, prefill and decode.", COUNT_BUCKETS)
+
             
     def sampling(self, forward_output: ForwardBatchOutput):
         generated_tokens = torch.empty(0, device=self.device, dtype=torch.int32)
@@ -220,10 +257,51 @@ class Engine:
             else:
                 top_ps = None
 
-            sample_options = SamplingOptions(logit.size(0), self.device, pretrained_config=self.model.generation_config, temperatures=temperatures, top_ps=top_ps)
+            token_masks = None
+            if self.json_automaton is not None:
+                states = [self.json_states.get(id, self.json_automaton.initial) for id in batch_query_ids(self.batch)]
+                token_masks = self.json_automaton.masks(
+                    [self.json_automaton.initial if state is None else state for state in states], self.device)
+                unconstrained = [row for row, state in enumerate(states) if state is None]
+                if unconstrained:
+                    token_masks[unconstrained] = True
+
+            sample_options = SamplingOptions(logit.size(0), self.device, pretrained_config=self.model.generation_config, temperatures=temperatures, top_ps=top_ps, token_masks=token_masks)
             generated_tokens, probs=self.sampler(logit, sample_options)
         return generated_tokens, probs
-    
+
+    def advance_json_states(self, updates: list[sched_ext.QueryUpdate]):
+        for update in updates:
+            # the token sampled after a prefill chunk other than the last is dropped
+            if update.is_prefill:
+                continue
+            if update.decode_done:
+                self.json_states.pop(update.id, None)
+                self.json_seen.pop(update.id, None)
+                continue
+            state = self.json_states.get(update.id, self.json_automaton.initial)
+            if state is None:
+                continue
+            self.json_seen[update.id] = self.json_batches
+            try:
+                self.json_states[update.id] = self.json_automaton.advance(state, update.generated_token)
+            except ValueError as e:
+                # restarting the grammar mid generation would force a second JSON value after the broken one
+                logger.warning(f"json_mode: query {update.id}: {e}, no longer constrained")
+                self.json_states[update.id] = None
+
+    def prune_json_states(self, batch: Optional[sched_ext.BatchQueryTodo]):
+        """Forget queries that ended without decode_done (cancelled, dropped by the scheduler) once they
+        have been out of JSON_STATE_IDLE_BATCHES batches in a row."""
+        self.json_batches += 1
+        if batch is not None:
+            for id in batch.query_ids:
+                if id in self.json_seen:
+                    self.json_seen[id] = self.json_batches
+        for id in [id for id, seen in self.json_seen.items() if self.json_batches - seen > JSON_STATE_IDLE_BATCHES]:
+            del self.json_seen[id]
+            self.json_states.pop(id, None)
+
     def loop(self):
 
         next_batch = None   
@@ -246,7 +324,11 @@ class Engine:
             next_batch = self.sched_client.update_last_batch(self.updates)
             if next_batch.query_ids == []:
                 next_batch = None
+            else:
+                self.batch_queries.observe(len(next_batch.query_ids))
             self.pub_socket.send_pyobj(next_batch)  
+            if self.json_automaton is not None:
+                self.prune_json_states(next_batch)
 
             if next_batch is not None:
                 self.query_manager.add_query(next_batch)
@@ -254,15 +336,19 @@ class Engine:
             
             if self.batch is not None:
                 self.model_runner.sync()
-                print(f"Model execution time (GPU): {self.model_runner.model_time:.3f} ms, {1000/self.model_runner.model_time:.3f} tokens/s")
+                self.model_time.observe(self.model_runner.model_time / 1000)
                 # if self.rank == 0:
                 
                 generated_tokens, probs = self.sampling( self.model_runner.output)
                 
                 self.updates = self.query_manager.update(self.batch)
                 fill_generated_tokens(self.updates, generated_tokens, self.query_manager)
+                if self.json_automaton is not None:
+                    self.advance_json_states(self.updates)
             else:
                 self.updates = []
+            if self.metrics_publisher is not None:
+                self.metrics_publisher.maybe_publish()
 
 class BalanceServeThreadContext(ThreadContext):
     def get_local_messages(self):
@@ -273,8 +359,8 @@ class BalanceServeThreadContext(ThreadContext):
         return local_messages
     
 
-def run_engine(args, token_queue, broadcast_endpoint, event, kvcache_event):
-    engine = Engine(args, token_queue, broadcast_endpoint, kvcache_event)
+def run_engine(args, token_queue, broadcast_endpoint, event, kvcache_event, metrics_queue=None):
+    engine = Engine(args, token_queue, broadcast_endpoint, kvcache_event, metrics_queue)
     if args.use_cuda_graph:
         engine.model_runner.warmup()
         
@@ -299,6 +385,8 @@ class BalanceServeInterface(BackendInterfaceBase):
     ever_generated_ids: Set[int] = set()
 
     def __init__(self, args: ConfigArgs = default_args):
+        # fail here rather than in the engine subprocess
+        check_kvc2_cache_dtype(args.kv_cache_dtype)
         self.args = args
         self.queue_map:dict[int,asyncio.Queue] = {}
         self.thread_map: dict[int, int] = {}
@@ -306,6 +394,8 @@ class BalanceServeInterface(BackendInterfaceBase):
         self.broadcast_endpoint = tempfile.NamedTemporaryFile(delete=False).name # @TODO add to config
         ctx = mp.get_context("spawn")
         self.token_queue = ctx.Queue(maxsize=1000) 
+        metrics_queue = ctx.Queue(maxsize=4)
+        MetricsRegistry.get_instance().add_source("engine", SnapshotReceiver(metrics_queue))
         self.tokenizer = AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True)
         self.sched_client = SchedulerClient(args.sched_port)
         self.streamer = TextStreamer(self.tokenizer)
@@ -313,7 +403,7 @@ class BalanceServeInterface(BackendInterfaceBase):
         start_event = ctx.Event()
         kvcache_event = ctx.Event()
 
-        p = ctx.Process(target=run_engine, args=(self.args, self.token_queue, self.broadcast_endpoint, start_event, kvcache_event))
+        p = ctx.Process(target=run_engine, args=(self.args, self.token_queue, self.broadcast_endpoint, start_event, kvcache_event, metrics_queue))
         p.start()
         processes.append(p)
         kvcache_event.wait()
@@ -418,8 +508,10 @@ class BalanceServeInterface(BackendInterfaceBase):
         logger.debug(f"get input ids of shape {input_ids.shape}")
         return input_ids
     
+    @record_request
     async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, 
-                        max_tokens: Optional[float] = None, max_completion_tokens: Optional[float] = None):
+                        max_tokens: Optional[float] = None, max_completion_tokens: Optional[float] = None,
+                        request_metrics: Optional[RequestMetrics] = None):
         profiler = Profiler()
         profiler.create_and_start_timer("tokenize")
         
@@ -444,6 +536,7 @@ class BalanceServeInterface(BackendInterfaceBase):
         query_length = input_ids[0].shape[0]
         query_add.query_length = query_length
         profiler.set_counter("prefill", query_length)
+        request_metrics.prompt(query_length)
         #@TODO add server
         stop_criteria =  [self.tokenizer.encode(self.tokenizer.eos_token, add_special_tokens=False),self.tokenizer.encode("<|im_end|>")]
         query_add.stop_criteria = stop_criteria
@@ -462,7 +555,7 @@ class BalanceServeInterface(BackendInterfaceBase):
         self.queue_map[query_id] = queue
         self.thread_map[thread_id] = query_id
         is_first_token = True
-        async for token in chat_stream(self.queue_map[query_id], self.tokenizer):
+        async for token in chat_stream(self.queue_map[query_id], self.tokenizer, request_metrics):
             if is_first_token:
                 is_first_token=False
                 profiler.pause_timer("prefill")
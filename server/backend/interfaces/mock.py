@@ -0,0 +1,110 @@
+'''
+Description  : A model free backend for load testing the server. It answers every request with a
+               deterministic word sequence seeded by the prompt, at configured rates: prompts are
+               "prefilled" one at a time at mock_prefill_tps words/s, at most mock_max_batch requests
+               run at once and each decodes at mock_decode_tps tokens/s, the rest wait their turn.
+               The endpoints, streaming and metrics in front of it are the real ones, so the serving
+               stack can be measured on any CPU box.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import asyncio
+import random
+import zlib
+from typing import List, Optional
+
+from ktransformers.server.config.log import logger
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.utils.multi_timer import Profiler
+from ktransformers.util.metrics import RequestMetrics
+from ..args import ConfigArgs, default_args
+from ..base import BackendInterfaceBase, ThreadContext
+
+WORDS = ("the", "model", "token", "cache", "expert", "layer", "memory", "page", "stream", "batch", "prefill",
+         "decode", "latency", "throughput", "kernel", "thread")
+
+
+def prompt_text(local_messages) -> str:
+    if isinstance(local_messages, str):
+        return local_messages
+    if isinstance(local_messages, List):
+        return "\n".join(str(m.get("content") or "") for m in local_messages)
+    raise ValueError("local_messages should be List or str")
+
+
+def mock_tokens(prompt: str, num_tokens: int) -> List[str]:
+    """The reply to a prompt: the same words for the same prompt, whatever the load."""
+    rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+    return [" " + rng.choice(WORDS) for _ in range(num_tokens)]
+
+
+class MockThreadContext(ThreadContext):
+    def get_local_messages(self):
+        return [{"role": m.role.value, "content": m.get_text_content()} for m in self.messages]
+
+
+class MockInterface(BackendInterfaceBase):
+
+    def __init__(self, args: ConfigArgs = default_args):
+        self.args = args
+        self.prefill_tps = float(args.mock_prefill_tps)
+        self.decode_tps = float(args.mock_decode_tps)
+        self.output_tokens = int(args.mock_output_tokens)
+        self.slots = asyncio.Semaphore(int(args.mock_max_batch))
+        self.prefill_lock = asyncio.Lock()
+        logger.info(f"mock backend: prefill {self.prefill_tps} tokens/s, decode {self.decode_tps} tokens/s per "
+                    f"request, {args.mock_max_batch} requests at once")
+
+    def max_new_tokens(self, max_tokens: Optional[int], max_completion_tokens: Optional[int]) -> int:
+        if max_tokens is not None:
+            max_completion_tokens = max_tokens
+        if max_completion_tokens is None:
+            return self.output_tokens
+        return min(self.args.max_new_tokens, max_completion_tokens)
+
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None,
+                        top_p: Optional[float] = None, max_tokens: Optional[int] = None,
+                        max_completion_tokens: Optional[int] = None):
+        request_metrics = RequestMetrics()
+        profiler = Profiler()
+        try:
+            profiler.create_and_start_timer("tokenize")
+            prompt = prompt_text(local_messages)
+            # a word is a token, close enough for load shapes
+            prompt_tokens = max(len(prompt.split()), 1)
+            profiler.set_counter("prefill", prompt_tokens)
+            request_metrics.prompt(prompt_tokens)
+            profiler.pause_timer("tokenize")
+
+            profiler.create_and_start_timer("prefill")
+            tokens = mock_tokens(prompt, self.max_new_tokens(max_tokens, max_completion_tokens))
+            async with self.slots:
+                async with self.prefill_lock:
+                    await asyncio.sleep(prompt_tokens / self.prefill_tps)
+                profiler.pause_timer("prefill")
+
+                profiler.create_and_start_timer("decode")
+                profiler.set_counter("decode", 0)
+                loop = asyncio.get_running_loop()
+                begin = loop.time()
+                for i, token in enumerate(tokens):
+                    # on a fixed schedule, so a slow consumer doesn't slow the rate down
+                    delay = begin + i / self.decode_tps - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    request_metrics.token()
+                    profiler.inc("decode")
+                    yield token, None
+                profiler.pause_timer("decode")
+            # a request limit cuts the reply, the default length ends it
+            limited = max_tokens is not None or max_completion_tokens is not None
+            yield "", "length" if limited else "stop"
+            yield RawUsage(
+                tokenize_time=profiler.get_timer_sec("tokenize"),
+                prefill_time=profiler.get_timer_sec("prefill"),
+                decode_time=profiler.get_timer_sec("decode"),
+                prefill_count=profiler.get_counter("prefill"),
+                decode_count=profiler.get_counter("decode"),
+            )
+        finally:
+            request_metrics.finish()
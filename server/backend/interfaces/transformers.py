@@ -23,6 +23,9 @@ from ..base import ThreadContext, BackendInterfaceBase
 from ktransformers.server.config.log import logger
 from ..args import ConfigArgs, default_args
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled, MLAWrapperSingleton
+from ktransformers.util.ngram_decoding import NgramSpeculator
+from ktransformers.util.metrics import RequestMetrics
+from ktransformers.util.json_grammar import JsonLogitsMask, json_automaton
 
 # This TextStreamer is a modified version from https://github.com/huggingface/transformers/blob/main/src/transformers/generation/streamers.py
 class TextStreamer:
@@ -129,6 +132,12 @@ class TransformersInterface(BackendInterfaceBase):
     seq_length: int
 
     streamer: TextStreamer
+    # prompt-lookup drafts of the current request, when args.ngram_decoding
+    speculator: Optional[NgramSpeculator] = None
+    # TTFT / inter-token latency of the current request
+    request_metrics: Optional[RequestMetrics] = None
+    # grammar state of the current request, when args.json_mode
+    json_mask: Optional[JsonLogitsMask] = None
 
     # thread_related
     last_request_id: Optional[str] = None
@@ -147,6 +156,7 @@ class TransformersInterface(BackendInterfaceBase):
             max_cache_len=args.cache_lens,
             device=args.device,
             dtype=self.model.dtype,
+            kv_cache_dtype=args.kv_cache_dtype,
         )
         # logger.info(f"StaticCache (length={args.cache_lens}) created at {args.device}, batch size:{args.batch_size}")
 
@@ -204,8 +214,27 @@ class TransformersInterface(BackendInterfaceBase):
     def append_new_tokens(self, new_tokens: int) -> Optional[str]:
         self.generated_ids[0, self.seq_length] = new_tokens
         self.seq_length += 1
+        if self.request_metrics is not None:
+            self.request_metrics.token()
         return self.streamer.put(new_tokens)
 
+    def ngram_forward(self, input_ids: torch.Tensor, cache_position: torch.Tensor) -> torch.Tensor:
+        logits = self.model(
+            input_ids,
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            return_dict=False,
+            use_cache=True,
+        )[0][0]
+        return self.logits_warper(self.inputs.view(1, -1).expand(logits.size(0), -1), logits)
+
+    def decode_tokens(self, budget: int) -> List[int]:
+        if self.speculator is None:
+            return [self.decode_one_tokens()]
+        new_tokens = self.speculator.step(budget)
+        self.ever_generated_ids.update(new_tokens)
+        return new_tokens
+
     def prepare_logits_wrapper(self, inputs, device, temperature: Optional[float] = None, top_p: Optional[float] = None):
         if temperature is None or temperature == 0:
             temperature = self.model.generation_config.temperature
@@ -231,7 +260,16 @@ class TransformersInterface(BackendInterfaceBase):
                 self.model._get_logits_warper(generation_config)
             )
 
+    def new_json_mask(self) -> Optional[JsonLogitsMask]:
+        if not self.args.json_mode:
+            return None
+        automaton = json_automaton(self.tokenizer, self.model.config.vocab_size, self.args.json_schema,
+                                   self.model.generation_config.eos_token_id)
+        return JsonLogitsMask(automaton)
+
     def logits_to_token(self, logits: torch.Tensor):
+        if self.json_mask is not None:
+            logits = self.json_mask(logits)
         logits = self.logits_warper(self.inputs.view(1, -1), logits.view(1, -1))
 
         probs = torch.nn.functional.softmax(logits, dim=-1)
@@ -244,6 +282,8 @@ class TransformersInterface(BackendInterfaceBase):
 
         last = last.item()
         self.ever_generated_ids.add(last)
+        if self.json_mask is not None:
+            self.json_mask.advance(last)
         return last
 
     def decode_one_tokens(self):
@@ -334,9 +374,19 @@ class TransformersInterface(BackendInterfaceBase):
             logits = self.model(inputs_embeds=inputs_embeds, return_dict=False)[0]
 
         self.prepare_logits_wrapper(input_ids, device, temperature, top_p)
+        self.json_mask = self.new_json_mask()
         next_token = self.logits_to_token(logits[0, -1, :])
         self.max_new_tokens = min(max_new_tokens, self.args.cache_lens - self.seq_length) - 1 
-        yield self.append_new_tokens(next_token)
+        text = self.append_new_tokens(next_token)
+        self.speculator = None
+        # the flashinfer MLA plan is made for one decode token, drafts aren't checked against the JSON grammar
+        if self.args.ngram_decoding and self.use_static_cache and not flashinfer_enabled and self.json_mask is None:
+            self.speculator = NgramSpeculator(
+                self.ngram_forward, self.cache, self.generated_ids[0, :self.seq_length].tolist(),
+                num_draft=self.args.ngram_num_draft, max_ngram=self.args.ngram_max_ngram, do_sample=True,
+                device=self.args.device,
+            )
+        yield text
 
     @torch.no_grad
     def generate(self):
@@ -347,25 +397,34 @@ class TransformersInterface(BackendInterfaceBase):
             return
         self.profiler.set_counter("decode", 0)
 
-        for i in range(1, self.max_new_tokens):
+        generated = 1
+        while generated < self.max_new_tokens:
             with torch.nn.attention.sdpa_kernel(backends=[SDPBackend.FLASH_ATTENTION, SDPBackend.MATH, SDPBackend.EFFICIENT_ATTENTION]):
                 if flashinfer_enabled:
                     MLAWrapperSingleton.plan_all(None,None,None,self.active_cache_position.to(torch.int32)+1, None,
                                              num_heads=self.model.config.num_attention_heads, head_dim_ckv=self.model.config.kv_lora_rank, 
                                              head_dim_kpe=self.model.config.qk_rope_head_dim, page_size=self.cache.page_size,
                                              sm_scale=self.model.model.layers[0].self_attn.softmax_scale, q_data_type=torch.bfloat16, kv_data_type=torch.bfloat16)
-                next_token = self.decode_one_tokens()
+                next_tokens = self.decode_tokens(self.max_new_tokens - generated)
+            for next_token in next_tokens:
+                generated += 1
                 self.profiler.inc("decode")
                 if next_token == self.tokenizer.eos_token_id or "<|im_end|>" == self.tokenizer.decode(next_token):
                     yield self.streamer.end(), None
                     yield "", "stop"
                     assert self.args.batch_size == 1
-                    break
+                    self.log_speculation()
+                    return
                 yield self.append_new_tokens(next_token), None
 
-        else:   # for's else, if output get max new tokens
-            yield self.streamer.end(), None
-            yield "", "length"
+        # if output get max new tokens
+        yield self.streamer.end(), None
+        yield "", "length"
+        self.log_speculation()
+
+    def log_speculation(self):
+        if self.speculator is not None:
+            logger.info(str(self.speculator.stats))
         
         
 
@@ -383,44 +442,49 @@ class TransformersInterface(BackendInterfaceBase):
                 return True
 
     async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, max_tokens: Optional[float] = None, max_completion_tokens: Optional[float] = None):
-        self.streamer.reset()
-        self.profiler.create_and_start_timer("tokenize")
-        if isinstance(local_messages, List):
-            input_ids = self.format_and_tokenize_input_ids(thread_id, local_messages)
-        elif isinstance(local_messages, str):
-            #local_messages = local_messages[0]['content']
-            input_ids = self.tokenize_prompt(local_messages)
-            #input_ids = torch.tensor([[6366]], device=input_ids.device)
-        else:
-            raise ValueError("local_messages should be List or str")
+        self.request_metrics = RequestMetrics()
+        try:
+            self.streamer.reset()
+            self.profiler.create_and_start_timer("tokenize")
+            if isinstance(local_messages, List):
+                input_ids = self.format_and_tokenize_input_ids(thread_id, local_messages)
+            elif isinstance(local_messages, str):
+                #local_messages = local_messages[0]['content']
+                input_ids = self.tokenize_prompt(local_messages)
+                #input_ids = torch.tensor([[6366]], device=input_ids.device)
+            else:
+                raise ValueError("local_messages should be List or str")
         
-        if Config().user_force_think:
-            token_thinks = torch.tensor([self.tokenizer.encode("<think>\n",add_special_tokens=False)],device=input_ids.device)
-            input_ids = torch.cat(
-                [input_ids, token_thinks], dim=1
-            )
+            if Config().user_force_think:
+                token_thinks = torch.tensor([self.tokenizer.encode("<think>\n",add_special_tokens=False)],device=input_ids.device)
+                input_ids = torch.cat(
+                    [input_ids, token_thinks], dim=1
+                )
 
-        self.profiler.pause_timer("tokenize")
+            self.profiler.pause_timer("tokenize")
+            self.request_metrics.prompt(input_ids.shape[-1])
 
-        self.profiler.create_and_start_timer("prefill")
+            self.profiler.create_and_start_timer("prefill")
 
-        if Config().user_force_think:
-            think = '<think>\n'
-            print(think, end="",flush=True)
-            yield think, None
+            if Config().user_force_think:
+                think = '<think>\n'
+                print(think, end="",flush=True)
+                yield think, None
         
-        for t in self.prefill(input_ids, self.check_is_new(thread_id), temperature, top_p, max_tokens, max_completion_tokens):
-            # output think token after prefill done
-            if t is not None:
-                print(t, end="",flush=True)
-                yield t, None
-        self.profiler.pause_timer("prefill")
-
-        self.profiler.create_and_start_timer("decode")
-        for t, finish_reason in self.generate():
-            if t is not None:
-                print(t, end="",flush=True)
-                yield t, finish_reason
-        print("")
-        self.profiler.pause_timer("decode")
-        self.report_last_time_performance()
+            for t in self.prefill(input_ids, self.check_is_new(thread_id), temperature, top_p, max_tokens, max_completion_tokens):
+                # output think token after prefill done
+                if t is not None:
+                    print(t, end="",flush=True)
+                    yield t, None
+            self.profiler.pause_timer("prefill")
+
+            self.profiler.create_and_start_timer("decode")
+            for t, finish_reason in self.generate():
+                if t is not None:
+                    print(t, end="",flush=True)
+                    yield t, finish_reason
+            print("")
+            self.profiler.pause_timer("decode")
+            self.report_last_time_performance()
+        finally:
+            self.request_metrics.finish()
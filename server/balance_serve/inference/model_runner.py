@@ -31,6 +31,9 @@ from ktransformers.models.custom_modeling_qwen2_moe import KQwen2MoeForCausalLM
 from ktransformers.models.custom_modeling_qwen3_moe import KQwen3MoeForCausalLM
 from ktransformers.server.balance_serve.inference.query_manager import QueryManager
 from ktransformers.server.balance_serve.settings import sched_ext
+from ktransformers.util.metrics import COUNT_BUCKETS, MetricsRegistry
+from ktransformers.util.expert_prefetch import ExpertPrefetcher
+from ktransformers.util.routing_stats import ExpertRoutingStats
 
 
 
@@ -56,7 +59,15 @@ class ModelRunner:
         self.features_buf = None
         self.output = None
         self.graph_memory_pool = None
+        # expert prefetch buffers of each captured graph, and the (graph, tokens) of the last replay
+        self.prefetch_buffers = []
+        self.replayed = None
         self.cuda_graphs = deduplicate_and_sort([1, 2, 3, Config().max_batch_size, 64, Config().chunk_size])
+        registry = MetricsRegistry.get_instance()
+        self.decode_queries = registry.histogram("ktransformers_engine_decode_queries",
+                                                 "Decode queries in a batch.", COUNT_BUCKETS)
+        self.batch_tokens = registry.histogram("ktransformers_engine_batch_tokens",
+                                               "Tokens in a batch, prefill chunks and decode.", COUNT_BUCKETS)
         self.use_cuda_graph = use_cuda_graph
         self.model_time = 0
         self.page_size = page_size
@@ -140,12 +151,16 @@ class ModelRunner:
             self.outputs_buf[i].num_batchs = batch_size
 
             capture_graphs(i)
+            self.prefetch_buffers.append(ExpertPrefetcher.get_instance().take_captured())
 
             with torch.cuda.stream(self.stream):
                 self.graphs[i].replay()
 
             self.sync(calc_time=False)
             print(f"cuda_graph: {i+1}/{len(self.cuda_graphs)}, warmup finished.")
+        # the warmup batches ran through the gates, they are not traffic
+        ExpertRoutingStats.get_instance().reset()
+        ExpertPrefetcher.get_instance().reset()
         
     def run(self, batch: sched_ext.BatchQueryTodo = None, query_manager: QueryManager = None):
         with torch.cuda.stream(self.stream):
@@ -155,11 +170,11 @@ class ModelRunner:
             for i in range(len(batch.decode_mini_batches)):
                 batch_size += len(batch.decode_mini_batches[i])
                 num_tokens += len(batch.decode_mini_batches[i])
-                print(f'decode_batch_i: {len(batch.decode_mini_batches[i])},')
 
             for i in range(len(batch.prefill_mini_batches)):
                 num_tokens += batch.prefill_mini_batches[i][2]
-                print(f'prefill_batch_i: {batch.prefill_mini_batches[i][2]},')
+            self.decode_queries.observe(batch_size - len(batch.prefill_mini_batches))
+            self.batch_tokens.observe(num_tokens)
 
 
 
@@ -197,6 +212,7 @@ class ModelRunner:
 
                 self.page_idx_buf[cuda_graph_idx][num_tokens:].fill_(self.model.cache.max_cache_len // self.model.cache.page_size -1)
                 self.replay(cuda_graph_idx)
+                self.replayed = (cuda_graph_idx, num_tokens)
                 self.output = ForwardBatchOutput()
                 
                 self.output.top_ps.append(self.input[cuda_graph_idx].minibatch.top_ps)
@@ -223,5 +239,9 @@ class ModelRunner:
 
     def sync(self, calc_time = True):
         self.stream.synchronize()
+        if self.replayed is not None:
+            cuda_graph_idx, num_tokens = self.replayed
+            self.replayed = None
+            ExpertPrefetcher.get_instance().on_replay(self.prefetch_buffers[cuda_graph_idx], num_tokens)
         if calc_time:
             self.model_time = self.start_model_event.elapsed_time(self.end_model_event)  # In ms
\ No newline at end of file
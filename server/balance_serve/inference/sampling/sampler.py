@@ -29,8 +29,12 @@ class SamplingOptions():
 
 	# Dispatch in CUDA graph
 	need_min_p_sampling: bool
+
+	# (bsz, vocab) bool, the tokens each request may sample, None for all
+	token_masks: torch.Tensor
 	
-	def __init__(self, bsz = 1, device = torch.device('cuda'), pretrained_config:GenerationConfig = None, temperatures: torch.Tensor = None, top_ps: torch.Tensor = None):
+	def __init__(self, bsz = 1, device = torch.device('cuda'), pretrained_config:GenerationConfig = None, temperatures: torch.Tensor = None, top_ps: torch.Tensor = None, token_masks: torch.Tensor = None):
+		self.token_masks = token_masks
 		if pretrained_config is None and temperatures is None:
 			self.temperatures = torch.full((bsz, 1), 0, device=device, dtype=torch.float32)
 			self.top_ps = torch.ones((bsz, 1), device=device, dtype=torch.float32)
@@ -64,6 +68,8 @@ class Sampler(nn.Module):
 			sampling_config = SamplingOptions()
 
 		logits = logits.contiguous()
+		if sampling_config.token_masks is not None:
+			logits = logits.masked_fill(~sampling_config.token_masks, float("-inf"))
 		origin_logits = logits.clone()
 		if sampling_config.is_all_greedy:
 			# Use torch.argmax if all requests use greedy sampling
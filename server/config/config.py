@@ -77,6 +77,10 @@ class Config(metaclass=Singleton):
         self.server_ip = self.server.get("ip", "0.0.0.0")
         self.server_port = self.server.get("port", 9016)
         self.api_key = self.server.get("api_key", "")
+        # streamed frames are joined into one write up to this many bytes, waiting up to this long for more
+        # (0 sends what is ready at once)
+        self.stream_flush_bytes = self.server.get("stream_flush_bytes", 65536)
+        self.stream_flush_ms = self.server.get("stream_flush_ms", 0)
 
         # db configs
         self.db_configs: dict = cfg.get("db", {})
@@ -111,7 +115,9 @@ class Config(metaclass=Singleton):
         )
         
         self.max_new_tokens = self.model.get("max_new_tokens", 2000)
+        # constrain every generation to JSON: the schema in the json_schema file, or any JSON object
         self.json_mode = self.model.get("json_mode", False)
+        self.json_schema: Optional[str] = self.model.get("json_schema", None)
         self.healing = self.model.get("healing", False)
         self.ban_strings: Optional[list] = self.model.get("ban_strings", None)
         self.gpu_split: Optional[str] = self.model.get("gpu_split", None)
@@ -146,11 +152,35 @@ class Config(metaclass=Singleton):
         self.cache_8bit = self.model.get("cache_8bit", False)
         self.cache_q4 = self.model.get("cache_q4", True)
         self.ngram_decoding = self.model.get("ngram_decoding", False)
+        # tokens drafted per forward, and the longest n-gram looked up in the prompt and history
+        self.ngram_num_draft = self.model.get("ngram_num_draft", 4)
+        self.ngram_max_ngram = self.model.get("ngram_max_ngram", 3)
+        # prefill chunk length picked per context position by measured tokens/s, chunk_size the longest,
+        # under a cap on the estimated activation memory (MB, None for no cap)
+        self.adaptive_chunk = self.model.get("adaptive_chunk", False)
+        self.chunk_memory_mb = self.model.get("chunk_memory_mb", None)
         self.print_timings = self.model.get("print_timings", False)
         self.amnesia = self.model.get("amnesia", False)
         self.batch_size = self.model.get("batch_size", 1)
         self.cache_lens = self.model.get("cache_lens", 4096)
+        # auto keeps the model dtype, int8 / int4 quantize the kv cache pages
+        self.kv_cache_dtype = self.model.get("kv_cache_dtype", "auto")
+        # parallel load_weights: worker threads, and the tensor bytes being read at once
+        self.load_workers = self.model.get("load_workers", 1)
+        self.load_max_inflight_mb = self.model.get("load_max_inflight_mb", 4096)
         self.device = self.model.get("device", "cuda:2")
+        # type: mock, rates of the model free backend used for load testing
+        self.mock_prefill_tps = self.model.get("mock_prefill_tps", 2000)
+        self.mock_decode_tps = self.model.get("mock_decode_tps", 20)
+        self.mock_max_batch = self.model.get("mock_max_batch", 4)
+        self.mock_output_tokens = self.model.get("mock_output_tokens", 128)
+        # replies to temperature 0 requests kept in memory (and response_cache_dir if set), LRU within the MB
+        # caps, replayed at response_cache_replay_tps tokens/s (0: at once)
+        self.response_cache = self.model.get("response_cache", False)
+        self.response_cache_mb = self.model.get("response_cache_mb", 256)
+        self.response_cache_dir: Optional[str] = self.model.get("response_cache_dir", None)
+        self.response_cache_disk_mb = self.model.get("response_cache_disk_mb", 4096)
+        self.response_cache_replay_tps = self.model.get("response_cache_replay_tps", 0)
 
         # web config
         self.web: dict = cfg.get("web", {})
@@ -185,6 +215,29 @@ class Config(metaclass=Singleton):
         self.preselect_block_count = self.long_context_config.get("preselect_block_count", 32)
         self.layer_step = self.long_context_config.get("layer_step", 1)
         self.token_step = self.long_context_config.get("token_step", 100)
+        self.importance_decay = float(self.long_context_config.get("importance_decay", 1.0))
+
+        # routing stats
+        self.routing_stats_config: dict = cfg.get("routing_stats", {})
+        self.routing_stats_enable = self.routing_stats_config.get("enable", False)
+        self.routing_stats_coactivation = self.routing_stats_config.get("coactivation", True)
+        self.routing_stats_dump_path: Optional[str] = self.routing_stats_config.get("dump_path", None)
+
+        # expert prefetch
+        self.expert_prefetch_config: dict = cfg.get("expert_prefetch", {})
+        self.expert_prefetch_enable = self.expert_prefetch_config.get("enable", False)
+        self.expert_prefetch_max_tokens = self.expert_prefetch_config.get("max_tokens", 4)
+
+        # expert placement
+        self.expert_placement_config: dict = cfg.get("expert_placement", {})
+        self.expert_placement_enable = self.expert_placement_config.get("enable", False)
+        self.expert_placement_stats_path: Optional[str] = self.expert_placement_config.get("stats_path", None)
+        self.expert_placement_local_nodes = self.expert_placement_config.get("local_nodes", "0")
+        self.expert_placement_cxl_nodes = self.expert_placement_config.get("cxl_nodes", "")
+        self.expert_placement_local_capacity_gb = self.expert_placement_config.get("local_capacity_gb", 0)
+        self.expert_placement_cxl_capacity_gb = self.expert_placement_config.get("cxl_capacity_gb", 0)
+        self.expert_placement_cxl_backing_dir: Optional[str] = self.expert_placement_config.get("cxl_backing_dir", None)
+        self.expert_placement_threads_per_node = self.expert_placement_config.get("threads_per_node", 0)
 
         # local chat
         self.local_chat_config: dict = cfg.get("local_chat", {})
@@ -7,7 +7,9 @@ from pydantic import BaseModel
 
 from ktransformers.server.schemas.assistants.runs import RunStreamResponse
 from ktransformers.server.schemas.endpoints.chat import ChatCompletionChunk
+from ktransformers.server.config.config import Config
 from ktransformers.server.config.log import logger
+from ktransformers.server.utils.stream_writer import coalesce
 from ktransformers.server.schemas.base import Object
 from ktransformers.server.schemas.assistants.messages import ContentType, ImageFileObject, ImageUrlObject, MessageObject, Text, TextObject
 
@@ -105,7 +107,8 @@ async def filter_api_event(async_events: AsyncIterable):
 
 async def filter_chat_chunk(async_events: AsyncIterable):
     async for event in async_events:
-        if isinstance(event, ChatCompletionChunk):
+        # str: a frame already rendered from a template
+        if isinstance(event, (ChatCompletionChunk, str)):
             yield event
 
 
@@ -117,20 +120,27 @@ async def filter_by_types(async_events: AsyncIterable, types: List):
                 continue
 
 
-def api_stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_api_event(async_events)))), media_type="text/event-stream")
+def coalesced_response(frames: AsyncIterable):
+    # disconnects cancel the response task, which closes the generator, so frames aren't checked one by one
+    config = Config()
+    return StreamingResponse(coalesce(frames, config.stream_flush_ms / 1000, config.stream_flush_bytes),
+                             media_type="text/event-stream")
 
 
-def chat_stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_chat_chunk(async_events)))), media_type="text/event-stream")
+def api_stream_response(async_events: AsyncIterable):
+    return coalesced_response(to_stream_reply(add_done(filter_api_event(async_events))))
 
 
-def stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(async_events))), media_type="text/event-stream")
+def chat_stream_response(async_events: AsyncIterable):
+    return coalesced_response(to_stream_reply(add_done(filter_chat_chunk(async_events))))
 
 
-def check_link_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, async_events), media_type="text/event-stream")
+def stream_response(async_events: AsyncIterable):
+    return coalesced_response(to_stream_reply(add_done(async_events)))
+
+
+def check_link_response(async_events: AsyncIterable):
+    return coalesced_response(async_events)
 
 
 def wrap_async_generator_into_queue(async_events: AsyncIterable) -> asyncio.Queue:
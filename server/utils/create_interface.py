@@ -25,10 +25,17 @@ def create_interface(config: Config, default_args: ConfigArgs):
         from ktransformers.server.backend.interfaces.ktransformers import  KTransformersInterface as BackendInterface
     elif config.backend_type == 'balance_serve':
         from ktransformers.server.backend.interfaces.balance_serve import BalanceServeInterface as BackendInterface
+    elif config.backend_type == 'mock':
+        from ktransformers.server.backend.interfaces.mock import MockInterface as BackendInterface
     else:
         raise NotImplementedError(f'{config.backend_type} not implemented')
-    GlobalInterface.interface = BackendInterface(default_args)
-    GlobalContextManager.context_manager = ThreadContextManager(GlobalInterface.interface)
+    backend = BackendInterface(default_args)
+    GlobalInterface.interface = backend
+    if config.response_cache:
+        from ktransformers.server.utils.response_cache import ResponseCache
+        GlobalInterface.interface = ResponseCache(backend, default_args)
+    # thread contexts are picked by backend type, so they get the backend itself, not the cache in front of it
+    GlobalContextManager.context_manager = ThreadContextManager(backend)
 
 class GlobalContextManager:
     context_manager: ThreadContextManager
@@ -0,0 +1,280 @@
+'''
+Description  : Response cache for deterministic requests. Wraps the backend interface, so the OpenAI
+               chat, legacy completions and Ollama endpoints all go through it: a request with
+               temperature 0 is keyed by the sha256 of the model identity, its prompt tokens and its
+               sampling parameters. A key generated before is replayed from memory or disk, at
+               response_cache_replay_tps tokens/s (0: at once); a key being generated is followed
+               as it streams; any other starts a generation its identical requests can join, and
+               is stored once it finishes. Memory and disk are each LRU bounded in bytes.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ktransformers.server.config.log import logger
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.util.metrics import MetricsRegistry
+
+# settings a reply depends on besides the prompt and the sampling parameters
+IDENTITY_FIELDS = ("backend_type", "model_name", "model_dir", "gguf_path", "optimize_config_path",
+                   "max_new_tokens", "cache_lens", "json_mode", "json_schema", "user_force_think",
+                   "mock_output_tokens")
+SAMPLING_FIELDS = ("temperature", "top_p", "max_tokens", "max_completion_tokens")
+
+
+def model_identity(args) -> dict:
+    return {name: getattr(args, name, None) for name in IDENTITY_FIELDS}
+
+
+def is_deterministic(params: dict) -> bool:
+    return params.get("temperature") == 0
+
+
+def entry_bytes(entry: dict) -> int:
+    return sum(len(token) + 16 for token, _ in entry["items"]) + 256
+
+
+class ResponseStore:
+    """
+    Finished replies by key, {"items": [[token, finish_reason], ...], "usage": RawUsage fields or None}.
+    Memory holds up to memory_bytes, the directory (if any) up to disk_bytes, least recently used out first.
+    """
+
+    def __init__(self, memory_bytes: int, directory: Optional[str] = None, disk_bytes: int = 0):
+        self.memory_bytes = memory_bytes
+        self.memory: "OrderedDict[str, dict]" = OrderedDict()
+        self.memory_used = 0
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.disk: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_used = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            files = []
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(directory, name))
+                    files.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+            for _, key, size in sorted(files):
+                self.disk[key] = size
+                self.disk_used += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry
+        if key not in self.disk:
+            return None
+        try:
+            with open(self.path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"response cache: dropping {key}: {e}")
+            self.disk_used -= self.disk.pop(key)
+            return None
+        self.disk.move_to_end(key)
+        os.utime(self.path(key))
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: dict):
+        self._remember(key, entry)
+        if self.directory is None or key in self.disk:
+            return
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.disk_bytes:
+            return
+        tmp_path = f"{self.path(key)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+        self.disk[key] = len(data)
+        self.disk_used += len(data)
+        while self.disk_used > self.disk_bytes:
+            old, size = self.disk.popitem(last=False)
+            self.disk_used -= size
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def _remember(self, key: str, entry: dict):
+        size = entry_bytes(entry)
+        if size > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_used -= entry_bytes(self.memory.pop(key))
+        self.memory[key] = entry
+        self.memory_used += size
+        while self.memory_used > self.memory_bytes:
+            _, old = self.memory.popitem(last=False)
+            self.memory_used -= entry_bytes(old)
+
+
+class _Flight:
+    """One generation in progress: what it yielded so far, followed by every request waiting on its key."""
+
+    def __init__(self):
+        self.items: list = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.followers = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def push(self, item):
+        self.items.append(item)
+        self._wake()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self, on_abandon):
+        self.followers += 1
+        try:
+            i = 0
+            while True:
+                changed = self.changed
+                while i < len(self.items):
+                    yield self.items[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.followers -= 1
+            if self.followers == 0 and not self.done:
+                # nobody reads the reply any more
+                on_abandon()
+
+
+class ResponseCache:
+    """
+    Stands in for the backend interface: inference() goes through the cache, every other attribute is the
+    interface's. Requests that aren't deterministic go straight to the interface.
+    """
+
+    def __init__(self, interface, args):
+        self.interface = interface
+        self.identity = model_identity(args)
+        self.store = ResponseStore(int(args.response_cache_mb) << 20, args.response_cache_dir,
+                                   int(args.response_cache_disk_mb) << 20)
+        self.replay_tps = float(args.response_cache_replay_tps or 0)
+        self.flights: Dict[str, _Flight] = {}
+        registry = MetricsRegistry.get_instance()
+        self.hits = registry.counter("ktransformers_response_cache_hits_total",
+                                     "Deterministic requests replayed from the response cache.")
+        self.joins = registry.counter("ktransformers_response_cache_joins_total",
+                                      "Deterministic requests that followed an identical one in flight.")
+        self.misses = registry.counter("ktransformers_response_cache_misses_total",
+                                       "Deterministic requests generated by the backend.")
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+    def prompt_tokens(self, local_messages) -> List:
+        """The prompt as the model sees it: its tokens, or its text for a backend without a tokenizer."""
+        tokenizer = getattr(self.interface, "tokenizer", None)
+        if tokenizer is None:
+            return [local_messages] if isinstance(local_messages, str) else list(local_messages)
+        if isinstance(local_messages, str):
+            return tokenizer.encode(local_messages)
+        return list(tokenizer.apply_chat_template(local_messages, tokenize=True, add_generation_prompt=True))
+
+    def key(self, local_messages, params: dict) -> str:
+        content = {"model": self.identity, "prompt": self.prompt_tokens(local_messages),
+                   "sampling": {name: params.get(name) for name in SAMPLING_FIELDS}}
+        return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def inference(self, local_messages, thread_id, *args, **kwargs):
+        params = dict(zip(SAMPLING_FIELDS, args), **kwargs)
+        if not is_deterministic(params):
+            async for item in self.interface.inference(local_messages, thread_id, *args, **kwargs):
+                yield item
+            return
+
+        key = self.key(local_messages, params)
+        entry = self.store.get(key)
+        if entry is not None:
+            self.hits.inc()
+            async for item in self.replay(entry):
+                yield item
+            return
+
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.joins.inc()
+        else:
+            self.misses.inc()
+            flight = self.flights[key] = _Flight()
+            flight.task = asyncio.create_task(self.generate(key, flight, local_messages, thread_id, args, kwargs))
+        async for item in flight.follow(lambda: self.abandon(key, flight)):
+            yield item
+
+    async def generate(self, key: str, flight: _Flight, local_messages, thread_id, args, kwargs):
+        try:
+            async for item in self.interface.inference(local_messages, thread_id, *args, **kwargs):
+                flight.push(item)
+        except BaseException as e:
+            self.flights.pop(key, None)
+            flight.finish(e)
+            if not isinstance(e, asyncio.CancelledError):
+                logger.warning(f"response cache: generation of {key} failed: {e!r}")
+            return
+        self.flights.pop(key, None)
+        entry = self.entry(flight.items)
+        if entry is not None:
+            self.store.put(key, entry)
+        flight.finish()
+
+    def abandon(self, key: str, flight: _Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        flight.task.cancel()
+
+    @staticmethod
+    def entry(items: list) -> Optional[dict]:
+        """The stored form of a reply, None unless it ran to a finish reason."""
+        tokens, usage, finished = [], None, False
+        for item in items:
+            if isinstance(item, RawUsage):
+                usage = item.model_dump()
+            elif isinstance(item, tuple) and len(item) == 2:
+                tokens.append([item[0], item[1]])
+                finished = finished or item[1] is not None
+        return {"items": tokens, "usage": usage} if finished else None
+
+    async def replay(self, entry: dict):
+        loop = asyncio.get_running_loop()
+        begin = loop.time()
+        first = None
+        for i, (token, finish_reason) in enumerate(entry["items"]):
+            if self.replay_tps > 0:
+                delay = begin + i / self.replay_tps - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if first is None:
+                first = loop.time() - begin
+            yield token, finish_reason
+        usage = entry["usage"]
+        if usage is not None:
+            elapsed = loop.time() - begin
+            yield RawUsage(tokenize_time=0.0, prefill_time=first or 0.0, decode_time=elapsed - (first or 0.0),
+                           prefill_count=usage["prefill_count"], decode_count=usage["decode_count"])
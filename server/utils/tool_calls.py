@@ -0,0 +1,224 @@
+'''
+Description  : Incremental parser for DeepSeek style tool calls in streamed chat output:
+
+                   <｜tool▁calls▁begin｜><｜tool▁call▁begin｜>function<｜tool▁sep｜>name
+                   ```json
+                   {"arg": 1}
+                   ```<｜tool▁call▁end｜><｜tool▁calls▁end｜>
+
+               (or the short <tools▁begin>, <tool▁begin>, ... markers of the tool prompt). It is a
+               character level state machine that only holds back the few characters that may
+               still turn into a marker, so feeding a token costs O(len(token)) however long the
+               response is, and it turns the text into OpenAI chat.completion.chunk deltas.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+from enum import Enum
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+TOOL_CALLS_BEGIN = "<｜tool▁calls▁begin｜>"
+TOOL_CALL_BEGIN = "<｜tool▁call▁begin｜>"
+TOOL_SEP = "<｜tool▁sep｜>"
+TOOL_CALL_END = "<｜tool▁call▁end｜>"
+TOOL_CALLS_END = "<｜tool▁calls▁end｜>"
+
+# the short markers get_tool_instructions asks for
+MARKER_ALIASES = {
+    "<tools▁begin>": TOOL_CALLS_BEGIN,
+    "<tool▁begin>": TOOL_CALL_BEGIN,
+    "<tool▁sep>": TOOL_SEP,
+    "<tool▁end>": TOOL_CALL_END,
+    "<tools▁end>": TOOL_CALLS_END,
+}
+
+ARGS_BEGIN = "```json"
+ARGS_END = "```"
+
+
+class State(Enum):
+    TEXT = 0        # content, until the calls begin
+    CALLS = 1       # between two calls
+    HEADER = 2      # "function", until the separator
+    NAME = 3        # function name, until the end of the line
+    PRE_ARGS = 4    # until the json fence opens
+    ARGS = 5        # arguments, until the fence closes
+    POST_ARGS = 6   # until the call ends
+    DONE = 7        # after the calls end, everything is dropped
+
+
+# markers each state reacts to, by canonical marker; the characters of other text go to the state's sink
+STATE_MARKERS = {
+    State.TEXT: (TOOL_CALLS_BEGIN,),
+    State.CALLS: (TOOL_CALL_BEGIN, TOOL_CALLS_END),
+    State.HEADER: (TOOL_SEP, TOOL_CALL_END, TOOL_CALLS_END),
+    State.NAME: ("\n", TOOL_CALL_END, TOOL_CALLS_END),
+    State.PRE_ARGS: (ARGS_BEGIN, TOOL_CALL_END, TOOL_CALLS_END),
+    State.ARGS: (ARGS_END, TOOL_CALL_END, TOOL_CALLS_END),
+    State.POST_ARGS: (TOOL_CALL_END, TOOL_CALLS_END),
+    State.DONE: (),
+}
+
+
+def _compile(markers):
+    spellings = {}
+    for marker in markers:
+        spellings[marker] = marker
+        spellings.update({alias: canonical for alias, canonical in MARKER_ALIASES.items() if canonical == marker})
+    prefixes = {spelling[:i] for spelling in spellings for i in range(1, len(spelling))}
+    return spellings, prefixes
+
+
+COMPILED_MARKERS = {state: _compile(markers) for state, markers in STATE_MARKERS.items()}
+
+
+class ToolCallParser:
+    """
+    feed() takes a text delta and returns the chunk deltas it completes: {"content": ...} for text before the
+    tool calls, a {"role", "content": None, "tool_calls": [{index, id, type, function: {name, arguments: ""}}]}
+    delta when the arguments of a call open, then {"tool_calls": [{index, function: {arguments}}]} deltas as
+    they stream. Calls are reported once their ```json fence opens, so the deltas always add up to
+    `tool_calls`; a call that ends before that is malformed and dropped, as is any text after the calls end.
+    """
+    def __init__(self):
+        self.state = State.TEXT
+        self.pending = ""
+        self.content: List[str] = []
+        self.tool_calls: List[Dict[str, Any]] = []
+        self._name: List[str] = []
+        self._args: List[str] = []
+        self._args_started = False
+        self._args_space = ""
+        self._deltas: List[Dict[str, Any]] = []
+        self._text: List[str] = []
+
+    @property
+    def done(self) -> bool:
+        return self.state == State.DONE
+
+    @property
+    def finish_reason(self) -> Optional[str]:
+        return "tool_calls" if self.tool_calls else None
+
+    def feed(self, delta: str) -> List[Dict[str, Any]]:
+        for char in delta:
+            self._push(char)
+        return self._flush()
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """End of the output: characters held back for a marker that never completed are text again."""
+        pending, self.pending = self.pending, ""
+        self._sink(pending)
+        if self.state == State.ARGS:
+            self._close_args()
+        return self._flush()
+
+    def message(self) -> Dict[str, Any]:
+        """The whole response as a chat.completion message."""
+        if self.tool_calls:
+            return {"role": "assistant", "content": None, "tool_calls": self.tool_calls}
+        return {"role": "assistant", "content": "".join(self.content)}
+
+    def _push(self, char: str):
+        spellings, prefixes = COMPILED_MARKERS[self.state]
+        candidate = self.pending + char
+        # the longest suffix that is a marker, or may still become one; what is before it is plain text
+        for start in range(len(candidate)):
+            tail = candidate[start:]
+            if tail in spellings:
+                self.pending = ""
+                self._sink(candidate[:start])
+                self._on_marker(spellings[tail])
+                return
+            if tail in prefixes:
+                self.pending = tail
+                self._sink(candidate[:start])
+                return
+        self.pending = ""
+        self._sink(candidate)
+
+    def _sink(self, text: str):
+        if not text:
+            return
+        if self.state == State.TEXT:
+            self._text.append(text)
+        elif self.state == State.NAME:
+            self._name.append(text)
+        elif self.state == State.ARGS:
+            for char in text:
+                if char.isspace():
+                    # leading whitespace is dropped, trailing whitespace is held until more arguments follow
+                    if self._args_started:
+                        self._args_space += char
+                    continue
+                self._args.append(self._args_space + char)
+                self._args_space = ""
+                self._args_started = True
+
+    def _on_marker(self, marker: str):
+        state = self.state
+        if marker == TOOL_CALLS_END:
+            if state == State.ARGS:
+                self._close_args()
+            self.state = State.DONE
+        elif marker == TOOL_CALL_END:
+            if state == State.ARGS:
+                self._close_args()
+            self.state = State.CALLS
+        elif state == State.TEXT:
+            self.state = State.CALLS
+        elif state == State.CALLS:
+            self._name = []
+            self.state = State.HEADER
+        elif state == State.HEADER:
+            self.state = State.NAME
+        elif state == State.NAME:
+            self.state = State.PRE_ARGS
+        elif state == State.PRE_ARGS:
+            self._open_args()
+            self.state = State.ARGS
+        elif state == State.ARGS:
+            self._close_args()
+            self.state = State.POST_ARGS
+
+    def _open_args(self):
+        call = {
+            "id": f"call_{uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": "".join(self._name).strip(), "arguments": ""},
+        }
+        self.tool_calls.append(call)
+        self._args_started = False
+        self._args_space = ""
+        self._deltas.append({
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "index": len(self.tool_calls) - 1, "id": call["id"], "type": "function",
+                "function": {"name": call["function"]["name"], "arguments": ""},
+            }],
+        })
+
+    def _close_args(self):
+        self._flush_args()
+        self._args_space = ""
+
+    def _flush_args(self):
+        if not self._args:
+            return
+        arguments = "".join(self._args)
+        self._args = []
+        self.tool_calls[-1]["function"]["arguments"] += arguments
+        self._deltas.append({"tool_calls": [{"index": len(self.tool_calls) - 1, "function": {"arguments": arguments}}]})
+
+    def _flush(self) -> List[Dict[str, Any]]:
+        if self.state == State.ARGS:
+            self._flush_args()
+        if self._text:
+            text = "".join(self._text)
+            self._text = []
+            self.content.append(text)
+            # content always precedes the calls, it goes out first
+            self._deltas.insert(0, {"content": text})
+        deltas, self._deltas = self._deltas, []
+        return deltas
@@ -0,0 +1,72 @@
+"""
+CPU microbenchmark of the block importance scoring used by DynamicScaledDotProductAttention
+during the last prefill chunk: per head python loop (the previous implementation) against
+the head batched attn_score_one_block, swept over head count and context length. Also checks
+both pick the same preselected blocks.
+
+    python tests/bench_attn_score.py --heads 8 32 64 --context 4096 16384 65536
+"""
+import argparse
+import math
+import time
+import torch
+from ktransformers.operators.dynamic_attention import attn_score_one_block
+
+
+def attn_score_per_head(importance, query, key, head_dim, use_softmax=True):
+    n_gqa = query.size(1) // key.size(1)
+    for head_idx in range(query.size(1)):
+        key_item = key[..., head_idx // n_gqa, :].view(key.size(0), -1)
+        qk = torch.einsum("qd,kd->qk", query[:, head_idx, :], key_item)
+        if use_softmax:
+            qk = torch.nn.functional.softmax(
+                qk / math.sqrt(head_dim), dim=-1, dtype=torch.float32
+            ).to(torch.float16)
+        importance[..., head_idx] += torch.sum(qk, dim=-2)
+
+
+def select_blocks(importance, block_size, count):
+    block_num = importance.size(0) // block_size
+    scores = importance[:block_num * block_size].view(block_num, block_size, -1).float().mean(dim=(-1, -2))
+    return set(torch.topk(scores, k=min(count, block_num)).indices.tolist())
+
+
+def timeit(fn, repeat):
+    fn()
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - begin) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--heads", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--kv_heads", type=int, default=8)
+    parser.add_argument("--context", type=int, nargs="+", default=[4096, 16384, 65536])
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--query_len", type=int, default=128)
+    parser.add_argument("--block_size", type=int, default=128)
+    parser.add_argument("--preselect_block_count", type=int, default=96)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print(f"{'heads':>6} {'context':>8} {'loop ms':>10} {'batched ms':>11} {'speedup':>8} {'same blocks':>12}")
+    for heads in args.heads:
+        kv_heads = min(args.kv_heads, heads)
+        for context in args.context:
+            query = torch.randn(args.query_len, heads, args.head_dim, dtype=torch.float16)
+            key = torch.randn(context, kv_heads, args.head_dim, dtype=torch.float16)
+            ref = torch.zeros(context, heads, dtype=torch.float16)
+            out = torch.zeros(context, heads, dtype=torch.float16)
+            loop_s = timeit(lambda: attn_score_per_head(ref.zero_(), query, key, args.head_dim), args.repeat)
+            batched_s = timeit(lambda: attn_score_one_block(out.zero_(), query, key, args.head_dim), args.repeat)
+            same = select_blocks(ref, args.block_size, args.preselect_block_count) == \
+                select_blocks(out, args.block_size, args.preselect_block_count)
+            print(f"{heads:>6} {context:>8} {loop_s * 1e3:>10.2f} {batched_s * 1e3:>11.2f} "
+                  f"{loop_s / batched_s:>7.2f}x {str(same):>12}")
+
+
+if __name__ == "__main__":
+    main()
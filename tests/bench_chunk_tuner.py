@@ -0,0 +1,86 @@
+"""
+Fixed against adaptive prefill chunk lengths on a synthetic layer: per chunk a fixed overhead (--overhead_ms,
+standing in for expert dispatch and CPUInfer syncs), an MLP over the chunk and causal attention of the chunk over
+the whole context so far. For each prompt length prints the prefill tokens/s of every fixed --chunks length and
+of the ChunkTuner, cold (exploring on that prompt) and warm (after --warmup prompts), with the lengths it chose;
+the tuner keeps the attention scores of a chunk under --memory_mb, the fixed lengths don't.
+
+    python tests/bench_chunk_tuner.py --lengths 2048 8192 16384 --chunks 512 1024 4096
+"""
+import argparse
+import time
+import torch
+from ktransformers.util.chunk_tuner import ChunkTuner
+
+
+class SyntheticPrefill:
+    def __init__(self, hidden, heads, max_len, overhead):
+        gen = torch.Generator().manual_seed(0)
+        self.heads, self.head_dim = heads, hidden // heads
+        self.overhead = overhead
+        self.wq = torch.randn(hidden, hidden, generator=gen) / hidden ** 0.5
+        self.wk = torch.randn(hidden, hidden, generator=gen) / hidden ** 0.5
+        self.w1 = torch.randn(hidden, 4 * hidden, generator=gen) / hidden ** 0.5
+        self.w2 = torch.randn(4 * hidden, hidden, generator=gen) / (4 * hidden) ** 0.5
+        self.keys = torch.empty(heads, max_len, self.head_dim)
+
+    def score_bytes(self, length, position):
+        return 4 * self.heads * length * (position + length)
+
+    def chunk(self, x, position):
+        length = x.size(0)
+        time.sleep(self.overhead)
+        q = (x @ self.wq).view(length, self.heads, self.head_dim).transpose(0, 1)
+        self.keys[:, position:position + length] = (x @ self.wk).view(length, self.heads, self.head_dim).transpose(0, 1)
+        keys = self.keys[:, :position + length]
+        scores = q @ keys.transpose(1, 2) / self.head_dim ** 0.5
+        causal = torch.arange(position + length)[None, :] > torch.arange(position, position + length)[:, None]
+        attn = torch.softmax(scores.masked_fill(causal, float("-inf")), dim=-1) @ keys
+        return torch.relu(attn.transpose(0, 1).reshape(length, -1) @ self.w1) @ self.w2
+
+    def prefill(self, x, chunk_size=None, tuner=None):
+        position, chosen = 0, []
+        begin = time.perf_counter()
+        while position < x.size(0):
+            length = tuner.choose(position, x.size(0) - position) if tuner is not None else chunk_size
+            length = min(length, x.size(0) - position)
+            chunk_begin = time.perf_counter()
+            self.chunk(x[position:position + length], position)
+            if tuner is not None:
+                tuner.record(position, length, time.perf_counter() - chunk_begin)
+            chosen.append(length)
+            position += length
+        return x.size(0) / (time.perf_counter() - begin), chosen
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[2048, 8192, 16384])
+    parser.add_argument("--chunks", type=int, nargs="+", default=[512, 1024, 4096])
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--overhead_ms", type=float, default=20.0)
+    parser.add_argument("--max_chunk", type=int, default=4096)
+    parser.add_argument("--memory_mb", type=int, default=1024, help="cap on the tuner's attention scores")
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    model = SyntheticPrefill(args.hidden, args.heads, max(args.lengths), args.overhead_ms / 1000)
+    header = "".join(f"{f'fixed {chunk}':>12}" for chunk in args.chunks)
+    print("prefill tokens/s")
+    print(f"{'prompt':>8}{header}{'adaptive':>12}{'warm':>12}  warm chunk lengths")
+    for seq_length in args.lengths:
+        x = torch.randn(seq_length, args.hidden, generator=torch.Generator().manual_seed(seq_length))
+        fixed = [model.prefill(x, chunk_size=chunk)[0] for chunk in args.chunks]
+        tuner = ChunkTuner(f"synthetic:{seq_length}", args.max_chunk, memory_cap=args.memory_mb << 20,
+                           bytes_fn=model.score_bytes)
+        cold, _ = model.prefill(x, tuner=tuner)
+        for _ in range(args.warmup):
+            model.prefill(x, tuner=tuner)
+        warm, chosen = model.prefill(x, tuner=tuner)
+        row = "".join(f"{tps:>12.0f}" for tps in fixed)
+        print(f"{seq_length:>8}{row}{cold:>12.0f}{warm:>12.0f}  {chosen}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+CPU prefill throughput of KDeepseekV2Attention.forward_windows by prompt length: the masked path (a causal
+mask over max_cache_len per chunk, scores over the whole cache width, outputs concatenated) against implicit
+causality (keys up to the last query of the chunk, online softmax, preallocated output).
+
+    python tests/bench_chunked_prefill.py --prompt 1024 4096 8192 --cache 16384
+"""
+import argparse
+import time
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.modeling_deepseek import DeepseekV2Attention
+from ktransformers.operators.attention import KDeepseekV2Attention
+from mla_helpers import causal_mask
+
+
+def masked_windows(attn, hidden_states, cache, cache_position):
+    """The loop forward_windows replaced: a dense masked forward_chunck per chunk, outputs concatenated."""
+    attn.decode_max_q_len = 0
+    attn_output = None
+    for begin in range(0, hidden_states.size(1), attn.chunck_size):
+        position = cache_position[begin:begin + attn.chunck_size]
+        cur_output, _, _ = attn.forward_chunck(hidden_states[:, begin:begin + attn.chunck_size],
+                                               causal_mask(position, cache.max_cache_len), position[None, :], cache,
+                                               cache_position=position)
+        attn_output = cur_output if attn_output is None else torch.cat((attn_output, cur_output), dim=-2)
+    return attn_output
+
+
+@torch.no_grad()
+def prefill_tokens_per_s(attn, config, prompt, cache_len, masked, repeat):
+    hidden_states = torch.randn(1, prompt, config.hidden_size)
+    cache_position = torch.arange(prompt)
+    elapsed = []
+    for _ in range(repeat):
+        cache = StaticCache(config, 1, cache_len, "cpu", torch.float32)
+        begin = time.perf_counter()
+        if masked:
+            masked_windows(attn, hidden_states, cache, cache_position)
+        else:
+            attn.decode_max_q_len = 16
+            attn.forward_windows(hidden_states, None, cache_position[None, :], cache, cache_position=cache_position)
+        elapsed.append(time.perf_counter() - begin)
+    return prompt / sorted(elapsed)[len(elapsed) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt", type=int, nargs="+", default=[1024, 4096, 8192])
+    parser.add_argument("--cache", type=int, default=16384)
+    parser.add_argument("--chunk", type=int, default=1000)
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = DeepseekV2Config(
+        hidden_size=2048, num_hidden_layers=1, num_attention_heads=args.heads, num_key_value_heads=args.heads,
+        q_lora_rank=None, kv_lora_rank=512, qk_rope_head_dim=64, v_head_dim=128, qk_nope_head_dim=128,
+        max_position_embeddings=args.cache, architectures=["DeepseekV2ForCausalLM"],
+    )
+    attn = KDeepseekV2Attention("blk.0.attn", None, config, DeepseekV2Attention(config, 0),
+                                chunck_size=args.chunk).eval()
+    print(f"{'prompt':>8} {'masked tok/s':>13} {'implicit tok/s':>15} {'speedup':>8}")
+    for prompt in args.prompt:
+        if prompt > args.cache:
+            continue
+        masked = prefill_tokens_per_s(attn, config, prompt, args.cache, True, args.repeat)
+        implicit = prefill_tokens_per_s(attn, config, prompt, args.cache, False, args.repeat)
+        print(f"{prompt:>8} {masked:>13.1f} {implicit:>15.1f} {implicit / masked:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
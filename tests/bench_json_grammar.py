@@ -0,0 +1,116 @@
+"""
+Per-token cost of JSON mode (util/json_grammar.py). Compiles the token automaton of any JSON object (or
+--schema) over a synthetic vocabulary of --vocab tokens (or a Hugging Face --tokenizer), then samples from
+random logits and prints the time per token of plain sampling, of sampling with the precomputed mask and next
+state lookup, and of building the mask by walking the vocabulary from the current state, as a constrained
+decoder without precomputation would.
+
+    python tests/bench_json_grammar.py --vocab 128000 --tokens 500
+    python tests/bench_json_grammar.py --tokenizer /path/to/model --schema schema.json
+"""
+import argparse
+import json
+import random
+import string
+import time
+import torch
+from ktransformers.util.json_grammar import JsonAutomaton, TokenAutomaton, json_automaton, token_strings
+
+PUNCTUATION = ['{"', '":', '": "', '", "', '"}', '},', '}]', '[{', '[', ']', ',', ':', '"', '{', '}', ' ', '  ',
+               '\n', '\n  ', '\\n', '\\"', 'true', 'false', 'null']
+
+
+def synthetic_vocab(size, seed=0):
+    rng = random.Random(seed)
+    tokens = ["<eos>"] + [c for c in string.printable if c not in "\x0b\x0c\r"] + PUNCTUATION
+    tokens += [str(i) for i in range(1000)]
+    seen = set(tokens)
+    letters = string.ascii_letters + "éü中"
+    while len(tokens) < size:
+        word = "".join(rng.choice(letters) for _ in range(rng.randint(2, 9)))
+        # about as many quotes, commas and colons next to words as a BPE vocabulary has
+        word = (rng.choices(["", " ", "\"", "_"], [50, 45, 2, 3])[0] + word
+                + rng.choices(["", "\"", ",", ":", "."], [90, 2, 3, 2, 3])[0])
+        if word not in seen:
+            seen.add(word)
+            tokens.append(word)
+    return tokens
+
+
+def scan_mask(automaton, state, tokens):
+    """The mask of a state by stepping every token's characters through the character automaton."""
+    allowed = torch.zeros(len(tokens), dtype=torch.bool)
+    for token_id, text in enumerate(tokens):
+        current = state
+        for ch in text:
+            current = automaton.step(current, ch)
+            if current is None:
+                break
+        allowed[token_id] = bool(text) and current is not None
+    return allowed
+
+
+def sample(logits, generator):
+    return torch.multinomial(torch.softmax(logits, -1), 1, generator=generator).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab", type=int, default=128000)
+    parser.add_argument("--tokenizer", type=str, default=None, help="Hugging Face tokenizer instead of --vocab")
+    parser.add_argument("--schema", type=str, default=None)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--scan_tokens", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+        automaton = json_automaton(tokenizer, len(tokenizer), args.schema)
+        tokens = token_strings(tokenizer)
+    else:
+        schema = None
+        if args.schema is not None:
+            with open(args.schema, encoding="utf-8") as f:
+                schema = json.load(f)
+        tokens = synthetic_vocab(args.vocab)
+        automaton = TokenAutomaton(JsonAutomaton(schema, object_root=True), tokens, [0])
+    compiled = sum(nexts is not None for nexts in automaton.next)
+    print(f"vocab {automaton.vocab_size}: {compiled} states compiled in {time.perf_counter() - begin:.1f} s, "
+          f"masks {automaton.table().numel() / 2 ** 20:.1f} MB")
+
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(args.tokens, automaton.vocab_size, generator=generator).to(args.device)
+    automaton.table(args.device)
+
+    begin = time.perf_counter()
+    for i in range(args.tokens):
+        sample(logits[i], generator)
+    plain = (time.perf_counter() - begin) / args.tokens
+
+    state, states = automaton.initial, []
+    begin = time.perf_counter()
+    for i in range(args.tokens):
+        allowed = automaton.masks([state], args.device)[0]
+        token = sample(logits[i].masked_fill(~allowed, float("-inf")), generator)
+        states.append(state)
+        state = automaton.advance(state, token)
+        if automaton.done(state):
+            state = automaton.initial
+    masked = (time.perf_counter() - begin) / args.tokens
+
+    begin = time.perf_counter()
+    for state in states[:args.scan_tokens]:
+        scan_mask(automaton.automaton, automaton.char_states[state], tokens)
+    scan = (time.perf_counter() - begin) / min(args.scan_tokens, len(states))
+
+    print(f"{'per token':>22} {'ms':>9} {'overhead':>9}")
+    print(f"{'sampling':>22} {plain * 1000:>9.3f} {'':>9}")
+    print(f"{'precomputed mask':>22} {masked * 1000:>9.3f} {(masked - plain) * 1000:>9.3f}")
+    print(f"{'vocabulary scan':>22} {scan * 1000 + plain * 1000:>9.1f} {scan * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Restore time of a long context KV cache: the eager full-file load (CPUInfer load_kvcache when the
+extension is built, otherwise a plain read of every block) against mapping a KVSnapshot and faulting
+in only the blocks one decode step attends to (preselected + local window of every layer). The page
+cache is dropped for the file before each cold run, so the numbers include the disk reads.
+
+    python tests/bench_kv_snapshot.py --context 131072 --layers 4 --path /tmp/kv_snapshot.bin
+"""
+import argparse
+import os
+import time
+import numpy as np
+from ktransformers.util.kv_snapshot import KVSnapshot
+
+try:
+    import torch
+    from ktransformers.operators.cpuinfer import CPUInfer, CPUInferKVCache
+except ImportError:
+    CPUInferKVCache = None
+
+
+def write_synthetic(path, geometry, length, preselect_block_count, seed=0):
+    rng = np.random.default_rng(seed)
+    snapshot = KVSnapshot.create(path, geometry, length, {"generate_token_idx": 0}, preselect_block_count)
+    block = rng.standard_normal((geometry["kv_head_num"], geometry["block_size"], geometry["head_dim"])).astype(np.float16)
+    for layer_idx in range(geometry["layer_num"]):
+        for block_idx in range(snapshot.block_num):
+            k, v = snapshot.kv(layer_idx, block_idx)
+            k[:] = block
+            v[:] = block
+    snapshot.section("importance")[:] = 1
+    preselect = snapshot.section("preselect")
+    for layer_idx in range(geometry["layer_num"]):
+        preselect[layer_idx] = np.sort(rng.choice(snapshot.block_num, preselect_block_count, replace=False))
+    del k, v, preselect
+    snapshot.close()
+
+
+def eager_read(path):
+    """Every byte of the file goes through memory, like load_kvcache does."""
+    with open(path, "rb", buffering=0) as f:
+        buf = bytearray(64 << 20)
+        total = 0
+        while n := f.readinto(buf):
+            total += n
+    return total
+
+
+def snapshot_restore(path, local_block_num):
+    begin = time.perf_counter()
+    snapshot = KVSnapshot.open(path)
+    opened = time.perf_counter() - begin
+    preselect = snapshot.section("preselect")
+    # the copy update_kvcache_one_block_fp16 makes into the CPUInfer cache
+    scratch = None
+    for layer_idx in range(snapshot.geometry["layer_num"]):
+        local = range(max(snapshot.block_num - local_block_num, 0), snapshot.block_num)
+        blocks = sorted(set(preselect[layer_idx].tolist()) | set(local))
+        snapshot.prefetch(layer_idx, blocks)
+        for block_idx in blocks:
+            k, v = snapshot.kv(layer_idx, block_idx)
+            if scratch is None:
+                scratch = np.empty_like(k)
+            np.copyto(scratch, k)
+            np.copyto(scratch, v)
+    restored = time.perf_counter() - begin
+    del preselect, k, v
+    snapshot.close()
+    return opened, restored
+
+
+def cpuinfer_round_trip(path, geometry, length, threads):
+    """Fill a CPUInfer cache, dump it with dump_kvcache and time load_kvcache."""
+    cpu_infer = CPUInfer(threads)
+    block_num = (length + geometry["block_size"] - 1) // geometry["block_size"]
+    cache = CPUInferKVCache(
+        geometry["layer_num"], geometry["kv_head_num"], geometry["q_head_num"], geometry["head_dim"],
+        geometry["block_size"], anchor_num=geometry["anchor_num"], max_batch_size=1, max_block_num=block_num,
+        max_thread_num=threads,
+    )
+    k = torch.randn(geometry["kv_head_num"], geometry["block_size"], geometry["head_dim"], dtype=torch.float16)
+    for layer_idx in range(geometry["layer_num"]):
+        for block_idx in range(block_num):
+            cpu_infer.submit(cache.update_kvcache_one_block_fp16(k, k, layer_idx, block_idx))
+        cpu_infer.sync()
+    block_table = torch.arange(block_num, dtype=torch.int32)
+    cpu_infer.submit(cache.dump_kvcache(block_table, torch.tensor([length], dtype=torch.int32), path))
+    cpu_infer.sync()
+    drop_page_cache(path)
+    begin = time.perf_counter()
+    cpu_infer.submit(cache.load_kvcache(path))
+    cpu_infer.sync()
+    return time.perf_counter() - begin
+
+
+def drop_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--context", type=int, default=131072)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--kv_heads", type=int, default=8)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--block_size", type=int, default=128)
+    parser.add_argument("--preselect_block_count", type=int, default=96)
+    parser.add_argument("--local_windows_len", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--path", type=str, default="/tmp/kv_snapshot.bin")
+    args = parser.parse_args()
+
+    geometry = {
+        "layer_num": args.layers, "kv_head_num": args.kv_heads, "q_head_num": args.kv_heads,
+        "head_dim": args.head_dim, "block_size": args.block_size, "anchor_num": 1,
+    }
+    write_synthetic(args.path, geometry, args.context, args.preselect_block_count)
+    size = os.path.getsize(args.path)
+    local_block_num = args.local_windows_len // args.block_size + 1
+    print(f"context {args.context}, {args.layers} layers, snapshot {size / 2**30:.2f} GiB")
+
+    drop_page_cache(args.path)
+    begin = time.perf_counter()
+    eager_read(args.path)
+    print(f"{'eager full read':<28} {(time.perf_counter() - begin) * 1e3:>10.1f} ms")
+
+    if CPUInferKVCache is not None:
+        dump_path = args.path + ".dump"
+        print(f"{'cpuinfer load_kvcache':<28} {cpuinfer_round_trip(dump_path, geometry, args.context, args.threads) * 1e3:>10.1f} ms")
+        os.remove(dump_path)
+
+    drop_page_cache(args.path)
+    opened, restored = snapshot_restore(args.path, local_block_num)
+    print(f"{'snapshot open':<28} {opened * 1e3:>10.3f} ms")
+    print(f"{'snapshot first decode step':<28} {restored * 1e3:>10.1f} ms")
+    os.remove(args.path)
+
+
+if __name__ == "__main__":
+    main()
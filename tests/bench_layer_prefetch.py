@@ -0,0 +1,60 @@
+"""
+Per-layer prefill on a synthetic layer stack: every layer's weight is "read" for --load_ms (a sleep standing in
+for the GGUF read and dequantization, which release the GIL) and then computes a prompt of --tokens rows
+through a few matmuls. Loading each layer in turn against LayerPrefetcher at several depths; prints the wall
+time, the load and compute time it adds up from, the share of load time hidden behind compute, and checks the
+outputs are identical.
+
+    python tests/bench_layer_prefetch.py --layers 24 --hidden 2048 --tokens 4096 --load_ms 20 --depth 1 2
+"""
+import argparse
+import time
+import torch
+from test_layer_prefetch import Stack
+
+
+def run(stack, x, depth):
+    begin = time.perf_counter()
+    if depth == 0:
+        out = stack.in_turn(x)
+    else:
+        out = stack.prefetched(x, depth)
+    return time.perf_counter() - begin, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=24)
+    parser.add_argument("--hidden", type=int, default=2048)
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--load_ms", type=float, default=20.0)
+    parser.add_argument("--depth", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    stack = Stack(args.layers, args.hidden, load_delay=args.load_ms / 1000)
+    x = torch.randn(args.tokens, args.hidden, generator=torch.Generator().manual_seed(0))
+    # compute alone, layers preloaded
+    for layer in stack.layers:
+        stack.load(layer)
+    begin = time.perf_counter()
+    for layer in stack.layers:
+        layer(x)
+    compute = time.perf_counter() - begin
+    for layer in stack.layers:
+        stack.unload(layer)
+    load = args.layers * args.load_ms / 1000
+
+    print(f"{args.layers} layers: load {load * 1000:.0f} ms, compute {compute * 1000:.0f} ms")
+    print(f"{'depth':>6} {'wall ms':>9} {'load hidden':>12} {'max loaded':>11}")
+    in_turn, expected = run(stack, x, 0)
+    print(f"{'none':>6} {in_turn * 1000:>9.0f} {max(load + compute - in_turn, 0) / load:>12.0%} {1:>11}")
+    for depth in args.depth:
+        stack.max_loaded = 0
+        wall, out = run(stack, x, depth)
+        assert torch.equal(out, expected), "prefetched outputs differ"
+        hidden = min(max(load + compute - wall, 0) / load, 1.0)
+        print(f"{depth:>6} {wall * 1000:>9.0f} {hidden:>12.0%} {stack.max_loaded:>11}")
+
+
+if __name__ == "__main__":
+    main()
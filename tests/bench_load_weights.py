@@ -0,0 +1,64 @@
+"""
+load_weights on a synthetic GGUF file (F16 matrices, F32 norms) of a llama shaped model: the serial path
+against the worker pool at several worker counts and byte budgets. Every run is checked bit-identical to
+the serial load.
+
+    python tests/bench_load_weights.py --layers 16 --hidden 1024 --workers 2 4 8
+"""
+import argparse
+import os
+import tempfile
+import time
+import torch
+from ktransformers.models.configuration_llama import LlamaConfig
+from ktransformers.models.modeling_llama import LlamaForCausalLM
+from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
+from ktransformers.util.utils import load_weights
+from test_parallel_load import write_gguf
+
+
+def build(args):
+    return LlamaForCausalLM(LlamaConfig(
+        vocab_size=args.vocab, hidden_size=args.hidden, intermediate_size=args.hidden * 4,
+        num_hidden_layers=args.layers, num_attention_heads=8, num_key_value_heads=8,
+    ))
+
+
+def timed_load(args, gguf_loader, **kwargs):
+    model = build(args)
+    begin = time.perf_counter()
+    load_weights(model, gguf_loader, **kwargs)
+    return time.perf_counter() - begin, model.state_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, default=16)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--max_inflight_mb", type=int, nargs="+", default=[4096, 64])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.gguf")
+        model = build(args)
+        write_gguf(path, {translate_name_to_gguf(name): value.numpy() for name, value in model.state_dict().items()})
+        del model
+        print(f"{args.layers} layers, hidden {args.hidden}: {os.path.getsize(path) / 2**20:.0f} MiB")
+        gguf_loader = GGUFLoader(path)
+        timed_load(args, gguf_loader)  # warm the page cache
+
+        serial_s, expected = timed_load(args, gguf_loader)
+        print(f"{'serial':<24} {serial_s * 1e3:>9.1f} ms")
+        for max_inflight_mb in args.max_inflight_mb:
+            for workers in args.workers:
+                parallel_s, loaded = timed_load(args, gguf_loader, num_workers=workers,
+                                                max_bytes_in_flight=max_inflight_mb << 20)
+                assert all(torch.equal(loaded[name], value) for name, value in expected.items())
+                print(f"{f'{workers} workers, {max_inflight_mb} MB':<24} {parallel_s * 1e3:>9.1f} ms"
+                      f"   {serial_s / parallel_s:>5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Overhead of the serving metrics (util/metrics.py) on the hot paths: nanoseconds per counter increment,
+histogram observation and RequestMetrics.token() (one per generated token), from one thread and from several
+at once, and the time to render /metrics. The per-token cost should stay under a microsecond.
+
+    python tests/bench_metrics.py --iterations 1000000 --threads 1 4
+"""
+import argparse
+import threading
+import time
+from ktransformers.util.metrics import MetricsRegistry, RequestMetrics
+
+
+def ns_per_call(fn, iterations, threads):
+    def work():
+        for _ in range(iterations):
+            fn()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    begin = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - begin) / (iterations * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    counter = registry.counter("bench_total", "bench")
+    histogram = registry.histogram("bench_seconds", "bench")
+    request = RequestMetrics(registry)
+    calls = {
+        "empty loop": lambda: None,
+        "counter.inc": counter.inc,
+        "histogram.observe": lambda: histogram.observe(0.003),
+        "request.token": request.token,
+    }
+    print(f"{'threads':>8} " + " ".join(f"{name:>18}" for name in calls) + "   (ns per call)")
+    for threads in args.threads:
+        row = [ns_per_call(fn, args.iterations, threads) for fn in calls.values()]
+        print(f"{threads:>8} " + " ".join(f"{ns:>18.1f}" for ns in row))
+    begin = time.perf_counter()
+    text = registry.render()
+    print(f"render: {(time.perf_counter() - begin) * 1e3:.3f} ms, {len(text)} bytes")
+
+
+if __name__ == "__main__":
+    main()
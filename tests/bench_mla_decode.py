@@ -0,0 +1,65 @@
+"""
+CPU decode latency of KDeepseekV2Attention.forward_chunck, the dense path (scores and mask over the whole
+max_cache_len) against the length-aware path (valid pages, split log-sum-exp), swept over the tokens in the
+cache and the cache size. With the length-aware path a row should stay flat across cache sizes.
+
+    python tests/bench_mla_decode.py --valid 512 2048 8192 --cache 4096 32768
+"""
+import argparse
+import time
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.modeling_deepseek import DeepseekV2Attention
+from ktransformers.operators.attention import KDeepseekV2Attention
+from mla_helpers import causal_mask
+
+
+@torch.no_grad()
+def decode_ms(attn, config, valid, cache_len, decode_max_q_len, repeat):
+    attn.decode_max_q_len = decode_max_q_len
+    cache = StaticCache(config, 1, cache_len, "cpu", torch.float32)
+    # fill the cache as a prefill would, the latency of that is not measured
+    for begin in range(0, valid, 1024):
+        position = torch.arange(begin, min(begin + 1024, valid))
+        cache.update(torch.randn(1, position.size(0), 1, config.kv_lora_rank),
+                     torch.randn(1, position.size(0), 1, config.qk_rope_head_dim), 0, {"cache_position": position})
+    hidden_states = torch.randn(1, 1, config.hidden_size)
+    cache_position = torch.tensor([valid])
+    mask = causal_mask(cache_position, cache_len)
+    elapsed = []
+    for _ in range(repeat):
+        cache.remove_suffix(valid)
+        begin = time.perf_counter()
+        attn.forward_chunck(hidden_states, mask, cache_position[None, :], cache, cache_position=cache_position)
+        elapsed.append(time.perf_counter() - begin)
+    return sorted(elapsed)[len(elapsed) // 2] * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--valid", type=int, nargs="+", default=[512, 2048, 8192])
+    parser.add_argument("--cache", type=int, nargs="+", default=[4096, 32768])
+    parser.add_argument("--heads", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = DeepseekV2Config(
+        hidden_size=2048, num_hidden_layers=1, num_attention_heads=args.heads, num_key_value_heads=args.heads,
+        q_lora_rank=None, kv_lora_rank=512, qk_rope_head_dim=64, v_head_dim=128, qk_nope_head_dim=128,
+        max_position_embeddings=max(args.cache), architectures=["DeepseekV2ForCausalLM"],
+    )
+    attn = KDeepseekV2Attention("blk.0.attn", None, config, DeepseekV2Attention(config, 0)).eval()
+    print(f"{'valid':>8} {'cache':>8} {'dense ms':>10} {'length-aware ms':>16} {'speedup':>8}")
+    for valid in args.valid:
+        for cache_len in args.cache:
+            if valid >= cache_len:
+                continue
+            dense = decode_ms(attn, config, valid, cache_len, 0, args.repeat)
+            length_aware = decode_ms(attn, config, valid, cache_len, 16, args.repeat)
+            print(f"{valid:>8} {cache_len:>8} {dense:>10.2f} {length_aware:>16.2f} {dense / length_aware:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
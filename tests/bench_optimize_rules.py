@@ -0,0 +1,71 @@
+"""
+Startup cost of the optimize rule matching on a DeepSeek-V3 sized module graph (61 layers, 256 routed
+experts, tiny hidden size): the previous rule-by-rule gen_optimize_config against the compiled
+OptimizeRules, and the per-module config lookup of inject, the recursive prefix-filtered dicts
+against the config trie. Both produce the same plan (tests/test_optimize_rules.py).
+
+    python tests/bench_optimize_rules.py --rule_file DeepSeek-V3-Chat.yaml --experts 256
+"""
+import argparse
+import time
+from ktransformers.optimize.optimize import OptimizeConfigTrie, OptimizeRules, gen_optimize_config
+from test_optimize_rules import build_model, load_rules, reference_gen_optimize_config
+
+
+def reference_lookup(module, local_optimization_dict, prefix=""):
+    """The module walk of the previous inject: a filtered copy of the config for every injected child."""
+    visited = 0
+    for name, child in module._modules.items():
+        if child is not None:
+            child_prefix = prefix + name
+            if child_prefix in local_optimization_dict:
+                visited += 1
+                child_prefix += "."
+                child_optimization_dict = {k: v for k, v in local_optimization_dict.items() if k.startswith(child_prefix)}
+                visited += reference_lookup(child, child_optimization_dict, child_prefix)
+    return visited
+
+
+def trie_lookup(module, trie):
+    visited = 0
+    for name, child in module._modules.items():
+        if child is not None:
+            node = trie.children.get(name)
+            if node is not None and node.meta is not None:
+                visited += 1 + trie_lookup(child, node)
+    return visited
+
+
+def timed(fn):
+    begin = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - begin, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rule_file", type=str, default="DeepSeek-V3-Chat.yaml")
+    parser.add_argument("--experts", type=int, default=256)
+    args = parser.parse_args()
+
+    model = build_model(args.rule_file, args.experts)
+    rule_list = load_rules(args.rule_file)
+    print(f"{args.rule_file}: {sum(1 for _ in model.modules())} modules, {len(rule_list)} rules")
+
+    expected = {}
+    ref_s, _ = timed(lambda: reference_gen_optimize_config(model, expected, rule_list))
+    plan = {}
+    compiled_s, _ = timed(lambda: gen_optimize_config(model, plan, OptimizeRules(rule_list)))
+    assert list(plan.items()) == list(expected.items())
+    print(f"{'gen_optimize_config':<22} reference {ref_s * 1e3:>9.1f} ms   compiled {compiled_s * 1e3:>9.1f} ms"
+          f"   {ref_s / compiled_s:>6.1f}x")
+
+    ref_s, ref_visited = timed(lambda: reference_lookup(model, expected))
+    trie_s, visited = timed(lambda: trie_lookup(model, OptimizeConfigTrie.build(plan)))
+    assert visited == ref_visited
+    print(f"{'inject lookup':<22} reference {ref_s * 1e3:>9.1f} ms   trie     {trie_s * 1e3:>9.1f} ms"
+          f"   {ref_s / trie_s:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
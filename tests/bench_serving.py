@@ -0,0 +1,260 @@
+"""
+Serving load generator for the OpenAI chat endpoint. Closed loop keeps --concurrency requests in flight, each
+client sending its next request when the last one ends; open loop sends requests at their arrival times whatever
+the server does, Poisson or constant at --rate requests/s or replayed from a trace. Prompt and output lengths are
+drawn from distributions: fixed:N, uniform:LO:HI or lognormal:MEDIAN:SIGMA. Reports p50 / p90 / p99 time to first
+token, inter-token latency and end to end latency, request and token throughput and goodput, the requests per
+second that met both --slo-ttft and --slo-itl (mean inter-token latency), and writes them as JSON with --output.
+
+A trace is JSON lines of {"timestamp": seconds from the start, "prompt_tokens": n, "output_tokens": m}, the
+lengths optional. With the server on the mock backend (model type: mock) the numbers measure the serving stack
+alone, at the rates configured for the mock:
+
+    python tests/bench_serving.py --mode closed --concurrency 16 --num-requests 200
+    python tests/bench_serving.py --mode open --rate 4 --arrival poisson --duration 60 --output results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# a word is about a token, and the mock backend counts words
+PROMPT_WORDS = ("the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "while", "cache", "pages", "fill",
+                "and", "experts", "route", "tokens")
+
+
+@dataclass
+class RequestResult:
+    start: float
+    prompt_tokens: int
+    max_tokens: int
+    ttft: Optional[float] = None
+    itls: List[float] = field(default_factory=list)
+    latency: Optional[float] = None
+    output_tokens: int = 0
+    error: Optional[str] = None
+
+
+def parse_length(spec: str) -> Callable[[random.Random], int]:
+    """fixed:N, uniform:LO:HI (inclusive) or lognormal:MEDIAN:SIGMA, as a sampler of lengths of at least 1."""
+    kind, _, rest = spec.partition(":")
+    values = [float(v) for v in rest.split(":")] if rest else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: max(int(values[0]), 1)
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: max(rng.randint(int(values[0]), int(values[1])), 1)
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: max(int(round(rng.lognormvariate(math.log(values[0]), values[1]))), 1)
+    raise ValueError(f"bad length distribution {spec}, expected fixed:N, uniform:LO:HI or lognormal:MEDIAN:SIGMA")
+
+
+def arrival_times(arrival: str, rate: float, count: int, rng: random.Random) -> List[float]:
+    """Send times in seconds from the start of `count` requests at `rate` requests/s."""
+    if arrival == "constant":
+        return [i / rate for i in range(count)]
+    if arrival == "poisson":
+        times, now = [], 0.0
+        for _ in range(count):
+            times.append(now)
+            now += rng.expovariate(rate)
+        return times
+    raise ValueError(f"unknown arrival process {arrival}")
+
+
+def load_trace(path: str) -> List[dict]:
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda e: e["timestamp"])
+
+
+def make_prompt(num_tokens: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(PROMPT_WORDS) for _ in range(num_tokens))
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """Linear interpolation between closest ranks, as numpy.percentile does by default."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def distribution(values: Sequence[float]) -> Dict[str, Optional[float]]:
+    return {"mean": sum(values) / len(values) if values else None, "p50": percentile(values, 50),
+            "p90": percentile(values, 90), "p99": percentile(values, 99)}
+
+
+def meets_slo(result: RequestResult, slo_ttft: Optional[float], slo_itl: Optional[float]) -> bool:
+    if result.error is not None or result.ttft is None:
+        return False
+    if slo_ttft is not None and result.ttft > slo_ttft:
+        return False
+    if slo_itl is not None and result.itls and sum(result.itls) / len(result.itls) > slo_itl:
+        return False
+    return True
+
+
+def summarize(results: Sequence[RequestResult], duration: float, slo_ttft: Optional[float] = None,
+              slo_itl: Optional[float] = None) -> dict:
+    done = [r for r in results if r.error is None]
+    good = [r for r in done if meets_slo(r, slo_ttft, slo_itl)]
+    output_tokens = sum(r.output_tokens for r in done)
+    return {
+        "duration": duration,
+        "requests": len(results),
+        "completed": len(done),
+        "failed": len(results) - len(done),
+        "request_throughput": len(done) / duration,
+        "output_throughput": output_tokens / duration,
+        "total_throughput": (output_tokens + sum(r.prompt_tokens for r in done)) / duration,
+        "goodput": len(good) / duration,
+        "slo_attainment": len(good) / len(results) if results else None,
+        "slo": {"ttft": slo_ttft, "itl": slo_itl},
+        "ttft": distribution([r.ttft for r in done if r.ttft is not None]),
+        "itl": distribution([itl for r in done for itl in r.itls]),
+        "latency": distribution([r.latency for r in done]),
+        "output_tokens": distribution([r.output_tokens for r in done]),
+    }
+
+
+async def send(session, url: str, model: str, prompt: str, prompt_tokens: int, max_tokens: int) -> RequestResult:
+    payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": True,
+               "max_tokens": max_tokens, "temperature": 0.0}
+    result = RequestResult(start=time.perf_counter(), prompt_tokens=prompt_tokens, max_tokens=max_tokens)
+    last = None
+    try:
+        async with session.post(url, json=payload) as response:
+            if response.status != 200:
+                result.error = f"status {response.status}"
+                return result
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[6:]
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                if not choices or not (choices[0].get("delta") or {}).get("content"):
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    result.ttft = now - result.start
+                else:
+                    result.itls.append(now - last)
+                last = now
+                result.output_tokens += 1
+        result.latency = time.perf_counter() - result.start
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+def plan(args, rng: random.Random) -> Iterator[dict]:
+    """The requests of the run in send order, drawn as they are sent: prompt, lengths and the open loop send time."""
+    prompt_len, output_len = parse_length(args.prompt_len), parse_length(args.output_len)
+    if args.arrival == "trace":
+        entries = load_trace(args.trace)
+    elif args.mode == "open":
+        # without a count, enough for the duration; the run stops at it
+        count = args.num_requests or int(args.rate * args.duration * 2) + 16
+        entries = ({"timestamp": t} for t in arrival_times(args.arrival, args.rate, count, rng))
+    else:
+        entries = ({"timestamp": 0.0} for _ in (range(args.num_requests) if args.num_requests else itertools.count()))
+    for entry in entries:
+        prompt_tokens = int(entry.get("prompt_tokens") or prompt_len(rng))
+        yield {"at": float(entry["timestamp"]), "prompt_tokens": prompt_tokens,
+               "max_tokens": int(entry.get("output_tokens") or output_len(rng)),
+               "prompt": make_prompt(prompt_tokens, rng)}
+
+
+async def run(args) -> Tuple[dict, List[RequestResult]]:
+    import aiohttp
+
+    rng = random.Random(args.seed)
+    requests = plan(args, rng)
+    results: List[RequestResult] = []
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        begin = time.perf_counter()
+        deadline = begin + args.duration if args.duration else math.inf
+
+        async def one(request):
+            results.append(await send(session, args.api_url, args.model, request["prompt"],
+                                      request["prompt_tokens"], request["max_tokens"]))
+
+        if args.mode == "closed":
+            pending = iter(requests)
+
+            async def client():
+                for request in pending:
+                    if time.perf_counter() >= deadline:
+                        return
+                    await one(request)
+
+            await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        else:
+            tasks = []
+            for request in requests:
+                if begin + request["at"] >= deadline:
+                    break
+                delay = begin + request["at"] - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(one(request)))
+            await asyncio.gather(*tasks)
+        duration = time.perf_counter() - begin
+    summary = summarize(results, duration, args.slo_ttft, args.slo_itl)
+    summary["config"] = {k: v for k, v in vars(args).items() if k != "output"}
+    return summary, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--api_url", type=str, default="http://localhost:10002/v1/chat/completions")
+    parser.add_argument("--model", type=str, default="DeepSeek-V3")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop clients")
+    parser.add_argument("--rate", type=float, default=1.0, help="open loop requests/s")
+    parser.add_argument("--arrival", choices=["poisson", "constant", "trace"], default="poisson")
+    parser.add_argument("--trace", type=str, default=None, help="JSON lines for --arrival trace")
+    parser.add_argument("--prompt-len", type=str, default="fixed:512")
+    parser.add_argument("--output-len", type=str, default="fixed:128")
+    parser.add_argument("--num-requests", type=int, default=None)
+    parser.add_argument("--duration", type=float, default=None, help="seconds, no new request after it")
+    parser.add_argument("--slo-ttft", type=float, default=None, help="seconds")
+    parser.add_argument("--slo-itl", type=float, default=None, help="seconds, mean per request")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds without a byte from the server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="summary and per request results as JSON")
+    args = parser.parse_args()
+    if args.arrival == "trace" and args.trace is None:
+        parser.error("--arrival trace needs --trace")
+    if args.num_requests is None and args.duration is None and args.arrival != "trace":
+        parser.error("give --num-requests or --duration")
+
+    summary, results = asyncio.run(run(args))
+    print(f"{summary['completed']}/{summary['requests']} requests in {summary['duration']:.1f}s, "
+          f"{summary['request_throughput']:.2f} req/s, {summary['output_throughput']:.1f} output tok/s, "
+          f"goodput {summary['goodput']:.2f} req/s")
+    for name in ("ttft", "itl", "latency"):
+        stats = summary[name]
+        if stats["p50"] is not None:
+            print(f"{name:>8} p50 {stats['p50'] * 1000:9.1f} ms  p90 {stats['p90'] * 1000:9.1f} ms  "
+                  f"p99 {stats['p99'] * 1000:9.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "requests": [asdict(r) for r in results]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
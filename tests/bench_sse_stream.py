@@ -0,0 +1,91 @@
+"""
+Streaming layer throughput with many concurrent streams and a fake token generator shaped like the chat
+endpoint: the previous path (a pydantic chunk serialized per token, the request polled for a disconnect per
+event, one write per event) against template frames coalesced into larger writes. Prints the tokens per
+second the HTTP layer sustains and the writes per stream, and checks the two byte streams are identical.
+
+    python tests/bench_sse_stream.py --streams 1 64 512 --tokens 512
+"""
+import argparse
+import asyncio
+import time
+from ktransformers.server.schemas.assistants.streaming import (
+    add_done, chat_stream_response, check_client_link, filter_chat_chunk, to_stream_reply,
+)
+from ktransformers.server.schemas.endpoints.chat import ChatCompletionChunk
+from ktransformers.server.utils.stream_writer import JsonTemplate, hole
+
+
+class FakeRequest:
+    async def is_disconnected(self):
+        # starlette polls receive() here, at least one trip through the event loop
+        await asyncio.sleep(0)
+        return False
+
+
+async def tokens(count, templated):
+    chunk = ChatCompletionChunk(id="chatcmpl", choices=[], object="chat.completion.chunk", created=0,
+                                model="DeepSeek-V3", system_fingerprint="fp_000000000000")
+    content = hole()
+    chunk.choices = [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    content_frame = JsonTemplate(chunk.to_stream_reply(), [content])
+    for i in range(count):
+        # the backend hands a token over every few loop turns
+        await asyncio.sleep(0)
+        token = f" token{i}"
+        if templated:
+            yield content_frame.render(token)
+        else:
+            chunk.choices = [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+            yield chunk
+    chunk.choices = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    yield chunk
+
+
+async def drain(body):
+    writes, size = 0, 0
+    async for write in body:
+        # a send yields to the loop like the ASGI server does
+        await asyncio.sleep(0)
+        writes += 1
+        size += len(write)
+    return writes, size
+
+
+async def run(streams, count, coalesced):
+    request = FakeRequest()
+    if coalesced:
+        bodies = [chat_stream_response(tokens(count, True)).body_iterator for _ in range(streams)]
+    else:
+        bodies = [check_client_link(request, to_stream_reply(add_done(filter_chat_chunk(tokens(count, False)))))
+                  for _ in range(streams)]
+    begin = time.perf_counter()
+    results = await asyncio.gather(*(drain(body) for body in bodies))
+    return streams * count / (time.perf_counter() - begin), results
+
+
+async def wire(count, coalesced):
+    if coalesced:
+        body = chat_stream_response(tokens(count, True)).body_iterator
+    else:
+        body = check_client_link(FakeRequest(), to_stream_reply(add_done(filter_chat_chunk(tokens(count, False)))))
+    return "".join([write async for write in body])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 64, 512])
+    parser.add_argument("--tokens", type=int, default=512)
+    args = parser.parse_args()
+
+    assert asyncio.run(wire(100, False)) == asyncio.run(wire(100, True)), "SSE bytes differ"
+    print(f"{'streams':>8} {'per-event tok/s':>16} {'coalesced tok/s':>16} {'speedup':>8} {'writes/stream':>14}")
+    for streams in args.streams:
+        before, _ = asyncio.run(run(streams, args.tokens, False))
+        after, results = asyncio.run(run(streams, args.tokens, True))
+        writes = sum(w for w, _ in results) / streams
+        print(f"{streams:>8} {before:>16.0f} {after:>16.0f} {after / before:>7.2f}x {writes:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
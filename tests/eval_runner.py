@@ -0,0 +1,355 @@
+"""
+Evaluation runner for the OpenAI chat endpoint: one async loop for every dataset, --concurrency requests in
+flight, every finished task appended to a JSON lines journal so a run that stops (a crash, ctrl-c, a server
+restart) continues where it was when started again with the same --journal. Tasks are sent in prompt order by
+default, so prompts with a shared prefix (the instruction every MMLU question starts with) go one after another
+and hit the prefix cache; --order dataset or shuffle keeps or shuffles the dataset order instead.
+
+A scorer turns a dataset into tasks and a completion into a prediction and a score: mmlu, mmlu_pro, aime,
+humaneval (journal lines have the task_id and completion evaluate_functional_correctness reads, the score is
+left to it) and jsonl, a local file of {"id", "prompt", "answer"} lines scored by exact match. --server_cmd
+starts the server first, waits for /v1/models and stops it at the end. Against the mock backend:
+
+    python tests/eval_runner.py --scorer jsonl --file prompts.jsonl --journal results/eval.jsonl \\
+        --server_cmd "ktransformers --backend_type mock --port 10002"
+    python tests/eval_runner.py --scorer mmlu --limit 1000 --concurrency 16 --journal results/mmlu.jsonl
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shlex
+import subprocess
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MMLU_HINT = ("There is a single choice question. Answer the question by replying {letters}. No other answers are "
+             "accepted. Just the letter.")
+
+
+@dataclass
+class Task:
+    id: str
+    prompt: str
+    answer: Any = None
+
+
+def _sibling(directory: str, name: str):
+    """evaluation.py / prompts.py of a dataset directory next to this file; they share module names."""
+    spec = importlib.util.spec_from_file_location(f"{directory}_{name}", os.path.join(HERE, directory, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Scorer:
+    """A dataset: its tasks, the request options and how a completion is scored."""
+    name = None
+    params: Dict[str, Any] = {}
+
+    def load(self, file: Optional[str]) -> List[Task]:
+        raise NotImplementedError
+
+    def score(self, task: Task, completion: str) -> Dict[str, Any]:
+        """The journal fields of a completion, at least prediction and score (None when scored elsewhere)."""
+        raise NotImplementedError
+
+
+class MMLUScorer(Scorer):
+    name = "mmlu"
+    dataset = "cais/mmlu"
+
+    def rows(self, file: Optional[str]) -> Iterable[dict]:
+        import pandas as pd
+        return pd.read_parquet(file or f"hf://datasets/{self.dataset}/all/test-00000-of-00001.parquet").to_dict("records")
+
+    def task(self, index: int, row: dict) -> Task:
+        return Task(str(index), self.prompt(row["question"], row["choices"]), chr(65 + int(row["answer"])))
+
+    def prompt(self, question: str, options: List[str]) -> str:
+        letters = ", ".join(chr(65 + i) for i in range(len(options)))
+        options_str = "\n".join(f"{chr(65 + i)}. {opt}" for i, opt in enumerate(options))
+        return MMLU_HINT.format(letters=letters) + "\nQuestion: " + question + "\n" + options_str + "\nAnswer: '"
+
+    def load(self, file):
+        return [self.task(i, row) for i, row in enumerate(self.rows(file))]
+
+    def score(self, task, completion):
+        # the last character of the last line, as mmlu_test.py scores
+        prediction = completion.strip().lstrip("\n").split("\n")[-1][-1:]
+        return {"prediction": prediction, "score": int(prediction == task.answer)}
+
+
+class MMLUProScorer(MMLUScorer):
+    name = "mmlu_pro"
+    dataset = "TIGER-Lab/MMLU-Pro"
+
+    def rows(self, file):
+        from datasets import load_dataset
+        return load_dataset(file or self.dataset)["test"]
+
+    def task(self, index, row):
+        return Task(str(row["question_id"]), self.prompt(row["question"], row["options"]), row["answer"])
+
+
+class AIMEScorer(Scorer):
+    name = "aime"
+    params = {"temperature": 0.6, "max_tokens": 10240}
+
+    def __init__(self):
+        self.evaluation = _sibling("AIME_2024", "evaluation")
+        self.prompts = _sibling("AIME_2024", "prompts")
+
+    def load(self, file):
+        from datasets import load_dataset
+        return [Task(str(row["ID"]), self.prompts.instruct_prompt(row["Problem"]), row["Answer"])
+                for row in load_dataset(file or "Maxwell-Jia/AIME_2024")["train"]]
+
+    def score(self, task, completion):
+        prediction = self.evaluation.filter_answer(completion) if completion.strip() else ""
+        try:
+            score = int(prediction == task.answer or float(prediction) == float(task.answer))
+        except ValueError:
+            score = 0
+        return {"prediction": prediction, "score": score}
+
+
+class HumanEvalScorer(Scorer):
+    name = "humaneval"
+    params = {"temperature": 0.6}
+
+    def __init__(self):
+        self.evaluation = _sibling("humaneval", "evaluation")
+        self.prompts = _sibling("humaneval", "prompts")
+
+    def load(self, file):
+        from human_eval.data import read_problems
+        problems = read_problems(file) if file else read_problems()
+        return [Task(task_id, self.prompts.instruct_prompt(problem["prompt"])) for task_id, problem in problems.items()]
+
+    def score(self, task, completion):
+        completion = self.evaluation.filter_code(self.evaluation.fix_indents(completion))
+        # evaluate_functional_correctness runs the journal
+        return {"task_id": task.id, "completion": completion, "prediction": completion, "score": None}
+
+
+class JsonlScorer(Scorer):
+    name = "jsonl"
+
+    def load(self, file):
+        if file is None:
+            raise ValueError("the jsonl scorer needs --file")
+        with open(file, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return [Task(str(row.get("id", i)), row["prompt"], row.get("answer")) for i, row in enumerate(rows)]
+
+    def score(self, task, completion):
+        prediction = completion.strip()
+        return {"prediction": prediction, "score": None if task.answer is None else int(prediction == task.answer)}
+
+
+SCORERS = {scorer.name: scorer for scorer in (MMLUScorer, MMLUProScorer, AIMEScorer, HumanEvalScorer, JsonlScorer)}
+
+
+def order_tasks(tasks: List[Task], order: str, seed: int = 42) -> List[Task]:
+    """prefix: sorted by prompt, so each prompt shares the longest prefix there is with the one sent before it."""
+    if order == "prefix":
+        return sorted(tasks, key=lambda task: task.prompt)
+    if order == "shuffle":
+        tasks = list(tasks)
+        random.Random(seed).shuffle(tasks)
+        return tasks
+    if order == "dataset":
+        return list(tasks)
+    raise ValueError(f"unknown order {order}")
+
+
+class Journal:
+    """One JSON line per finished task, flushed as it is written; a torn last line from a crash is ignored."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[record["id"]] = record
+            self._end_with_newline()
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _end_with_newline(self):
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.records
+
+    def write(self, record: dict):
+        self.records[record["id"]] = record
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+async def run_eval(tasks: List[Task], scorer: Scorer, complete: Callable[[str, Dict[str, Any]], Awaitable[str]],
+                   journal: Journal, concurrency: int = 8, retries: int = 3, progress: bool = True) -> dict:
+    """
+    Sends the tasks not in the journal through complete(prompt, params), at most `concurrency` at once and in the
+    given order, and journals each scored result. A task that fails `retries` times is left out of the journal,
+    for the next run to retry.
+    """
+    pending = [task for task in tasks if task.id not in journal]
+    queue: asyncio.Queue = asyncio.Queue()
+    for task in pending:
+        queue.put_nowait(task)
+    failed: List[str] = []
+    begin = time.perf_counter()
+
+    async def worker():
+        while not queue.empty():
+            task = queue.get_nowait()
+            start = time.perf_counter()
+            for attempt in range(retries):
+                try:
+                    completion = await complete(task.prompt, scorer.params)
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt + 1 < retries:
+                        await asyncio.sleep(min(2 ** attempt, 30))
+            else:
+                print(f"task {task.id} failed: {error}")
+                failed.append(task.id)
+                continue
+            record = {"id": task.id, "answer": task.answer, **scorer.score(task, completion),
+                      "time": time.perf_counter() - start}
+            journal.write(record)
+            if progress:
+                print(f"[{len(journal.records)}/{len(tasks)}] {task.id} score={record['score']}")
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)))))
+    elapsed = time.perf_counter() - begin
+    records = [journal.records[task.id] for task in tasks if task.id in journal]
+    scored = [r["score"] for r in records if r.get("score") is not None]
+    return {
+        "tasks": len(tasks),
+        "done": len(records),
+        "this_run": len(pending) - len(failed),
+        "failed": failed,
+        "score": sum(scored) / len(scored) if scored else None,
+        "time": elapsed,
+        "throughput": (len(pending) - len(failed)) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class ChatClient:
+    """Non streaming chat completions on one aiohttp session."""
+
+    def __init__(self, api_url: str, model: str, auth_token: Optional[str] = None, timeout: float = 3600):
+        import aiohttp
+
+        headers = {"Authorization": f"Bearer {auth_token}"} if auth_token else {}
+        self.api_url = api_url
+        self.model = model
+        self.session = aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=timeout),
+                                             connector=aiohttp.TCPConnector(limit=0))
+
+    async def __call__(self, prompt: str, params: Dict[str, Any]) -> str:
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stream": False, **params}
+        async with self.session.post(self.api_url, json=payload) as response:
+            if response.status != 200:
+                raise RuntimeError(f"status {response.status}: {await response.text()}")
+            result = await response.json()
+        return result["choices"][0]["message"]["content"] or ""
+
+    async def wait_ready(self, timeout: float):
+        models_url = self.api_url.split("/v1/")[0] + "/v1/models"
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with self.session.get(models_url) as response:
+                    if response.status == 200:
+                        return
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"server at {models_url} not ready after {timeout}s")
+            await asyncio.sleep(1)
+
+    async def close(self):
+        await self.session.close()
+
+
+async def main_async(args) -> dict:
+    scorer = SCORERS[args.scorer]()
+    tasks = scorer.load(args.file)
+    if args.limit is not None:
+        # a seeded sample, the same tasks whatever the order
+        tasks = order_tasks(tasks, "shuffle", args.seed)[:args.limit]
+    tasks = order_tasks(tasks, args.order, args.seed)
+    journal = Journal(args.journal)
+    server = None
+    if args.server_cmd:
+        server_log = open(args.server_log, "w")
+        server = subprocess.Popen(shlex.split(args.server_cmd), stdout=server_log, stderr=subprocess.STDOUT)
+    client = ChatClient(args.api_url, args.model, args.auth_token)
+    try:
+        if server is not None:
+            await client.wait_ready(args.server_timeout)
+        summary = await run_eval(tasks, scorer, client, journal, args.concurrency, args.retries)
+    finally:
+        await client.close()
+        journal.close()
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent, resumable evaluation against the chat endpoint")
+    parser.add_argument("--scorer", choices=sorted(SCORERS), required=True)
+    parser.add_argument("--file", type=str, default=None, help="dataset file or name, the scorer's default if not set")
+    parser.add_argument("--journal", type=str, required=True, help="JSON lines results, resumed if it exists")
+    parser.add_argument("--api_url", type=str, default="http://localhost:10002/v1/chat/completions")
+    parser.add_argument("--model", type=str, default="DeepSeek-V3")
+    parser.add_argument("--auth_token", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--order", choices=["prefix", "dataset", "shuffle"], default="prefix")
+    parser.add_argument("--limit", type=int, default=None, help="a seeded sample of this many tasks")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server_cmd", type=str, default=None, help="command starting the server for the run")
+    parser.add_argument("--server_log", type=str, default="/tmp/server_log.txt")
+    parser.add_argument("--server_timeout", type=float, default=600)
+    parser.add_argument("--summary", type=str, default=None, help="summary JSON path")
+    args = parser.parse_args()
+
+    summary = asyncio.run(main_async(args))
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump({"config": vars(args), **summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Shared by the MLA attention tests: a tiny random DeepSeek config, a causal mask over the cache, a dense masked
+softmax over the compressed kv and the unabsorbed DeepseekV2Attention over a whole prompt as independent references.
+"""
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+
+KV_LORA_RANK, ROPE_DIM = 32, 16
+
+
+def tiny_deepseek():
+    return DeepseekV2Config(
+        vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=1, num_attention_heads=4,
+        num_key_value_heads=4, q_lora_rank=32, kv_lora_rank=KV_LORA_RANK, qk_rope_head_dim=ROPE_DIM,
+        v_head_dim=16, qk_nope_head_dim=16, max_position_embeddings=2048, architectures=["DeepseekV2ForCausalLM"],
+    )
+
+
+def causal_mask(cache_position, max_cache_len):
+    mask = torch.zeros(1, 1, cache_position.size(0), max_cache_len)
+    key_pos = torch.arange(max_cache_len)
+    return mask.masked_fill(key_pos[None, :] > cache_position[:, None], torch.finfo(torch.float32).min)
+
+
+def dense_attention(q_nope, q_pe, kv, softmax_scale, cache_position):
+    scores = (torch.matmul(q_nope, kv[:, None, :, :KV_LORA_RANK].mT)
+              + torch.matmul(q_pe, kv[:, None, :, KV_LORA_RANK:].mT)) * softmax_scale
+    key_pos = torch.arange(kv.size(1))
+    scores = scores.masked_fill(key_pos[None, :] > cache_position[:, None], float("-inf"))
+    return torch.matmul(torch.softmax(scores, dim=-1), kv[:, None, :, :KV_LORA_RANK])
+
+
+@torch.no_grad()
+def prompt_attention(attn, hidden_states):
+    """The wrapped DeepseekV2Attention over the whole prompt at once: no cache, no absorbed weights."""
+    cache_position = torch.arange(hidden_states.size(1))
+    out, _, _ = attn.orig_module(hidden_states, causal_mask(cache_position, cache_position.size(0)),
+                                 cache_position[None, :])
+    return out
@@ -0,0 +1,91 @@
+"""
+Adaptive prefill chunk length (util/chunk_tuner.py): on a cost model where a chunk pays a fixed overhead, a
+per-token cost and an attention cost growing with its position, the tuner tries each length once per position
+bucket and then settles on the fastest one, which gets shorter deeper into the context; it never picks a length
+over the memory cap, always covers the prompt exactly, and a new tuner on the same cache file starts from the
+saved decisions.
+
+    python -m pytest tests/test_chunk_tuner.py
+"""
+from functools import partial
+from types import SimpleNamespace
+import pytest
+from ktransformers.util.chunk_tuner import ChunkTuner, activation_bytes, chunk_candidates
+
+
+def cost(length, position, overhead=0.05, per_token=1e-5, per_pair=1e-9, cached_pairs=1 << 26):
+    """
+    Seconds to prefill `length` tokens after `position`: a fixed overhead, linear work per token and attention work
+    per (query, key) pair, three times slower once the scores of a chunk outgrow the cache.
+    """
+    pairs = length * (position + length / 2)
+    attention = per_pair * pairs * (3 if length * (position + length) > cached_pairs else 1)
+    return overhead + per_token * length + attention
+
+
+def prefill(tuner, seq_length):
+    chunks, position = [], 0
+    while position < seq_length:
+        length = tuner.choose(position, seq_length - position)
+        tuner.record(position, length, cost(length, position))
+        chunks.append((position, length))
+        position += length
+    return chunks
+
+
+def test_candidates():
+    assert chunk_candidates(256, 2048) == [256, 512, 1024, 2048]
+    assert chunk_candidates(256, 3000) == [256, 512, 1024, 2048, 3000]
+    assert chunk_candidates(256, 256) == [256]
+
+
+def test_covers_prompt():
+    tuner = ChunkTuner("model", 4096)
+    for seq_length in (1, 100, 256, 257, 5000, 20000):
+        chunks = prefill(tuner, seq_length)
+        assert sum(length for _, length in chunks) == seq_length
+        assert all(0 < length <= 4096 for _, length in chunks)
+
+
+def test_converges_to_fastest():
+    tuner = ChunkTuner("model", 8192)
+    for _ in range(8):
+        prefill(tuner, 32768)
+    decisions = tuner.decisions()
+    # short prompts favour long chunks to amortize the overhead, long contexts shorter ones
+    assert decisions[0] == 8192
+    assert decisions[max(decisions)] < 8192
+    for position, length in prefill(tuner, 32768):
+        bucket = tuner.stats[position.bit_length()]
+        assert length == min(max(bucket, key=lambda c: bucket[c][0]), 32768 - position)
+
+
+def test_memory_cap():
+    config = SimpleNamespace(hidden_size=1024, intermediate_size=4096, num_attention_heads=16)
+    cap = activation_bytes(config, 1024, 16384)
+    tuner = ChunkTuner("model", 8192, memory_cap=cap, bytes_fn=partial(activation_bytes, config))
+    for position, length in prefill(tuner, 40000):
+        assert activation_bytes(config, length, position) <= cap or length == 256
+
+
+def test_saved_per_key(tmp_path):
+    path = str(tmp_path / "chunk_tuner.json")
+    tuner = ChunkTuner("model:threads=32", 4096, cache_path=path)
+    prefill(tuner, 16384)
+    tuner.save()
+    ChunkTuner("model:threads=8", 4096, cache_path=path).save()
+
+    restored = ChunkTuner("model:threads=32", 4096, cache_path=path)
+    assert restored.stats == tuner.stats
+    assert restored.choose(4096, 12288) == tuner.choose(4096, 12288)
+    assert ChunkTuner("model:threads=8", 4096, cache_path=path).stats == {}
+
+
+def test_shared_instance():
+    assert ChunkTuner.get_instance("shared", 4096) is ChunkTuner.get_instance("shared", 4096)
+    assert ChunkTuner.get_instance("shared", 4096) is not ChunkTuner.get_instance("shared", 8192)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
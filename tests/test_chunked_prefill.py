@@ -0,0 +1,61 @@
+"""
+Chunked prefill (KDeepseekV2Attention.forward_windows): with implicit causality and a preallocated output it
+gives the same hidden states as the unabsorbed attention run over the whole prompt at once. Covers a prompt that
+is not a whole number of chunks, a second prompt continuing the cache, and the bounded key passes of the kernel.
+
+    python -m pytest tests/test_chunked_prefill.py
+"""
+import pytest
+import torch
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.modeling_deepseek import DeepseekV2Attention
+from ktransformers.operators.attention import KDeepseekV2Attention
+from ktransformers.operators import mla_decode
+from mla_helpers import dense_attention, prompt_attention, tiny_deepseek, KV_LORA_RANK, ROPE_DIM
+
+MAX_CACHE_LEN = 512
+
+
+@torch.no_grad()
+def prefill(attn, config, prompts):
+    """The prompts one after the other through forward_windows; the hidden states fed and the outputs."""
+    cache = StaticCache(config, 1, MAX_CACHE_LEN, "cpu", torch.float32)
+    gen = torch.Generator().manual_seed(1)
+    inputs, outputs, begin = [], [], 0
+    for length in prompts:
+        hidden_states = torch.randn(1, length, config.hidden_size, generator=gen)
+        cache_position = torch.arange(begin, begin + length)
+        out, _, _ = attn.forward_windows(hidden_states, None, cache_position[None, :], cache,
+                                         cache_position=cache_position)
+        assert out.shape == hidden_states.shape
+        inputs.append(hidden_states)
+        outputs.append(out)
+        begin += length
+    return torch.cat(inputs, dim=1), torch.cat(outputs, dim=1)
+
+
+@pytest.mark.parametrize("prompts", [[200], [64, 150], [300, 1]])
+def test_matches_whole_prompt(prompts):
+    torch.manual_seed(0)
+    config = tiny_deepseek()
+    attn = KDeepseekV2Attention("blk.0.attn", None, config, DeepseekV2Attention(config, 0), chunck_size=64).eval()
+    hidden_states, out = prefill(attn, config, prompts)
+    expected = prompt_attention(attn, hidden_states)
+    assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+
+
+@pytest.mark.parametrize("max_score_elems", [1, 4 * 64 * 130, 1 << 24])
+def test_key_passes(max_score_elems):
+    # a 64 token chunk at the end of 400 cached tokens, the keys scored in one or several passes
+    gen = torch.Generator().manual_seed(0)
+    q_nope = torch.randn(1, 4, 64, KV_LORA_RANK, generator=gen)
+    q_pe = torch.randn(1, 4, 64, ROPE_DIM, generator=gen)
+    kv = torch.randn(1, 400, KV_LORA_RANK + ROPE_DIM, generator=gen)
+    cache_position = torch.arange(336, 400)
+    out = mla_decode.mla_prefix_attention(q_nope, q_pe, kv, KV_LORA_RANK, 0.2, cache_position, 64, max_score_elems)
+    assert torch.allclose(out, dense_attention(q_nope, q_pe, kv, 0.2, cache_position), atol=1e-5)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,139 @@
+"""
+Evaluation runner (tests/eval_runner.py): never more than --concurrency requests in flight, a second run only
+sends what the journal of the first doesn't have (a torn last line included), failed tasks stay out of the
+journal, prefix order puts prompts with a shared prefix together, the scorers score like the scripts they
+replace, and a run against a local chat endpoint works end to end.
+
+    python -m pytest tests/test_eval_runner.py
+"""
+import asyncio
+import json
+
+import pytest
+from eval_runner import AIMEScorer, ChatClient, Journal, JsonlScorer, MMLUScorer, Task, order_tasks, run_eval
+
+
+def tasks(count):
+    return [Task(str(i), f"question {i}", f"answer {i}") for i in range(count)]
+
+
+class Model:
+    """Answers a task right, after a short while, counting the requests in flight."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.prompts = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def __call__(self, prompt, params):
+        self.prompts.append(prompt)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if prompt in self.fail:
+                raise RuntimeError("status 500")
+            return prompt.replace("question", "answer")
+        finally:
+            self.in_flight -= 1
+
+
+def test_bounded_concurrency(tmp_path):
+    model = Model()
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    summary = asyncio.run(run_eval(tasks(20), JsonlScorer(), model, journal, concurrency=3, progress=False))
+    assert model.max_in_flight == 3
+    assert summary["done"] == 20 and summary["score"] == 1.0
+
+
+def test_resume(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = Journal(str(path))
+    asyncio.run(run_eval(tasks(5), JsonlScorer(), Model(), journal, progress=False))
+    journal.close()
+    # a crash while writing the next line
+    with open(path, "a") as f:
+        f.write('{"id": "5", "answ')
+
+    model = Model()
+    journal = Journal(str(path))
+    summary = asyncio.run(run_eval(tasks(8), JsonlScorer(), model, journal, progress=False))
+    journal.close()
+    assert sorted(model.prompts) == ["question 5", "question 6", "question 7"]
+    assert summary["done"] == 8 and summary["this_run"] == 3
+    ids = []
+    with open(path) as f:
+        for line in f:
+            try:
+                ids.append(json.loads(line)["id"])
+            except json.JSONDecodeError:
+                pass
+    assert sorted(ids, key=int) == [str(i) for i in range(8)]
+
+
+def test_failed_tasks_not_journaled(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    model = Model(fail={"question 2"})
+    summary = asyncio.run(run_eval(tasks(4), JsonlScorer(), model, journal, retries=2, progress=False))
+    assert summary["failed"] == ["2"] and "2" not in journal
+    assert model.prompts.count("question 2") == 2
+
+
+def test_prefix_order():
+    prompts = ["sys B\nq2", "sys A\nq1", "other", "sys B\nq1", "sys A\nq2"]
+    ordered = [t.prompt for t in order_tasks([Task(str(i), p) for i, p in enumerate(prompts)], "prefix")]
+    assert ordered == ["other", "sys A\nq1", "sys A\nq2", "sys B\nq1", "sys B\nq2"]
+    assert [t.id for t in order_tasks(tasks(3), "dataset")] == ["0", "1", "2"]
+
+
+def test_scorers():
+    mmlu = MMLUScorer()
+    task = mmlu.task(0, {"question": "2 + 2?", "choices": ["3", "4", "5", "6"], "answer": 1})
+    assert task.prompt.startswith("There is a single choice question. Answer the question by replying A, B, C, D.")
+    assert task.prompt.endswith("D. 6\nAnswer: '")
+    assert mmlu.score(task, "\nB")["score"] == 1 and mmlu.score(task, "C")["score"] == 0
+
+    aime = AIMEScorer()
+    task = Task("1", "", 204)
+    assert aime.score(task, "so the answer is\n$\\boxed{204}$")["score"] == 1
+    assert aime.score(task, "no idea")["score"] == 0
+    assert aime.score(task, "")["score"] == 0
+
+
+def test_end_to_end(tmp_path):
+    web = pytest.importorskip("aiohttp.web")
+
+    async def chat(request):
+        body = await request.json()
+        content = body["messages"][0]["content"].replace("question", "answer")
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    async def models(request):
+        return web.json_response({"data": []})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", chat)
+        app.router.add_get("/v1/models", models)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        client = ChatClient(f"http://127.0.0.1:{port}/v1/chat/completions", "mock")
+        journal = Journal(str(tmp_path / "journal.jsonl"))
+        try:
+            await client.wait_ready(10)
+            return await run_eval(tasks(10), JsonlScorer(), client, journal, concurrency=4, progress=False)
+        finally:
+            await client.close()
+            journal.close()
+            await runner.cleanup()
+
+    summary = asyncio.run(main())
+    assert summary["done"] == 10 and summary["score"] == 1.0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
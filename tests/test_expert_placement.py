@@ -0,0 +1,124 @@
+"""
+Expert placement (util/expert_placement.py): numactl style node lists parse, the greedy planner spreads experts
+without statistics, balances the routing mass of hot experts over the DRAM nodes, spills cold experts to CXL
+once DRAM is full and keeps what fits nowhere on the last node, gather_experts copies the experts of a node
+into its own buffer, and a prefill batch hands each shard only the (token, expert) pairs it is routed to.
+
+    python -m pytest tests/test_expert_placement.py
+"""
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+from ktransformers.util.expert_placement import (
+    MemoryTopology, check_cuda_graph, gather_experts, parse_node_list, plan_expert_placement,
+)
+
+GB = 1024 ** 3
+
+
+@pytest.mark.parametrize("nodes, expected", [
+    ("0-1,3", [0, 1, 3]), (" 2 , 0,", [0, 2]), ("1-1", [1]), ("0-2,1", [0, 1, 2]), (3, [3]), ([1, 0, 1], [0, 1]),
+    (None, []), ("", []),
+])
+def test_parse_node_list(nodes, expected):
+    assert parse_node_list(nodes) == expected
+
+
+def test_parse_node_list_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_node_list("0-a")
+
+
+def test_round_robin_without_stats():
+    topology = MemoryTopology("0,1")
+    placement = plan_expert_placement(torch.zeros(4, 8), topology, GB)
+    for layer_idx in range(4):
+        groups = placement.groups(layer_idx)
+        assert sorted(groups) == [0, 1]
+        assert len(groups[0]) == len(groups[1]) == 4
+
+
+def test_hot_experts_balanced_over_dram():
+    topology = MemoryTopology("0,1")
+    frequency = torch.zeros(1, 8)
+    frequency[0, 5], frequency[0, 2], frequency[0, 7] = 0.5, 0.3, 0.2
+    placement = plan_expert_placement(frequency, topology, GB)
+    # the two hottest go to different sockets, the third joins the lighter one
+    assert placement.node_map[0, 5] != placement.node_map[0, 2]
+    assert placement.node_map[0, 7] == placement.node_map[0, 2]
+
+
+def test_cold_experts_spill_to_cxl():
+    topology = MemoryTopology("0", "2", local_capacity_gb=3, cxl_capacity_gb=8)
+    frequency = torch.arange(16, dtype=torch.float32).view(2, 8)
+    placement = plan_expert_placement(frequency, topology, GB)
+    on_dram = (placement.node_map == 0).nonzero().tolist()
+    assert sorted(on_dram) == [[1, 5], [1, 6], [1, 7]]
+    assert (placement.node_map == 2).sum() == 13
+    assert placement.summary() == {"node0(dram)": 3, "node2(cxl)": 13}
+    # CXL experts are computed by the socket they are attached to
+    assert topology.get_node(2).compute_node == 0
+
+
+def test_overflow_stays_on_last_node(capsys):
+    topology = MemoryTopology("0", "1", local_capacity_gb=1, cxl_capacity_gb=1)
+    placement = plan_expert_placement(torch.ones(1, 4), topology, GB)
+    assert placement.node_map.tolist() == [[0, 1, 1, 1]]
+    assert "2 experts don't fit" in capsys.readouterr().out
+
+
+def test_topology_needs_dram():
+    with pytest.raises(ValueError):
+        MemoryTopology("")
+
+
+def test_gather_experts(tmp_path):
+    topology = MemoryTopology("0", "1", cxl_backing_dir=str(tmp_path))
+    weights = np.arange(6 * 16, dtype=np.uint8).reshape(6, 16)
+    gathered = gather_experts(weights, [1, 4], 6, topology.get_node(1), "gate")
+    assert gathered.tobytes() == weights[[1, 4]].tobytes()
+    assert (tmp_path / "node1" / "gate").exists()
+
+
+def test_cuda_graph_refused():
+    check_cuda_graph(False)
+    with pytest.raises(ValueError):
+        check_cuda_graph(True)
+
+
+def test_placed_rows_not_padded():
+    experts = pytest.importorskip("ktransformers.operators.experts")
+    submitted = []
+    cpu_infer = SimpleNamespace(submit=submitted.append, sync=lambda: None)
+    moe = SimpleNamespace(forward=lambda qlen, k, *ptrs: (qlen, k))
+    shards = [experts.PlacedExpertsShard(node, node, owned, 6, moe, cpu_infer, ())
+              for node, owned in enumerate([[0, 1, 2], [3, 4, 5]])]
+    placed = SimpleNamespace(shards=shards)
+    gen = torch.Generator().manual_seed(0)
+    input_tensor = torch.randn(4, 8, generator=gen)
+    expert_ids = torch.tensor([[0, 3], [1, 2], [4, 5], [2, 5]])
+    weights = torch.rand(4, 2, generator=gen)
+
+    pending = experts.KExpertsCPU.submit_placed(placed, input_tensor, expert_ids, weights,
+                                                torch.tensor([4], dtype=torch.int32))
+    # each shard runs one row per routed pair: 4 pairs on either shard, none with weight 0
+    assert submitted == [(4, 1), (4, 1)]
+    for shard, rows, (shard_ids, shard_weights, shard_input, _), output in pending:
+        assert (shard_weights > 0).all()
+        # an expert scales its input by its global id + 1
+        scale = torch.tensor(shard.experts)[shard_ids] + 1
+        torch.mul(shard_input, (scale * shard_weights).sum(dim=-1, keepdim=True), out=output)
+    expected = input_tensor * ((expert_ids + 1) * weights).sum(dim=-1, keepdim=True)
+    assert torch.allclose(experts.KExpertsCPU.sync_placed(placed, pending, input_tensor), expected)
+
+    # decode: one row owning one expert on each shard, submitted as is
+    submitted.clear()
+    pending = experts.KExpertsCPU.submit_placed(placed, input_tensor[:1], expert_ids[:1], weights[:1],
+                                                torch.tensor([1], dtype=torch.int32))
+    assert submitted == [(1, 1), (1, 1)] and all(rows is None for _, rows, _, _ in pending)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,182 @@
+"""
+Speculative expert prefetching (util/expert_prefetch.py): neighbouring experts share one madvise, the gate of the
+next layer run on the current hidden states decides which of its experts get prefetched, the guess is scored
+against the routing that layer then picks, prefill sized batches and placed experts are left alone, and a cuda
+graph replay is scored and prefetched from its static buffers the same way the eager decode is.
+
+    python -m pytest tests/test_expert_prefetch.py
+"""
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+from ktransformers.util import expert_prefetch
+from ktransformers.util.expert_prefetch import ExpertPrefetcher, expert_runs
+
+NUM_EXPERTS = 8
+HIDDEN = 4
+
+
+class Gate(torch.nn.Module):
+    """Routes a token to the experts whose row of `weight` matches its hidden state best."""
+
+    def __init__(self, seed):
+        super().__init__()
+        self.register_buffer("weight", torch.randn(NUM_EXPERTS, HIDDEN, generator=torch.Generator().manual_seed(seed)))
+
+    def forward(self, hidden_states):
+        return hidden_states @ self.weight.T
+
+
+def make_block(layer_idx, expert_bytes=4096):
+    experts = SimpleNamespace(n_routed_experts=NUM_EXPERTS, **{
+        name: np.zeros(NUM_EXPERTS * expert_bytes, dtype=np.uint8) for name in ("gate", "up", "down")})
+    return SimpleNamespace(key=f"blk.{layer_idx}.ffn_gate_exps", gate=Gate(layer_idx), top_k=2, experts=experts)
+
+
+@pytest.fixture
+def madvised(monkeypatch):
+    calls = []
+    monkeypatch.setattr(expert_prefetch, "madvise_willneed", lambda addr, nbytes: calls.append((addr, nbytes)))
+    return calls
+
+
+def routing(block, hidden_states):
+    return torch.topk(block.gate(hidden_states), block.top_k, dim=-1).indices
+
+
+def decode_step(prefetcher, blocks, hidden_states):
+    for block in blocks:
+        prefetcher.on_gate(block, hidden_states, routing(block, hidden_states))
+
+
+@pytest.mark.parametrize("expert_ids, expected", [
+    ([], []), ([3], [(3, 4)]), ([5, 1, 2, 7, 6], [(1, 3), (5, 8)]),
+])
+def test_expert_runs(expert_ids, expected):
+    assert expert_runs(expert_ids) == expected
+
+
+def test_next_layer_prefetched(madvised):
+    prefetcher = ExpertPrefetcher(enable=True)
+    blocks = [make_block(i) for i in range(3)]
+    hidden_states = torch.randn(1, HIDDEN, generator=torch.Generator().manual_seed(0))
+    # the first step only learns the blocks, each layer meets the next one on the second
+    decode_step(prefetcher, blocks, hidden_states)
+    assert madvised == [] and prefetcher.issued == 0
+    decode_step(prefetcher, blocks, hidden_states)
+
+    expected = [sorted(routing(block, hidden_states).flatten().tolist()) for block in blocks[1:]]
+    assert prefetcher.issued == sum(len(ids) for ids in expected)
+    addresses = {addr for addr, _ in madvised}
+    assert blocks[1].experts.gate.ctypes.data + expected[0][0] * 4096 in addresses
+    assert blocks[0].experts.gate.ctypes.data not in addresses
+    # same hidden states for every layer here, so every guess is right
+    stats = prefetcher.stats()
+    assert stats["hit_rate"] == stats["precision"] == 1.0
+    assert stats["prefetched_bytes"] == 3 * 4096 * prefetcher.issued
+
+
+def test_wrong_guess_scored(madvised):
+    prefetcher = ExpertPrefetcher(enable=True)
+    blocks = [make_block(0), make_block(1)]
+    hidden_states = torch.randn(1, HIDDEN, generator=torch.Generator().manual_seed(0))
+    decode_step(prefetcher, blocks, hidden_states)
+    prefetcher.on_gate(blocks[0], hidden_states, routing(blocks[0], hidden_states))
+    guess = prefetcher.predicted[1]
+    wrong = torch.tensor([[e for e in range(NUM_EXPERTS) if e not in guess.tolist()][:2]])
+    prefetcher.on_gate(blocks[1], hidden_states, wrong)
+    assert prefetcher.hits == 0 and prefetcher.actual == 2
+
+
+def test_prefill_not_prefetched(madvised):
+    prefetcher = ExpertPrefetcher(enable=True, max_tokens=4)
+    blocks = [make_block(0), make_block(1)]
+    hidden_states = torch.randn(16, HIDDEN)
+    decode_step(prefetcher, blocks, hidden_states)
+    decode_step(prefetcher, blocks, hidden_states)
+    assert madvised == [] and prefetcher.predicted == {}
+
+
+def test_placed_experts_not_prefetched(madvised):
+    prefetcher = ExpertPrefetcher(enable=True)
+    blocks = [make_block(0), make_block(1)]
+    blocks[1].experts.shards = [object()]
+    hidden_states = torch.randn(1, HIDDEN)
+    decode_step(prefetcher, blocks, hidden_states)
+    decode_step(prefetcher, blocks, hidden_states)
+    assert madvised == [] and prefetcher.issued == 0
+
+
+def test_replay_matches_eager(madvised):
+    blocks = [make_block(i) for i in range(3)]
+    hidden_states = torch.randn(3, HIDDEN, generator=torch.Generator().manual_seed(1))
+
+    eager = ExpertPrefetcher(enable=True)
+    decode_step(eager, blocks, hidden_states[:2])
+    decode_step(eager, blocks, hidden_states[:2])
+    eager_calls = list(madvised)
+    madvised.clear()
+
+    # what the captured gates leave in their buffers, for a graph padded to 3 rows
+    replayed = ExpertPrefetcher(enable=True)
+    decode_step(replayed, blocks, hidden_states[:2])
+    replayed.reset()
+    madvised.clear()
+    captured = {}
+    for layer_idx, block in enumerate(blocks):
+        predicted = routing(blocks[layer_idx + 1], hidden_states) if layer_idx + 1 < len(blocks) else None
+        captured[layer_idx] = (routing(block, hidden_states), predicted)
+    replayed.on_replay(captured, num_tokens=2)
+    replayed.on_replay(captured, num_tokens=2)
+
+    eager_stats, replayed_stats = eager.stats(), replayed.stats()
+    assert replayed_stats["prefetched_experts"] == 2 * eager_stats["prefetched_experts"]
+    assert replayed_stats["hit_rate"] == 1.0
+    assert set(madvised) == set(eager_calls)
+
+
+def test_replay_too_many_tokens(madvised):
+    prefetcher = ExpertPrefetcher(enable=True, max_tokens=2)
+    prefetcher.blocks[1] = make_block(1)
+    ids = torch.tensor([[0, 1], [2, 3], [4, 5]])
+    prefetcher.on_replay({0: (ids, ids)}, num_tokens=3)
+    assert madvised == [] and prefetcher.predicted == {}
+    prefetcher.on_replay({0: (ids, ids)}, num_tokens=2)
+    assert prefetcher.predicted[1].tolist() == [0, 1, 2, 3]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a cuda device")
+def test_graph_replay_prefetches(madvised):
+    prefetcher = ExpertPrefetcher(enable=True)
+    blocks = [make_block(i) for i in range(2)]
+    for block in blocks:
+        block.gate.cuda()
+    hidden_states = torch.randn(1, HIDDEN, device="cuda")
+    decode_step(prefetcher, blocks, hidden_states)
+    prefetcher.reset()
+    madvised.clear()
+
+    graph = torch.cuda.CUDAGraph()
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        with torch.cuda.graph(graph, stream=stream):
+            decode_step(prefetcher, blocks, hidden_states)
+    torch.cuda.current_stream().wait_stream(stream)
+    assert madvised == []
+    captured = prefetcher.take_captured()
+    assert sorted(captured) == [0, 1] and prefetcher.captured == {}
+
+    for _ in range(2):
+        graph.replay()
+        torch.cuda.synchronize()
+        prefetcher.on_replay(captured)
+    expected = routing(blocks[1], hidden_states).flatten().unique().cpu()
+    assert prefetcher.predicted == {} and prefetcher.issued == 2 * expected.numel()
+    assert prefetcher.stats()["hit_rate"] == 1.0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
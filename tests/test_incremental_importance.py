@@ -0,0 +1,116 @@
+"""
+Recall of the DYNAMIC_INCREMENTAL block preselection (BlockImportance fed chunk by chunk) against the
+full recompute done by the DYNAMIC path at the end of prefill, and the decode step adding the attention
+weight of its own token without starting a new refresh.
+
+    python -m pytest tests/test_incremental_importance.py
+"""
+import math
+from types import SimpleNamespace
+import torch
+from ktransformers.operators.dynamic_attention import (
+    BlockImportance,
+    DynamicScaledDotProductAttention,
+    attn_score_one_block,
+    preselect_block_scores,
+)
+
+HEADS = 8
+KV_HEADS = 2
+HEAD_DIM = 64
+BLOCK_SIZE = 32
+QUERY_LEN = 32
+
+
+def make_sequence(block_num: int, hot_blocks: list[int], seed: int = 0):
+    """Keys of `hot_blocks` line up with a direction every query shares, everything else is noise."""
+    gen = torch.Generator().manual_seed(seed)
+    direction = torch.randn(HEAD_DIM, generator=gen)
+    direction = direction / direction.norm()
+    key = torch.randn(block_num * BLOCK_SIZE, KV_HEADS, HEAD_DIM, generator=gen)
+    for block in hot_blocks:
+        key[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] += 4 * direction
+    query = torch.randn(block_num * BLOCK_SIZE, HEADS, HEAD_DIM, generator=gen) + 4 * direction
+    return query.half(), key.half()
+
+
+def full_selection(query, key, seq_len, topk):
+    importance = torch.zeros(seq_len, HEADS, dtype=torch.float16)
+    attn_score_one_block(importance, query[seq_len - QUERY_LEN:seq_len], key[:seq_len], HEAD_DIM)
+    block_num = seq_len // BLOCK_SIZE
+    scores = preselect_block_scores(importance.view(1, block_num, BLOCK_SIZE, HEADS), BLOCK_SIZE)[0]
+    return set(torch.topk(scores, k=topk).indices.tolist())
+
+
+def incremental_selection(tracker, query, key, begin, end, topk):
+    importance = torch.zeros(end - begin, HEADS, dtype=torch.float16)
+    attn_score_one_block(importance, query[end - QUERY_LEN:end], key[begin:end], HEAD_DIM)
+    tracker.update(0, importance, begin)
+    scores = tracker.scores(0, end // BLOCK_SIZE)
+    return set(torch.topk(scores, k=topk).indices.tolist())
+
+
+def test_single_chunk_matches_full_recompute():
+    block_num, topk = 32, 6
+    query, key = make_sequence(block_num, hot_blocks=[1, 5, 9, 17, 23, 30])
+    seq_len = block_num * BLOCK_SIZE
+    tracker = BlockImportance(1, block_num, BLOCK_SIZE)
+    assert incremental_selection(tracker, query, key, 0, seq_len, topk) == \
+        full_selection(query, key, seq_len, topk)
+
+
+def test_chunked_recall():
+    block_num, chunk_blocks, topk = 64, 16, 8
+    hot_blocks = [2, 7, 19, 28, 35, 44, 51, 60]
+    query, key = make_sequence(block_num, hot_blocks, seed=1)
+    tracker = BlockImportance(1, block_num, BLOCK_SIZE, decay=1.0)
+    recalls = []
+    for chunk in range(block_num // chunk_blocks):
+        begin, end = chunk * chunk_blocks * BLOCK_SIZE, (chunk + 1) * chunk_blocks * BLOCK_SIZE
+        selected = incremental_selection(tracker, query, key, begin, end, topk)
+        reference = full_selection(query, key, end, topk)
+        recalls.append(len(selected & reference) / len(reference))
+    assert min(recalls) >= 0.75, recalls
+    assert sum(recalls) / len(recalls) >= 0.9, recalls
+
+
+def test_decay_is_lazy():
+    tracker = BlockImportance(1, 4, BLOCK_SIZE, decay=0.5)
+    ones = torch.ones(BLOCK_SIZE, HEADS, dtype=torch.float16)
+    tracker.update(0, ones, 0)
+    tracker.update(0, ones, BLOCK_SIZE)
+    # block 0 was written one refresh ago
+    scores = tracker.scores(0, 2) * (BLOCK_SIZE + 2 * (BLOCK_SIZE // 4))
+    assert torch.allclose(scores[0], torch.tensor(0.5 * BLOCK_SIZE + BLOCK_SIZE // 4))
+    assert torch.allclose(scores[1], torch.tensor(BLOCK_SIZE + 0.5 * (BLOCK_SIZE // 4)))
+
+
+def test_decode_step_touches_its_block():
+    gen = torch.Generator().manual_seed(2)
+    position = 3 * BLOCK_SIZE + 5
+    query = torch.randn(HEADS, HEAD_DIM, generator=gen).half()
+    key = torch.randn(position + 1, KV_HEADS, HEAD_DIM, generator=gen).half()
+    # the weight the query gives every cached token, as attn_with_kvcache sees it
+    scores = torch.einsum("hd,shd->hs", query.float(), key.float().repeat_interleave(HEADS // KV_HEADS, dim=1))
+    scores = scores / math.sqrt(HEAD_DIM)
+    tracker = BlockImportance(1, 8, BLOCK_SIZE, decay=0.5)
+    tracker.update(0, torch.ones(3 * BLOCK_SIZE, HEADS), 0)
+    attn = SimpleNamespace(
+        q_head_num=HEADS, kv_head_num=KV_HEADS, head_dim=HEAD_DIM, block_importance=tracker,
+        q_in_cpu=query.view(1, 1, HEADS, HEAD_DIM), k_in_cpu=key[position].view(1, 1, KV_HEADS, HEAD_DIM),
+        lse_cpu=torch.logsumexp(scores, dim=-1).view(1, 1, HEADS),
+    )
+    before = tracker.stats[0].clone()
+    DynamicScaledDotProductAttention.update_importance_decode(attn, 0, position)
+    expected = torch.softmax(scores, dim=-1)[:, position].mean()
+    assert torch.allclose(tracker.stats[0, 3, 0], expected, rtol=1e-3)
+    # the prompt blocks are neither touched nor decayed by the decode step
+    assert torch.equal(tracker.stats[0, :3], before[:3]) and tracker.steps[0] == 1
+
+
+if __name__ == "__main__":
+    test_single_chunk_matches_full_recompute()
+    test_chunked_recall()
+    test_decay_is_lazy()
+    test_decode_step_touches_its_block()
+    print("ok")
@@ -0,0 +1,165 @@
+"""
+Grammar constrained JSON decoding (util/json_grammar.py): the character automaton accepts exactly the JSON texts
+(and schema instances) it should, the precomputed token masks and next states equal walking every token's
+characters, a state compiled on first use lands in the cached mask table in place, and sampling from random
+logits through JsonLogitsMask only ever finishes on text that json.loads parses and that matches the schema.
+
+    python -m pytest tests/test_json_grammar.py
+"""
+import json
+import string
+import pytest
+import torch
+from ktransformers.util.json_grammar import (
+    JsonAutomaton, JsonLogitsMask, TokenAutomaton, pack_bits, unpack_bits,
+)
+
+EOS = 0
+TOKENS = (["<eos>"] + [c for c in string.printable if c not in "\x0b\x0c\r"]
+          + ['{"', '":', '", "', '"}', '": "', ' {', '},', '[{', '}]', '\\n', '\\"', '\\u00e9', 'true', 'false',
+             'null', '12', '0.5', 'e-3', '  ', '\n  ', 'é', '�', '"name', 'name"', '":"', '"age": ',
+             '", "tags": ["', ' hello', ' world', 'ok', '"a"', '"b"', '"c"'])
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"enum": ["a", "b"]}},
+        "score": {"type": ["number", "null"]},
+        "ok": {"type": "boolean"},
+    },
+    "required": ["name", "ok"],
+}
+
+
+def accepts(automaton, text):
+    state = automaton.initial
+    for ch in text:
+        state = automaton.step(state, ch)
+        if state is None:
+            return False
+    return automaton.accepting(state)
+
+
+def generate(automaton, generator, max_tokens=300):
+    mask = JsonLogitsMask(automaton)
+    out = []
+    for _ in range(max_tokens):
+        logits = mask(torch.randn(len(TOKENS), generator=generator))
+        token = torch.multinomial(torch.softmax(logits, -1), 1, generator=generator).item()
+        mask.advance(token)
+        if token == EOS:
+            return "".join(out)
+        out.append(TOKENS[token])
+    return None
+
+
+@pytest.mark.parametrize("value", [{}, [], {"a": [1, -2.5e3, "x\n\"yé"]}, {"k": {"n": None, "t": True}}, [0, {}]])
+def test_accepts_json(value):
+    automaton = JsonAutomaton()
+    assert accepts(automaton, json.dumps(value))
+    assert accepts(automaton, json.dumps(value, indent=1, ensure_ascii=False))
+
+
+@pytest.mark.parametrize("text", ['{"a":01}', '{"a" 1}', '[1,]', '{,}', '{"a":1,}', '[1 2]', '{"a":tru}', '"\\x"',
+                                  '{"a":"b\nc"}', '{} {}', '-', '1.', '[[[[[1]]]]]'])
+def test_rejects_invalid(text):
+    assert not accepts(JsonAutomaton(max_depth=4), text)
+
+
+def test_schema_instances():
+    automaton = JsonAutomaton(SCHEMA)
+    assert accepts(automaton, '{"name": "x", "ok": true}')
+    assert accepts(automaton, '{"name": "x", "age": 3, "tags": ["a", "b"], "score": null, "ok": false}')
+    assert accepts(automaton, '{"name":"x","score":1.5e2,"ok":true}')
+    assert not accepts(automaton, '{"ok": true}')                       # name is required
+    assert not accepts(automaton, '{"name": "x"}')                      # and ok
+    assert not accepts(automaton, '{"name": "x", "other": 1, "ok": true}')
+    assert not accepts(automaton, '{"name": "x", "age": 3.5, "ok": true}')
+    assert not accepts(automaton, '{"name": "x", "tags": ["c"], "ok": true}')
+    assert not accepts(automaton, '{"age": 3, "name": "x", "ok": true}')  # properties come in order
+
+
+def test_object_root():
+    assert not accepts(JsonAutomaton(object_root=True), "[1]")
+    assert accepts(JsonAutomaton(object_root=True), '{"a": [1]}')
+
+
+@pytest.mark.parametrize("schema", [None, SCHEMA])
+def test_masks_match_character_walk(schema):
+    automaton = TokenAutomaton(JsonAutomaton(schema, max_depth=3, object_root=True), TOKENS, [EOS])
+    compiled = [i for i, nexts in enumerate(automaton.next) if nexts is not None]
+    assert len(compiled) > 50
+    masks = automaton.masks(compiled)
+    for row, index in enumerate(compiled):
+        state = automaton.char_states[index]
+        for token_id, text in enumerate(TOKENS):
+            if token_id == EOS:
+                assert masks[row, token_id] == automaton.automaton.accepting(state)
+                continue
+            walked = state
+            for ch in text:
+                walked = automaton.automaton.step(walked, ch)
+                if walked is None:
+                    break
+            assert masks[row, token_id] == (walked is not None), (state, text)
+            if walked is not None:
+                assert automaton.char_states[automaton.advance(index, token_id)] == walked
+
+
+@pytest.mark.parametrize("schema", [None, SCHEMA])
+def test_generations_parse(schema):
+    automaton = TokenAutomaton(JsonAutomaton(schema, object_root=True), TOKENS, [EOS])
+    generator = torch.Generator().manual_seed(0)
+    finished = [text for text in (generate(automaton, generator) for _ in range(100)) if text is not None]
+    assert len(finished) >= 10
+    for text in finished:
+        value = json.loads(text)
+        assert isinstance(value, dict)
+        if schema is not None:
+            assert set(value) <= set(SCHEMA["properties"]) and {"name", "ok"} <= set(value)
+            assert isinstance(value["name"], str) and isinstance(value["ok"], bool)
+            assert isinstance(value.get("age", 0), int)
+            assert set(value.get("tags", [])) <= {"a", "b"}
+
+
+def test_disallowed_token():
+    automaton = TokenAutomaton(JsonAutomaton(object_root=True), TOKENS, [EOS])
+    with pytest.raises(ValueError):
+        automaton.advance(automaton.initial, TOKENS.index("a"))
+    state = automaton.advance(automaton.initial, TOKENS.index("{"))
+    state = automaton.advance(state, TOKENS.index("}"))
+    assert automaton.done(state)
+    assert automaton.masks([state])[0].nonzero().flatten().tolist() == [EOS]
+
+
+def test_lazy_state_updates_table():
+    automaton = TokenAutomaton(JsonAutomaton(SCHEMA, object_root=True), TOKENS, [EOS], max_states=1)
+    tables = {automaton.table().data_ptr()}
+    initial_states = len(automaton._rows)
+    generator = torch.Generator().manual_seed(0)
+    # walk random generations, every state on the way is compiled when its mask is first asked for
+    for _ in range(20):
+        state = automaton.initial
+        for _ in range(50):
+            allowed = automaton.masks([state])[0]
+            tables.add(automaton.table().data_ptr())
+            assert torch.equal(allowed, unpack_bits(automaton._rows[state], len(TOKENS)))
+            token = torch.multinomial(allowed.float(), 1, generator=generator).item()
+            if token == EOS:
+                break
+            state = automaton.advance(state, token)
+    # the table grows by doubling instead of being rebuilt for every new state
+    assert len(automaton._rows) > 4 * initial_states
+    assert len(tables) <= (len(automaton._rows) // initial_states).bit_length() + 1
+
+
+def test_pack_bits():
+    mask = torch.rand(1001, generator=torch.Generator().manual_seed(0)) > 0.5
+    assert torch.equal(unpack_bits(pack_bits(mask), 1001), mask)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
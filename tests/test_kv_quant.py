@@ -0,0 +1,188 @@
+"""
+int8 / int4 kv cache storage (models/custom_cache.py): round trip error of QuantizedKVPages, token by token
+writes that leave the tokens already quantized alone unless the scale has to grow, the context a
+memory budget holds, the MLA latent cache read by forward_chunck, and a free-running greedy / perplexity
+regression on a tiny random llama against the full precision StaticCache.
+
+    python -m pytest tests/test_kv_quant.py
+"""
+import math
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, PretrainedConfig
+from ktransformers.models.custom_cache import (
+    KDeepSeekV3Cache, KGQACache, QuantizedKVPages, StaticCache, kv_bytes_per_token,
+)
+
+PAGE_SIZE = 64
+
+
+def relative_error(x, ref):
+    return ((x - ref).norm() / ref.norm()).item()
+
+
+def test_round_trip():
+    gen = torch.Generator().manual_seed(0)
+    states = torch.randn(4 * PAGE_SIZE, 2, 128, generator=gen)
+    positions = torch.arange(states.size(0))
+    for bits, tolerance in ((8, 0.02), (4, 0.2)):
+        pages = QuantizedKVPages(4, PAGE_SIZE, 2, 128, bits)
+        pages.write(positions // PAGE_SIZE, positions % PAGE_SIZE, states)
+        out = torch.empty(4, PAGE_SIZE, 2, 128)
+        pages.read(out)
+        assert relative_error(out.view_as(states), states) < tolerance, bits
+
+
+def test_page_rescales_on_larger_token():
+    pages = QuantizedKVPages(1, PAGE_SIZE, 1, 64, 8)
+    first = torch.linspace(-1, 1, 64).view(1, 1, 64)
+    pages.write(torch.tensor([0]), torch.tensor([0]), first)
+    # 4x the absmax of the page: rescaled, not clipped, and the first token keeps its values
+    pages.write(torch.tensor([0]), torch.tensor([1]), first * 4)
+    out = torch.empty(1, PAGE_SIZE, 1, 64)
+    pages.read(out)
+    assert torch.allclose(out[0, 1], first[0] * 4, atol=4 / 127)
+    assert torch.allclose(out[0, 0], first[0], atol=2 * 4 / 127)
+
+
+@pytest.mark.parametrize("bits", [8, 4])
+def test_decode_writes_keep_page(bits):
+    gen = torch.Generator().manual_seed(0)
+    states = torch.randn(PAGE_SIZE, 2, 128, generator=gen)
+    # the largest token first: no later write needs a wider scale
+    states[0] *= 4
+    positions = torch.arange(PAGE_SIZE)
+    once = QuantizedKVPages(1, PAGE_SIZE, 2, 128, bits)
+    once.write(positions // PAGE_SIZE, positions % PAGE_SIZE, states)
+    stepped = QuantizedKVPages(1, PAGE_SIZE, 2, 128, bits)
+    stepped.write(torch.tensor([0]), torch.tensor([0]), states[:1])
+    first = stepped.data[0, 0].clone()
+    requantized = []
+    dequantize = stepped.dequantize
+    stepped.dequantize = lambda *args: requantized.append(args) or dequantize(*args)
+    for pos in range(1, PAGE_SIZE):
+        stepped.write(torch.tensor([0]), torch.tensor([pos]), states[pos:pos + 1])
+    assert requantized == [] and torch.equal(stepped.data[0, 0], first)
+    assert torch.equal(stepped.data, once.data) and torch.equal(stepped.scales, once.scales)
+
+
+def deepseek_config(layers=2):
+    return PretrainedConfig(
+        architectures=["DeepseekV2ForCausalLM"], num_hidden_layers=layers, hidden_size=256,
+        num_attention_heads=4, num_key_value_heads=4, kv_lora_rank=512, qk_rope_head_dim=64,
+        max_position_embeddings=4096,
+    )
+
+
+def test_context_in_same_memory():
+    config = deepseek_config(layers=61)
+    bf16 = kv_bytes_per_token(config, "auto", torch.bfloat16)
+    assert bf16 / kv_bytes_per_token(config, "int8") >= 1.99
+    assert bf16 / kv_bytes_per_token(config, "int4") >= 3.9
+    assert kv_bytes_per_token(config, "auto", torch.float32) / kv_bytes_per_token(config, "int8") >= 3.9
+
+
+def test_mla_latent_cache():
+    config = deepseek_config()
+    gen = torch.Generator().manual_seed(0)
+    ref = StaticCache(config, 1, 300, "cpu", torch.float32)
+    quant = StaticCache(config, 1, 300, "cpu", torch.float32, kv_cache_dtype="int8")
+    # a prefill chunk then a few decode steps, like forward_chunck issues them
+    for begin, end in ((0, 200), (200, 201), (201, 202), (202, 250)):
+        compressed_kv = torch.randn(1, end - begin, 1, 512, generator=gen)
+        k_pe = torch.randn(1, end - begin, 1, 64, generator=gen)
+        position = torch.arange(begin, end)
+        for layer_idx in range(2):
+            expected, ref_table = ref.update(compressed_kv, k_pe, layer_idx, {"cache_position": position})
+            out, page_table = quant.update(compressed_kv, k_pe, layer_idx, {"cache_position": position})
+            expected, out = ref.seq_major(expected, ref_table, 1), quant.seq_major(out, page_table, 1)
+            assert out.shape == expected.shape
+            assert relative_error(out.view(-1, 576)[:end], expected.view(-1, 576)[:end]) < 0.02
+            assert not out.view(-1, 576)[end:].any()
+    quant.remove_suffix(100)
+    out, page_table = quant.get_layer_cache(0)
+    assert not quant.seq_major(out, page_table, 1).view(-1, 576)[100:].any()
+
+
+
+def test_mla_reads_written_pages_of_batch(monkeypatch):
+    config = deepseek_config()
+    quant = StaticCache(config, 2, 1024, "cpu", torch.float32, kv_cache_dtype="int8")
+    gen = torch.Generator().manual_seed(0)
+    quant.reserve(1, 1024)
+    read = []
+    monkeypatch.setattr(QuantizedKVPages, "read_pages",
+                        lambda self, out, pages, read_pages=QuantizedKVPages.read_pages:
+                        read.append(len(pages)) or read_pages(self, out, pages))
+    for begin, end in ((0, 200), (200, 201)):
+        position = torch.arange(begin, end)
+        quant.update(torch.randn(1, end - begin, 1, 512, generator=gen),
+                     torch.randn(1, end - begin, 1, 64, generator=gen), 0, {"cache_position": position})
+    # the 4 pages sequence 0 wrote, not the 16 pages sequence 1 reserved or the pool
+    assert read == [4, 4]
+
+
+@pytest.mark.parametrize("cache_class", [KDeepSeekV3Cache, KGQACache])
+def test_kvc2_caches_reject_quantization(cache_class):
+    config = deepseek_config()
+    cache_class(config, kv_cache_dtype="auto")
+    with pytest.raises(ValueError):
+        cache_class(config, kv_cache_dtype="int8")
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=256, hidden_size=128, intermediate_size=256, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=2, max_position_embeddings=512, architectures=["LlamaForCausalLM"],
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+@torch.no_grad()
+def greedy(model, prompt, new_tokens, kv_cache_dtype):
+    """Greedy tokens and the perplexity of the prompt, prefilled in two chunks."""
+    cache = StaticCache(model.config, 1, prompt.size(1) + new_tokens, "cpu", torch.float32, kv_cache_dtype)
+    split = prompt.size(1) // 2
+    nll = 0.0
+    logits = None
+    for begin, end in ((0, split), (split, prompt.size(1))):
+        if logits is not None:
+            nll -= torch.log_softmax(logits[0, -1], -1)[prompt[0, begin]].item()
+        logits = model(prompt[:, begin:end], past_key_values=cache, cache_position=torch.arange(begin, end),
+                       use_cache=True).logits
+        log_probs = torch.log_softmax(logits[0, :-1], -1)
+        nll -= log_probs.gather(-1, prompt[0, begin + 1:end, None]).sum().item()
+    ppl = math.exp(nll / (prompt.size(1) - 1))
+    tokens = []
+    position = prompt.size(1)
+    for _ in range(new_tokens):
+        token = logits[:, -1].argmax(-1, keepdim=True)
+        tokens.append(token.item())
+        logits = model(token, past_key_values=cache, cache_position=torch.tensor([position]), use_cache=True).logits
+        position += 1
+    return tokens, ppl
+
+
+def first_divergence(tokens, ref_tokens):
+    return next((step for step, (a, b) in enumerate(zip(tokens, ref_tokens)) if a != b), len(ref_tokens))
+
+
+def test_tiny_model_greedy_match():
+    model = tiny_llama()
+    prompt = torch.randint(0, model.config.vocab_size, (1, 160), generator=torch.Generator().manual_seed(1))
+    ref_tokens, ref_ppl = greedy(model, prompt, 32, "auto")
+    # free running: the quantized cache has to follow the reference tokens for at least `min_steps` steps
+    for kv_cache_dtype, min_steps, max_ppl_drift in (("int8", 32, 0.01), ("int4", 16, 0.05)):
+        tokens, ppl = greedy(model, prompt, 32, kv_cache_dtype)
+        assert first_divergence(tokens, ref_tokens) >= min_steps, (kv_cache_dtype, tokens, ref_tokens)
+        assert abs(ppl - ref_ppl) / ref_ppl <= max_ppl_drift, (kv_cache_dtype, ppl, ref_ppl)
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_page_rescales_on_larger_token()
+    test_context_in_same_memory()
+    test_mla_latent_cache()
+    test_tiny_model_greedy_match()
+    print("ok")
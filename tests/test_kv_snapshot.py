@@ -0,0 +1,129 @@
+"""
+On-disk KV snapshot format (util/kv_snapshot.py): round trip of blocks and metadata, page alignment of
+the block records, the checks done when a snapshot is opened, and a dynamic attention cache restored from
+a snapshot decodes the same next token as the cache it was saved from.
+
+    python -m pytest tests/test_kv_snapshot.py
+"""
+import os
+import struct
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+from ktransformers.util.kv_snapshot import PAGE_SIZE, SNAPSHOT_MAGIC, KVSnapshot
+
+GEOMETRY = {
+    "layer_num": 2, "kv_head_num": 2, "q_head_num": 4, "head_dim": 16, "block_size": 32, "anchor_num": 1,
+    "anchor_type": "DYNAMIC", "kv_type": "FP16",
+}
+LENGTH = 100
+
+
+def write(path, preselect_block_count=2):
+    snapshot = KVSnapshot.create(path, GEOMETRY, LENGTH, {"generate_token_idx": 3}, preselect_block_count)
+    # nothing is visible under the final name until the header is written
+    assert not os.path.exists(path)
+    for layer_idx in range(GEOMETRY["layer_num"]):
+        for block_idx in range(snapshot.block_num):
+            k, v = snapshot.kv(layer_idx, block_idx)
+            k[:] = layer_idx * 100 + block_idx
+            v[:] = -(layer_idx * 100 + block_idx)
+    snapshot.section("anchor")[:] = 0.5
+    snapshot.section("importance")[1, 2] = 7
+    snapshot.section("preselect")[:] = [[0, 2], [1, 3]]
+    del k, v
+    snapshot.close()
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "kv.snap")
+    write(path)
+    snapshot = KVSnapshot.open(path)
+    assert snapshot.block_num == 4 and snapshot.length == LENGTH
+    assert snapshot.meta == {"generate_token_idx": 3}
+    assert snapshot.header["source"] == {"anchor_type": "DYNAMIC", "kv_type": "FP16"}
+    snapshot.check_geometry(GEOMETRY)
+    for layer_idx in range(2):
+        for block_idx in range(4):
+            k, v = snapshot.kv(layer_idx, block_idx)
+            assert k.shape == (2, 32, 16)
+            assert np.all(k == layer_idx * 100 + block_idx) and np.all(v == -(layer_idx * 100 + block_idx))
+    assert np.all(snapshot.section("anchor") == 0.5)
+    assert np.all(snapshot.section("importance")[1, 2] == 7) and not snapshot.section("importance")[0].any()
+    assert snapshot.section("preselect").tolist() == [[0, 2], [1, 3]]
+    # the mapping is copy on write, writes through a view never reach the file
+    k[:] = 0
+    del k, v
+    snapshot.close()
+    assert np.all(KVSnapshot.open(path).kv(1, 3)[0] == 103)
+
+
+def test_records_are_page_aligned(tmp_path):
+    path = str(tmp_path / "kv.snap")
+    write(path)
+    snapshot = KVSnapshot.open(path)
+    assert snapshot.data_offset % PAGE_SIZE == 0
+    for section in snapshot.header["sections"].values():
+        assert section["offset"] % PAGE_SIZE == 0
+    assert snapshot.header["sections"]["kv"]["record_bytes"] % PAGE_SIZE == 0
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = str(tmp_path / "kv.snap")
+    write(path)
+    with pytest.raises(ValueError, match="doesn't match"):
+        KVSnapshot.open(path).check_geometry({**GEOMETRY, "head_dim": 32})
+    with open(path, "r+b") as f:
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(struct.pack("<I", 99))
+    with pytest.raises(ValueError, match="version 99"):
+        KVSnapshot.open(path)
+    other = tmp_path / "other.bin"
+    other.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError, match="not a kv snapshot"):
+        KVSnapshot.open(str(other))
+
+
+def test_restored_cache_decodes(tmp_path):
+    dynamic_attention = pytest.importorskip("ktransformers.operators.dynamic_attention")
+    config = SimpleNamespace(num_key_value_heads=2, num_attention_heads=4, hidden_size=4 * 64, num_hidden_layers=2)
+
+    def make():
+        return dynamic_attention.DynamicScaledDotProductAttention(
+            max_seq_len=512, block_size=32, config=config, device=torch.device("cpu"), local_windows_len=64,
+            topk=4, threads_num=2, preselect_block=True, preselect_block_count=4, prefill_chunk_size=4096,
+        )
+
+    gen = torch.Generator().manual_seed(0)
+    length = 200
+    prompt = [torch.randn(1, length, heads, 64, generator=gen).half() for heads in (4, 2, 2)]
+    step = [torch.randn(1, 1, heads, 64, generator=gen).half() for heads in (4, 2, 2)]
+
+    original = make()
+    original.remaining_length = length
+    for layer_idx in range(config.num_hidden_layers):
+        original.apply(layer_idx, 1, 0, *prompt, mode="prefill")
+    original.calc_anchor(length)
+    original.clear_importance(length)
+    path = str(tmp_path / "kv.snapshot")
+    original.save_snapshot(path, length)
+
+    restored = make()
+    restored.load_snapshot(path, length)
+    assert restored.generate_token_idx == original.generate_token_idx
+    for layer_idx in range(config.num_hidden_layers):
+        expected = original.apply(layer_idx, 1, length, *step, mode="generate").clone()
+        actual = restored.apply(layer_idx, 1, length, *step, mode="generate").clone()
+        torch.testing.assert_close(actual, expected)
+    # every layer faulted its blocks in, the mapping is released
+    assert restored.snapshot is None and restored.snapshot_layers == {0, 1}
+
+
+if __name__ == "__main__":
+    import tempfile
+    import pathlib
+    for test in (test_round_trip, test_records_are_page_aligned, test_open_rejects_other_files):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("ok")
@@ -0,0 +1,133 @@
+"""
+Layer-ahead prefetch for per-layer prefill (util/layer_prefetch.py): on a stack of layers whose weights only
+exist between load and unload, iterating through a LayerPrefetcher gives the same outputs as loading each layer
+in turn, never holds more than depth + 1 layers, loads off the calling thread except for layers with CPUInfer
+backed operators, and raises a failed load in the caller at the layer it failed on.
+
+    python -m pytest tests/test_layer_prefetch.py
+"""
+import threading
+import time
+import pytest
+import torch
+from torch import nn
+from ktransformers.util.layer_prefetch import LayerPrefetcher, loads_off_thread
+
+
+class StoredLayer(nn.Module):
+    """A layer whose weight is read from `stored` by load(), after `load_delay` seconds of "I/O"."""
+
+    def __init__(self, stored: torch.Tensor, load_delay: float = 0.0):
+        super().__init__()
+        self.stored = stored
+        self.load_delay = load_delay
+        self.weight = None
+
+    def forward(self, x):
+        assert self.weight is not None, "layer used while unloaded"
+        return torch.tanh(x @ self.weight)
+
+
+class Stack:
+    """Layers and their loader, counting the layers loaded at once and the threads that loaded them."""
+
+    def __init__(self, num_layers: int, hidden: int, load_delay: float = 0.0, fail_at: int = None):
+        gen = torch.Generator().manual_seed(0)
+        self.layers = [StoredLayer(torch.randn(hidden, hidden, generator=gen) / hidden ** 0.5, load_delay)
+                       for _ in range(num_layers)]
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+        self.loaded = self.max_loaded = 0
+        self.load_threads = set()
+        self.layer_threads = {}
+
+    def load(self, layer: StoredLayer):
+        if self.fail_at is not None and layer is self.layers[self.fail_at]:
+            raise RuntimeError("weights missing")
+        time.sleep(layer.load_delay)
+        layer.weight = layer.stored.clone()
+        with self.lock:
+            self.loaded += 1
+            self.max_loaded = max(self.max_loaded, self.loaded)
+            self.load_threads.add(threading.get_ident())
+            self.layer_threads[self.layers.index(layer)] = threading.get_ident()
+
+    def unload(self, layer: StoredLayer):
+        layer.weight = None
+        with self.lock:
+            self.loaded -= 1
+
+    def in_turn(self, x):
+        for layer in self.layers:
+            self.load(layer)
+            x = layer(x)
+            self.unload(layer)
+        return x
+
+    def prefetched(self, x, depth):
+        for layer in LayerPrefetcher(self.layers, self.load, self.unload, depth):
+            x = layer(x)
+        return x
+
+
+@pytest.mark.parametrize("depth", [1, 2, 8])
+def test_matches_in_turn(depth):
+    stack = Stack(6, 32, load_delay=0.002)
+    x = torch.randn(4, 32, generator=torch.Generator().manual_seed(1))
+    expected = stack.in_turn(x)
+    stack.max_loaded = 0
+    stack.load_threads.clear()
+    assert torch.equal(stack.prefetched(x, depth), expected)
+    assert stack.max_loaded <= min(depth + 1, 6)
+    assert stack.loaded == 0
+    assert threading.get_ident() not in stack.load_threads
+
+
+
+class CPUInferOp:
+    """Stands in for KExpertsCPU / KLinearCPUInfer, which share a class level CPU_INFER."""
+    CPU_INFER = object()
+
+
+def test_cpuinfer_layers_load_in_turn():
+    stack = Stack(6, 16, load_delay=0.002)
+    stack.layers[3].experts = nn.Module()
+    stack.layers[3].experts.prefill_experts = CPUInferOp()
+    assert [loads_off_thread(layer) for layer in stack.layers] == [True, True, True, False, True, True]
+    x = torch.randn(2, 16, generator=torch.Generator().manual_seed(1))
+    expected = stack.in_turn(x)
+    stack.max_loaded = 0
+    stack.layer_threads.clear()
+    assert torch.equal(stack.prefetched(x, 2), expected)
+    assert stack.layer_threads[3] == threading.get_ident()
+    assert threading.get_ident() not in {stack.layer_threads[i] for i in (0, 1, 2, 4, 5)}
+    assert stack.max_loaded <= 3 and stack.loaded == 0
+
+def test_failed_load_raises_at_its_layer():
+    stack = Stack(5, 8, fail_at=3)
+    reached = []
+    with pytest.raises(RuntimeError, match="weights missing"):
+        for i, layer in enumerate(LayerPrefetcher(stack.layers, stack.load, stack.unload, 2)):
+            reached.append(i)
+    assert reached == [0, 1, 2]
+
+
+def test_early_exit():
+    stack = Stack(5, 8, load_delay=0.005)
+    for i, layer in enumerate(LayerPrefetcher(stack.layers, stack.load, stack.unload, 2)):
+        if i == 1:
+            break
+    # the loads queued ahead finished, nothing runs in the background any more
+    loaded = stack.loaded
+    time.sleep(0.02)
+    assert stack.loaded == loaded
+
+
+def test_depth():
+    with pytest.raises(ValueError):
+        LayerPrefetcher([], lambda layer: None, lambda layer: None, 0)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
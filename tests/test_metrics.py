@@ -0,0 +1,151 @@
+"""
+Serving metrics registry (util/metrics.py): counters and histograms updated from many threads without locks
+lose no updates, the text output follows the Prometheus exposition format (cumulative buckets, +Inf, _sum,
+_count), snapshots of another process merge in, and RequestMetrics keeps TTFT / inter-token latency and the
+waiting / in-flight gauges straight however a request ends, also through the record_request wrapper, and the
+shards of threads that have ended are folded in and let go.
+
+    python -m pytest tests/test_metrics.py
+"""
+import asyncio
+import queue
+import threading
+import pytest
+from ktransformers.util.metrics import (
+    MetricsRegistry, RequestMetrics, SnapshotPublisher, SnapshotReceiver, record_request, render_text,
+)
+
+
+def parse(text):
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE"):
+            _, _, name, kind = line.split()
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            key, value = line.rsplit(" ", 1)
+            samples[key] = float(value)
+    return samples, types
+
+
+def test_threads_lose_no_updates():
+    registry = MetricsRegistry()
+    counter = registry.counter("c_total", "c")
+    histogram = registry.histogram("h_seconds", "h", buckets=(0.1, 1.0))
+
+    def work(seed):
+        for i in range(20000):
+            counter.inc()
+            histogram.observe((0.05, 0.5, 5.0)[(i + seed) % 3])
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value() == 160000
+    snapshot = histogram.snapshot()
+    assert sum(snapshot["counts"]) == 160000 and snapshot["counts"][0] > 0 and snapshot["counts"][2] > 0
+
+
+def test_ended_threads_shards_retired():
+    registry = MetricsRegistry()
+    counter = registry.counter("c_total", "c")
+    counter.inc()
+    for _ in range(4):
+        thread = threading.Thread(target=counter.inc, args=(2,))
+        thread.start()
+        thread.join()
+    assert counter.value() == 9 and len(counter._shards) == 1
+    registry.reset()
+    assert counter.value() == 0
+
+
+def test_text_format():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests.").inc(3)
+    registry.gauge("depth", "Depth.").set(7)
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.1, 0.5, 2.0):
+        histogram.observe(value)
+    samples, types = parse(registry.render())
+    assert types == {"requests_total": "counter", "depth": "gauge", "latency_seconds": "histogram"}
+    assert samples["requests_total"] == 3 and samples["depth"] == 7
+    # a value on a bound counts for that bound
+    assert samples['latency_seconds_bucket{le="0.1"}'] == 1
+    assert samples['latency_seconds_bucket{le="1.0"}'] == 2
+    assert samples['latency_seconds_bucket{le="+Inf"}'] == 3
+    assert samples["latency_seconds_count"] == 3 and samples["latency_seconds_sum"] == pytest.approx(2.6)
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", "not a gauge")
+
+
+def test_sources_merge():
+    engine, server = MetricsRegistry(), MetricsRegistry()
+    engine.histogram("model_seconds", "m", buckets=(1.0,)).observe(0.5)
+    engine.counter("shared_total", "s").inc(2)
+    server.counter("shared_total", "s").inc(1)
+    channel = queue.Queue(maxsize=1)
+    publisher = SnapshotPublisher(channel, interval=0, registry=engine)
+    publisher.maybe_publish()
+    # a full queue drops the snapshot instead of blocking the engine
+    publisher.maybe_publish()
+    server.add_source("engine", SnapshotReceiver(channel))
+    samples, _ = parse(server.render())
+    assert samples["shared_total"] == 3 and samples["model_seconds_count"] == 1
+    # the receiver keeps the last snapshot when nothing new came
+    assert parse(server.render())[0] == samples
+    assert render_text({}) == "\n"
+
+
+def test_request_metrics():
+    registry = MetricsRegistry()
+    done = RequestMetrics(registry)
+    done.prompt(10)
+    for _ in range(5):
+        done.token()
+    cancelled = RequestMetrics(registry)
+    samples, _ = parse(registry.render())
+    assert samples["ktransformers_requests_in_flight"] == 2 and samples["ktransformers_requests_waiting"] == 1
+    done.finish()
+    cancelled.finish()
+    cancelled.finish()
+    samples, _ = parse(registry.render())
+    assert samples["ktransformers_requests_in_flight"] == 0 and samples["ktransformers_requests_waiting"] == 0
+    assert samples["ktransformers_requests_total"] == 2 and samples["ktransformers_prompt_tokens_total"] == 10
+    assert samples["ktransformers_generated_tokens_total"] == 5
+    assert samples["ktransformers_time_to_first_token_seconds_count"] == 1
+    assert samples["ktransformers_inter_token_latency_seconds_count"] == 4
+
+
+def test_record_request(monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(MetricsRegistry, "_instance", registry)
+
+    @record_request
+    async def inference(num_tokens, request_metrics=None):
+        request_metrics.prompt(3)
+        for i in range(num_tokens):
+            request_metrics.token()
+            yield i
+
+    async def consume(num_tokens, take):
+        items, taken = inference(num_tokens), []
+        async for item in items:
+            taken.append(item)
+            if len(taken) == take:
+                break
+        await items.aclose()
+        return taken
+
+    assert asyncio.run(consume(4, 4)) == [0, 1, 2, 3]
+    # a client that went away after the first token
+    assert asyncio.run(consume(4, 1)) == [0]
+    samples, _ = parse(registry.render())
+    assert samples["ktransformers_requests_in_flight"] == 0 and samples["ktransformers_requests_waiting"] == 0
+    assert samples["ktransformers_requests_total"] == 2 and samples["ktransformers_generated_tokens_total"] == 5
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,64 @@
+"""
+Length-aware MLA decode (operators/mla_decode.py): the split / log-sum-exp attention matches a dense masked
+softmax over the valid prefix for any split size and a few causal query tokens, and on a tiny random DeepSeek
+config KDeepseekV2Attention.forward_chunck gives the output of the unabsorbed attention over the whole prompt both
+through it and through the dense masked path over max_cache_len, on the plain and the int8 StaticCache.
+
+    python -m pytest tests/test_mla_decode.py
+"""
+import pytest
+import torch
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.modeling_deepseek import DeepseekV2Attention
+from ktransformers.operators.attention import KDeepseekV2Attention
+from ktransformers.operators.mla_decode import mla_prefix_attention
+from mla_helpers import causal_mask, dense_attention, prompt_attention, tiny_deepseek, KV_LORA_RANK, ROPE_DIM
+
+
+@pytest.mark.parametrize("kv_len,q_len,split_size", [(1, 1, 64), (700, 1, 64), (700, 1, 256), (700, 4, 128),
+                                                     (64, 3, 64), (1000, 1, None)])
+def test_matches_dense(kv_len, q_len, split_size):
+    gen = torch.Generator().manual_seed(kv_len)
+    q_nope = torch.randn(1, 4, q_len, KV_LORA_RANK, generator=gen)
+    q_pe = torch.randn(1, 4, q_len, ROPE_DIM, generator=gen)
+    kv = torch.randn(1, kv_len, KV_LORA_RANK + ROPE_DIM, generator=gen)
+    cache_position = torch.arange(kv_len - q_len, kv_len)
+    out = mla_prefix_attention(q_nope, q_pe, kv, KV_LORA_RANK, 0.2, cache_position, split_size)
+    assert torch.allclose(out, dense_attention(q_nope, q_pe, kv, 0.2, cache_position), atol=1e-5)
+
+
+@torch.no_grad()
+def run(attn, config, steps, decode_max_q_len, kv_cache_dtype):
+    """A prefill chunk then decode steps and a 3 token verify step; the hidden states fed and the outputs."""
+    attn.decode_max_q_len = decode_max_q_len
+    cache = StaticCache(config, 1, 512, "cpu", torch.float32, kv_cache_dtype)
+    gen = torch.Generator().manual_seed(1)
+    inputs, outputs = [], []
+    for begin, end in steps:
+        hidden_states = torch.randn(1, end - begin, config.hidden_size, generator=gen)
+        cache_position = torch.arange(begin, end)
+        out, _, _ = attn.forward_chunck(hidden_states, causal_mask(cache_position, 512), cache_position[None, :],
+                                        cache, cache_position=cache_position)
+        inputs.append(hidden_states)
+        outputs.append(out)
+    return torch.cat(inputs, dim=1), torch.cat(outputs, dim=1)
+
+
+@pytest.mark.parametrize("kv_cache_dtype, atol", [("auto", 1e-5), ("int8", 2e-2)])
+def test_forward_chunck_matches_dense(kv_cache_dtype, atol):
+    torch.manual_seed(0)
+    config = tiny_deepseek()
+    attn = KDeepseekV2Attention("blk.0.attn", None, config, DeepseekV2Attention(config, 0)).eval()
+    steps = [(0, 100), (100, 101), (101, 102), (102, 105), (105, 106), (106, 300), (300, 301)]
+    hidden_states, dense = run(attn, config, steps, 0, kv_cache_dtype)
+    _, length_aware = run(attn, config, steps, 16, kv_cache_dtype)
+    expected = prompt_attention(attn, hidden_states)
+    assert torch.allclose(dense, expected, atol=atol), (dense - expected).abs().max()
+    assert torch.allclose(length_aware, expected, atol=atol), (length_aware - expected).abs().max()
+    # both paths read the same cache, quantized or not
+    assert torch.allclose(length_aware, dense, atol=1e-5), (length_aware - dense).abs().max()
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,114 @@
+"""
+Mock backend (server/backend/interfaces/mock.py) and the load generator helpers (tests/bench_serving.py): the
+mock answers a prompt with the same tokens every time, at the configured decode rate, cut by max_tokens, and runs
+at most mock_max_batch requests at once; the percentiles, length distributions and goodput of the load generator
+are the textbook ones.
+
+    python -m pytest tests/test_mock_backend.py
+"""
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+from bench_serving import RequestResult, arrival_times, parse_length, percentile, summarize
+from ktransformers.server.backend.interfaces.mock import MockInterface, mock_tokens
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+
+
+def mock_args(**kwargs):
+    args = dict(mock_prefill_tps=10000, mock_decode_tps=200, mock_output_tokens=8, mock_max_batch=2,
+                max_new_tokens=500)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+async def collect(interface, prompt, **kwargs):
+    tokens, finish, usage = [], None, None
+    async for item in interface.inference([{"role": "user", "content": prompt}], "thread", **kwargs):
+        if isinstance(item, RawUsage):
+            usage = item
+        elif item[1] is None:
+            tokens.append(item[0])
+        else:
+            finish = item[1]
+    return tokens, finish, usage
+
+
+def test_deterministic_reply():
+    assert mock_tokens("hello world", 16) == mock_tokens("hello world", 16)
+    assert mock_tokens("hello world", 16) != mock_tokens("hello there", 16)
+    tokens, finish, usage = asyncio.run(collect(MockInterface(mock_args()), "hello world"))
+    assert tokens == mock_tokens("hello world", 8)
+    assert finish == "stop"
+    assert usage.prefill_count == 2 and usage.decode_count == 8
+
+
+def test_max_tokens_cuts_reply():
+    tokens, finish, _ = asyncio.run(collect(MockInterface(mock_args()), "hello world", max_tokens=3))
+    assert tokens == mock_tokens("hello world", 3)
+    assert finish == "length"
+
+
+def test_rates_and_batch():
+    async def main():
+        interface = MockInterface(mock_args(mock_decode_tps=50, mock_output_tokens=6, mock_max_batch=2))
+        begin = time.perf_counter()
+        await asyncio.gather(*(collect(interface, f"prompt {i}") for i in range(4)))
+        return time.perf_counter() - begin
+
+    # 6 tokens at 50/s take 0.1s from the first; 4 requests two at a time take two rounds
+    elapsed = asyncio.run(main())
+    assert 0.19 <= elapsed < 0.5, elapsed
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3.0], 99) == 3.0
+    values = list(range(1, 101))
+    assert percentile(values, 50) == pytest.approx(50.5)
+    assert percentile(values, 99) == pytest.approx(99.01)
+
+
+def test_length_distributions():
+    rng = random.Random(0)
+    assert parse_length("fixed:128")(rng) == 128
+    assert all(10 <= parse_length("uniform:10:20")(rng) <= 20 for _ in range(100))
+    lognormal = sorted(parse_length("lognormal:256:0.5")(rng) for _ in range(2001))
+    assert 230 <= lognormal[1000] <= 280
+    with pytest.raises(ValueError):
+        parse_length("normal:1")
+
+
+def test_poisson_arrivals():
+    times = arrival_times("poisson", 4.0, 4001, random.Random(0))
+    assert times == sorted(times) and times[0] == 0.0
+    assert times[-1] / 4000 == pytest.approx(0.25, rel=0.05)
+    assert arrival_times("constant", 2.0, 3, random.Random(0)) == [0.0, 0.5, 1.0]
+
+
+def test_goodput():
+    results = [
+        RequestResult(start=0, prompt_tokens=10, max_tokens=4, ttft=0.1, itls=[0.01] * 3, latency=0.13,
+                      output_tokens=4),
+        # first token too late
+        RequestResult(start=0, prompt_tokens=10, max_tokens=4, ttft=2.0, itls=[0.01] * 3, latency=2.03,
+                      output_tokens=4),
+        # tokens too slow on average
+        RequestResult(start=0, prompt_tokens=10, max_tokens=4, ttft=0.1, itls=[0.1] * 3, latency=0.4,
+                      output_tokens=4),
+        RequestResult(start=0, prompt_tokens=10, max_tokens=4, error="status 500"),
+    ]
+    summary = summarize(results, 2.0, slo_ttft=1.0, slo_itl=0.05)
+    assert summary["completed"] == 3 and summary["failed"] == 1
+    assert summary["goodput"] == 0.5
+    assert summary["slo_attainment"] == 0.25
+    assert summary["output_throughput"] == 6.0
+    assert summary["ttft"]["p50"] == pytest.approx(0.1)
+    assert summarize(results, 2.0)["goodput"] == 1.5
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
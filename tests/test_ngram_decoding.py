@@ -0,0 +1,113 @@
+"""
+Prompt-lookup speculative decoding (util/ngram_decoding.py): the n-gram index drafts from earlier
+occurrences only, verification keeps greedy tokens and the sampling distribution, and on a tiny random
+llama the speculative greedy output is exactly the token-by-token greedy output, with the StaticCache rolled
+back on rejection. Run directly to print acceptance rate and tokens/s.
+
+    python -m pytest tests/test_ngram_decoding.py
+"""
+import time
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.util.ngram_decoding import NgramSpeculator, PromptLookup, verify_draft
+
+
+def test_prompt_lookup():
+    lookup = PromptLookup([1, 2, 3, 4, 5, 9, 2, 3, 7, 8, 2, 3], num_draft=3, max_ngram=2)
+    # the latest earlier "2 3" is followed by 7 8 2
+    assert lookup.draft() == [7, 8, 2]
+    assert lookup.draft(1) == [7]
+    lookup.extend([7])
+    assert lookup.draft() == [8, 2, 3]
+    # the longest n-gram wins: "4 9" was followed by 1 6, the later "9" alone by 2 8
+    lookup = PromptLookup([4, 9, 1, 6, 3, 9, 2, 8, 4, 9], num_draft=2, max_ngram=2)
+    assert lookup.draft() == [1, 6]
+    # the trailing n-gram never matches itself
+    assert PromptLookup([5, 6, 7]).draft() == []
+    assert PromptLookup([5, 6, 7]).draft(0) == []
+
+
+def test_verify_greedy():
+    scores = torch.full((4, 10), -1.0)
+    for position, token in enumerate([3, 4, 9, 1]):
+        scores[position, token] = 1.0
+    assert verify_draft(scores, [3, 4, 9]) == [3, 4, 9, 1]
+    assert verify_draft(scores, [3, 5, 9]) == [3, 4]
+    assert verify_draft(scores, [0, 4, 9]) == [3]
+    assert verify_draft(scores[:1], []) == [3]
+
+
+def test_verify_sampling_keeps_distribution():
+    torch.manual_seed(0)
+    probs = torch.tensor([0.5, 0.3, 0.2])
+    scores = probs.log().expand(2, -1)
+    counts = torch.zeros(3)
+    for _ in range(20000):
+        counts[verify_draft(scores, [1], do_sample=True)[0]] += 1
+    assert torch.allclose(counts / counts.sum(), probs, atol=0.015)
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64, hidden_size=128, intermediate_size=256, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=2, max_position_embeddings=512, architectures=["LlamaForCausalLM"],
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def repetitive_prompt(length=96):
+    # code / RAG like: a few spans repeated, so the prompt has something to look up
+    spans = torch.randint(0, 64, (4, 8), generator=torch.Generator().manual_seed(1))
+    order = torch.randint(0, 4, (length // 8,), generator=torch.Generator().manual_seed(2))
+    return spans[order].view(1, -1)
+
+
+@torch.no_grad()
+def decode(model, prompt, new_tokens, ngram: bool):
+    cache = StaticCache(model.config, 1, prompt.size(1) + new_tokens + 8, "cpu", torch.float32)
+    logits = model(prompt, past_key_values=cache, cache_position=torch.arange(prompt.size(1)), use_cache=True).logits
+    tokens = [logits[0, -1].argmax().item()]
+    begin = time.perf_counter()
+    if not ngram:
+        while len(tokens) < new_tokens:
+            position = prompt.size(1) + len(tokens) - 1
+            logits = model(torch.tensor([tokens[-1:]]), past_key_values=cache,
+                           cache_position=torch.tensor([position]), use_cache=True).logits
+            tokens.append(logits[0, -1].argmax().item())
+        return tokens, len(tokens) / (time.perf_counter() - begin), None
+
+    def forward(input_ids, cache_position):
+        return model(input_ids, past_key_values=cache, cache_position=cache_position, use_cache=True).logits[0]
+
+    speculator = NgramSpeculator(forward, cache, prompt[0].tolist() + tokens, num_draft=4, max_ngram=3)
+    while len(tokens) < new_tokens:
+        tokens += speculator.step(new_tokens - len(tokens))
+    assert cache.get_seq_length() == prompt.size(1) + new_tokens - 1
+    return tokens, len(tokens) / (time.perf_counter() - begin), speculator.stats
+
+
+def test_greedy_matches_plain_decode():
+    model = tiny_llama()
+    prompt = repetitive_prompt()
+    ref_tokens, _, _ = decode(model, prompt, 48, ngram=False)
+    tokens, _, stats = decode(model, prompt, 48, ngram=True)
+    assert tokens == ref_tokens
+    assert stats.tokens == len(tokens) - 1
+    assert stats.forwards <= stats.tokens
+    assert stats.drafted > 0
+
+
+if __name__ == "__main__":
+    test_prompt_lookup()
+    test_verify_greedy()
+    test_verify_sampling_keeps_distribution()
+    model = tiny_llama()
+    prompt = repetitive_prompt()
+    ref_tokens, plain_tps, _ = decode(model, prompt, 128, ngram=False)
+    tokens, ngram_tps, stats = decode(model, prompt, 128, ngram=True)
+    assert tokens == ref_tokens
+    print(f"plain:  {plain_tps:.1f} tokens/s")
+    print(f"ngram:  {ngram_tps:.1f} tokens/s")
+    print(stats)
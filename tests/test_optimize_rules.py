@@ -0,0 +1,179 @@
+"""
+Golden plan test of the compiled optimize rules (optimize/optimize.py): for every shipped
+optimize_rules/*.yaml, the injection plan of gen_optimize_config over a tiny model of that family
+is exactly the plan of the previous rule-by-rule matcher (kept below as the reference), and
+the config trie inject() walks resolves every module to the same entry.
+
+    python -m pytest tests/test_optimize_rules.py
+"""
+import copy
+import os
+import re
+import pytest
+import yaml
+from ktransformers.optimize.optimize import OptimizeConfigTrie, OptimizeRules, gen_optimize_config
+from ktransformers.util.custom_gguf import translate_name_to_gguf
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "optimize", "optimize_rules")
+
+YARN = {
+    "type": "yarn", "factor": 40, "original_max_position_embeddings": 4096, "beta_fast": 32, "beta_slow": 1,
+    "mscale": 1.0, "mscale_all_dim": 1.0,
+}
+
+
+def deepseek_v2(layers, experts):
+    from ktransformers.models.configuration_deepseek import DeepseekV2Config
+    from ktransformers.models.modeling_deepseek import DeepseekV2ForCausalLM
+    return DeepseekV2ForCausalLM(DeepseekV2Config(
+        vocab_size=256, hidden_size=64, intermediate_size=128, moe_intermediate_size=32, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=4, n_shared_experts=1, n_routed_experts=experts,
+        num_experts_per_tok=2, first_k_dense_replace=1, q_lora_rank=32, kv_lora_rank=32, qk_rope_head_dim=16,
+        v_head_dim=16, qk_nope_head_dim=16, n_group=1, topk_group=1, rope_scaling=YARN,
+    ))
+
+
+def deepseek_v3(layers, experts):
+    from ktransformers.models.configuration_deepseek_v3 import DeepseekV3Config
+    from ktransformers.models.modeling_deepseek_v3 import DeepseekV3ForCausalLM
+    return DeepseekV3ForCausalLM(DeepseekV3Config(
+        vocab_size=256, hidden_size=64, intermediate_size=128, moe_intermediate_size=32, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=4, n_shared_experts=1, n_routed_experts=experts,
+        num_experts_per_tok=2, first_k_dense_replace=3, q_lora_rank=32, kv_lora_rank=32, qk_rope_head_dim=16,
+        v_head_dim=16, qk_nope_head_dim=16, n_group=1, topk_group=1, rope_scaling=YARN,
+    ))
+
+
+def qwen2_moe(layers, experts):
+    from transformers.models.qwen2_moe.configuration_qwen2_moe import Qwen2MoeConfig
+    from ktransformers.models.modeling_qwen2_moe import Qwen2MoeForCausalLM
+    return Qwen2MoeForCausalLM(Qwen2MoeConfig(
+        vocab_size=256, hidden_size=64, intermediate_size=128, moe_intermediate_size=32,
+        shared_expert_intermediate_size=64, num_hidden_layers=layers, num_attention_heads=4,
+        num_key_value_heads=2, num_experts=experts, num_experts_per_tok=2,
+    ))
+
+
+def qwen3_moe(layers, experts):
+    from ktransformers.models.configuration_qwen3_moe import Qwen3MoeConfig
+    from ktransformers.models.modeling_qwen3_moe import Qwen3MoeForCausalLM
+    return Qwen3MoeForCausalLM(Qwen3MoeConfig(
+        vocab_size=256, hidden_size=64, intermediate_size=128, moe_intermediate_size=32, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=2, head_dim=16, num_experts=experts, num_experts_per_tok=2,
+    ))
+
+
+def llama(layers, experts):
+    from ktransformers.models.configuration_llama import LlamaConfig
+    from ktransformers.models.modeling_llama import LlamaForCausalLM
+    return LlamaForCausalLM(LlamaConfig(
+        vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=layers, num_attention_heads=4,
+        num_key_value_heads=2,
+    ))
+
+
+def mixtral(layers, experts):
+    from transformers.models.mixtral.configuration_mixtral import MixtralConfig
+    from ktransformers.models.modeling_mixtral import MixtralForCausalLM
+    return MixtralForCausalLM(MixtralConfig(
+        vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=layers, num_attention_heads=4,
+        num_key_value_heads=2, num_local_experts=experts, num_experts_per_tok=2,
+    ))
+
+
+# rule file prefix -> (model family, layers of the full size model, so layer range rules are exercised)
+FAMILIES = {
+    "DeepSeek-V2-Lite": (deepseek_v2, 27),
+    "DeepSeek-V2": (deepseek_v2, 60),
+    "DeepSeek-V3": (deepseek_v3, 61),
+    "Moonlight": (deepseek_v3, 27),
+    "Qwen2-57B": (qwen2_moe, 28),
+    "Qwen2-serve": (qwen2_moe, 28),
+    "Qwen3Moe": (qwen3_moe, 48),
+    "Internlm2_5": (llama, 32),
+    "Mixtral": (mixtral, 32),
+}
+
+
+def build_model(rule_file: str, experts: int = 4):
+    for prefix, (family, layers) in FAMILIES.items():
+        if rule_file.startswith(prefix):
+            return family(layers, experts)
+    raise KeyError(f"no model family for {rule_file}")
+
+
+def rule_files():
+    return sorted(name for name in os.listdir(RULES_DIR) if name.endswith(".yaml"))
+
+
+def load_rules(rule_file: str):
+    with open(os.path.join(RULES_DIR, rule_file), "r", encoding="utf-8") as f:
+        return yaml.load(f.read(), Loader=yaml.FullLoader)
+
+
+def reference_gen_optimize_config(module, out_data, rule_list, prefix="", default_device="cpu"):
+    """The matcher before OptimizeRules: every rule's class import and regex, for every module."""
+    module_name = prefix[:-1]
+    translated_name = translate_name_to_gguf(prefix)[:-1]
+    recursive = True
+    for rule in rule_list:
+        match_meta = rule["match"]
+        if "class" in match_meta:
+            import_path = match_meta["class"].split(".")
+            module_cls = getattr(__import__(".".join(import_path[:-1]), fromlist=[""]), import_path[-1])
+            if not isinstance(module, module_cls):
+                continue
+        if "name" in match_meta:
+            if re.search(match_meta["name"], module_name) is None:
+                continue
+        replace_meta = rule["replace"]
+        if module_name not in out_data:
+            out_data[module_name] = {"key": translated_name,
+                                     "class": replace_meta["class"] if "class" in replace_meta else "default",
+                                     "kwargs": copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict()}
+        else:
+            if out_data[module_name]["class"] == "default":
+                out_data[module_name]["class"] = replace_meta["class"] if "class" in replace_meta else "default"
+            out_data[module_name]["kwargs"].update(copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict())
+        if "recursive" in rule:
+            recursive = bool(rule["recursive"])
+        break
+    if module_name not in out_data:
+        out_data[module_name] = {"class": "default", "key": translated_name,
+                                 "kwargs": {"generate_device": default_device, "prefill_device": default_device}}
+    if recursive:
+        for name, child in module._modules.items():
+            if child is not None:
+                reference_gen_optimize_config(child, out_data, rule_list, prefix + name + ".")
+
+
+@pytest.mark.parametrize("rule_file", rule_files())
+def test_golden_plan(rule_file):
+    model = build_model(rule_file)
+    rule_list = load_rules(rule_file)
+    expected, plan = {}, {}
+    reference_gen_optimize_config(model, expected, rule_list)
+    gen_optimize_config(model, plan, OptimizeRules(rule_list))
+    # same entries in the same order, so inject visits and prints modules identically
+    assert list(plan.items()) == list(expected.items())
+
+    trie = OptimizeConfigTrie.build(plan)
+    for module_name, meta in plan.items():
+        node = trie
+        for segment in module_name.split(".") if module_name else []:
+            node = node.children[segment]
+        assert node.meta is meta
+
+
+def test_rules_are_checked_up_front():
+    with pytest.raises(Exception, match="at least one"):
+        OptimizeRules([{"match": {}, "replace": {"class": "default"}}])
+    with pytest.raises(Exception, match="replace must be in rule"):
+        OptimizeRules([{"match": {"name": "^lm_head$"}}])
+
+
+if __name__ == "__main__":
+    for rule_file in rule_files():
+        test_golden_plan(rule_file)
+    test_rules_are_checked_up_front()
+    print("ok")
@@ -0,0 +1,180 @@
+"""
+Stress tests of the paged kv allocator (models/page_allocator.py): fragmentation under random
+grow/truncate/free churn, page reuse, and copy on write prefix sharing, first on the bare page
+tables, then through the MLA StaticCache, where pages reserved ahead of decode are written without the
+per step page check.
+
+    python -m pytest tests/test_page_allocator.py
+"""
+import random
+import pytest
+from ktransformers.models.page_allocator import OutOfPages, PageAllocator, SequencePages
+
+PAGE_SIZE = 64
+
+
+def check_invariants(seqs: SequencePages):
+    allocator = seqs.allocator
+    counts = [0] * allocator.num_pages
+    for table in seqs.tables:
+        for page in table:
+            counts[page] += 1
+    assert counts == allocator.refcount
+    assert sorted(allocator.free) == [page for page, count in enumerate(counts) if count == 0]
+    assert len(set(allocator.free)) == len(allocator.free)
+
+
+def test_alloc_release_reuse():
+    allocator = PageAllocator(8)
+    first = allocator.alloc(3)
+    assert first == [0, 1, 2]
+    allocator.release(first)
+    # released pages come back in ascending order, so a regrown sequence stays contiguous
+    assert allocator.alloc(3) == [0, 1, 2]
+    assert allocator.num_used == 3
+    with pytest.raises(OutOfPages):
+        allocator.alloc(6)
+    assert allocator.num_used == 3
+
+
+def test_random_churn_has_no_leaks_or_fragmentation():
+    rng = random.Random(0)
+    num_pages, max_seqs = 256, 8
+    seqs = SequencePages(PageAllocator(num_pages), max_seqs, PAGE_SIZE)
+    lengths = [0] * max_seqs
+    for step in range(5000):
+        seq_id = rng.randrange(max_seqs)
+        op = rng.random()
+        try:
+            if op < 0.6:
+                lengths[seq_id] += rng.randint(1, 3 * PAGE_SIZE)
+                seqs.reserve(seq_id, lengths[seq_id])
+            elif op < 0.8:
+                lengths[seq_id] = rng.randint(0, lengths[seq_id])
+                seqs.truncate(seq_id, lengths[seq_id])
+            elif op < 0.9:
+                src = rng.randrange(max_seqs)
+                if src != seq_id:
+                    lengths[seq_id] = rng.randint(0, lengths[src])
+                    seqs.fork(src, seq_id, lengths[seq_id])
+            else:
+                lengths[seq_id] = 0
+                seqs.free(seq_id)
+        except OutOfPages:
+            # a full pool fails the request, the tables stay consistent
+            lengths[seq_id] = len(seqs.tables[seq_id]) * PAGE_SIZE
+            seqs.truncate(seq_id, 0)
+            lengths[seq_id] = 0
+        if step % 100 == 0:
+            check_invariants(seqs)
+        for sid, table in enumerate(seqs.tables):
+            assert len(table) == seqs.num_pages(lengths[sid])
+    check_invariants(seqs)
+    # any free page is usable no matter how the pool was churned
+    for seq_id in range(max_seqs):
+        seqs.free(seq_id)
+    assert seqs.allocator.num_free == num_pages
+    seqs.reserve(0, num_pages * PAGE_SIZE)
+    assert seqs.allocator.num_free == 0
+
+
+def test_prefix_sharing_copy_on_write():
+    copies = []
+    seqs = SequencePages(PageAllocator(16), 3, PAGE_SIZE, copy_page=lambda src, dst: copies.append((src, dst)))
+    seqs.reserve(0, 4 * PAGE_SIZE)
+    prefix = list(seqs.tables[0])
+    seqs.fork(0, 1, 3 * PAGE_SIZE + 10)
+    seqs.fork(0, 2, 2 * PAGE_SIZE)
+    assert seqs.tables[1] == prefix
+    assert seqs.tables[2] == prefix[:2]
+    assert seqs.allocator.num_used == 4
+    # seq 1 writes past the shared prefix inside page 3: only that page is copied
+    seqs.make_writable(1, 3 * PAGE_SIZE + 10, 3 * PAGE_SIZE + 11)
+    assert seqs.tables[1][:3] == prefix[:3] and seqs.tables[1][3] != prefix[3]
+    assert copies == [(prefix[3], seqs.tables[1][3])]
+    # seq 2 grows into fresh pages without touching the shared ones
+    seqs.reserve(2, 5 * PAGE_SIZE)
+    assert seqs.tables[2][:2] == prefix[:2]
+    assert seqs.allocator.refcount[prefix[0]] == 3
+    check_invariants(seqs)
+    seqs.free(0)
+    seqs.free(1)
+    seqs.free(2)
+    assert seqs.allocator.num_free == 16
+
+
+def mla_cache(num_pages):
+    torch = pytest.importorskip("torch")
+    from transformers import PretrainedConfig
+    from ktransformers.models.custom_cache import StaticCache
+    config = PretrainedConfig(
+        architectures=["DeepseekV2ForCausalLM"], num_hidden_layers=2, hidden_size=64, num_attention_heads=2,
+        num_key_value_heads=2, kv_lora_rank=32, qk_rope_head_dim=8, max_position_embeddings=1024,
+    )
+    # 2 sequences of up to 4 pages each
+    cache = StaticCache(config, 2, 4 * PAGE_SIZE, "cpu", torch.float32, num_pages=num_pages)
+
+    def write(bsz, begin, end, value):
+        position = torch.arange(begin, end)
+        for layer_idx in range(2):
+            kv = torch.full((bsz, end - begin, 1, 32), value)
+            pe = torch.full((bsz, end - begin, 1, 8), value)
+            out, table = cache.update(kv, pe, layer_idx, {"cache_position": position})
+        return cache.seq_major(out, table, 2).view(2, -1, 40)
+
+    return torch, cache, write
+
+
+def test_static_cache_fork():
+    torch, cache, write = mla_cache(num_pages=6)
+    write(1, 0, 150, 1.0)
+    assert cache.allocator.num_used == 3
+    cache.fork(0, 1, 150)
+    assert cache.allocator.num_used == 3
+    seqs = write(2, 150, 160, 2.0)
+    # both rows write into the shared third page, the first writer gets a copy, the last one keeps it
+    assert cache.allocator.num_used == 4
+    assert cache.seq_pages.tables[0][:2] == cache.seq_pages.tables[1][:2]
+    assert torch.all(seqs[:, :150] == 1.0) and torch.all(seqs[:, 150:160] == 2.0)
+    assert not seqs[:, 160:].any()
+    cache.remove_suffix(100)
+    # the partial second page is unshared before its tail is zeroed
+    assert cache.allocator.num_used == 3
+    seqs = write(1, 100, 101, 3.0)
+    assert torch.all(seqs[:, :100] == 1.0)
+    assert torch.all(seqs[0, 100] == 3.0) and not seqs[0, 101:].any()
+    assert not seqs[1, 100:].any()
+    cache.reset()
+    assert cache.allocator.num_free == 6
+
+
+def test_static_cache_reserve():
+    torch, cache, write = mla_cache(num_pages=8)
+    write(1, 0, 100, 1.0)
+    cache.fork(0, 1, 100)
+    # decode reserves its pages up front: a third page each, the first reserver copies the shared second one
+    for seq_id in range(2):
+        cache.reserve(seq_id, 130, 100)
+    assert cache.allocator.num_used == 5
+    assert cache.seq_pages.tables[0][0] == cache.seq_pages.tables[1][0]
+    assert cache.seq_pages.tables[0][1] != cache.seq_pages.tables[1][1]
+    prepared = []
+    prepare_pages = cache._prepare_pages
+    cache._prepare_pages = lambda *args: prepared.append(args) or prepare_pages(*args)
+    for pos in range(100, 130):
+        seqs = write(2, pos, pos + 1, 2.0)
+    assert prepared == []
+    assert torch.all(seqs[:, :100] == 1.0) and torch.all(seqs[:, 100:130] == 2.0) and not seqs[:, 130:].any()
+    # truncating drops the reservation, the next write checks its pages again
+    cache.remove_suffix(120)
+    write(2, 120, 121, 3.0)
+    assert len(prepared) == 1
+
+
+if __name__ == "__main__":
+    test_alloc_release_reuse()
+    test_random_churn_has_no_leaks_or_fragmentation()
+    test_prefix_sharing_copy_on_write()
+    test_static_cache_fork()
+    test_static_cache_reserve()
+    print("ok")
@@ -0,0 +1,156 @@
+"""
+Parallel load_weights (util/weight_loader.py): on a synthetic GGUF file, a tiny llama with some injected
+operators loads bit-identical weights serially and on a worker pool, the bytes in flight never exceed the
+budget, and errors surface the same way as in the serial path.
+
+    python -m pytest tests/test_parallel_load.py
+"""
+import struct
+import numpy as np
+import pytest
+import torch
+from torch import nn
+from ktransformers.operators.base_operator import BaseInjectedModule
+from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
+from ktransformers.util.utils import load_weights, set_module
+from ktransformers.util.weight_loader import ByteBudget, ParallelWeightLoader
+from test_optimize_rules import llama
+
+GGML_F32, GGML_F16, GGUF_STRING = 0, 1, 8
+ALIGNMENT = 32
+
+
+def gguf_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def write_gguf(path, tensors: dict, architecture: str = "qwen2"):
+    """GGUF v3 with only general.architecture; 2-D tensors are stored as F16, the rest as F32."""
+    infos, blobs, offset = [], [], 0
+    for name, array in tensors.items():
+        array = np.ascontiguousarray(array, dtype=np.float16 if array.ndim == 2 else np.float32)
+        offset += -offset % ALIGNMENT
+        infos.append(gguf_string(name) + struct.pack("<I", array.ndim)
+                     + b"".join(struct.pack("<Q", dim) for dim in reversed(array.shape))
+                     + struct.pack("<IQ", GGML_F16 if array.dtype == np.float16 else GGML_F32, offset))
+        blobs.append((offset, array.tobytes()))
+        offset += array.nbytes
+    header = (b"GGUF" + struct.pack("<IQQ", 3, len(tensors), 1)
+              + gguf_string("general.architecture") + struct.pack("<I", GGUF_STRING) + gguf_string(architecture)
+              + b"".join(infos))
+    header += b"\0" * (-len(header) % ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(header)
+        for blob_offset, blob in blobs:
+            f.seek(len(header) + blob_offset)
+            f.write(blob)
+
+
+class InjectedLinear(BaseInjectedModule):
+    """An operator loading its own weight, like the KTransformersLinear backends."""
+    def load(self):
+        weight = self.gguf_loader.load_gguf_tensor(self.key + ".weight").to(torch.get_default_dtype())
+        self.orig_module.weight = nn.Parameter(weight, requires_grad=False)
+
+
+class ConcurrentInjectedLinear(InjectedLinear):
+    load_concurrently = True
+
+
+def injected_llama(gguf_loader, layers=4):
+    torch.manual_seed(0)
+    model = llama(layers, 0)
+    for idx in range(layers):
+        prefix = f"model.layers.{idx}."
+        # a container operator (loaded through its children), a serialized and a concurrent operator
+        for name, cls in (("mlp", BaseInjectedModule), ("self_attn.o_proj", InjectedLinear),
+                          ("self_attn.q_proj", ConcurrentInjectedLinear)):
+            orig = model.get_submodule(prefix + name)
+            set_module(model, prefix + name, cls(translate_name_to_gguf(prefix + name), gguf_loader, model.config,
+                                                 orig, "cpu"))
+    return model
+
+
+@pytest.fixture(scope="module")
+def gguf_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp("gguf") / "model.gguf"
+    torch.manual_seed(1)
+    tensors = {translate_name_to_gguf(name): torch.randn(value.shape).numpy()
+               for name, value in llama(4, 0).state_dict().items()}
+    write_gguf(str(path), tensors)
+    return str(path), tensors
+
+
+def state(model):
+    return {name: value.clone() for name, value in model.state_dict().items()}
+
+
+@pytest.mark.parametrize("num_workers,max_bytes_in_flight", [(2, 4 << 30), (8, 4 << 30), (8, 1 << 10)])
+def test_parallel_matches_serial(gguf_file, num_workers, max_bytes_in_flight):
+    path, tensors = gguf_file
+    gguf_loader = GGUFLoader(path)
+    serial = injected_llama(gguf_loader)
+    load_weights(serial, gguf_loader)
+    parallel = injected_llama(gguf_loader)
+    load_weights(parallel, gguf_loader, num_workers=num_workers, max_bytes_in_flight=max_bytes_in_flight)
+
+    expected, loaded = state(serial), state(parallel)
+    assert list(loaded) == list(expected)
+    for name, value in expected.items():
+        assert torch.equal(loaded[name], value), name
+    # and those are the file contents
+    source = tensors[translate_name_to_gguf("model.layers.3.self_attn.o_proj.weight")]
+    assert torch.equal(loaded["model.layers.3.self_attn.o_proj.orig_module.weight"],
+                       torch.from_numpy(source.astype(np.float16)).float())
+
+
+def test_bytes_in_flight_are_bounded(gguf_file):
+    path, _ = gguf_file
+
+    class RecordingBudget(ByteBudget):
+        peak = 0
+
+        def acquire(self, nbytes):
+            nbytes = super().acquire(nbytes)
+            with self.cond:
+                RecordingBudget.peak = max(RecordingBudget.peak, self.in_flight)
+            return nbytes
+
+    gguf_loader = GGUFLoader(path)
+    loader = ParallelWeightLoader(gguf_loader, 8, 8 << 10)
+    loader.budget = RecordingBudget(8 << 10)
+    loader.load(injected_llama(gguf_loader))
+    assert 0 < RecordingBudget.peak <= 8 << 10
+    assert loader.budget.in_flight == 0
+
+    # a task larger than the budget runs alone
+    budget = ByteBudget(100)
+    assert budget.acquire(1000) == 100 and budget.in_flight == 100
+    budget.release(100)
+
+
+def test_errors_surface(gguf_file, tmp_path):
+    path, tensors = gguf_file
+    missing = dict(tensors)
+    del missing["blk.2.ffn_up.weight"]
+    write_gguf(str(tmp_path / "model.gguf"), missing)
+    gguf_loader = GGUFLoader(str(tmp_path / "model.gguf"))
+    with pytest.raises(KeyError, match=r"blk\.2\.ffn_up\.weight"):
+        load_weights(injected_llama(gguf_loader), gguf_loader, num_workers=4)
+
+    class BrokenLinear(InjectedLinear):
+        def load(self):
+            raise RuntimeError(f"cannot load {self.key}")
+
+    gguf_loader = GGUFLoader(path)
+    model = injected_llama(gguf_loader)
+    set_module(model, "model.layers.1.self_attn.o_proj",
+               BrokenLinear("blk.1.attn_output", gguf_loader, model.config, model.model.layers[1].self_attn.o_proj.orig_module, "cpu"))
+    with pytest.raises(RuntimeError, match=r"cannot load blk\.1\.attn_output"):
+        load_weights(model, gguf_loader, num_workers=4)
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,221 @@
+"""
+Response cache (server/utils/response_cache.py) in front of the mock backend: a repeated temperature 0 request is
+replayed with the same reply and usage, far sooner than generating it; identical requests in flight share one
+generation; sampled requests, and requests differing in a sampling parameter, are generated again; replies
+survive a restart on disk, memory and disk stay within their caps, replays keep the configured pace and a
+generation nobody reads any more is dropped, not stored.
+
+    python -m pytest tests/test_response_cache.py
+"""
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+from ktransformers.server.backend.interfaces.mock import MockInterface, mock_tokens
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.utils.response_cache import ResponseCache, ResponseStore
+from ktransformers.util.metrics import MetricsRegistry
+
+
+class CountingMock(MockInterface):
+    def __init__(self, args):
+        super().__init__(args)
+        self.calls = 0
+
+    async def inference(self, *args, **kwargs):
+        self.calls += 1
+        async for item in super().inference(*args, **kwargs):
+            yield item
+
+
+def cache_args(**kwargs):
+    args = dict(mock_prefill_tps=10000, mock_decode_tps=200, mock_output_tokens=10, mock_max_batch=4,
+                max_new_tokens=500, backend_type="mock", model_name="mock", response_cache_mb=16,
+                response_cache_dir=None, response_cache_disk_mb=16, response_cache_replay_tps=0)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    MetricsRegistry.set_instance(MetricsRegistry())
+    yield
+    MetricsRegistry.set_instance(None)
+
+
+def make_cache(**kwargs):
+    args = cache_args(**kwargs)
+    return ResponseCache(CountingMock(args), args)
+
+
+async def collect(cache, prompt, *args, stop_after=None):
+    tokens, finish, usage = [], None, None
+    begin = time.perf_counter()
+    stream = cache.inference([{"role": "user", "content": prompt}], "thread", *args)
+    async for item in stream:
+        if isinstance(item, RawUsage):
+            usage = item
+        elif item[1] is None:
+            tokens.append(item[0])
+            if stop_after is not None and len(tokens) == stop_after:
+                await stream.aclose()
+                break
+        else:
+            finish = item[1]
+    return tokens, finish, usage, time.perf_counter() - begin
+
+
+def test_hit_replays_reply():
+    async def main():
+        cache = make_cache()
+        first = await collect(cache, "hello world", 0, 1.0)
+        second = await collect(cache, "hello world", 0, 1.0)
+        return cache, first, second
+
+    cache, first, second = asyncio.run(main())
+    assert first[0] == second[0] == mock_tokens("hello world", 10)
+    assert first[1] == second[1] == "stop"
+    assert (second[2].prefill_count, second[2].decode_count) == (first[2].prefill_count, first[2].decode_count)
+    assert cache.interface.calls == 1
+    assert cache.hits.value() == 1 and cache.misses.value() == 1
+    # 10 tokens at 200/s take 45ms to generate
+    assert second[3] < first[3] / 5
+
+
+def test_only_deterministic_requests():
+    async def main():
+        cache = make_cache()
+        for _ in range(2):
+            await collect(cache, "hello", 0.7, 1.0)
+            await collect(cache, "hello")
+        await collect(cache, "hello", 0, 1.0)
+        await collect(cache, "hello", 0, 1.0, 4)   # max_tokens is part of the key
+        await collect(cache, "hello", 0, 0.5)
+        return cache
+
+    cache = asyncio.run(main())
+    assert cache.interface.calls == 7
+    assert cache.hits.value() == 0
+
+
+def test_concurrent_requests_share_generation():
+    async def main():
+        cache = make_cache()
+        return cache, await asyncio.gather(*(collect(cache, "same prompt", 0) for _ in range(6)))
+
+    cache, results = asyncio.run(main())
+    assert cache.interface.calls == 1
+    assert cache.misses.value() == 1 and cache.joins.value() == 5
+    assert all(result[:2] == results[0][:2] for result in results)
+
+
+def test_hit_rate_and_latency():
+    """A templated workload: 40 requests over 5 prompts, arriving in bursts."""
+    async def main():
+        cache = make_cache(mock_decode_tps=500)
+        rng = random.Random(0)
+        prompts = [f"agent step {rng.randrange(5)}" for _ in range(40)]
+        results = []
+        for burst in range(0, 40, 8):
+            results += await asyncio.gather(*(collect(cache, prompt, 0) for prompt in prompts[burst:burst + 8]))
+        return cache, prompts, results
+
+    cache, prompts, results = asyncio.run(main())
+    assert cache.interface.calls == len(set(prompts))
+    served = cache.hits.value() + cache.joins.value()
+    assert served / len(prompts) == (len(prompts) - len(set(prompts))) / len(prompts)
+    for prompt, (tokens, finish, _, _) in zip(prompts, results):
+        assert tokens == mock_tokens(prompt, 10) and finish == "stop"
+    latencies = sorted(result[3] for result in results)
+    # the replays are near instant, only the generations (and their followers) take the 20ms of decoding
+    assert latencies[len(latencies) // 2] < 0.01
+
+
+def test_restart_reads_disk(tmp_path):
+    async def main():
+        first = make_cache(response_cache_dir=str(tmp_path))
+        reply = await collect(first, "persisted", 0)
+        second = make_cache(response_cache_dir=str(tmp_path))
+        return second, reply, await collect(second, "persisted", 0)
+
+    second, reply, replayed = asyncio.run(main())
+    assert second.interface.calls == 0
+    assert replayed[:2] == reply[:2]
+
+
+def test_store_bounds(tmp_path):
+    entry = {"items": [["x" * 1000, None], ["", "stop"]], "usage": None}
+    store = ResponseStore(3000, str(tmp_path), 3000)
+    for key in ("a", "b", "c", "d"):
+        store.put(key, entry)
+        assert store.memory_used <= 3000 and store.disk_used <= 3000
+    assert "a" not in store.memory and "a" not in store.disk and "d" in store.memory
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(f"{key}.json" for key in store.disk)
+    # a disk hit comes back into memory
+    store.memory.clear()
+    store.memory_used = 0
+    key = next(iter(store.disk))
+    assert store.get(key) == entry and key in store.memory
+
+
+def test_replay_pacing():
+    async def main():
+        cache = make_cache(response_cache_replay_tps=100)
+        await collect(cache, "paced", 0)
+        return await collect(cache, "paced", 0)
+
+    # 10 tokens and the finish at 100/s
+    assert 0.09 <= asyncio.run(main())[3] < 0.3
+
+
+def test_abandoned_generation_not_stored():
+    async def main():
+        cache = make_cache(mock_decode_tps=100)
+        partial = await collect(cache, "walk away", 0, stop_after=2)
+        await asyncio.sleep(0.05)
+        full = await collect(cache, "walk away", 0)
+        return cache, partial, full
+
+    cache, partial, full = asyncio.run(main())
+    assert partial[0] == mock_tokens("walk away", 2)
+    assert full[0] == mock_tokens("walk away", 10)
+    assert cache.interface.calls == 2 and cache.hits.value() == 0
+
+
+class Database:
+    """Stands in for the assistant database managers a thread context reads on creation."""
+
+    def db_get_thread_by_id(self, thread_id):
+        return SimpleNamespace(id=thread_id)
+
+    def db_get_assistant_by_id(self, assistant_id):
+        return SimpleNamespace(id=assistant_id)
+
+    def db_list_messages_of_thread(self, thread_id, order=None):
+        return []
+
+
+def test_thread_context_behind_cache(monkeypatch):
+    create_interface = pytest.importorskip("ktransformers.server.utils.create_interface")
+    from ktransformers.server.backend import base
+    from ktransformers.server.backend.interfaces.mock import MockThreadContext
+    for manager in ("ThreadsDatabaseManager", "MessageDatabaseManager", "RunsDatabaseManager",
+                    "AssistantDatabaseManager"):
+        monkeypatch.setattr(base, manager, Database)
+
+    create_interface.create_interface(SimpleNamespace(backend_type="mock", response_cache=True), cache_args())
+    interface = create_interface.get_interface()
+    context_manager = create_interface.get_thread_context_manager()
+    assert isinstance(interface, ResponseCache)
+    assert context_manager.interface is interface.interface
+
+    run = SimpleNamespace(thread_id="thread", assistant_id="assistant")
+    context = asyncio.run(context_manager.get_context_by_run_object(run))
+    assert isinstance(context, MockThreadContext) and context.interface is interface.interface
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
@@ -0,0 +1,103 @@
+"""
+Expert routing telemetry (util/routing_stats.py): layer indices come out of gguf and hf keys, a gate call adds one
+count per selected expert and a co-activation count per pair of experts picked for the same token, the counters
+survive a state_dict round trip, and a gate captured in a cuda graph is counted on every replay.
+
+    python -m pytest tests/test_routing_stats.py
+"""
+from types import SimpleNamespace
+import pytest
+import torch
+from ktransformers.util.routing_stats import ExpertRoutingStats, layer_idx_from_key, record_routing
+
+
+@pytest.fixture
+def stats():
+    stats = ExpertRoutingStats(enable=True)
+    ExpertRoutingStats.set_instance(stats)
+    yield stats
+    ExpertRoutingStats.set_instance(None)
+
+
+def expected_counts(topk_idx, num_experts):
+    counts = torch.zeros(num_experts, dtype=torch.int64)
+    coactivation = torch.zeros(num_experts, num_experts, dtype=torch.int64)
+    for token in topk_idx.reshape(-1, topk_idx.size(-1)).tolist():
+        for a in token:
+            counts[a] += 1
+            for b in token:
+                coactivation[a, b] += 1
+    return counts, coactivation
+
+
+@pytest.mark.parametrize("key, expected", [
+    ("blk.3.ffn_gate_exps", 3), ("model.layers.12.mlp", 12), ("layers.0", 0),
+])
+def test_layer_idx_from_key(key, expected):
+    assert layer_idx_from_key(key) == expected
+
+
+def test_layer_idx_needs_a_layer():
+    with pytest.raises(ValueError):
+        layer_idx_from_key("model.embed_tokens")
+
+
+def test_record_counts(stats):
+    torch.manual_seed(0)
+    topk_idx = torch.stack([torch.randperm(8)[:2] for _ in range(24)]).view(2, 12, 2)
+    stats.record(1, topk_idx, 3, 8)
+    stats.record(1, topk_idx[:1], 3, 8)
+    counts, coactivation = expected_counts(torch.cat([topk_idx, topk_idx[:1]]), 8)
+    assert stats.counts[1].tolist() == counts.tolist()
+    assert stats.coactivation[1].tolist() == coactivation.tolist()
+    assert stats.tokens.tolist() == [0, 36, 0]
+    assert stats.counts[0].sum() == stats.counts[2].sum() == 0
+    assert stats.hot_experts(1, 1) == [int(counts.argmax())]
+
+
+def test_record_routing_reads_config(stats):
+    config = SimpleNamespace(num_hidden_layers=4, n_routed_experts=6)
+    record_routing("blk.2.ffn_gate_exps", torch.tensor([[0, 5], [5, 1]]), config)
+    assert stats.counts[2].tolist() == [1, 1, 0, 0, 0, 2]
+    assert stats.summary()["layers"][0]["hot_experts"][0] == 5
+
+
+def test_disabled_records_nothing():
+    stats = ExpertRoutingStats(enable=False)
+    stats.record(0, torch.tensor([[1, 2]]), 1, 4)
+    assert stats.counts is None
+
+
+def test_state_dict_round_trip(stats, tmp_path):
+    stats.record(0, torch.tensor([[1, 2], [2, 3]]), 2, 4)
+    path = stats.dump(str(tmp_path / "routing.pt"))
+    loaded = ExpertRoutingStats.load(path)
+    assert loaded.counts.tolist() == stats.counts.tolist()
+    assert loaded.coactivation.tolist() == stats.coactivation.tolist()
+    assert (tmp_path / "routing.json").exists()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a cuda device")
+def test_graph_replay_is_counted(stats):
+    topk_idx = torch.tensor([[0, 3], [3, 1]], device="cuda")
+    # the eager forward before capture allocates the counters
+    stats.record(0, topk_idx, 1, 4)
+    stats.reset()
+    graph = torch.cuda.CUDAGraph()
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        with torch.cuda.graph(graph, stream=stream):
+            stats.record(0, topk_idx, 1, 4)
+    torch.cuda.current_stream().wait_stream(stream)
+    for _ in range(3):
+        graph.replay()
+    torch.cuda.synchronize()
+    assert stats.counts[0].tolist() == [3, 3, 0, 6]
+    assert stats.tokens.tolist() == [6]
+    assert stats.coactivation[0, 0, 3] == 3
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
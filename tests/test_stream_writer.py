@@ -0,0 +1,144 @@
+"""
+Streaming response writer (server/utils/stream_writer.py): coalesced writes carry the same bytes as the frames
+one by one, within the size budget and without holding back the first frame; a slow client holds the generator
+at most max_frames frames ahead; generator errors reach the response and a closed response stops the generator; and template frames are byte for byte the frames the
+endpoints rendered before, for chat chunks, legacy completions and ollama lines.
+
+    python -m pytest tests/test_stream_writer.py
+"""
+import asyncio
+import json
+import random
+from datetime import datetime
+import pytest
+from ktransformers.server.utils.stream_writer import JsonTemplate, coalesce, hole
+
+
+def random_token(rng):
+    return "".join(rng.choice(["a", " ", "\n", "\t", '"', "\\", "/", "\x00", "\x1f", "\x7f", "é", "中", "😀", " ",
+                               "<｜tool▁sep｜>"]) for _ in range(rng.randint(0, 6)))
+
+
+async def frames(tokens, delay=0.0, fail=False, closed=None):
+    try:
+        for token in tokens:
+            await asyncio.sleep(delay)
+            yield token
+        if fail:
+            raise RuntimeError("inference failed")
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def collect(async_frames, **kwargs):
+    return [write async for write in coalesce(async_frames, **kwargs)]
+
+
+@pytest.mark.parametrize("max_delay,max_bytes", [(0, 1 << 16), (0.01, 1 << 16), (0, 1), (0.01, 5)])
+def test_same_bytes(max_delay, max_bytes):
+    rng = random.Random(0)
+    tokens = [random_token(rng) or "x" for _ in range(300)]
+    writes = asyncio.run(collect(frames(tokens), max_delay=max_delay, max_bytes=max_bytes))
+    assert "".join(writes) == "".join(tokens)
+    assert all(len(write) < max_bytes + max(map(len, tokens)) for write in writes)
+    if max_bytes == 1:
+        assert writes == tokens
+
+
+def test_coalesces_and_flushes_first_frame():
+    async def run():
+        writes, times = [], []
+        begin = asyncio.get_running_loop().time()
+        async for write in coalesce(frames(["a"] * 20, delay=0.002), max_delay=0.05):
+            writes.append(write)
+            times.append(asyncio.get_running_loop().time() - begin)
+        return writes, times
+    writes, times = asyncio.run(run())
+    assert writes[0] == "a" and times[0] < 0.04
+    assert "".join(writes) == "a" * 20 and len(writes) < 20
+
+
+def test_errors_and_close():
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(frames(["a", "b"], fail=True)))
+
+    async def close_early():
+        closed = []
+        writes = coalesce(frames(["a"] * 1000, delay=0.001, closed=closed))
+        assert await writes.__anext__() == "a"
+        await writes.aclose()
+        await asyncio.sleep(0.01)
+        return closed
+    assert asyncio.run(close_early()) == [True]
+
+
+def test_slow_client_bounds_queue():
+    async def run():
+        produced = []
+
+        async def counted():
+            for i in range(1000):
+                produced.append(i)
+                yield "a"
+
+        writes = coalesce(counted(), max_bytes=1, max_frames=8)
+        assert await writes.__anext__() == "a"
+        await asyncio.sleep(0.02)
+        ahead = len(produced)
+        rest = [write async for write in writes]
+        return ahead, rest
+    ahead, rest = asyncio.run(run())
+    # the queue, the frame the pump holds while waiting, and the one written
+    assert ahead <= 8 + 2
+    assert "".join(rest) == "a" * 999
+
+
+def test_template():
+    rng = random.Random(1)
+    first, second = hole(), hole()
+    template = JsonTemplate(f"data: {json.dumps({'a': first, 'b': [1, {'c': second}]}, ensure_ascii=False)}\n\n",
+                            [first, second])
+    for _ in range(200):
+        x, y = random_token(rng), random_token(rng)
+        assert template.render(x, y) == f"data: {json.dumps({'a': x, 'b': [1, {'c': y}]}, ensure_ascii=False)}\n\n"
+    with pytest.raises(ValueError):
+        JsonTemplate(json.dumps([first, second]), [second, first])
+
+
+def test_endpoint_frames_unchanged():
+    # the ollama endpoint module pulls in the model backends
+    completions = pytest.importorskip("ktransformers.server.api.ollama.completions")
+    OllamaChatCompletionStreamResponse = completions.OllamaChatCompletionStreamResponse
+    OllamaGenerationStreamResponse = completions.OllamaGenerationStreamResponse
+    from ktransformers.server.schemas.endpoints.chat import ChatCompletionChunk
+    rng = random.Random(2)
+    chunk = ChatCompletionChunk(id="id", choices=[], object="chat.completion.chunk", created=1, model="m",
+                                system_fingerprint="fp_0")
+    content = hole()
+    chunk.choices = [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    chat = JsonTemplate(chunk.to_stream_reply(), [content])
+    legacy = JsonTemplate(f"data:{json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n", [content],
+                          ensure_ascii=True)
+    created_at = hole()
+    ollama = JsonTemplate(OllamaChatCompletionStreamResponse(
+        model="m", created_at=created_at, message={"role": "assistant", "content": content}, done=False,
+    ).model_dump_json() + "\n", [created_at, content])
+    generate = JsonTemplate(OllamaGenerationStreamResponse(
+        model="m", created_at=created_at, response=content, done=False).model_dump_json() + "\n",
+        [created_at, content])
+    for _ in range(200):
+        token, now = random_token(rng), str(datetime.now())
+        chunk.choices = [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+        assert chat.render(token) == chunk.to_stream_reply()
+        assert legacy.render(token) == f"data:{json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n"
+        assert ollama.render(now, token) == OllamaChatCompletionStreamResponse(
+            model="m", created_at=now, message={"role": "assistant", "content": token}, done=False,
+        ).model_dump_json() + "\n"
+        assert generate.render(now, token) == OllamaGenerationStreamResponse(
+            model="m", created_at=now, response=token, done=False).model_dump_json() + "\n"
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(pytest.main([__file__, "-q"]))
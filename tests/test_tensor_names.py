@@ -0,0 +1,66 @@
+"""
+Model -> GGUF tensor names (util/custom_gguf.py): every tensor of the supported architectures maps to
+a llama.cpp tensor name of that architecture, no two tensors share a name, and TensorNameIndex resolves
+both ways and fails with the nearest names on a tensor the files don't hold.
+
+    python -m pytest tests/test_tensor_names.py
+"""
+import re
+import pytest
+from ktransformers.util.custom_gguf import TensorNameIndex, translate_name_to_gguf
+from test_optimize_rules import build_model
+
+COMMON = ["token_embd.weight", "output_norm.weight", "output.weight", r"blk\.\d+\.(attn_norm|ffn_norm)\.weight"]
+DENSE_MLP = [r"blk\.\d+\.ffn_(gate|up|down)\.weight"]
+ATTENTION = [r"blk\.\d+\.attn_(q|k|v|output)\.weight"]
+MLA = [r"blk\.\d+\.attn_(q_a|q_a_norm|q_b|kv_a_mqa|kv_a_norm|kv_b|output)\.weight"]
+SHARED_EXPERTS = [r"blk\.\d+\.ffn_gate_inp\.weight", r"blk\.\d+\.ffn_(gate|up|down)_shexp\.weight"]
+
+# rule file of the architecture -> llama.cpp tensor names
+ARCHITECTURES = {
+    "DeepSeek-V2-Chat.yaml": COMMON + DENSE_MLP + MLA + SHARED_EXPERTS,
+    "DeepSeek-V3-Chat.yaml": COMMON + DENSE_MLP + MLA + SHARED_EXPERTS,
+    "Qwen2-57B-A14B-Instruct.yaml": COMMON + ATTENTION + SHARED_EXPERTS + [
+        r"blk\.\d+\.attn_(q|k|v)\.bias", r"blk\.\d+\.ffn_gate_inp_shexp\.weight"],
+    "Qwen3Moe-serve.yaml": COMMON + ATTENTION + [r"blk\.\d+\.attn_(q|k)_norm\.weight", r"blk\.\d+\.ffn_gate_inp\.weight"],
+    "Internlm2_5-7b-Chat-1m.yaml": COMMON + ATTENTION + DENSE_MLP,
+    "Mixtral.yaml": COMMON + ATTENTION + [r"blk\.\d+\.ffn_gate_inp\.weight", r"blk\.\d+\.ffn_(gate|up|down)\.\d+\.weight"],
+}
+
+
+def model_names(rule_file):
+    # the routed expert banks and the gate bias are loaded by their operators under the packed names
+    return [name for name in build_model(rule_file).state_dict()
+            if ".mlp.experts." not in name and not name.endswith("e_score_correction_bias")]
+
+
+@pytest.mark.parametrize("rule_file", sorted(ARCHITECTURES))
+def test_every_tensor_maps(rule_file):
+    pattern = re.compile("|".join(f"(?:{name})" for name in ARCHITECTURES[rule_file]))
+    names = model_names(rule_file)
+    translated = {name: translate_name_to_gguf(name) for name in names}
+    unmapped = [f"{name} -> {gguf}" for name, gguf in translated.items() if pattern.fullmatch(gguf) is None]
+    assert not unmapped, unmapped
+    assert len(set(translated.values())) == len(translated)
+
+    index = TensorNameIndex(dict.fromkeys(translated.values()))
+    for name, gguf in translated.items():
+        assert index.resolve(name) == gguf
+        assert index.to_model[gguf] == name
+    assert index.unresolved() == []
+
+
+def test_missing_tensor_is_an_error():
+    index = TensorNameIndex(dict.fromkeys(["blk.0.attn_q.weight", "blk.0.attn_k.weight", "blk.1.attn_q.weight"]), "model.gguf")
+    with pytest.raises(KeyError, match=r"blk\.0\.attn_v\.weight.*model\.gguf.*blk\.0\.attn_q\.weight"):
+        index.resolve("model.layers.0.self_attn.v_proj.weight")
+    # nearest names come from the same block
+    assert index.nearest("blk.0.attn_v.weight") == ["blk.0.attn_q.weight", "blk.0.attn_k.weight"]
+    assert index.unresolved() == ["blk.0.attn_q.weight", "blk.0.attn_k.weight", "blk.1.attn_q.weight"]
+
+
+if __name__ == "__main__":
+    for rule_file in sorted(ARCHITECTURES):
+        test_every_tensor_maps(rule_file)
+    test_missing_tensor_is_an_error()
+    print("ok")
@@ -0,0 +1,181 @@
+"""
+Streaming tool call parser (server/utils/tool_calls.py): on random well-formed responses cut into random
+token deltas, the calls and content match the previous buffer + regex parser of the chat endpoint (kept below
+as the reference); on malformed ones it doesn't raise and its deltas still add up to the calls it reports;
+and the state it keeps between tokens doesn't grow with the response.
+
+    python -m pytest tests/test_tool_calls.py
+"""
+import json
+import random
+import re
+from ktransformers.server.utils.tool_calls import (
+    MARKER_ALIASES, TOOL_CALL_BEGIN, TOOL_CALL_END, TOOL_CALLS_BEGIN, TOOL_CALLS_END, TOOL_SEP, ToolCallParser,
+)
+
+SHORT = {canonical: alias for alias, canonical in MARKER_ALIASES.items()}
+
+
+def reference_tools(buffer):
+    """getTools of server/api/openai/endpoints/chat.py before the streaming parser, without the logging."""
+    extracted_tools = []
+    working_buffer = buffer
+    while TOOL_CALL_BEGIN in working_buffer and TOOL_CALL_END in working_buffer:
+        start_index = working_buffer.find(TOOL_CALL_BEGIN)
+        end_index = working_buffer.find(TOOL_CALL_END) + len(TOOL_CALL_END)
+        if start_index == -1 or end_index == -1 or start_index > end_index:
+            break
+        full_tool_call = working_buffer[start_index:end_index]
+        working_buffer = working_buffer.replace(full_tool_call, "", 1)
+        function_name_start = full_tool_call.find(TOOL_SEP) + len(TOOL_SEP)
+        function_name_end = full_tool_call.find("\n", function_name_start)
+        function_name = full_tool_call[function_name_start:function_name_end].strip()
+        json_match = re.search(r'```json\s*(.*?)\s*```', full_tool_call, re.DOTALL)
+        if json_match:
+            extracted_tools.append({"name": function_name, "arguments": json_match.group(1).strip()})
+    return extracted_tools
+
+
+def reference_parse(text):
+    for alias, canonical in MARKER_ALIASES.items():
+        text = text.replace(alias, canonical)
+    if TOOL_CALLS_BEGIN not in text:
+        return text, []
+    content, calls = text.split(TOOL_CALLS_BEGIN, 1)
+    return content, reference_tools(calls.split(TOOL_CALLS_END, 1)[0] + TOOL_CALLS_END)
+
+
+def marker(rng, canonical):
+    return SHORT[canonical] if rng.random() < 0.5 else canonical
+
+
+def random_text(rng, n):
+    # markdown, brackets and backticks, nothing that spells a marker
+    return "".join(rng.choice("abc xyz<>|{}`\n\"'.,:") for _ in range(n)).replace("```", "`` ")
+
+
+def random_arguments(rng):
+    value = {f"k{i}": rng.choice([rng.randint(-99, 99), random_text(rng, rng.randint(0, 12)).replace("`", ""),
+                                  [1, 2], {"nested": True}])
+             for i in range(rng.randint(0, 4))}
+    return json.dumps(value, indent=rng.choice([None, 2]))
+
+
+def random_response(rng):
+    text = random_text(rng, rng.randint(0, 40))
+    if rng.random() < 0.2:
+        return text
+    text += marker(rng, TOOL_CALLS_BEGIN)
+    for _ in range(rng.randint(1, 3)):
+        name = rng.choice(["get_weather", "search", "run_code", "f"])
+        space = rng.choice(["", " ", "\n", "\n\n  "])
+        text += (f"{marker(rng, TOOL_CALL_BEGIN)}function{marker(rng, TOOL_SEP)}{name}\n```json{space}"
+                 f"{random_arguments(rng)}{space}```{marker(rng, TOOL_CALL_END)}")
+    return text + marker(rng, TOOL_CALLS_END) + random_text(rng, rng.randint(0, 10))
+
+
+def split(rng, text):
+    deltas, begin = [], 0
+    while begin < len(text):
+        end = begin + rng.choice([1, 1, 2, 3, 5, 8, 20])
+        deltas.append(text[begin:end])
+        begin = end
+    return deltas
+
+
+def run(deltas):
+    parser = ToolCallParser()
+    out = []
+    for delta in deltas:
+        out += parser.feed(delta)
+    out += parser.finish()
+    return parser, out
+
+
+def check_deltas(parser, out):
+    """The streamed deltas add up to the reported content and calls."""
+    content = "".join(delta["content"] for delta in out if delta.get("content"))
+    assert content == "".join(parser.content)
+    calls = {}
+    for delta in out:
+        for call in delta.get("tool_calls", []):
+            if "id" in call:
+                assert call["index"] == len(calls)
+                calls[call["index"]] = {"id": call["id"], "name": call["function"]["name"], "arguments": ""}
+            calls[call["index"]]["arguments"] += call["function"]["arguments"]
+    assert [calls[idx] for idx in range(len(calls))] == [
+        {"id": call["id"], "name": call["function"]["name"], "arguments": call["function"]["arguments"]}
+        for call in parser.tool_calls
+    ]
+
+
+def test_matches_reference():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = random_response(rng)
+        parser, out = run(split(rng, text))
+        content, calls = reference_parse(text)
+        assert [{"name": call["function"]["name"], "arguments": call["function"]["arguments"]}
+                for call in parser.tool_calls] == calls, text
+        if calls:
+            assert parser.finish_reason == "tool_calls" and parser.message()["content"] is None
+            assert "".join(parser.content) == content
+            assert all(json.loads(call["arguments"]) is not None for call in calls)
+        else:
+            assert parser.message()["content"] == content
+        check_deltas(parser, out)
+
+
+def test_arguments_stream_before_the_call_ends():
+    parser = ToolCallParser()
+    assert parser.feed("Let me check.<tools▁begin><tool▁begin>function<tool▁sep>get_weather\n") == [
+        {"content": "Let me check."}]
+    deltas = parser.feed('```json\n{"city": ')
+    assert deltas[0]["tool_calls"][0]["function"] == {"name": "get_weather", "arguments": ""}
+    assert deltas[1] == {"tool_calls": [{"index": 0, "function": {"arguments": '{"city":'}}]}
+    # the space is held until it turns out not to be trailing
+    assert parser.feed('"Paris"}') == [{"tool_calls": [{"index": 0, "function": {"arguments": ' "Paris"}'}}]}]
+    assert parser.feed("\n```<tool▁end><tools▁end>ignored") == []
+    assert parser.done and parser.tool_calls[0]["function"]["arguments"] == '{"city": "Paris"}'
+
+
+def test_malformed():
+    rng = random.Random(1)
+    for _ in range(500):
+        text = random_response(rng)
+        cut = rng.randint(0, len(text))
+        if rng.random() < 0.5:
+            text = text[:cut]
+        else:
+            garbage = rng.choice(["```", "```json", "\n", TOOL_CALL_END, SHORT[TOOL_CALL_BEGIN], TOOL_SEP, "<｜"])
+            text = text[:cut] + garbage + text[cut:]
+        parser, out = run(split(rng, text))
+        check_deltas(parser, out)
+    # a call without a json fence is dropped, the next one is kept
+    parser, out = run([f"{TOOL_CALLS_BEGIN}{TOOL_CALL_BEGIN}function{TOOL_SEP}a\n{{}}{TOOL_CALL_END}"
+                       f"{TOOL_CALL_BEGIN}function{TOOL_SEP}b\n```json{{}}```{TOOL_CALL_END}"])
+    assert [call["function"]["name"] for call in parser.tool_calls] == ["b"]
+    # a marker prefix left at the end is text again
+    parser, out = run(["price <tools▁"])
+    assert parser.message()["content"] == "price <tools▁"
+
+
+def test_state_does_not_grow():
+    parser = ToolCallParser()
+    longest = max(len(spelling) for spelling in list(MARKER_ALIASES) + list(MARKER_ALIASES.values()))
+    rng = random.Random(2)
+    for delta in split(rng, random_text(rng, 20000)):
+        parser.feed(delta)
+        assert len(parser.pending) < longest
+    parser.feed(TOOL_CALLS_BEGIN + TOOL_CALL_BEGIN + f"function{TOOL_SEP}f\n```json")
+    for delta in split(rng, '{"text": "' + "abc " * 5000 + '"}'):
+        parser.feed(delta)
+        assert len(parser.pending) < longest and not parser._args
+
+
+if __name__ == "__main__":
+    test_matches_reference()
+    test_arguments_stream_before_the_call_ends()
+    test_malformed()
+    test_state_does_not_grow()
+    print("ok")
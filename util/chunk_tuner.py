@@ -0,0 +1,129 @@
+'''
+Description  : Adaptive prefill chunk length. Attention work per token grows with the context position
+               while the linear and expert work doesn't, so the chunk length with the best tokens/s
+               shifts as a prompt is prefilled and differs between machines. ChunkTuner times every
+               chunk it hands out and keeps a tokens/s estimate per (position bucket, chunk length);
+               each length that fits the memory cap is tried once per bucket, largest first, then the
+               best one is used. Estimates are saved per model and thread count, so a restarted
+               process starts from what it learned.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+def chunk_candidates(min_chunk: int, max_chunk: int) -> List[int]:
+    """Powers of two from min_chunk up to max_chunk, and max_chunk itself."""
+    candidates = []
+    chunk = min_chunk
+    while chunk < max_chunk:
+        candidates.append(chunk)
+        chunk *= 2
+    candidates.append(max_chunk)
+    return candidates
+
+
+def activation_bytes(config, chunk: int, position: int, dtype_bytes: int = 4) -> int:
+    """
+    Rough peak activation bytes of prefilling `chunk` tokens after `position`: hidden states and the MLP
+    intermediate of the chunk, and one layer's attention scores over the whole context.
+    """
+    hidden = config.hidden_size
+    if getattr(config, "moe_intermediate_size", None) and getattr(config, "num_experts_per_tok", None):
+        intermediate = config.moe_intermediate_size * config.num_experts_per_tok
+    else:
+        intermediate = config.intermediate_size
+    per_token = 6 * hidden + 3 * intermediate
+    scores = config.num_attention_heads * (position + chunk)
+    return dtype_bytes * chunk * (per_token + scores)
+
+
+class ChunkTuner:
+    """
+    choose(position, remaining) the length of the next chunk, record(position, length, seconds) once it ran.
+    `stats` is {position bucket: {chunk length: [tokens/s, samples]}}, a bucket being position.bit_length().
+    """
+    _instances: Dict[tuple, "ChunkTuner"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, key: str, max_chunk: int, min_chunk: int = 256, memory_cap: Optional[int] = None,
+                 bytes_fn: Optional[Callable[[int, int], int]] = None, cache_path: Optional[str] = None,
+                 alpha: float = 0.3):
+        self.key = key
+        self.candidates = chunk_candidates(min(min_chunk, max_chunk), max_chunk)
+        self.memory_cap = memory_cap
+        self.bytes_fn = bytes_fn
+        self.cache_path = cache_path
+        self.alpha = alpha
+        self.stats: Dict[int, Dict[int, list]] = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                saved = json.load(f).get(key, {})
+            self.stats = {int(bucket): {int(chunk): list(stat) for chunk, stat in chunks.items()}
+                          for bucket, chunks in saved.items()}
+
+    @classmethod
+    def get_instance(cls, key: str, max_chunk: int, **kwargs) -> "ChunkTuner":
+        """One tuner per model, thread count and chunk limit in a process, shared by its prompts."""
+        with cls._lock:
+            tuner = cls._instances.get((key, max_chunk))
+            if tuner is None:
+                tuner = cls._instances[(key, max_chunk)] = cls(key, max_chunk, **kwargs)
+            return tuner
+
+    def fits(self, chunk: int, position: int) -> bool:
+        return self.memory_cap is None or self.bytes_fn is None or self.bytes_fn(chunk, position) <= self.memory_cap
+
+    def allowed(self, position: int) -> List[int]:
+        allowed = [chunk for chunk in self.candidates if self.fits(chunk, position)]
+        # the smallest length always runs, as the fixed chunking would
+        return allowed or self.candidates[:1]
+
+    def choose(self, position: int, remaining: int) -> int:
+        allowed = self.allowed(position)
+        if remaining <= allowed[0]:
+            return remaining
+        stats = self.stats.get(position.bit_length(), {})
+        for chunk in reversed(allowed):
+            # only a full chunk measures its length
+            if chunk <= remaining and chunk not in stats:
+                return chunk
+        measured = [chunk for chunk in allowed if chunk in stats]
+        if not measured:
+            return min(allowed[-1], remaining)
+        return min(max(measured, key=lambda chunk: stats[chunk][0]), remaining)
+
+    def record(self, position: int, length: int, seconds: float):
+        if length not in self.candidates or seconds <= 0:
+            return
+        stats = self.stats.setdefault(position.bit_length(), {})
+        tokens_per_second = length / seconds
+        if length in stats:
+            stat = stats[length]
+            stat[0] += self.alpha * (tokens_per_second - stat[0])
+            stat[1] += 1
+        else:
+            stats[length] = [tokens_per_second, 1]
+
+    def decisions(self) -> Dict[int, int]:
+        """The chunk length used for each measured position bucket."""
+        return {bucket: max(chunks, key=lambda chunk: chunks[chunk][0]) for bucket, chunks in sorted(self.stats.items())
+                if chunks}
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with self._lock:
+            saved = {}
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, encoding="utf-8") as f:
+                    saved = json.load(f)
+            saved[self.key] = {str(bucket): {str(chunk): stat for chunk, stat in chunks.items()}
+                               for bucket, chunks in self.stats.items()}
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(saved, f, indent=1)
+            os.replace(tmp_path, self.cache_path)
@@ -6,6 +6,7 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 '''
 import torch
 from typing import Dict
+from ktransformers.util.expert_prefetch import ExpertPrefetcher
 
 class CUDAGraphRunner:
 
@@ -13,6 +14,7 @@ class CUDAGraphRunner:
         self.graph = None
         self.input_buffers: Dict[str, torch.Tensor] = {}
         self.output_buffers: Dict[str, torch.Tensor] = {}
+        self.prefetch_buffers: Dict[int, tuple] = {}
 
     def capture(
         self,
@@ -44,6 +46,7 @@ class CUDAGraphRunner:
             capture_stream.wait_stream(torch.cuda.current_stream())
             torch.cuda.set_device(main_device)
             torch.cuda.set_stream(capture_stream)
+        self.prefetch_buffers = ExpertPrefetcher.get_instance().take_captured()
         if past_key_values != None:    
             past_key_values.change_seq_length(-1)
         torch.cuda.synchronize(self.main_device)
@@ -75,6 +78,7 @@ class CUDAGraphRunner:
         #time.sleep(1)
         self.graph.replay()
         torch.cuda.synchronize(self.main_device)
+        ExpertPrefetcher.get_instance().on_replay(self.prefetch_buffers)
         # Return the output tensor.
         return self.output_buffers["logits"]
 
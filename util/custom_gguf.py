@@ -28,6 +28,8 @@ import KTransformersOps
 from .custom_loader import SafeTensorLoader
 import ctypes
 import math
+import difflib
+import functools
 
 class GGMLQuantizationType(IntEnum):
     F32     = 0
@@ -175,6 +177,11 @@ DATA_TYPES = {
     "FP8": 13,
 }
 
+SAFETENSORS_ITEMSIZE = {
+    "F64": 8, "I64": 8, "U64": 8, "F32": 4, "I32": 4, "U32": 4, "F16": 2, "BF16": 2, "I16": 2, "U16": 2,
+    "F8_E4M3": 1, "F8_E5M2": 1, "I8": 1, "U8": 1, "BOOL": 1,
+}
+
 class GGUFLoader:
     tensor_info: dict
     gguf_path: str
@@ -202,6 +209,7 @@ class GGUFLoader:
         safetensor_loader = SafeTensorLoader(gguf_path)
         if safetensor_loader.tensor_file_map:
             self.safetensor_loader = safetensor_loader
+            self.name_index = TensorNameIndex(safetensor_loader.tensor_file_map, gguf_path)
             return
         # Walk through all the .gguf files in the directory
         found_gguf = False
@@ -216,6 +224,7 @@ class GGUFLoader:
                             self.file_data_map[file_name] = np.memmap(file_name, mode = 'r')
         if not found_gguf:
             raise FileNotFoundError(f"Cannot find any .gguf files in: {gguf_path}")
+        self.name_index = TensorNameIndex(self.tensor_file_map, gguf_path)
                             
     def load_gguf(self, f):
         f.seek(0)
@@ -309,6 +318,15 @@ class GGUFLoader:
         itemsize = int(np.empty([], dtype = item_type).itemsize)
         return mmap_data[offset : offset + itemsize * item_count]
     
+    def tensor_nbytes(self, name: str) -> int:
+        """Bytes loading tensor `name` reads from the model files."""
+        if self.safetensor_loader is not None:
+            loader = self.safetensor_loader
+            tensor_slice = loader.file_handle_map[loader.tensor_file_map[name]].get_slice(name)
+            return math.prod(tensor_slice.get_shape()) * SAFETENSORS_ITEMSIZE.get(tensor_slice.get_dtype(), 2)
+        t = self.tensor_info[name]
+        return t["item_count"] * int(np.dtype(t["item_type"]).itemsize)
+
     def get_undequanted_tensor_and_ggml_type(self, name):
         t = self.tensor_info[name]
         data = self.get_mmap_tensor(name)
@@ -985,59 +1003,117 @@ def translate_name_to_gguf_mixtral(name):
     
     return new_name
 
+# (model name fragment, gguf name fragment), applied in order, so an entry only sees the output of the
+# ones before it (e.g. ".mlp.gate_proj" is gone by the time ".mlp.gate" is replaced)
+GGUF_NAME_TABLE = [
+    ("lm_head.", "output."),
+    ("model.embed_tokens.", "token_embd."),
+    ("model.norm.", "output_norm."),
+
+    ("model.layers.", "blk."),
+    (".input_layernorm", ".attn_norm"),
+    (".mlp.down_proj", ".ffn_down"),
+    (".mlp.gate_proj", ".ffn_gate"),
+    (".mlp.up_proj", ".ffn_up"),
+    (".post_attention_layernorm", ".ffn_norm"),
+    (".self_attn.q_proj", ".attn_q"),
+    (".self_attn.k_proj", ".attn_k"),
+    (".self_attn.v_proj", ".attn_v"),
+    (".self_attn.o_proj", ".attn_output"),
+    (".self_attn.qkv_proj", ".attn_qkv"),
+    (".self_attn.kv_a_proj_with_mqa", ".attn_kv_a_mqa"),
+    (".self_attn.kv_a_layernorm", ".attn_kv_a_norm"),
+    (".self_attn.kv_b_proj", ".attn_kv_b"),
+    (".self_attn.q_a_proj", ".attn_q_a"),
+    (".self_attn.q_a_layernorm", ".attn_q_a_norm"),
+    (".self_attn.q_b_proj", ".attn_q_b"),
+
+    (".self_attn.q_norm", ".attn_q_norm"),
+    (".self_attn.k_norm", ".attn_k_norm"),
+
+    (".shared_expert.", ".shared_experts."),
+    (".shared_expert_", ".shared_experts_"),
+    (".gate_up_proj.", ".up_proj"),
+
+    (".mlp.shared_experts.down_proj", ".ffn_down_shexp"),
+    (".mlp.gate", ".ffn_gate_inp"),
+    (".mlp.shared_experts.gate_proj", ".ffn_gate_shexp"),
+    (".mlp.shared_experts.up_proj", ".ffn_up_shexp"),
+    (".mlp.shared_experts_gate", ".ffn_gate_inp_shexp"),
+
+    (".mlp.experts", ""),
+
+    (".block_sparse_moe.gate.", ".ffn_gate_inp."),
+    (".block_sparse_moe.experts", ""),
+
+    (".feed_forward.experts", ""),
+    (".feed_forward.router", ".ffn_gate_inp"),
+    (".feed_forward.shared_experts.down_proj", ".ffn_down_shexp"),
+    (".feed_forward.shared_experts.gate_proj", ".ffn_gate_shexp"),
+    (".feed_forward.shared_experts.up_proj", ".ffn_up_shexp"),
+]
+
+@functools.lru_cache(maxsize=None)
 def translate_name_to_gguf(name):
 
     name = translate_name_to_gguf_mixtral(name)
+    for model_fragment, gguf_fragment in GGUF_NAME_TABLE:
+        if model_fragment in name:
+            name = name.replace(model_fragment, gguf_fragment)
+    return name
 
-    name = name.replace("lm_head.", "output.")
-    name = name.replace("model.embed_tokens.", "token_embd.")
-    name = name.replace("model.norm.", "output_norm.")
-    
-    name = name.replace("model.layers.", "blk.")
-    name = name.replace(".input_layernorm", ".attn_norm")
-    name = name.replace(".mlp.down_proj", ".ffn_down")
-    name = name.replace(".mlp.gate_proj", ".ffn_gate")
-    name = name.replace(".mlp.up_proj", ".ffn_up")
-    name = name.replace(".post_attention_layernorm", ".ffn_norm")
-    name = name.replace(".self_attn.q_proj", ".attn_q")
-    name = name.replace(".self_attn.k_proj", ".attn_k")
-    name = name.replace(".self_attn.v_proj", ".attn_v")
-    name = name.replace(".self_attn.o_proj", ".attn_output")
-    name = name.replace(".self_attn.qkv_proj", ".attn_qkv")
-    name = name.replace(".self_attn.kv_a_proj_with_mqa", ".attn_kv_a_mqa")
-    name = name.replace(".self_attn.kv_a_layernorm", ".attn_kv_a_norm")
-    name = name.replace(".self_attn.kv_b_proj", ".attn_kv_b")
-    name = name.replace(".self_attn.q_a_proj", ".attn_q_a")
-    name = name.replace(".self_attn.q_a_layernorm", ".attn_q_a_norm")
-    name = name.replace(".self_attn.q_b_proj", ".attn_q_b")
-
-    name = name.replace(".self_attn.q_norm", ".attn_q_norm")
-    name = name.replace(".self_attn.k_norm", ".attn_k_norm")
-    
-    name = name.replace(".shared_expert.", ".shared_experts.")
-    name = name.replace(".shared_expert_", ".shared_experts_")
-    name = name.replace(".gate_up_proj.", ".up_proj")
-    
-    name = name.replace(".mlp.shared_experts.down_proj", ".ffn_down_shexp")
-    name = name.replace(".mlp.gate", ".ffn_gate_inp")
-    name = name.replace(".mlp.shared_experts.gate_proj", ".ffn_gate_shexp")
-    name = name.replace(".mlp.shared_experts.up_proj", ".ffn_up_shexp")
-    name = name.replace(".mlp.shared_experts_gate", ".ffn_gate_inp_shexp")
-
-
-    name = name.replace(".mlp.experts", "")
-
-    
-    name = name.replace(".block_sparse_moe.gate.", ".ffn_gate_inp.")
-    name = name.replace(".block_sparse_moe.experts", "")
-    
-    name = name.replace(".feed_forward.experts", "")
-    name = name.replace(".feed_forward.router", ".ffn_gate_inp")
-    name = name.replace(".feed_forward.shared_experts.down_proj", ".ffn_down_shexp")
-    name = name.replace(".feed_forward.shared_experts.gate_proj", ".ffn_gate_shexp")
-    name = name.replace(".feed_forward.shared_experts.up_proj", ".ffn_up_shexp")
 
-    return name
+class TensorNameIndex:
+    """
+    Model <-> file tensor names of one loader. `tensor_names` is the loader's tensor map, built once;
+    `resolve` translates a model name, records the pair both ways and fails on names the files don't hold.
+    """
+    def __init__(self, tensor_names, source: str = ""):
+        self.tensor_names = tensor_names
+        self.source = source
+        self.to_file: dict = {}
+        self.to_model: dict = {}
+        self._by_block = None
+
+    def resolve(self, model_name: str) -> str:
+        file_name = self.to_file.get(model_name)
+        if file_name is not None:
+            return file_name
+        file_name = translate_name_to_gguf(model_name)
+        if file_name not in self.tensor_names:
+            raise KeyError(
+                f"{model_name} (as {file_name}) is not in {self.source or 'the model files'}, "
+                f"nearest names: {self.nearest(file_name)}"
+            )
+        self.to_file[model_name] = file_name
+        self.to_model[file_name] = model_name
+        return file_name
+
+    def unresolved(self) -> list:
+        """File tensors no model name resolved to."""
+        return [name for name in self.tensor_names if name not in self.to_model]
+
+    def nearest(self, file_name: str, n: int = 5) -> list:
+        # only on the error path: compare against the names of the same block, or all of them
+        candidates = self.by_block().get(self._block(file_name)) or list(self.tensor_names)
+        return difflib.get_close_matches(file_name, candidates, n=n, cutoff=0.0)
+
+    def with_prefix(self, prefix: str) -> list:
+        """File tensors under `prefix` (e.g. "blk.3.ffn_"), looked up in its block only."""
+        return [name for name in self.by_block().get(self._block(prefix), ()) if name.startswith(prefix)]
+
+    def by_block(self) -> dict:
+        if self._by_block is None:
+            by_block = {}
+            for name in self.tensor_names:
+                by_block.setdefault(self._block(name), []).append(name)
+            self._by_block = by_block
+        return self._by_block
+
+    @staticmethod
+    def _block(name: str) -> str:
+        parts = name.split(".")
+        return ".".join(parts[:2]) if parts[0] == "blk" else ""
 
 
 if __name__ == '__main__':
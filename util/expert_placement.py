@@ -0,0 +1,282 @@
+'''
+Description  : Locality-aware expert placement. Given routing statistics and a
+               description of the memory tiers (local DRAM numa nodes and CXL
+               numa nodes, or backing files that emulate them), decide which
+               numa node holds every routed expert and lay the expert weights
+               out in per-node buffers so each node's worker pool only touches
+               local memory.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os
+import mmap
+import ctypes
+import ctypes.util
+import platform
+import threading
+import numpy as np
+import torch
+
+MPOL_BIND = 2
+MPOL_MF_MOVE = 1 << 1
+_SYS_MBIND = {"x86_64": 237, "aarch64": 235, "ppc64le": 259}
+_NODE_SYSFS = "/sys/devices/system/node"
+PLACEMENT_CUDA_GRAPH_ERROR = ("expert_placement routes every token to per numa node expert pools on the host, "
+                              "which a cuda graph can't capture, set use_cuda_graph to False")
+
+
+def check_cuda_graph(use_cuda_graph: bool):
+    """Placed experts only run eagerly, refuse a cuda graph decode before the model is loaded."""
+    if use_cuda_graph:
+        raise ValueError(PLACEMENT_CUDA_GRAPH_ERROR)
+
+
+def parse_node_list(nodes: str | int | list | None) -> list[int]:
+    """Parse a numactl style node/cpu list ("0-1,3") into a sorted list of ints."""
+    if nodes is None or nodes == "":
+        return []
+    if isinstance(nodes, int):
+        return [nodes]
+    if isinstance(nodes, (list, tuple)):
+        return sorted(set(int(n) for n in nodes))
+    res = set()
+    for part in str(nodes).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            begin, end = part.split("-")
+            res.update(range(int(begin), int(end) + 1))
+        else:
+            res.add(int(part))
+    return sorted(res)
+
+
+def node_cpus(node: int) -> list[int]:
+    path = os.path.join(_NODE_SYSFS, f"node{node}", "cpulist")
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return parse_node_list(f.read().strip())
+
+
+def physical_cpus(cpus: list[int]) -> list[int]:
+    """Keep the first hyper thread of every core."""
+    res = []
+    for cpu in cpus:
+        path = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        if not os.path.exists(path):
+            res.append(cpu)
+            continue
+        with open(path, "r") as f:
+            siblings = parse_node_list(f.read().strip())
+        if not siblings or siblings[0] == cpu:
+            res.append(cpu)
+    return res
+
+
+class MemoryNode:
+    """One memory tier node. CXL nodes have no cpus, their experts are computed by `compute_node`."""
+    def __init__(self, node: int, tier: str, capacity: int, compute_node: int, backing_dir: str | None = None):
+        self.node = node
+        self.tier = tier
+        self.capacity = capacity
+        self.compute_node = compute_node
+        self.backing_dir = backing_dir
+        self.used = 0
+
+    def __repr__(self):
+        return f"MemoryNode(node={self.node}, tier={self.tier}, compute_node={self.compute_node})"
+
+
+class MemoryTopology:
+    def __init__(self,
+                 local_nodes: str | list = "0",
+                 cxl_nodes: str | list = "",
+                 local_capacity_gb: float = 0,
+                 cxl_capacity_gb: float = 0,
+                 cxl_backing_dir: str | None = None,
+                 threads_per_node: int = 0):
+        self.local_nodes = parse_node_list(local_nodes)
+        self.cxl_nodes = parse_node_list(cxl_nodes)
+        if not self.local_nodes:
+            raise ValueError("expert placement needs at least one local DRAM node")
+        self.threads_per_node = threads_per_node
+        gb = 1024 ** 3
+        # capacity 0 means unbounded
+        local_capacity = int(local_capacity_gb * gb) or (1 << 62)
+        cxl_capacity = int(cxl_capacity_gb * gb) or (1 << 62)
+        self.nodes: list[MemoryNode] = [MemoryNode(n, "dram", local_capacity, n) for n in self.local_nodes]
+        for i, n in enumerate(self.cxl_nodes):
+            # attach CXL nodes to sockets round robin
+            compute_node = self.local_nodes[i % len(self.local_nodes)]
+            backing_dir = os.path.join(cxl_backing_dir, f"node{n}") if cxl_backing_dir else None
+            self.nodes.append(MemoryNode(n, "cxl", cxl_capacity, compute_node, backing_dir))
+
+    @classmethod
+    def from_config(cls, cfg) -> "MemoryTopology":
+        return cls(cfg.expert_placement_local_nodes, cfg.expert_placement_cxl_nodes,
+                   cfg.expert_placement_local_capacity_gb, cfg.expert_placement_cxl_capacity_gb,
+                   cfg.expert_placement_cxl_backing_dir, cfg.expert_placement_threads_per_node)
+
+    def get_node(self, node: int) -> MemoryNode:
+        for n in self.nodes:
+            if n.node == node:
+                return n
+        raise KeyError(f"numa node {node} is not part of the topology")
+
+    def compute_threads(self, node: int) -> tuple[list[int], int]:
+        cpus = node_cpus(node)
+        if not cpus:
+            cpus = sorted(os.sched_getaffinity(0))
+        thread_num = self.threads_per_node or max(1, len(physical_cpus(cpus)) - 1)
+        return cpus, thread_num
+
+
+class ExpertPlacement:
+    """node_map[layer, expert] is the numa node holding that expert."""
+    def __init__(self, node_map: torch.Tensor, topology: MemoryTopology):
+        self.node_map = node_map
+        self.topology = topology
+
+    def groups(self, layer_idx: int) -> dict[int, list[int]]:
+        res: dict[int, list[int]] = {}
+        for expert_idx, node in enumerate(self.node_map[layer_idx].tolist()):
+            res.setdefault(node, []).append(expert_idx)
+        return res
+
+    def summary(self) -> dict:
+        res = {}
+        for node in self.topology.nodes:
+            res[f"node{node.node}({node.tier})"] = int((self.node_map == node.node).sum())
+        return res
+
+
+def plan_expert_placement(frequency: torch.Tensor, topology: MemoryTopology, expert_bytes: int) -> ExpertPlacement:
+    """Greedy placement over the whole model.
+
+    (layer, expert) pairs are visited hottest first. Each one goes to the DRAM node with the least accumulated
+    routing mass that still has room, so bandwidth demand is balanced across sockets, then to the least loaded
+    CXL node once DRAM is full. Without statistics (all zeros) experts are simply spread round robin.
+    """
+    num_layers, num_experts = frequency.shape
+    frequency = frequency.to(torch.float64)
+    # break ties by spreading experts of one layer over nodes
+    order = torch.argsort(frequency.flatten(), descending=True, stable=True).tolist()
+    node_map = torch.full((num_layers, num_experts), topology.nodes[-1].node, dtype=torch.int32)
+    for node in topology.nodes:
+        node.used = 0
+    load = {node.node: 0.0 for node in topology.nodes}
+    for tier in ("dram", "cxl"):
+        candidates = [n for n in topology.nodes if n.tier == tier]
+        if not candidates:
+            continue
+        remaining = []
+        for flat in order:
+            layer_idx, expert_idx = divmod(flat, num_experts)
+            fits = [n for n in candidates if n.used + expert_bytes <= n.capacity]
+            if not fits:
+                remaining.append(flat)
+                continue
+            target = min(fits, key=lambda n: (load[n.node], n.used))
+            target.used += expert_bytes
+            load[target.node] += float(frequency[layer_idx, expert_idx]) + 1e-9
+            node_map[layer_idx, expert_idx] = target.node
+        order = remaining
+    if order:
+        print(f"Warning: {len(order)} experts don't fit the configured node capacities, "
+              f"keeping them on node {topology.nodes[-1].node}")
+    return ExpertPlacement(node_map, topology)
+
+
+_libnuma = None
+_libc = None
+
+
+def bind_memory(addr: int, nbytes: int, node: int) -> bool:
+    """mbind [addr, addr + nbytes) to `node`, must be called before the pages are touched."""
+    global _libnuma, _libc
+    maxnode = node + 2
+    mask = (ctypes.c_ulong * ((maxnode + 63) // 64))()
+    mask[node // 64] = 1 << (node % 64)
+    page = mmap.PAGESIZE
+    begin = addr & ~(page - 1)
+    length = addr + nbytes - begin
+    if _libnuma is None:
+        lib = ctypes.util.find_library("numa")
+        _libnuma = ctypes.CDLL(lib, use_errno=True) if lib else False
+    if _libnuma:
+        ret = _libnuma.mbind(ctypes.c_void_p(begin), ctypes.c_ulong(length), MPOL_BIND, mask,
+                             ctypes.c_ulong(maxnode), MPOL_MF_MOVE)
+    else:
+        nr = _SYS_MBIND.get(platform.machine())
+        if nr is None:
+            return False
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        ret = _libc.syscall(nr, ctypes.c_void_p(begin), ctypes.c_ulong(length), MPOL_BIND, mask,
+                            ctypes.c_ulong(maxnode), MPOL_MF_MOVE)
+    return ret == 0
+
+
+def alloc_node_buffer(nbytes: int, node: MemoryNode, name: str) -> np.ndarray:
+    """A uint8 buffer whose pages live on `node`: an mbind-ed anonymous mapping, or a file in the node's
+    backing dir (e.g. a tmpfs/dax mount on the CXL device) when the tier is emulated with files."""
+    if node.backing_dir is not None:
+        os.makedirs(node.backing_dir, exist_ok=True)
+        return np.memmap(os.path.join(node.backing_dir, name), dtype=np.uint8, mode="w+", shape=(max(nbytes, 1),))
+    buf = mmap.mmap(-1, max(nbytes, 1), flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    if not bind_memory(arr.ctypes.data, nbytes, node.node):
+        print(f"Warning: mbind to numa node {node.node} failed, {name} uses first touch placement")
+    return arr
+
+
+def gather_experts(src: np.ndarray, experts: list[int], num_experts: int, node: MemoryNode, name: str) -> np.ndarray:
+    """Copy the listed experts of a packed [num_experts, ...] weight into a contiguous buffer on `node`."""
+    src = np.ascontiguousarray(src).reshape(-1).view(np.uint8)
+    expert_bytes = src.nbytes // num_experts
+    dst = alloc_node_buffer(expert_bytes * len(experts), node, name)
+    for i, expert_idx in enumerate(experts):
+        # first touch happens here, after the policy is set
+        dst[i * expert_bytes:(i + 1) * expert_bytes] = src[expert_idx * expert_bytes:(expert_idx + 1) * expert_bytes]
+    return dst
+
+
+class ExpertPlacementPlanner():
+    """Computes the placement once for the whole model and hands out per layer groups."""
+    _instance: "ExpertPlacementPlanner" = None
+    _lock = threading.Lock()
+
+    def __init__(self, topology: MemoryTopology, stats_path: str | None = None):
+        self.topology = topology
+        self.stats_path = stats_path
+        self.placement: ExpertPlacement = None
+
+    @classmethod
+    def get_instance(cls) -> "ExpertPlacementPlanner":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    from ktransformers.server.config.config import Config
+                    cfg = Config()
+                    cls._instance = cls(MemoryTopology.from_config(cfg), cfg.expert_placement_stats_path)
+        return cls._instance
+
+    def _frequency(self, num_layers: int, num_experts: int) -> torch.Tensor:
+        from ktransformers.util.routing_stats import ExpertRoutingStats
+        if self.stats_path and os.path.exists(os.path.expanduser(self.stats_path)):
+            stats = ExpertRoutingStats.load(self.stats_path)
+        else:
+            stats = ExpertRoutingStats.get_instance()
+        if stats.counts is None or stats.num_layers != num_layers or stats.num_experts != num_experts:
+            return torch.zeros((num_layers, num_experts))
+        return stats.activation_frequency()
+
+    def get_placement(self, num_layers: int, num_experts: int, expert_bytes: int) -> ExpertPlacement:
+        with self._lock:
+            if self.placement is None:
+                self.placement = plan_expert_placement(self._frequency(num_layers, num_experts),
+                                                       self.topology, expert_bytes)
+                print(f"expert placement: {self.placement.summary()}")
+        return self.placement
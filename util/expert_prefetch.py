@@ -0,0 +1,165 @@
+'''
+Description  : Speculative expert prefetching for decode. While layer N runs, the gate of
+               layer N+1 is evaluated on layer N's MoE input to guess the experts layer N+1
+               will route to, and madvise(MADV_WILLNEED) is issued on their gate/up/down
+               pages so slow tier (CXL or cold mmap) faults overlap with layer N's compute.
+               Inside a cuda graph the gates only fill static buffers, on_replay reads them after
+               the replay and prefetches for the next step.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import mmap
+import ctypes
+import threading
+import numpy as np
+import torch
+from ktransformers.util.routing_stats import layer_idx_from_key
+
+MADV_WILLNEED = 3
+_libc = None
+
+
+def madvise_willneed(addr: int, nbytes: int) -> bool:
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    page = mmap.PAGESIZE
+    begin = addr & ~(page - 1)
+    return _libc.madvise(ctypes.c_void_p(begin), ctypes.c_size_t(addr + nbytes - begin), MADV_WILLNEED) == 0
+
+
+def expert_runs(expert_ids: list[int]) -> list[tuple[int, int]]:
+    """Coalesce sorted expert ids into [begin, end) runs so neighbouring experts share one madvise."""
+    runs = []
+    for expert_idx in sorted(expert_ids):
+        if runs and runs[-1][1] == expert_idx:
+            runs[-1][1] = expert_idx + 1
+        else:
+            runs.append([expert_idx, expert_idx + 1])
+    return [tuple(run) for run in runs]
+
+
+class ExpertPrefetcher():
+    _instance: "ExpertPrefetcher" = None
+    _lock = threading.Lock()
+
+    def __init__(self, enable: bool = False, max_tokens: int = 4):
+        self.enable = enable
+        # only prefetch for decode sized batches, prefill touches nearly every expert anyway
+        self.max_tokens = max_tokens
+        self.blocks: dict = {}
+        self.predicted: dict[int, torch.Tensor] = {}
+        # layer -> (topk ids, predicted ids of the next layer) buffers of the graph being captured
+        self.captured: dict[int, tuple] = {}
+        self.reset()
+
+    @classmethod
+    def get_instance(cls) -> "ExpertPrefetcher":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    from ktransformers.server.config.config import Config
+                    cfg = Config()
+                    cls._instance = cls(cfg.expert_prefetch_enable, cfg.expert_prefetch_max_tokens)
+        return cls._instance
+
+    def reset(self):
+        self.hits = 0
+        self.actual = 0
+        self.issued = 0
+        self.issued_bytes = 0
+        self.predicted.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enable": self.enable,
+            "hit_rate": self.hits / self.actual if self.actual else 0.0,
+            "precision": self.hits / self.issued if self.issued else 0.0,
+            "hits": self.hits,
+            "routed_experts": self.actual,
+            "prefetched_experts": self.issued,
+            "prefetched_bytes": self.issued_bytes,
+        }
+
+    @torch.no_grad()
+    def predict(self, block, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Run `block`'s gate on the current hidden states and return the ids it would route to."""
+        out = block.gate(hidden_states)
+        if isinstance(out, tuple):
+            # deepseek gates return (topk_idx, topk_weight[, aux_loss])
+            return out[0]
+        return torch.topk(out, block.top_k, dim=-1).indices
+
+    def prefetch(self, block, expert_ids: list[int]):
+        experts = getattr(block.experts, "generate_experts", block.experts)
+        if getattr(experts, "shards", None) is not None:
+            # already copied to node local memory by the placement
+            return
+        n_routed_experts = getattr(experts, "n_routed_experts", None)
+        if n_routed_experts is None:
+            return
+        for weight in (getattr(experts, "gate", None), getattr(experts, "up", None), getattr(experts, "down", None)):
+            if not isinstance(weight, np.ndarray):
+                return
+            expert_bytes = weight.nbytes // n_routed_experts
+            base = weight.ctypes.data
+            for begin, end in expert_runs(expert_ids):
+                madvise_willneed(base + begin * expert_bytes, (end - begin) * expert_bytes)
+            self.issued_bytes += expert_bytes * len(expert_ids)
+        self.issued += len(expert_ids)
+
+    def observe(self, layer_idx: int, ids: torch.Tensor, predicted: torch.Tensor | None):
+        """Score the guess made for `layer_idx` against its routing `ids`, then prefetch the guess for the next layer."""
+        guess = self.predicted.pop(layer_idx, None)
+        if guess is not None:
+            actual = torch.unique(ids.flatten())
+            self.hits += int(torch.isin(actual, guess).sum())
+            self.actual += actual.numel()
+        next_block = self.blocks.get(layer_idx + 1)
+        if next_block is None or predicted is None:
+            return
+        predicted = torch.unique(predicted.flatten())
+        self.predicted[layer_idx + 1] = predicted
+        self.prefetch(next_block, predicted.tolist())
+
+    def on_gate(self, block, hidden_states: torch.Tensor, topk_idx: torch.Tensor):
+        layer_idx = layer_idx_from_key(block.key)
+        self.blocks.setdefault(layer_idx, block)
+        ids = topk_idx.reshape(-1, topk_idx.size(-1))
+        if ids.size(0) > self.max_tokens:
+            self.predicted.clear()
+            return
+        next_block = self.blocks.get(layer_idx + 1)
+        predicted = None if next_block is None else self.predict(next_block, hidden_states)
+        if topk_idx.is_cuda and torch.cuda.is_current_stream_capturing():
+            # madvise is host work, the graph only leaves the routing in static buffers for on_replay
+            self.captured[layer_idx] = (ids.clone(), None if predicted is None else predicted.reshape(ids.size(0), -1).clone())
+            return
+        self.observe(layer_idx, ids.cpu(), None if predicted is None else predicted.cpu())
+
+    def take_captured(self) -> dict:
+        """The buffers of the graph captured since the last call, to pass to on_replay after each of its replays."""
+        captured, self.captured = self.captured, {}
+        return captured
+
+    def on_replay(self, captured: dict, num_tokens: int | None = None):
+        """
+        Score and prefetch what a finished replay left in `captured`, layer by layer as on_gate would have.
+        :param num_tokens: rows of the buffers holding real tokens, the rest pads the batch to the graph size
+        """
+        if not captured:
+            return
+        if num_tokens is not None and num_tokens > self.max_tokens:
+            self.predicted.clear()
+            return
+        for layer_idx in sorted(captured):
+            ids, predicted = captured[layer_idx]
+            self.observe(layer_idx, ids[:num_tokens].cpu(), None if predicted is None else predicted[:num_tokens].cpu())
+
+
+def expert_prefetch(block, hidden_states: torch.Tensor, topk_idx: torch.Tensor):
+    """Hook called by the injected MoE blocks right after the gate."""
+    prefetcher = ExpertPrefetcher.get_instance()
+    if not prefetcher.enable:
+        return
+    prefetcher.on_gate(block, hidden_states, topk_idx)
@@ -0,0 +1,580 @@
+'''
+Description  : Grammar constrained JSON decoding. A JSON schema (or any JSON value, nested up to a
+               depth) is compiled into a character automaton whose states are stacks of parse frames,
+               and that into a token automaton over the tokenizer vocabulary: for every reachable
+               state the allowed tokens as a packed bitmask and each allowed token's next state.
+               Decoding then costs one table row per token for the logits mask and one dict lookup to
+               advance, the vocabulary is only walked when a state is compiled.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import json
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Sequence
+import torch
+
+WHITESPACE = " \n\t"
+HEX = "0123456789abcdefABCDEF"
+DIGITS = "0123456789"
+# number phases a number may end in
+NUMBER_END = ("zero", "int", "frac", "exp")
+
+
+def is_plain(ch: str) -> bool:
+    """Characters a string takes as they are, without ending or escaping."""
+    return ch != '"' and ch != "\\" and ch >= " "
+
+
+def compile_schema(schema: Optional[dict]) -> tuple:
+    """
+    The grammar node of a JSON schema, None or {} for any value. Supported: type (one or a list), properties
+    (generated in their order, required ones always, no other keys), additionalProperties of objects without
+    properties, items, enum, const and anyOf / oneOf of branches starting with different characters. Value
+    constraints (pattern, minimum, lengths, formats) are not enforced.
+    """
+    if not schema:
+        return ("any",)
+    if "const" in schema:
+        return ("literal", (json.dumps(schema["const"], ensure_ascii=False),))
+    if "enum" in schema:
+        return ("literal", tuple(json.dumps(value, ensure_ascii=False) for value in schema["enum"]))
+    branches = schema.get("anyOf") or schema.get("oneOf")
+    if branches:
+        return ("union", tuple(compile_schema(branch) for branch in branches))
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        return ("union", tuple(compile_schema({**schema, "type": k}) for k in kind))
+    if kind == "object":
+        properties = schema.get("properties") or {}
+        required = set(schema.get("required", []))
+        if properties:
+            props = tuple((json.dumps(name, ensure_ascii=False), compile_schema(sub), name in required)
+                          for name, sub in properties.items())
+            return ("object", props, None)
+        additional = schema.get("additionalProperties", True)
+        return ("object", (), compile_schema(additional if isinstance(additional, dict) else None))
+    if kind == "array":
+        return ("array", compile_schema(schema.get("items")))
+    if kind == "string":
+        return ("string",)
+    if kind in ("number", "integer"):
+        return (kind,)
+    if kind == "boolean":
+        return ("literal", ("true", "false"))
+    if kind == "null":
+        return ("literal", ("null",))
+    if kind is None:
+        return ("any",)
+    raise ValueError(f"unsupported schema type {kind!r}")
+
+
+class JsonAutomaton:
+    """
+    Character automaton of one JSON value. A state is (frames, whitespace run), frames a tuple of parse frames
+    innermost last and () once the value is complete:
+        ("V", node, depth)          a value of node is expected
+        ("S", mode)                 inside a string: 0 plain, -1 after a backslash, k > 0 hex digits left
+        ("L", choices, typed)       one of the literal texts, typed the prefix read
+        ("N", integer, phase)       a number
+        ("O", node, phase, index, depth) an object, index the next property (or the one being read)
+        ("A", node, phase, depth)   an array
+    Values of "any" nodes open containers only below max_depth, and runs of whitespace between tokens are at
+    most max_whitespace characters so a constrained model can't pad forever.
+    """
+
+    def __init__(self, schema: Optional[dict] = None, max_depth: int = 4, max_whitespace: int = 8,
+                 object_root: bool = False):
+        root = compile_schema(schema)
+        if object_root and root == ("any",):
+            # what the OpenAI json_object response format asks for
+            root = ("object", (), ("any",))
+        self.max_depth = max_depth
+        self.max_whitespace = max_whitespace
+        self.initial = ((("V", root, 0),), 0)
+
+    def in_string(self, state) -> bool:
+        frames = state[0]
+        return bool(frames) and frames[-1][0] == "S" and frames[-1][1] == 0
+
+    def accepting(self, state) -> bool:
+        frames = state[0]
+        while frames:
+            top = frames[-1]
+            if top[0] == "N" and top[2] in NUMBER_END:
+                frames = self._complete(frames[:-1])
+            elif top[0] == "L" and top[2] in top[1]:
+                frames = self._complete(frames[:-1], top[2])
+            else:
+                return False
+            if frames is None:
+                return False
+        return True
+
+    def step(self, state, ch: str):
+        """The state after reading ch, None if ch can't come next."""
+        frames, ws = state
+        if not frames:
+            return None
+        top = frames[-1]
+        kind = top[0]
+        if kind == "S":
+            mode = top[1]
+            if mode == 0:
+                if ch == '"':
+                    frames = self._complete(frames[:-1])
+                    return None if frames is None else (frames, 0)
+                if ch == "\\":
+                    return (frames[:-1] + (("S", -1),), 0)
+                return state if ch >= " " else None
+            if mode == -1:
+                if ch == "u":
+                    return (frames[:-1] + (("S", 4),), 0)
+                return (frames[:-1] + (("S", 0),), 0) if ch in '"\\/bfnrt' else None
+            return (frames[:-1] + (("S", mode - 1),), 0) if ch in HEX else None
+
+        if ch in WHITESPACE:
+            if kind in ("N", "L"):
+                return self._end_and_step(frames, ch)
+            return (frames, ws + 1) if ws < self.max_whitespace else None
+
+        if kind == "V":
+            pushed = self._begin(top[1], top[2], ch)
+            return None if pushed is None else self._settle(frames[:-1] + pushed)
+        if kind == "L":
+            choices, typed = top[1], top[2] + ch
+            if any(choice.startswith(typed) for choice in choices):
+                return self._settle(frames[:-1] + (("L", choices, typed),))
+            return self._end_and_step(frames, ch)
+        if kind == "N":
+            phase = self._number(top[1], top[2], ch)
+            if phase is None:
+                return self._end_and_step(frames, ch)
+            return (frames[:-1] + (("N", top[1], phase),), 0)
+        if kind == "O":
+            return self._object(frames, ch)
+        if kind == "A":
+            return self._array(frames, ch)
+        return None
+
+    def _settle(self, frames):
+        """Completes a literal once nothing can extend it, e.g. a key or an enum string after its quote."""
+        top = frames[-1]
+        if top[0] == "L" and top[2] in top[1] and not any(
+                len(choice) > len(top[2]) and choice.startswith(top[2]) for choice in top[1]):
+            frames = self._complete(frames[:-1], top[2])
+            if frames is None:
+                return None
+        return (frames, 0)
+
+    def _end_and_step(self, frames, ch):
+        """A number or literal ends at a character it can't take, which the enclosing value then reads."""
+        top = frames[-1]
+        if top[0] == "N" and top[2] not in NUMBER_END:
+            return None
+        if top[0] == "L" and top[2] not in top[1]:
+            return None
+        rest = self._complete(frames[:-1], top[2] if top[0] == "L" else None)
+        if rest is None:
+            return None
+        return self.step((rest, 0), ch)
+
+    def _begin(self, node, depth, ch) -> Optional[tuple]:
+        kind = node[0]
+        if kind == "any":
+            if ch in "{[" and depth >= self.max_depth:
+                return None
+            for sub in (("object", (), node), ("array", node), ("string",), ("number",),
+                        ("literal", ("true", "false", "null"))):
+                pushed = self._begin(sub, depth, ch)
+                if pushed is not None:
+                    return pushed
+            return None
+        if kind == "union":
+            for sub in node[1]:
+                pushed = self._begin(sub, depth, ch)
+                if pushed is not None:
+                    return pushed
+            return None
+        if kind == "object":
+            return (("O", node, "open", 0, depth + 1),) if ch == "{" else None
+        if kind == "array":
+            return (("A", node, "open", depth + 1),) if ch == "[" else None
+        if kind == "string":
+            return (("S", 0),) if ch == '"' else None
+        if kind in ("number", "integer"):
+            phase = self._number(kind == "integer", "start", ch)
+            return None if phase is None else (("N", kind == "integer", phase),)
+        if kind == "literal":
+            if any(choice.startswith(ch) for choice in node[1]):
+                return (("L", node[1], ch),)
+            return None
+        raise ValueError(f"unknown grammar node {kind!r}")
+
+    @staticmethod
+    def _number(integer, phase, ch) -> Optional[str]:
+        if phase == "start":
+            return "minus" if ch == "-" else "zero" if ch == "0" else "int" if ch in DIGITS else None
+        if phase == "minus":
+            return "zero" if ch == "0" else "int" if ch in DIGITS else None
+        if ch in DIGITS:
+            if phase in ("int", "frac", "exp"):
+                return phase
+            return {"dot": "frac", "e": "exp", "esign": "exp"}.get(phase)
+        if integer:
+            return None
+        if ch == "." and phase in ("zero", "int"):
+            return "dot"
+        if ch in "eE" and phase in ("zero", "int", "frac"):
+            return "e"
+        if ch in "+-" and phase == "e":
+            return "esign"
+        return None
+
+    @staticmethod
+    def _keys(node, index) -> List[int]:
+        """Properties that may come at index: the optional ones up to and including the next required one."""
+        keys = []
+        for i in range(index, len(node[1])):
+            keys.append(i)
+            if node[1][i][2]:
+                break
+        return keys
+
+    @staticmethod
+    def _may_close(node, index) -> bool:
+        return not any(required for _, _, required in node[1][index:])
+
+    def _object(self, frames, ch):
+        _, node, phase, index, depth = frames[-1]
+        rest = frames[:-1]
+        props = node[1]
+        if phase in ("open", "key"):
+            if ch == "}" and phase == "open" and self._may_close(node, index):
+                rest = self._complete(rest)
+                return None if rest is None else (rest, 0)
+            if ch != '"':
+                return None
+            reading = ("O", node, "reading", index, depth)
+            if not props:
+                return (rest + (reading, ("S", 0)), 0)
+            choices = tuple(props[i][0] for i in self._keys(node, index))
+            return self._settle(rest + (reading, ("L", choices, ch)))
+        if phase == "colon":
+            return (rest + (("O", node, "value", index, depth),), 0) if ch == ":" else None
+        if phase == "value":
+            value = props[index][1] if props else node[2]
+            pushed = self._begin(value, depth, ch)
+            if pushed is None:
+                return None
+            return self._settle(rest + (("O", node, "value", index, depth),) + pushed)
+        if phase == "after":
+            if ch == "}" and self._may_close(node, index):
+                rest = self._complete(rest)
+                return None if rest is None else (rest, 0)
+            if ch == "," and (not props or index < len(props)):
+                return (rest + (("O", node, "key", index, depth),), 0)
+        return None
+
+    def _array(self, frames, ch):
+        _, node, phase, depth = frames[-1]
+        rest = frames[:-1]
+        if ch == "]" and phase in ("open", "after"):
+            rest = self._complete(rest)
+            return None if rest is None else (rest, 0)
+        if phase == "after":
+            return (rest + (("A", node, "value", depth),), 0) if ch == "," else None
+        pushed = self._begin(node[1], depth, ch)
+        if pushed is None:
+            return None
+        return self._settle(rest + (("A", node, "value", depth),) + pushed)
+
+    def _complete(self, frames, text: Optional[str] = None):
+        """The frames once the value on top of them is complete, text the literal it was."""
+        if not frames:
+            return frames
+        top = frames[-1]
+        if top[0] == "O":
+            _, node, phase, index, depth = top
+            if phase == "reading":
+                if node[1]:
+                    index = next(i for i in self._keys(node, index) if node[1][i][0] == text)
+                return frames[:-1] + (("O", node, "colon", index, depth),)
+            # a value of the properties
+            return frames[:-1] + (("O", node, "after", index + 1 if node[1] else index, depth),)
+        if top[0] == "A":
+            return frames[:-1] + (("A", top[1], "after", top[3]),)
+        return None
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.ids: List[int] = []
+
+
+class _Plain:
+    """The tokens continuing from a trie node with plain characters only, and where they leave plain text."""
+    __slots__ = ("ids", "id_set", "exits")
+
+    def __init__(self, node: _TrieNode):
+        ids, exits, stack = [], [], [node]
+        while stack:
+            current = stack.pop()
+            ids.extend(current.ids)
+            for ch, child in current.children.items():
+                if is_plain(ch):
+                    stack.append(child)
+                else:
+                    exits.append((child, ch))
+        self.ids = torch.tensor(ids, dtype=torch.long)
+        self.id_set = frozenset(ids)
+        self.exits = exits
+
+
+class TokenAutomaton:
+    """
+    JsonAutomaton lifted to tokens. `tokens[i]` is the text of token i ("" for special tokens, never allowed),
+    `eos_token_ids` are allowed where the value may end, vocab_size is the logits width. States are numbered
+    as they are reached and compiled breadth first from the initial one up to max_states, later ones when first
+    used.
+
+    Inside a string plain characters keep the state, so every token whose text from some point on is plain goes
+    to the state the string was in at that point: those tokens are kept as groups (a trie node's plain tokens
+    and their state) rather than one next entry each, and the walk of a string state jumps straight to the
+    quotes, backslashes and control characters below the node it is at.
+    """
+
+    def __init__(self, automaton: JsonAutomaton, tokens: Sequence[str], eos_token_ids: Iterable[int],
+                 vocab_size: Optional[int] = None, max_states: int = 1024):
+        self.automaton = automaton
+        self.vocab_size = vocab_size or len(tokens)
+        self.eos_token_ids = sorted(set(i for i in eos_token_ids if i is not None and i < self.vocab_size))
+        eos = set(self.eos_token_ids)
+        self.root = _TrieNode()
+        for token_id, text in enumerate(tokens[:self.vocab_size]):
+            if not text or token_id in eos:
+                continue
+            node = self.root
+            for ch in text:
+                node = node.children.setdefault(ch, _TrieNode())
+            node.ids.append(token_id)
+        self._plain: Dict[int, _Plain] = {}
+        self._step: Dict[tuple, Optional[tuple]] = {}
+
+        self.states: Dict[tuple, int] = {}
+        self.char_states: List[tuple] = []
+        # per state: next state of single allowed tokens, (token ids, next state) groups, whether it may end,
+        # and its packed bitmask; next is None until the state is compiled
+        self.next: List[Optional[Dict[int, int]]] = []
+        self.groups: List[List[tuple]] = []
+        self.accepting: List[bool] = []
+        self._rows: List[Optional[torch.Tensor]] = []
+        self._tables: Dict[str, torch.Tensor] = {}
+        self.initial = self.index(automaton.initial)
+        self.precompile(max_states)
+
+    def precompile(self, max_states: int):
+        """Compiles the states reachable from the initial one, breadth first, until max_states are compiled."""
+        queue, seen, compiled = deque([self.initial]), {self.initial}, 0
+        while queue and compiled < max_states:
+            state = queue.popleft()
+            self.ensure(state)
+            compiled += 1
+            targets = set(self.next[state].values()) | {target for _, target in self.groups[state]}
+            for target in targets:
+                if target not in seen:
+                    seen.add(target)
+                    queue.append(target)
+
+    def index(self, state) -> int:
+        """The number of a character state."""
+        found = self.states.get(state)
+        if found is None:
+            found = self.states[state] = len(self.char_states)
+            self.char_states.append(state)
+            self.next.append(None)
+            self.groups.append([])
+            self.accepting.append(False)
+            self._rows.append(None)
+        return found
+
+    def ensure(self, index: int):
+        if self.next[index] is None:
+            self._compile(index)
+
+    def _step_cached(self, state, ch):
+        key = (state, ch)
+        if key not in self._step:
+            self._step[key] = self.automaton.step(state, ch)
+        return self._step[key]
+
+    def _plain_below(self, node: _TrieNode) -> _Plain:
+        found = self._plain.get(id(node))
+        if found is None:
+            found = self._plain[id(node)] = _Plain(node)
+        return found
+
+    def _compile(self, index: int):
+        automaton = self.automaton
+        state = self.char_states[index]
+        nexts: Dict[int, int] = {}
+        groups = []
+        allowed = torch.zeros(self.vocab_size, dtype=torch.bool)
+        if automaton.in_string(state):
+            plain = self._plain_below(self.root)
+            groups.append((plain.id_set, index))
+            allowed[plain.ids] = True
+            stack = [(child, ch, state) for child, ch in plain.exits]
+        else:
+            stack = [(child, ch, state) for ch, child in self.root.children.items()]
+        while stack:
+            node, ch, previous = stack.pop()
+            current = self._step_cached(previous, ch)
+            if current is None:
+                continue
+            if automaton.in_string(current):
+                plain = self._plain_below(node)
+                if plain.id_set:
+                    groups.append((plain.id_set, self.index(current)))
+                    allowed[plain.ids] = True
+                stack.extend((child, c, current) for child, c in plain.exits)
+                continue
+            if node.ids:
+                target = self.index(current)
+                for token_id in node.ids:
+                    nexts[token_id] = target
+            stack.extend((child, c, current) for c, child in node.children.items())
+        if nexts:
+            allowed[torch.tensor(list(nexts), dtype=torch.long)] = True
+        if automaton.accepting(state) or not allowed.any():
+            # a state no token leads on from (a vocabulary without some character) ends the generation
+            self.accepting[index] = True
+            allowed[self.eos_token_ids] = True
+        self.next[index] = nexts
+        self.groups[index] = groups
+        self._rows[index] = pack_bits(allowed)
+        # device tables get the new row in place instead of being rebuilt
+        for table in self._tables.values():
+            if index < table.size(0):
+                table[index].copy_(self._rows[index])
+
+    def advance(self, state: int, token_id: int) -> int:
+        """The state after token_id: a dict lookup, or a set lookup in each of the state's few groups."""
+        self.ensure(state)
+        target = self.next[state].get(token_id)
+        if target is not None:
+            return target
+        for ids, target in self.groups[state]:
+            if token_id in ids:
+                return target
+        if self.accepting[state] and token_id in self.eos_token_ids:
+            return state
+        raise ValueError(f"token {token_id} is not allowed in state {state}")
+
+    def done(self, state: int) -> bool:
+        """Only the end of the generation is left."""
+        self.ensure(state)
+        return not self.next[state] and not self.groups[state]
+
+    def table(self, device=None) -> torch.Tensor:
+        """Bitmasks of every state, (states, ceil(vocab / 8)) uint8 on device, zeros for the uncompiled ones."""
+        key = str(device)
+        found = self._tables.get(key)
+        count = len(self._rows)
+        if found is None or found.size(0) < count:
+            # the capacity doubles, rows already on the device stay, only the states added since are copied over
+            kept = 0 if found is None else found.size(0)
+            grown = torch.zeros((max(count, 2 * kept), (self.vocab_size + 7) // 8), dtype=torch.uint8, device=device)
+            if found is not None:
+                grown[:kept] = found
+            empty = grown.new_zeros(grown.size(1), device="cpu")
+            grown[kept:count] = torch.stack([empty if row is None else row for row in self._rows[kept:count]])
+            found = self._tables[key] = grown
+        return found[:count]
+
+    def masks(self, states: Sequence[int], device=None) -> torch.Tensor:
+        """(len(states), vocab_size) bool, True where a token is allowed."""
+        for state in states:
+            self.ensure(state)
+        table = self.table(device)
+        rows = table[torch.tensor(states, device=table.device)]
+        return unpack_bits(rows, self.vocab_size)
+
+
+def pack_bits(mask: torch.Tensor) -> torch.Tensor:
+    padded = torch.zeros((mask.size(-1) + 7) // 8 * 8, dtype=torch.uint8)
+    padded[:mask.size(-1)] = mask
+    weights = torch.tensor([1, 2, 4, 8, 16, 32, 64, 128], dtype=torch.uint8)
+    return (padded.view(-1, 8) * weights).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(bits: torch.Tensor, size: int) -> torch.Tensor:
+    shifts = torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return ((bits.unsqueeze(-1) >> shifts) & 1).bool().flatten(-2)[..., :size]
+
+
+class JsonLogitsMask:
+    """The automaton state of one generation: mask the logits before sampling, advance on the sampled token."""
+
+    def __init__(self, automaton: TokenAutomaton):
+        self.automaton = automaton
+        self.state = automaton.initial
+
+    def __call__(self, logits: torch.Tensor) -> torch.Tensor:
+        allowed = self.automaton.masks([self.state], logits.device)[0]
+        return logits.masked_fill(~allowed, float("-inf"))
+
+    def advance(self, token_id: int):
+        self.state = self.automaton.advance(self.state, token_id)
+
+    @property
+    def done(self) -> bool:
+        return self.automaton.done(self.state)
+
+
+def token_strings(tokenizer) -> List[str]:
+    """The text of every token of a Hugging Face tokenizer, "" for special tokens."""
+    special = set(tokenizer.all_special_ids)
+    pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    tokens = []
+    for token_id, piece in enumerate(pieces):
+        if token_id in special or piece is None:
+            tokens.append("")
+        else:
+            # byte pieces of a split multi byte character decode to U+FFFD, plain inside strings only
+            text = tokenizer.convert_tokens_to_string([piece])
+            if piece.startswith("\u2581") and not text.startswith(" "):
+                # sentencepiece drops the leading space of a lone piece
+                text = " " + text
+            tokens.append(text)
+    return tokens
+
+
+def json_automaton(tokenizer, vocab_size: int, schema_path: Optional[str] = None,
+                   eos_token_ids=None) -> TokenAutomaton:
+    """
+    The token automaton of json_mode: the schema at schema_path, or any JSON object. It ends on the tokenizer's
+    eos, <|im_end|> and eos_token_ids (an id or a list, as in a generation config). Built once per tokenizer,
+    schema and vocabulary size in a process.
+    """
+    key = (id(tokenizer), schema_path, vocab_size)
+    automaton = _automata.get(key)
+    if automaton is None:
+        schema = None
+        if schema_path is not None:
+            with open(schema_path, encoding="utf-8") as f:
+                schema = json.load(f)
+        if eos_token_ids is None or isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        eos = {tokenizer.eos_token_id, *eos_token_ids}
+        im_end = tokenizer.encode("<|im_end|>", add_special_tokens=False)
+        if len(im_end) == 1:
+            eos.add(im_end[0])
+        automaton = _automata[key] = TokenAutomaton(JsonAutomaton(schema, object_root=True),
+                                                    token_strings(tokenizer), eos, vocab_size)
+    return automaton
+
+
+_automata: Dict[tuple, TokenAutomaton] = {}
@@ -0,0 +1,167 @@
+'''
+Description  : Versioned, page aligned on-disk snapshot of the long context KV cache. Every
+               (layer, block) record holds that block's keys and values back to back and starts
+               on a page boundary, followed by dense anchor / importance / preselect sections and
+               a JSON header with the geometry and position metadata. Restoring only mmaps the
+               file, blocks are faulted in when they are pushed back into the CPUInfer cache.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os
+import json
+import mmap
+import struct
+import numpy as np
+
+SNAPSHOT_MAGIC = b"KTKVSNAP"
+SNAPSHOT_VERSION = 1
+PAGE_SIZE = 4096
+# magic, version, header json length
+_PREFIX = struct.Struct("<8sII")
+GEOMETRY_KEYS = ("layer_num", "kv_head_num", "q_head_num", "head_dim", "block_size", "anchor_num")
+
+
+def align(n: int, alignment: int = PAGE_SIZE) -> int:
+    return (n + alignment - 1) // alignment * alignment
+
+
+def snapshot_layout(geometry: dict, block_num: int, preselect_block_count: int = 0) -> dict:
+    """Section offsets of a snapshot, relative to the start of the data area."""
+    layer_num, block_size = geometry["layer_num"], geometry["block_size"]
+    kv_head_num, head_dim = geometry["kv_head_num"], geometry["head_dim"]
+    block_elems = kv_head_num * block_size * head_dim
+    sections = {}
+    offset = 0
+
+    def add(name, dtype, shape, record_bytes=None):
+        nonlocal offset
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize if record_bytes is None \
+            else record_bytes * layer_num * block_num
+        sections[name] = {"offset": offset, "nbytes": nbytes, "dtype": dtype, "shape": list(shape)}
+        if record_bytes is not None:
+            sections[name]["record_bytes"] = record_bytes
+        offset = align(offset + nbytes)
+
+    # [layer, block] -> (k, v) each [kv_head_num, block_size, head_dim], one page aligned record per block
+    add("kv", "float16", (layer_num, block_num, 2, kv_head_num, block_size, head_dim),
+        record_bytes=align(2 * block_elems * 2))
+    add("anchor", "float16", (layer_num, block_num, kv_head_num, geometry["anchor_num"], head_dim))
+    add("importance", "float16", (layer_num, block_num, block_size))
+    add("preselect", "int32", (layer_num, preselect_block_count))
+    return {"sections": sections, "data_bytes": offset}
+
+
+class KVSnapshot:
+    """
+    `create` sizes the file and hands out writable views into it, the header is written by `close`
+    so a half written snapshot never opens. `open` maps the file copy on write and validates the
+    version, views are backed by the page cache until they are read.
+    """
+    def __init__(self, path: str, header: dict, data_offset: int, mm: mmap.mmap, file, tmp_path: str | None = None):
+        self.path = path
+        self.header = header
+        self.data_offset = data_offset
+        self.mm = mm
+        self.file = file
+        self.tmp_path = tmp_path
+
+    @classmethod
+    def create(cls, path: str, geometry: dict, length: int, meta: dict | None = None,
+               preselect_block_count: int = 0) -> "KVSnapshot":
+        block_num = (length + geometry["block_size"] - 1) // geometry["block_size"]
+        layout = snapshot_layout(geometry, block_num, preselect_block_count)
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "geometry": {key: geometry[key] for key in GEOMETRY_KEYS},
+            "source": {key: geometry[key] for key in geometry if key not in GEOMETRY_KEYS},
+            "length": length,
+            "block_num": block_num,
+            "meta": meta or {},
+            **layout,
+        }
+        # leave room for the header to grow a little when meta is filled in before close
+        data_offset = align(_PREFIX.size + len(json.dumps(header).encode()) + PAGE_SIZE)
+        header["data_offset"] = data_offset
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        tmp_path = path + ".tmp"
+        file = open(tmp_path, "w+b")
+        file.truncate(data_offset + max(layout["data_bytes"], 1))
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        return cls(path, header, data_offset, mm, file, tmp_path)
+
+    @classmethod
+    def open(cls, path: str) -> "KVSnapshot":
+        file = open(path, "rb")
+        prefix = file.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            file.close()
+            raise ValueError(f"{path} is not a kv snapshot")
+        magic, version, header_len = _PREFIX.unpack(prefix)
+        if magic != SNAPSHOT_MAGIC:
+            file.close()
+            raise ValueError(f"{path} is not a kv snapshot")
+        if version != SNAPSHOT_VERSION:
+            file.close()
+            raise ValueError(f"{path} is a version {version} kv snapshot, this build reads version {SNAPSHOT_VERSION}")
+        header = json.loads(file.read(header_len))
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        return cls(path, header, header["data_offset"], mm, file)
+
+    @property
+    def geometry(self) -> dict:
+        return self.header["geometry"]
+
+    @property
+    def length(self) -> int:
+        return self.header["length"]
+
+    @property
+    def block_num(self) -> int:
+        return self.header["block_num"]
+
+    @property
+    def meta(self) -> dict:
+        return self.header["meta"]
+
+    def check_geometry(self, geometry: dict):
+        mismatch = {key: (self.geometry[key], geometry[key]) for key in GEOMETRY_KEYS
+                    if self.geometry[key] != geometry[key]}
+        if mismatch:
+            raise ValueError(f"kv snapshot {self.path} doesn't match the cache (snapshot, cache): {mismatch}")
+
+    def section(self, name: str) -> np.ndarray:
+        sec = self.header["sections"][name]
+        count = int(np.prod(sec["shape"]))
+        return np.frombuffer(self.mm, dtype=sec["dtype"], count=count,
+                             offset=self.data_offset + sec["offset"]).reshape(sec["shape"])
+
+    def kv(self, layer_idx: int, block_idx: int) -> tuple[np.ndarray, np.ndarray]:
+        """Views of the [kv_head_num, block_size, head_dim] keys and values of one block."""
+        sec = self.header["sections"]["kv"]
+        _, _, _, kv_head_num, block_size, head_dim = sec["shape"]
+        offset = self.data_offset + sec["offset"] + (layer_idx * self.block_num + block_idx) * sec["record_bytes"]
+        record = np.frombuffer(self.mm, dtype=np.float16, count=2 * kv_head_num * block_size * head_dim,
+                               offset=offset).reshape(2, kv_head_num, block_size, head_dim)
+        return record[0], record[1]
+
+    def prefetch(self, layer_idx: int, blocks) -> None:
+        """Start readahead of the records of `blocks`, so they aren't faulted in one page at a time."""
+        sec = self.header["sections"]["kv"]
+        record_bytes = sec["record_bytes"]
+        base = self.data_offset + sec["offset"] + layer_idx * self.block_num * record_bytes
+        for block_idx in blocks:
+            self.mm.madvise(mmap.MADV_WILLNEED, base + block_idx * record_bytes, record_bytes)
+
+    def close(self):
+        if self.tmp_path is not None:
+            payload = json.dumps(self.header).encode()
+            if _PREFIX.size + len(payload) > self.data_offset:
+                raise ValueError("kv snapshot header outgrew its reserved space")
+            self.mm[:_PREFIX.size + len(payload)] = _PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(payload)) + payload
+            self.mm.flush()
+        self.mm.close()
+        self.file.close()
+        if self.tmp_path is not None:
+            os.replace(self.tmp_path, self.path)
+            self.tmp_path = None
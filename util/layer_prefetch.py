@@ -0,0 +1,104 @@
+'''
+Description  : Layer-ahead weight prefetch for per-layer prefill. Iterating a LayerPrefetcher yields the
+               layers in order; while the caller computes layer N, a background thread loads layers
+               N+1 .. N+depth and unloads N-1, so weight loading overlaps the prefill math instead of
+               running between layers. At most depth + 1 layers are loaded at any time: the unload of
+               the layer the caller left is queued before the next load. On CUDA the loads run on a side
+               stream; the compute stream waits for a layer's load before using it, and the side stream
+               waits for the compute on a layer before unloading it, so a freed block isn't reused for
+               the next layer while kernels still read it. Layers with CPUInfer backed operators are
+               loaded on the calling thread, in turn (see loads_off_thread).
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+import torch
+from torch import nn
+
+
+def loads_off_thread(layer: nn.Module) -> bool:
+    """
+    Whether the prefill operators of a decoder layer can load on the prefetch thread. Operators running on a
+    CPUInfer (KExpertsCPU, KLinearCPUInfer, all with a class level CPU_INFER) load through the task queue the
+    forward pass is using and set up class level buffers, so their layers load on the compute thread.
+    """
+    for module in layer.modules():
+        for op in (module, getattr(module, "prefill_experts", None), getattr(module, "prefill_linear", None)):
+            if hasattr(op, "CPU_INFER"):
+                return False
+    return True
+
+
+class LayerPrefetcher:
+    """
+    load(layer) and unload(layer) run on one worker thread, in submission order, and only touch that layer;
+    an exception from a load is raised in the caller when it reaches the layer. Iterating again starts over.
+    A layer `off_thread` rejects is loaded and unloaded by the caller once the queued work is done, and
+    prefetching doesn't reach past it.
+    """
+
+    def __init__(self, layers: Sequence[nn.Module], load: Callable[[nn.Module], None],
+                 unload: Callable[[nn.Module], None], depth: int = 1,
+                 off_thread: Callable[[nn.Module], bool] = loads_off_thread):
+        if depth < 1:
+            raise ValueError(f"prefetch depth should be at least 1, got {depth}")
+        self.layers = list(layers)
+        self.load = load
+        self.unload = unload
+        self.depth = depth
+        self.background = [off_thread(layer) for layer in self.layers]
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def __len__(self) -> int:
+        return len(self.layers)
+
+    def _load(self, layer: nn.Module) -> Optional[torch.cuda.Event]:
+        if self.stream is None:
+            self.load(layer)
+            return None
+        with torch.cuda.stream(self.stream):
+            self.load(layer)
+        return self.stream.record_event()
+
+    def _unload(self, layer: nn.Module, computed: Optional[torch.cuda.Event]):
+        if self.stream is None:
+            self.unload(layer)
+            return
+        self.stream.wait_event(computed)
+        with torch.cuda.stream(self.stream):
+            self.unload(layer)
+
+    def __iter__(self) -> Iterator[nn.Module]:
+        pool = ThreadPoolExecutor(1, thread_name_prefix="layer_prefetch")
+        loads: Dict[int, Future] = {}
+        unloads: List[Future] = []
+        try:
+            for i, layer in enumerate(self.layers):
+                if not self.background[i]:
+                    # nothing is queued past this layer, wait for the unloads before it and load it in turn
+                    for unloaded in unloads:
+                        unloaded.result()
+                    unloads.clear()
+                    if self.stream is not None:
+                        torch.cuda.current_stream().wait_stream(self.stream)
+                    self.load(layer)
+                    yield layer
+                    self.unload(layer)
+                    continue
+                for ahead in range(i, min(i + self.depth + 1, len(self.layers))):
+                    if not self.background[ahead]:
+                        break
+                    if ahead not in loads:
+                        loads[ahead] = pool.submit(self._load, self.layers[ahead])
+                loaded = loads.pop(i).result()
+                if loaded is not None:
+                    torch.cuda.current_stream().wait_event(loaded)
+                yield layer
+                computed = torch.cuda.current_stream().record_event() if self.stream is not None else None
+                unloads.append(pool.submit(self._unload, layer, computed))
+            for unloaded in unloads:
+                unloaded.result()
+        finally:
+            # on an early exit the queued loads still finish, the caller restores the layers anyway
+            pool.shutdown(wait=True)
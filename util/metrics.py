@@ -0,0 +1,359 @@
+'''
+Description  : Serving metrics. Counters, gauges and fixed-bucket histograms in a process wide
+               registry, rendered in the Prometheus text format for the /metrics endpoint. Writers
+               never take a lock: every thread updates a shard of its own, created on its first
+               update, and readers sum the shards, so recording a token is a few list operations
+               (well under a microsecond). Processes other than the server (the balance_serve
+               engine) publish snapshots that the server merges in when rendering.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import functools
+import math
+import threading
+import weakref
+from bisect import bisect_left
+from queue import Empty, Full
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# seconds, for TTFT / inter-token latency / model and CPUInfer wait times
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# queries or tokens in a batch
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class _Sharded:
+    """
+    Per-thread value lists of a metric; the shard of a thread is only ever written by that thread. Once the
+    thread has ended its shard is folded into `_retired` and dropped, so short lived threads don't pile up.
+    """
+
+    def __init__(self, name: str, help: str, width: int):
+        self.name = name
+        self.help = help
+        self._width = width
+        self._shards: List[Tuple[weakref.ref, list]] = []
+        self._retired = [0] * width
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _shard(self) -> list:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0] * self._width
+            # only taken once per thread, to register the shard for the readers
+            with self._lock:
+                self._retire()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+    def _retire(self):
+        # called with the lock held; a thread that has ended writes its shard no more
+        alive = []
+        for thread, shard in self._shards:
+            owner = thread()
+            if owner is not None and owner.is_alive():
+                alive.append((thread, shard))
+            else:
+                for i, value in enumerate(shard):
+                    self._retired[i] += value
+        self._shards = alive
+
+    def _sum(self) -> list:
+        with self._lock:
+            self._retire()
+            total = list(self._retired)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            for i, value in enumerate(shard):
+                total[i] += value
+        return total
+
+    def reset(self):
+        with self._lock:
+            self._retire()
+            self._retired = [0] * self._width
+            for _, shard in self._shards:
+                shard[:] = [0] * self._width
+
+
+class Counter(_Sharded):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, 1)
+
+    def inc(self, amount: float = 1):
+        try:
+            self._local.shard[0] += amount
+        except AttributeError:
+            self._shard()[0] += amount
+
+    def value(self) -> float:
+        return self._sum()[0]
+
+    def snapshot(self) -> dict:
+        return {"type": self.type, "help": self.help, "value": self.value()}
+
+
+class Gauge(_Sharded):
+    """Either set() from one place (a queue length) or inc() / dec() from anywhere (requests in flight)."""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, 1)
+        self._base = 0
+
+    def set(self, value: float):
+        self._base = value
+
+    def inc(self, amount: float = 1):
+        try:
+            self._local.shard[0] += amount
+        except AttributeError:
+            self._shard()[0] += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def value(self) -> float:
+        return self._base + self._sum()[0]
+
+    def snapshot(self) -> dict:
+        return {"type": self.type, "help": self.help, "value": self.value()}
+
+
+class Histogram(_Sharded):
+    """Fixed upper bounds; a shard is [count per bucket ..., count above the last bound, sum]."""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, len(buckets) + 2)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        # bisect_left: a value equal to a bound belongs to that bucket, as le="bound" says
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> dict:
+        total = self._sum()
+        return {"type": self.type, "help": self.help, "buckets": list(self.buckets), "counts": total[:-1],
+                "sum": total[-1]}
+
+
+def _merge(into: dict, snapshot: dict):
+    for name, metric in snapshot.items():
+        if name not in into:
+            into[name] = {**metric, **({"counts": list(metric["counts"])} if "counts" in metric else {})}
+        elif metric["type"] == "histogram":
+            target = into[name]
+            if target["buckets"] != metric["buckets"]:
+                continue
+            target["counts"] = [a + b for a, b in zip(target["counts"], metric["counts"])]
+            target["sum"] += metric["sum"]
+        else:
+            into[name]["value"] += metric["value"]
+
+
+def _format(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def render_text(snapshot: Dict[str, dict]) -> str:
+    """Prometheus text exposition format, version 0.0.4."""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        if metric["type"] == "histogram":
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [math.inf], metric["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{_format(float(bound))}"}} {_format(cumulative)}')
+            lines.append(f"{name}_sum {_format(metric['sum'])}")
+            lines.append(f"{name}_count {_format(cumulative)}")
+        else:
+            lines.append(f"{name} {_format(metric['value'])}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRegistry():
+    """Process wide metrics, looked up by name; the same name always returns the same metric."""
+    _instance: "MetricsRegistry" = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.metrics: Dict[str, _Sharded] = {}
+        self.sources: Dict[str, Callable[[], Optional[dict]]] = {}
+        self._create_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls) -> "MetricsRegistry":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def set_instance(cls, instance: "MetricsRegistry"):
+        cls._instance = instance
+
+    def _get(self, cls, name: str, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._create_lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(name, *args)
+        if not isinstance(metric, cls):
+            raise ValueError(f"metric {name} is a {metric.type}, not a {cls.type}")
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def add_source(self, name: str, source: Callable[[], Optional[dict]]):
+        """source() returns the latest snapshot() of another process, or None if it has none yet."""
+        self.sources[name] = source
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def collect(self) -> Dict[str, dict]:
+        """This process and the sources merged, metrics of the same name added up."""
+        merged = {}
+        _merge(merged, self.snapshot())
+        for source in list(self.sources.values()):
+            snapshot = source()
+            if snapshot:
+                _merge(merged, snapshot)
+        return merged
+
+    def render(self) -> str:
+        return render_text(self.collect())
+
+    def reset(self):
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+
+class RequestMetrics:
+    """
+    Time to first token, inter-token latency and token counts of one request: token() per generated token,
+    finish() once it is done. The generated tokens are added to their counter at finish().
+    """
+    __slots__ = ("registry", "start", "last", "count", "ttft", "itl", "in_flight", "waiting")
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = MetricsRegistry.get_instance() if registry is None else registry
+        self.start = perf_counter()
+        self.last = None
+        self.count = 0
+        self.ttft = self.registry.histogram("ktransformers_time_to_first_token_seconds",
+                                            "Time from the request reaching the backend to its first generated token.")
+        self.itl = self.registry.histogram("ktransformers_inter_token_latency_seconds",
+                                           "Time between consecutive generated tokens of a request.")
+        self.in_flight = self.registry.gauge("ktransformers_requests_in_flight",
+                                             "Requests in the backend, waiting or generating.")
+        self.waiting = self.registry.gauge("ktransformers_requests_waiting",
+                                           "Requests in the backend without their first token yet.")
+        self.registry.counter("ktransformers_requests_total", "Requests received by the backend.").inc()
+        self.in_flight.inc()
+        self.waiting.inc()
+
+    def prompt(self, num_tokens: int):
+        self.registry.counter("ktransformers_prompt_tokens_total", "Prompt tokens of the requests.").inc(num_tokens)
+
+    def token(self):
+        now = perf_counter()
+        if self.last is None:
+            self.ttft.observe(now - self.start)
+            self.waiting.dec()
+        else:
+            self.itl.observe(now - self.last)
+        self.last = now
+        self.count += 1
+
+    def finish(self):
+        if self.in_flight is not None:
+            if self.last is None:
+                self.waiting.dec()
+            self.in_flight.dec()
+            self.in_flight = None
+            self.registry.counter("ktransformers_generated_tokens_total", "Generated tokens.").inc(self.count)
+
+
+def record_request(inference):
+    """
+    For the inference() async generators of the backends: each call gets a RequestMetrics of its own as the
+    request_metrics keyword, finished however the generator ends (exhausted, raised or closed by a client that
+    went away).
+    """
+    @functools.wraps(inference)
+    async def wrapper(*args, **kwargs):
+        request_metrics = RequestMetrics()
+        items = inference(*args, request_metrics=request_metrics, **kwargs)
+        try:
+            async for item in items:
+                yield item
+        finally:
+            await items.aclose()
+            request_metrics.finish()
+    return wrapper
+
+
+class SnapshotPublisher:
+    """Puts the registry snapshot of this process on a multiprocessing queue, at most every `interval` seconds."""
+
+    def __init__(self, queue, interval: float = 1.0, registry: Optional[MetricsRegistry] = None):
+        self.queue = queue
+        self.interval = interval
+        self.registry = MetricsRegistry.get_instance() if registry is None else registry
+        self.last = -math.inf
+
+    def maybe_publish(self):
+        now = perf_counter()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        try:
+            self.queue.put_nowait(self.registry.snapshot())
+        except Full:
+            # the reader is behind, it gets the next one
+            pass
+
+
+class SnapshotReceiver:
+    """The latest snapshot a SnapshotPublisher put on the queue, as a MetricsRegistry source."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.latest: Optional[dict] = None
+
+    def __call__(self) -> Optional[dict]:
+        try:
+            while True:
+                self.latest = self.queue.get_nowait()
+        except Empty:
+            pass
+        return self.latest
@@ -0,0 +1,137 @@
+'''
+Description  : Prompt-lookup (n-gram) speculative decoding. The longest trailing n-gram of the
+               prompt + generated tokens is looked up in an index of its earlier occurrences, the
+               tokens that followed it are drafted, and the model verifies the last token plus the
+               draft in one forward. Rejected positions are dropped from the cache with
+               remove_suffix. Greedy output is unchanged, sampled output keeps its distribution.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import time
+from typing import Callable, List, Sequence
+import torch
+
+
+class PromptLookup:
+    """
+    n-gram -> end of its latest occurrence. The n-grams ending at the last token are indexed only once
+    the next token arrives, so a lookup of the trailing n-gram finds an earlier occurrence, never itself.
+    """
+    def __init__(self, tokens: Sequence[int] = (), num_draft: int = 4, max_ngram: int = 3, min_ngram: int = 1):
+        self.num_draft = num_draft
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.tokens: List[int] = []
+        self.index: dict = {}
+        self.extend(tokens)
+
+    def extend(self, tokens: Sequence[int]):
+        for token in tokens:
+            end = len(self.tokens)
+            for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                self.index[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(int(token))
+
+    def draft(self, num_draft: int = None) -> List[int]:
+        num_draft = self.num_draft if num_draft is None else num_draft
+        if num_draft <= 0:
+            return []
+        for n in range(min(self.max_ngram, len(self.tokens)), self.min_ngram - 1, -1):
+            end = self.index.get(tuple(self.tokens[-n:]))
+            if end is not None:
+                return self.tokens[end:end + num_draft]
+        return []
+
+
+def verify_draft(scores: torch.Tensor, draft: List[int], do_sample: bool = False) -> List[int]:
+    """
+    `scores` are the warped logits after the last token and after each draft token, [len(draft) + 1, vocab].
+    Returns the accepted draft prefix and one token of the model's own. Greedy accepts while the draft is the
+    argmax; sampling accepts draft token x with probability p(x) and on rejection samples p without x, which
+    is exactly sampling from p since the draft is deterministic.
+    """
+    if not do_sample:
+        target = torch.argmax(scores, dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == target[accepted]:
+            accepted += 1
+        return draft[:accepted] + [target[accepted]]
+    probs = torch.nn.functional.softmax(scores.float(), dim=-1)
+    for idx, token in enumerate(draft):
+        if torch.rand(()).item() < probs[idx, token].item():
+            continue
+        residual = probs[idx].clone()
+        residual[token] = 0
+        return draft[:idx] + [torch.multinomial(residual, num_samples=1).item()]
+    return draft + [torch.multinomial(probs[-1], num_samples=1).item()]
+
+
+class SpeculativeStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.forwards = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.tokens = 0
+        self.elapsed = 0.0
+
+    def record(self, drafted: int, accepted: int, elapsed: float):
+        self.forwards += 1
+        self.drafted += drafted
+        self.accepted += accepted
+        self.tokens += accepted + 1
+        self.elapsed += elapsed
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.tokens / self.forwards if self.forwards else 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"ngram decoding: {self.tokens} token(s) in {self.forwards} forward(s), "
+                f"{self.tokens_per_forward:.2f} tokens/forward, acceptance {self.accepted}/{self.drafted} "
+                f"({self.acceptance_rate:.1%}), {self.tokens_per_second:.2f} tokens/s")
+
+
+class NgramSpeculator:
+    """
+    Decode steps over `tokens`, the prompt and generated tokens whose last one is not in the cache yet.
+    `forward(input_ids [1, T], cache_position [T])` runs the model on the cache and returns the warped
+    scores of every position, [T, vocab]. The cache needs `remove_suffix` to drop rejected positions.
+    """
+    def __init__(self, forward: Callable[[torch.Tensor, torch.Tensor], torch.Tensor], cache, tokens: Sequence[int],
+                 num_draft: int = 4, max_ngram: int = 3, do_sample: bool = False, device="cpu"):
+        self.forward = forward
+        self.cache = cache
+        self.do_sample = do_sample
+        self.device = device
+        self.lookup = PromptLookup(tokens, num_draft, max_ngram)
+        self.stats = SpeculativeStats()
+
+    @property
+    def seq_length(self) -> int:
+        return len(self.lookup.tokens)
+
+    def step(self, budget: int) -> List[int]:
+        """At least one and at most `budget` new tokens, from one forward."""
+        begin = time.perf_counter()
+        draft = self.lookup.draft(min(self.lookup.num_draft, budget - 1))
+        input_ids = torch.tensor([self.lookup.tokens[-1:] + draft], dtype=torch.long, device=self.device)
+        cache_position = torch.arange(self.seq_length - 1, self.seq_length + len(draft), device=self.device)
+        scores = self.forward(input_ids, cache_position)
+        new_tokens = verify_draft(scores, draft, self.do_sample)
+        if len(new_tokens) <= len(draft):
+            # keep the last token and the accepted draft, the rejected positions get written again
+            self.cache.remove_suffix(self.seq_length + len(new_tokens) - 1)
+        self.lookup.extend(new_tokens)
+        self.stats.record(len(draft), len(new_tokens) - 1, time.perf_counter() - begin)
+        return new_tokens
@@ -0,0 +1,195 @@
+'''
+Description  : Expert routing telemetry. Accumulates per-layer expert activation
+               counts and co-activation histograms in preallocated counters so
+               placement tools can decide which experts live in local DRAM and
+               which can be pushed out to CXL memory.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import os
+import re
+import json
+import atexit
+import threading
+import torch
+
+_LAYER_PATTERN = re.compile(r"(?:^|\.)(?:blk|layers)\.(\d+)(?:\.|$)")
+
+
+def layer_idx_from_key(key: str) -> int:
+    """Extract the decoder layer index from a gguf ("blk.3.ffn_gate_exps") or hf ("model.layers.3.mlp") key."""
+    match = _LAYER_PATTERN.search(key)
+    if match is None:
+        raise ValueError(f"Can't find a layer index in {key}")
+    return int(match.group(1))
+
+
+class ExpertRoutingStats():
+    """Process wide routing counters.
+
+    counts:       [num_layers, num_experts]               tokens routed to each expert
+    coactivation: [num_layers, num_experts, num_experts]  tokens routed to both experts (diagonal == counts)
+    tokens:       [num_layers]                            tokens seen by the gate of each layer
+
+    All updates are whole-tensor ops on the gate's topk ids, there is no python work per token. They are
+    index_add_ into the preallocated counters, so a gate captured in a cuda graph keeps counting on every
+    replay; the counters are only read back to the host outside the graph (summary, state_dict, dump).
+    """
+    _instance: "ExpertRoutingStats" = None
+    _lock = threading.Lock()
+
+    def __init__(self, enable: bool = False, dump_path: str | None = None, track_coactivation: bool = True):
+        self.enable = enable
+        self.dump_path = dump_path
+        self.track_coactivation = track_coactivation
+        self.num_layers = 0
+        self.num_experts = 0
+        self.counts: torch.Tensor = None
+        self.coactivation: torch.Tensor = None
+        self.tokens: torch.Tensor = None
+        if self.enable and self.dump_path:
+            atexit.register(self.dump)
+
+    @classmethod
+    def get_instance(cls) -> "ExpertRoutingStats":
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    from ktransformers.server.config.config import Config
+                    cfg = Config()
+                    cls._instance = cls(cfg.routing_stats_enable, cfg.routing_stats_dump_path,
+                                        cfg.routing_stats_coactivation)
+        return cls._instance
+
+    @classmethod
+    def set_instance(cls, instance: "ExpertRoutingStats"):
+        cls._instance = instance
+
+    def allocate(self, num_layers: int, num_experts: int, device: str | torch.device = "cpu"):
+        self.num_layers = num_layers
+        self.num_experts = num_experts
+        self.counts = torch.zeros((num_layers, num_experts), dtype=torch.int64, device=device)
+        self.tokens = torch.zeros((num_layers,), dtype=torch.int64, device=device)
+        if self.track_coactivation:
+            self.coactivation = torch.zeros((num_layers, num_experts, num_experts), dtype=torch.int64, device=device)
+        else:
+            self.coactivation = None
+
+    def reset(self):
+        if self.counts is None:
+            return
+        self.counts.zero_()
+        self.tokens.zero_()
+        if self.coactivation is not None:
+            self.coactivation.zero_()
+
+    @torch.no_grad()
+    def record(self, layer_idx: int, topk_idx: torch.Tensor, num_layers: int, num_experts: int):
+        """Accumulate the experts selected by one gate call.
+
+        topk_idx: [..., num_experts_per_tok] expert ids, any leading shape.
+        """
+        if not self.enable:
+            return
+        if self.counts is None:
+            if topk_idx.is_cuda and torch.cuda.is_current_stream_capturing():
+                # zeroing counters allocated here would be captured too and rerun on every replay
+                raise RuntimeError("routing stats counters have to be allocated before cuda graph capture, "
+                                   "run an eager forward pass first")
+            self.allocate(num_layers, num_experts, topk_idx.device)
+        ids = topk_idx.reshape(-1, topk_idx.size(-1)).to(device=self.counts.device, dtype=torch.int64)
+        num_experts = self.num_experts
+        self.tokens[layer_idx] += ids.size(0)
+        flat = ids.flatten()
+        self.counts[layer_idx].index_add_(0, flat, torch.ones_like(flat))
+        if self.coactivation is not None:
+            pairs = (ids.unsqueeze(2) * num_experts + ids.unsqueeze(1)).flatten()
+            self.coactivation[layer_idx].view(-1).index_add_(0, pairs, torch.ones_like(pairs))
+
+    def hot_experts(self, layer_idx: int, topk: int | None = None) -> list[int]:
+        """Experts of `layer_idx` sorted by activation count, hottest first."""
+        if self.counts is None:
+            return []
+        order = torch.argsort(self.counts[layer_idx].cpu(), descending=True)
+        if topk is not None:
+            order = order[:topk]
+        return order.tolist()
+
+    def activation_frequency(self) -> torch.Tensor:
+        """[num_layers, num_experts] fraction of each layer's tokens routed to each expert."""
+        counts = self.counts.cpu().to(torch.float64)
+        tokens = self.tokens.cpu().to(torch.float64).clamp(min=1).unsqueeze(1)
+        return counts / tokens
+
+    def state_dict(self) -> dict:
+        if self.counts is None:
+            return {"num_layers": 0, "num_experts": 0}
+        res = {
+            "num_layers": self.num_layers,
+            "num_experts": self.num_experts,
+            "counts": self.counts.cpu(),
+            "tokens": self.tokens.cpu(),
+        }
+        if self.coactivation is not None:
+            res["coactivation"] = self.coactivation.cpu()
+        return res
+
+    def load_state_dict(self, state: dict):
+        if state.get("num_layers", 0) == 0:
+            return
+        self.track_coactivation = "coactivation" in state
+        self.allocate(state["num_layers"], state["num_experts"])
+        self.counts.copy_(state["counts"])
+        self.tokens.copy_(state["tokens"])
+        if self.coactivation is not None:
+            self.coactivation.copy_(state["coactivation"])
+
+    def summary(self, topk: int = 8) -> dict:
+        """Json friendly view used by the server endpoint."""
+        if self.counts is None:
+            return {"enable": self.enable, "num_layers": 0, "num_experts": 0, "layers": []}
+        counts = self.counts.cpu()
+        tokens = self.tokens.cpu()
+        layers = []
+        for layer_idx in range(self.num_layers):
+            if tokens[layer_idx] == 0:
+                continue
+            hot = self.hot_experts(layer_idx, topk)
+            layers.append({
+                "layer": layer_idx,
+                "tokens": int(tokens[layer_idx]),
+                "hot_experts": hot,
+                "hot_counts": counts[layer_idx, hot].tolist(),
+                "cold_experts": int((counts[layer_idx] == 0).sum()),
+            })
+        return {"enable": self.enable, "num_layers": self.num_layers, "num_experts": self.num_experts, "layers": layers}
+
+    def dump(self, path: str | None = None) -> str | None:
+        """Write the raw counters with torch.save and a json summary next to it."""
+        path = path or self.dump_path
+        if not path or self.counts is None:
+            return None
+        path = os.path.expanduser(path)
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        torch.save(self.state_dict(), path)
+        with open(os.path.splitext(path)[0] + ".json", "w", encoding="utf-8") as f:
+            json.dump(self.summary(topk=self.num_experts), f)
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "ExpertRoutingStats":
+        stats = cls(enable=False)
+        stats.load_state_dict(torch.load(os.path.expanduser(path)))
+        return stats
+
+
+def record_routing(key: str, topk_idx: torch.Tensor, config):
+    """Hook called by the injected MoE blocks right after the gate."""
+    stats = ExpertRoutingStats.get_instance()
+    if not stats.enable:
+        return
+    num_experts = getattr(config, "n_routed_experts", None) or getattr(config, "num_experts", None) \
+        or getattr(config, "num_local_experts")
+    stats.record(layer_idx_from_key(key), topk_idx, config.num_hidden_layers, num_experts)
@@ -9,12 +9,14 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 import torch
 from torch import nn
 import itertools
+import os
 import time
 import enum
-from ktransformers.util.custom_gguf import translate_name_to_gguf
+from functools import partial
 from ktransformers.util.custom_gguf import GGUFLoader
+from ktransformers.util.chunk_tuner import ChunkTuner, activation_bytes
 from ktransformers.operators import base_operator
-from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.custom_cache import StaticCache, kv_quant_bits
 from ktransformers.util.cuda_graph_runner import CUDAGraphRunner
 from ktransformers.util.textstream import TextStreamer
 from ktransformers.operators.flashinfer_wrapper import MLAWrapperSingleton
@@ -87,92 +89,44 @@ def get_all_used_cuda_device(device_map:dict):
     all_device_list = list(all_device_list)
     return all_device_list
 
-def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str = ""):
-    prefix = prefix.replace("orig_module.", "")
+def local_state_names(module: nn.Module):
     persistent_buffers = {k: v for k, v in module._buffers.items() if k not in module._non_persistent_buffers_set}
     local_name_params = itertools.chain(module._parameters.items(), persistent_buffers.items())
-    local_state = {k: v for k, v in local_name_params if v is not None}
-    for name, param in local_state.items():
-        key = prefix + name
-        translated_key = translate_name_to_gguf(key)
-        
-        # TODO: Merge all loader.
-        # I know this is ugly but lets do it for now.
-        if gguf_loader.safetensor_loader is not None:
-            load_dequantized_tensor = gguf_loader.safetensor_loader.load_dequantized_tensor
-            tensor_file_map = gguf_loader.safetensor_loader.tensor_file_map
-        else:
-            load_dequantized_tensor = gguf_loader.load_gguf_tensor
-            tensor_file_map = gguf_loader.tensor_file_map
-        
-        if translated_key in tensor_file_map:
-            target_dtype = torch.get_default_dtype()
-            device = "cpu"  # Force CPU loading
-            print(f"loading {translated_key} to {device}")
-            torch.cuda.empty_cache()
-            weights = load_dequantized_tensor(translated_key, device=device).to(dtype=target_dtype)
-            set_param(module, name, weights)
-            del weights
-        else:
-            # Handle missing keys with graceful fallback options
-            print(f"Warning: Couldn't find {translated_key} in GGUF file, trying alternatives...")
-            
-            # Try to find similar keys based on common patterns
-            alternative_found = False
-            
-            # Option 1: Try without prefix
-            base_key = key.split('.')[-1]
-            if base_key in tensor_file_map:
-                print(f"Found alternative key: {base_key}")
-                weights = load_dequantized_tensor(base_key, device="cpu").to(dtype=torch.get_default_dtype())
-                set_param(module, name, weights)
-                alternative_found = True
-                del weights
-            
-            # Option 2: Try with various transformations
-            if not alternative_found:
-                possible_alternatives = []
-                
-                # Try to find keys with similar patterns
-                key_parts = translated_key.split('.')
-                if len(key_parts) > 1:
-                    # Try matching only the last part of the key
-                    for existing_key in tensor_file_map.keys():
-                        if existing_key.endswith('.' + key_parts[-1]) or existing_key.endswith('/' + key_parts[-1]):
-                            possible_alternatives.append(existing_key)
-                            
-                    # Try matching keys that have the same shape
-                    target_shape = param.shape
-                    for existing_key in tensor_file_map.keys():
-                        try:
-                            if hasattr(tensor_file_map[existing_key], 'shape'):
-                                if tensor_file_map[existing_key].shape == target_shape:
-                                    possible_alternatives.append(existing_key)
-                        except Exception:
-                            pass  # Skip keys that don't have proper shape info
-                
-                if possible_alternatives:
-                    # Find the most similar key by string matching
-                    import difflib
-                    closest_match = difflib.get_close_matches(translated_key, possible_alternatives, n=1, cutoff=0.3)
-                    
-                    if closest_match:
-                        alternative_key = closest_match[0]
-                        print(f"Found close match: {alternative_key}")
-                        weights = load_dequantized_tensor(alternative_key, device="cpu").to(dtype=torch.get_default_dtype())
-                        set_param(module, name, weights)
-                        alternative_found = True
-                        del weights
-            
-            # Option 3: Initialize with zeros or random values that match parameter shape
-            if not alternative_found:
-                print(f"No alternative found for {translated_key}, initializing with zeros")
-                # Initialize with zeros of the correct shape
-                zero_init = torch.zeros_like(param, device="cpu")
-                set_param(module, name, zero_init)
-                del zero_init
+    return [k for k, v in local_name_params if v is not None]
+
+def load_tensor(module: nn.Module, name: str, translated_key: str, gguf_loader: GGUFLoader):
+    # TODO: Merge all loader.
+    # I know this is ugly but lets do it for now.
+    if gguf_loader.safetensor_loader is not None:
+        load_dequantized_tensor = gguf_loader.safetensor_loader.load_dequantized_tensor
+    else:
+        load_dequantized_tensor = gguf_loader.load_gguf_tensor
+    
+    target_dtype = torch.get_default_dtype()
+    device = "cpu"  # Force CPU loading
+    print(f"loading {translated_key} to {device}")
+    torch.cuda.empty_cache()
+    weights = load_dequantized_tensor(translated_key, device=device).to(dtype=target_dtype)
+    set_param(module, name, weights)
+    del weights
 
-def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix=''):
+def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str = ""):
+    prefix = prefix.replace("orig_module.", "")
+    for name in local_state_names(module):
+        # raises with the nearest file names rather than leaving the weight uninitialized
+        translated_key = gguf_loader.name_index.resolve(prefix + name)
+        load_tensor(module, name, translated_key, gguf_loader)
+
+def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix='', num_workers: int = 1,
+                 max_bytes_in_flight: int = 4 << 30):
+    """
+    Load the weights of `module` and its children. With `num_workers` > 1 the per-tensor and per-operator
+    loads run on a thread pool, at most `max_bytes_in_flight` of tensor data at a time (util/weight_loader.py).
+    """
+    if num_workers > 1:
+        from ktransformers.util.weight_loader import ParallelWeightLoader
+        ParallelWeightLoader(gguf_loader, num_workers, max_bytes_in_flight).load(module, prefix)
+        return
     #print(f"recursively loading weights {prefix}")
     if not isinstance(module, base_operator.BaseInjectedModule):
         load_cur_state_dict(module, gguf_loader, prefix)
@@ -181,13 +135,32 @@ def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix=''):
     else:
         module.load()
 
+def chunk_tuner(model, max_chunk: int, cpu_infer: int, localstore_path: str | None = None,
+                memory_mb: int | None = None) -> ChunkTuner:
+    """The process wide ChunkTuner of a model at the current thread counts, saved under `localstore_path` if given."""
+    config = model.config
+    key = (f"{config.architectures[0]}:{getattr(config, '_name_or_path', '')}:{config.num_hidden_layers}"
+           f":threads={torch.get_num_threads()}:cpu_infer={cpu_infer}")
+    cache_path = None if localstore_path is None else os.path.join(localstore_path, "chunk_tuner.json")
+    return ChunkTuner.get_instance(
+        key, max_chunk, memory_cap=None if memory_mb is None else memory_mb << 20,
+        bytes_fn=partial(activation_bytes, config), cache_path=cache_path,
+    )
+
 def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cuda_graph: bool = False,
                          mode = 'normal', force_think: bool = False, chunk_size = 16384, use_flashinfer_mla = False,
-                         num_heads = None, head_dim_ckv = None, head_dim_kpe = None, q_head_dim = None):
+                         num_heads = None, head_dim_ckv = None, head_dim_kpe = None, q_head_dim = None,
+                         kv_cache_dtype: str = "auto", ngram_decoding: bool = False, ngram_num_draft: int = 4,
+                         ngram_max_ngram: int = 3, adaptive_chunk: bool = False, chunk_memory_mb: int | None = None,
+                         cpu_infer: int = 0, localstore_path: str | None = None):
     import os
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
     torch._dynamo.config.suppress_errors = True
     
+    if use_cuda_graph and kv_quant_bits(kv_cache_dtype) is not None:
+        raise ValueError(f"kv_cache_dtype {kv_cache_dtype} writes can't be captured in a cuda graph, "
+                         f"set use_cuda_graph to False or kv_cache_dtype to auto")
+
     batch_size, seq_length = inputs.shape
     torch_device = "cpu"
     inputs = inputs.to(torch_device)
@@ -564,7 +537,8 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
                         max_batch_size=1, 
                         max_cache_len=seq_length + max_new_tokens, 
                         device="cpu", 
-                        dtype=cache_dtype
+                        dtype=cache_dtype,
+                        kv_cache_dtype=kv_cache_dtype
                     )
                 else:
                     # For GPU mode, use the device map
@@ -573,7 +547,8 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
                         max_batch_size=1, 
                         max_cache_len=seq_length + max_new_tokens, 
                         device=device_map, 
-                        dtype=cache_dtype
+                        dtype=cache_dtype,
+                        kv_cache_dtype=kv_cache_dtype
                     )
             except Exception as e:
                 print(f"Error initializing StaticCache: {e}")
@@ -624,13 +599,27 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
         generated_ids[:, cache_position] = inputs.to(torch_device).to(torch.int)
         start_time = time.time()
 
+        # chunk_size is the fixed chunk length, or the longest one the tuner picks
+        tuner = chunk_tuner(model, chunk_size, cpu_infer, localstore_path, chunk_memory_mb) if adaptive_chunk else None
+        if tuner is not None and torch.cuda.is_available():
+            # nothing queued before the prompt may land in the first chunk's time
+            torch.cuda.synchronize()
         chunk_start = 0
         while chunk_start < seq_length:
-            chunk_end = min(chunk_start + chunk_size, seq_length)
+            length = tuner.choose(chunk_start, seq_length - chunk_start) if tuner is not None else chunk_size
+            chunk_end = min(chunk_start + length, seq_length)
             if past_key_values != None:
                 past_key_values.cur_idx=cache_position[chunk_start:chunk_end]
+            chunk_begin = time.perf_counter()
             logits = chunk_prefill(inputs[:, chunk_start:chunk_end], cache_position[chunk_start:chunk_end], past_key_values)
-            chunk_start += chunk_size
+            if tuner is not None:
+                # the kernels of the chunk are only queued, the clock is read once they ran
+                if logits.is_cuda:
+                    torch.cuda.synchronize(logits.device)
+                tuner.record(chunk_start, chunk_end - chunk_start, time.perf_counter() - chunk_begin)
+            chunk_start = chunk_end
+        if tuner is not None:
+            tuner.save()
 
         next_token_scores = logits_warper(inputs, logits[:, -1, :])
         if generation_config.do_sample:
@@ -711,6 +700,10 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
             print(f"Error extracting token value: {e}")
             tokens.append(0)  # Default token
             
+        if isinstance(past_key_values, StaticCache) and past_key_values.is_MLA:
+            # the pages of every decode step up front, the steps then write without a host sync
+            end = seq_length + max_new_tokens + (ngram_num_draft if ngram_decoding else 0)
+            past_key_values.reserve(0, min(end, past_key_values.max_cache_len), seq_length)
         # Cache position management
         cache_position = torch.tensor([seq_length], device=torch_device, dtype=torch.int32)
         position_ids = cache_position.unsqueeze(0)
@@ -720,7 +713,33 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
         cuda_graph_runner = None
             
         start_time = time.time()
-        for i in range(1, max_new_tokens):
+        decode_steps = range(1, max_new_tokens)
+        speculator = None
+        if ngram_decoding and past_key_values is not None:
+            from ktransformers.util.ngram_decoding import NgramSpeculator
+
+            def ngram_forward(input_ids, cache_position):
+                inputs_embeds = model.model.embed_tokens(input_ids).to(dtype=torch.float32)
+                logits = model(inputs_embeds=inputs_embeds, position_ids=cache_position.unsqueeze(0),
+                               cache_position=cache_position, past_key_values=past_key_values,
+                               use_cache=True, return_dict=True).logits[0].to(dtype=torch.float32)
+                return logits_warper(input_ids.expand(logits.size(0), -1), logits)
+
+            speculator = NgramSpeculator(ngram_forward, past_key_values, generated_ids[0, :seq_length].tolist(),
+                                         num_draft=ngram_num_draft, max_ngram=ngram_max_ngram,
+                                         do_sample=generation_config.do_sample, device=torch_device)
+            stop = False
+            while not stop and len(tokens) < max_new_tokens:
+                for token in speculator.step(max_new_tokens - len(tokens)):
+                    tokens.append(token)
+                    if token == tokenizer.eos_token_id or tokenizer.decode([token]) == '<|im_end|>':
+                        print(stream.end(), end="", flush=True)
+                        stop = True
+                        break
+                    print(stream.put(token), end="", flush=True)
+            # the speculative loop generated every token
+            decode_steps = ()
+        for i in decode_steps:
             # Remove CUDA-specific code
             try:
                 print(f"Generating token {i}/{max_new_tokens}")
@@ -895,6 +914,8 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
     print(f"eval count:           {tokens_generated} token(s)")
     print(f"eval duration:        {total_time}s")
     print(f"eval rate:            {tokens_per_second} tokens/s")
+    if speculator is not None:
+        print(speculator.stats)
 
     return tokens
 
@@ -0,0 +1,94 @@
+'''
+Description  : Parallel load_weights. The module tree is walked in the same order as the serial
+               load_weights, every plain tensor and every injected operator becomes a task on a thread
+               pool, and a byte budget bounds how much tensor data is being read and dequantized at once,
+               so the reads of later layers overlap the dequantization and placement of earlier ones.
+Version      : 0.1.0
+Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterator, Tuple
+from torch import nn
+from ktransformers.operators.base_operator import BaseInjectedModule
+from ktransformers.util.custom_gguf import GGUFLoader
+from ktransformers.util.utils import load_tensor, local_state_names
+
+
+class ByteBudget:
+    """Bytes in flight. A task larger than the whole budget still runs, alone."""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes: int) -> int:
+        nbytes = min(nbytes, self.capacity)
+        with self.cond:
+            while self.in_flight > 0 and self.in_flight + nbytes > self.capacity:
+                self.cond.wait()
+            self.in_flight += nbytes
+        return nbytes
+
+    def release(self, nbytes: int):
+        with self.cond:
+            self.in_flight -= nbytes
+            self.cond.notify_all()
+
+
+class ParallelWeightLoader:
+    """
+    Tasks are the same calls the serial path makes: load_tensor for each tensor of a plain module, and
+    load() for each injected operator. Operators that share state while loading (a CPUInfer instance, class
+    level buffers) keep `load_concurrently = False` and run one at a time, still overlapping the rest.
+    """
+    def __init__(self, gguf_loader: GGUFLoader, num_workers: int, max_bytes_in_flight: int):
+        self.gguf_loader = gguf_loader
+        self.num_workers = num_workers
+        self.budget = ByteBudget(max_bytes_in_flight)
+        self.serial_lock = threading.Lock()
+        self.error: BaseException | None = None
+
+    def plan(self, module: nn.Module, prefix: str = "") -> Iterator[Tuple[int, Callable[[], None]]]:
+        """(bytes, task) in serial load_weights order. Names are resolved here, so a missing tensor fails first."""
+        if not isinstance(module, BaseInjectedModule):
+            state_prefix = prefix.replace("orig_module.", "")
+            for name in local_state_names(module):
+                translated_key = self.gguf_loader.name_index.resolve(state_prefix + name)
+                yield (self.gguf_loader.tensor_nbytes(translated_key),
+                       partial(load_tensor, module, name, translated_key, self.gguf_loader))
+            for name, child in module._modules.items():
+                yield from self.plan(child, prefix + name + ".")
+        elif type(module).load is BaseInjectedModule.load:
+            # BaseInjectedModule.load is load_weights over the children, with the operator key as prefix
+            for name, child in module._modules.items():
+                yield from self.plan(child, module.key + ".")
+        else:
+            nbytes = sum(self.gguf_loader.tensor_nbytes(name)
+                         for name in self.gguf_loader.name_index.with_prefix(module.key + "."))
+            yield nbytes, module.load if module.load_concurrently else partial(self.run_serial, module.load)
+
+    def run_serial(self, fn: Callable[[], None]):
+        with self.serial_lock:
+            fn()
+
+    def run(self, fn: Callable[[], None], nbytes: int):
+        try:
+            if self.error is None:
+                fn()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.budget.release(nbytes)
+
+    def load(self, module: nn.Module, prefix: str = ""):
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="load_weights") as pool:
+            for nbytes, fn in self.plan(module, prefix):
+                nbytes = self.budget.acquire(nbytes)
+                if self.error is not None:
+                    self.budget.release(nbytes)
+                    break
+                pool.submit(self.run, fn, nbytes)
+        if self.error is not None:
+            raise self.error